@@ -0,0 +1,49 @@
+# copyright ################################# #
+# This file is part of the Xfields Package.   #
+# Copyright (c) CERN, 2021.                   #
+# ########################################### #
+
+import time
+
+import numpy as np
+
+import xobjects as xo
+from xfields.solvers import FFTSolver3D, FFTSolver2p5D
+
+context = xo.ContextCpu()
+#context = xo.ContextCupy()
+
+print(repr(context))
+
+nx, ny, nz = 128, 128, 64
+dx, dy, dz = 1e-4, 1e-4, 1e-2
+n_rep = 5
+
+rho = context.nparray_to_context_array(
+            np.asfortranarray(np.random.rand(nx, ny, nz)))
+
+modes = {
+    'complex': dict(),
+    'rfft': dict(use_rfft=True),
+    'pruned': dict(use_pruned_fft=True),
+    'pruned+rfft': dict(use_rfft=True, use_pruned_fft=True),
+}
+
+for solver_class in [FFTSolver3D, FFTSolver2p5D]:
+    print(f'{solver_class.__name__}:')
+    phi_ref = None
+    for name, kwargs in modes.items():
+        solver = solver_class(dx=dx, dy=dy, dz=dz, nx=nx, ny=ny, nz=nz,
+                              context=context, **kwargs)
+        phi = solver.solve(rho) # warm up
+        t0 = time.perf_counter()
+        for _ in range(n_rep):
+            phi = solver.solve(rho)
+        t_solve = (time.perf_counter() - t0) / n_rep
+
+        phi = context.nparray_from_context_array(phi)
+        if phi_ref is None:
+            phi_ref = phi
+        err = np.max(np.abs(phi - phi_ref)) / np.max(np.abs(phi_ref))
+        print(f'    {name:12s} {t_solve*1e3:8.1f} ms/solve  '
+              f'(rel. diff. {err:.1e})')
@@ -0,0 +1,44 @@
+# copyright ################################# #
+# This file is part of the Xfields Package.   #
+# Copyright (c) CERN, 2021.                   #
+# ########################################### #
+
+# Strong scaling of the Poisson solvers on CPU with the multithreaded
+# scipy FFT backend
+
+import os
+import time
+
+import numpy as np
+
+import xobjects as xo
+from xfields.solvers import FFTSolver3D, FFTSolver2p5D
+
+context = xo.ContextCpu()
+
+nx, ny, nz = 256, 256, 64
+dx, dy, dz = 1e-4, 1e-4, 1e-2
+n_rep = 5
+
+n_threads_list = [nn for nn in [1, 2, 4, 8, 16, 32, 64]
+                  if nn <= os.cpu_count()]
+
+rho = np.asfortranarray(np.random.rand(nx, ny, nz))
+
+for solver_class in [FFTSolver3D, FFTSolver2p5D]:
+    for use_rfft in [False, True]:
+        print(f'{solver_class.__name__} (use_rfft={use_rfft}):')
+        t_ref = None
+        for n_threads in n_threads_list:
+            solver = solver_class(dx=dx, dy=dy, dz=dz, nx=nx, ny=ny, nz=nz,
+                                  context=context, use_rfft=use_rfft,
+                                  fft_backend='scipy', fft_threads=n_threads)
+            solver.solve(rho) # warm up
+            t0 = time.perf_counter()
+            for _ in range(n_rep):
+                solver.solve(rho)
+            t_solve = (time.perf_counter() - t0) / n_rep
+            if t_ref is None:
+                t_ref = t_solve
+            print(f'    {n_threads:3d} threads: {t_solve*1e3:8.1f} ms/solve '
+                  f'speedup {t_ref/t_solve:5.2f}')
@@ -0,0 +1,49 @@
+# copyright ################################# #
+# This file is part of the Xfields Package.   #
+# Copyright (c) CERN, 2021.                   #
+# ########################################### #
+
+# Charge deposition on CPU: atomic additions on the shared grid vs
+# per-thread private grids
+
+import os
+import time
+
+import numpy as np
+
+import xobjects as xo
+import xpart as xp
+import xfields as xf
+
+nx, ny, nz = 64, 64, 64
+n_rep = 5
+
+n_threads_list = [nn for nn in [1, 2, 4, 8, 16, 32, 64]
+                  if nn <= os.cpu_count()]
+
+for n_part in [1_000_000, 10_000_000]:
+    for n_threads in n_threads_list:
+        context = xo.ContextCpu(omp_num_threads=n_threads)
+        rng = np.random.default_rng(0)
+        particles = xp.Particles(_context=context, p0c=7e12,
+                                 x=rng.normal(0, 1e-3, n_part),
+                                 y=rng.normal(0, 1e-3, n_part),
+                                 zeta=rng.normal(0, 5e-2, n_part),
+                                 weight=1e11/n_part)
+        t_deposition = {}
+        for deposition in ['atomic', 'private_grids', 'auto']:
+            fmap = xf.TriLinearInterpolatedFieldMap(_context=context,
+                        x_range=(-5e-3, 5e-3), y_range=(-5e-3, 5e-3),
+                        z_range=(-0.25, 0.25), nx=nx, ny=ny, nz=nz,
+                        deposition=deposition)
+            fmap.update_from_particles(particles=particles,
+                                       update_phi=False) # warm up
+            t0 = time.perf_counter()
+            for _ in range(n_rep):
+                fmap.update_from_particles(particles=particles,
+                                           update_phi=False)
+            t_deposition[deposition] = (time.perf_counter() - t0) / n_rep
+        print(f'{n_part:.0e} particles, {n_threads:3d} threads: '
+              + ', '.join(f'{kk} {vv*1e3:8.1f} ms'
+                          for kk, vv in t_deposition.items())
+              + f', speedup {t_deposition["atomic"]/t_deposition["private_grids"]:5.2f}')
@@ -0,0 +1,60 @@
+# copyright ################################# #
+# This file is part of the Xfields Package.   #
+# Copyright (c) CERN, 2021.                   #
+# ########################################### #
+
+# Electron-cloud kick with the tricubic coefficients computed for each
+# particle vs precomputed per cell (coefficient_cache=True). The cache
+# makes each kick faster but has to be rebuilt whenever phi_taylor changes
+# and is 8 times larger than phi_taylor. When the map has many more cells
+# than there are particles, building the cache costs more than the kicks
+# it speeds up, unless the map is used for many kicks.
+
+import time
+
+import numpy as np
+
+import xobjects as xo
+import xpart as xp
+import xfields as xf
+
+context = xo.ContextCpu()
+n_part = 100_000
+n_rep = 5
+
+rng = np.random.default_rng(0)
+
+for n_cells in [8, 16, 32, 64, 128, 256]:
+    x_grid = np.linspace(-1., 1., n_cells + 1)
+    y_grid = np.linspace(-1., 1., n_cells + 1)
+    z_grid = np.linspace(-1., 1., 17)
+
+    t_kick = {}
+    for coefficient_cache in [False, True]:
+        fmap = xf.TriCubicInterpolatedFieldMap(_context=context,
+                    x_grid=x_grid, y_grid=y_grid, z_grid=z_grid,
+                    coefficient_cache=coefficient_cache)
+        fmap._phi_taylor[:] = rng.random(len(fmap._phi_taylor)) * 1e-9
+        if coefficient_cache:
+            t0 = time.perf_counter()
+            fmap.build_coefficient_cache()
+            t_build = time.perf_counter() - t0
+        ecloud = xf.ElectronCloud(length=1., fieldmap=fmap,
+                                  _buffer=fmap._buffer)
+        particles = xp.Particles(_context=context, p0c=450e9,
+                                 x=rng.uniform(-0.9, 0.9, n_part),
+                                 y=rng.uniform(-0.9, 0.9, n_part),
+                                 zeta=rng.uniform(-0.9, 0.9, n_part))
+        ecloud.track(particles) # warm up
+        t0 = time.perf_counter()
+        for _ in range(n_rep):
+            ecloud.track(particles)
+        t_kick[coefficient_cache] = (time.perf_counter() - t0) / n_rep
+
+    gain = t_kick[False] - t_kick[True]
+    n_kicks = t_build / gain if gain > 0 else np.inf
+    memory = len(fmap._coefficients) * 8 / 1e6
+    print(f'{n_cells:4d}x{n_cells:4d}x16 cells ({memory:7.1f} MB cache): '
+          f'kick {t_kick[False]*1e3:7.1f} ms -> {t_kick[True]*1e3:7.1f} ms, '
+          f'build {t_build*1e3:7.1f} ms, '
+          f'cache pays off after {n_kicks:5.1f} kicks')
@@ -157,3 +157,40 @@ def test_beambeam(test_context):
 
     assert np.allclose(p2np(p_before.px), p2np(particles_b1.px), atol=1e-14)
     assert np.allclose(p2np(p_before.py), p2np(particles_b1.py), atol=1e-14)
+
+
+@for_all_test_contexts
+def test_compute_spacial_moments(test_context):
+
+    import xobjects as xo
+    from xfields import BeamBeamBiGaussian2D
+
+    n_part = 10000
+    rng = np.random.default_rng(seed=3)
+    x = 1e-3 + 2e-3 * rng.standard_normal(n_part)
+    y = -1e-3 + 1e-3 * rng.standard_normal(n_part)
+    weight = rng.uniform(0.5, 1.5, n_part)
+    state = np.ones(n_part, dtype=np.int64)
+    state[::4] = 0
+    x[::4] = 1. # far away lost particles
+
+    particles = xp.Particles(_context=test_context, p0c=7e12, x=x, y=y,
+                             weight=weight, state=state)
+
+    bbeam = BeamBeamBiGaussian2D(_context=test_context, n_particles=1e11,
+                                 q0=1, beta0=1., sigma_x=1., sigma_y=1.,
+                                 mean_x=0., mean_y=0., min_sigma_diff=1e-10)
+    moments = bbeam.compute_spacial_moments(particles)
+
+    # Weighted moments of the active particles only (the lost ones were
+    # included before the single pass moments were introduced)
+    mask = state > 0
+    ww = weight[mask]
+    cov = np.cov(np.array([x[mask], y[mask]]), aweights=ww, bias=True)
+    xo.assert_allclose(moments[0], ww.sum(), rtol=1e-12, atol=0)
+    xo.assert_allclose(moments[1], np.average(x[mask], weights=ww),
+                       rtol=1e-10, atol=0)
+    xo.assert_allclose(moments[2], np.average(y[mask], weights=ww),
+                       rtol=1e-10, atol=0)
+    xo.assert_allclose(moments[3:], [cov[0, 0], cov[0, 1], cov[1, 1]],
+                       rtol=1e-9, atol=1e-9 * cov[0, 0])
@@ -3,10 +3,14 @@
 # Copyright (c) CERN, 2021.                   #
 # ########################################### #
 
+import os
+
 import numpy as np
+import pytest
 from numpy.random import default_rng
 import xobjects as xo
 import xpart as xp
+import xtrack as xt
 import xfields as xf
 
 from xobjects.test_helpers import for_all_test_contexts
@@ -102,3 +106,269 @@ def test_tricubic_interpolation(test_context):
     assert np.allclose(part.px[mask_p], true_px, atol=1.e-13, rtol=1.e-13)
     assert np.allclose(part.py[mask_p], true_py, atol=1.e-13, rtol=1.e-13)
     assert np.allclose(part.ptau[mask_p], true_ptau, atol=1.e-13, rtol=1.e-13)
+
+
+@for_all_test_contexts
+def test_windowed_fieldmap(test_context, tmp_path):
+    x_grid = np.linspace(-0.5, 0.5, 9)
+    y_grid = np.linspace(-0.4, 0.4, 7)
+    z_grid = np.linspace(-2., 2., 41)
+
+    fieldmap = xf.TriCubicInterpolatedFieldMap(_context=test_context,
+            x_grid=x_grid, y_grid=y_grid, z_grid=z_grid)
+    rng = default_rng(12345)
+    fieldmap._phi_taylor[:] = test_context.nparray_to_context_array(
+                                    rng.random(len(fieldmap._phi_taylor)))
+    fieldmap.to_file(tmp_path / 'ecloud.xfmap')
+
+    wfieldmap = xf.WindowedTriCubicInterpolatedFieldMap.from_file(
+            tmp_path / 'ecloud.xfmap', nz_window=8, _context=test_context)
+    assert wfieldmap.nz == 41
+    assert wfieldmap.nz_window == 8
+    assert len(wfieldmap._phi_taylor) == 8 * 9 * 7 * 8
+
+    ecloud = xf.ElectronCloud(length=1, fieldmap=fieldmap, tau_shift=0.1,
+                              _buffer=fieldmap._buffer)
+    wecloud = xf.ElectronCloud(length=1, fieldmap=wfieldmap, tau_shift=0.1,
+                               _buffer=wfieldmap._buffer)
+    assert not ecloud.iscollective
+    assert wecloud.iscollective
+
+    # The window follows the bunch when tracking through a line
+    line = xt.Line(elements=[wecloud], element_names=['ecloud'])
+    line.build_tracker(_buffer=wfieldmap._buffer)
+
+    p0c = 450e9
+    n_parts = 1000
+    for tau_center in [-1.6, 0.3, 1.7]:
+        tau = tau_center + (rng.random(n_parts) - 0.5) * 0.5
+        part = xp.Particles(_context=test_context, p0c=p0c,
+                            x=(rng.random(n_parts) - 0.5) * 1.,
+                            y=(rng.random(n_parts) - 0.5) * 0.8)
+        part.zeta = part.beta0 * tau
+        wpart = part.copy()
+
+        wfieldmap.prefetch_window_from_particles(wpart, tau_shift=0.1)
+
+        ecloud.track(part)
+        line.track(wpart)
+
+        part.move(_context=xo.ContextCpu())
+        wpart.move(_context=xo.ContextCpu())
+        assert np.sum(part.state > 0) > 0.8 * n_parts
+        assert np.all(wpart.state == part.state)
+        assert np.all(wpart.px == part.px)
+        assert np.all(wpart.py == part.py)
+        assert np.all(wpart.ptau == part.ptau)
+
+    # The window of the next interaction is prefetched by the element
+    ecloud_next = xf.ElectronCloud(length=1, fieldmap=fieldmap, tau_shift=1.1,
+                                   _buffer=fieldmap._buffer)
+    wecloud.next_tau_shift = 1.1
+    wecloud_next = xf.ElectronCloud(length=1, fieldmap=wfieldmap,
+                                    tau_shift=1.1, _buffer=wfieldmap._buffer)
+    tau = 0.3 + (rng.random(n_parts) - 0.5) * 0.5
+    part = xp.Particles(_context=test_context, p0c=p0c,
+                        x=(rng.random(n_parts) - 0.5) * 1.,
+                        y=(rng.random(n_parts) - 0.5) * 0.8)
+    part.zeta = part.beta0 * tau
+    wpart = part.copy()
+    ecloud.track(part)
+    ecloud_next.track(part)
+    wecloud.track(wpart)
+    assert wfieldmap._prefetched is not None
+    wecloud_next.track(wpart)
+    assert wfieldmap._prefetched is None
+    part.move(_context=xo.ContextCpu())
+    wpart.move(_context=xo.ContextCpu())
+    assert np.all(wpart.px == part.px)
+    assert np.all(wpart.ptau == part.ptau)
+
+    # No active particles: the window is not moved
+    iz_window_start = wfieldmap.iz_window_start
+    part = xp.Particles(_context=test_context, p0c=p0c, zeta=[-1.5, 1.5],
+                        state=[0, 0])
+    wfieldmap.update_window_from_particles(part)
+    wfieldmap.prefetch_window_from_particles(part)
+    assert wfieldmap.iz_window_start == iz_window_start
+
+    # The bunch does not fit in the window
+    part = xp.Particles(_context=test_context, p0c=p0c, zeta=[-1., 1.])
+    with pytest.raises(ValueError):
+        wfieldmap.update_window_from_particles(part)
+
+    with pytest.raises(ValueError):
+        wfieldmap.to_file(tmp_path / 'window.xfmap')
+
+    wfieldmap.close()
+
+
+@for_all_test_contexts
+def test_coefficient_cache(test_context):
+    x_grid = np.linspace(-0.5, 0.5, 9)
+    y_grid = np.linspace(-0.4, 0.4, 7)
+    z_grid = np.linspace(-0.5, 0.5, 11)
+
+    fieldmap = xf.TriCubicInterpolatedFieldMap(_context=test_context,
+            x_grid=x_grid, y_grid=y_grid, z_grid=z_grid)
+    cfieldmap = xf.TriCubicInterpolatedFieldMap(_context=test_context,
+            x_grid=x_grid, y_grid=y_grid, z_grid=z_grid,
+            coefficient_cache=True)
+    assert not fieldmap.coefficient_cache
+    assert cfieldmap.coefficient_cache
+    assert len(cfieldmap._coefficients) == 8 * len(cfieldmap._phi_taylor)
+
+    ecloud = xf.ElectronCloud(length=1, fieldmap=fieldmap,
+                              _buffer=fieldmap._buffer)
+    cecloud = xf.ElectronCloud(length=1, fieldmap=cfieldmap,
+                               _buffer=cfieldmap._buffer)
+
+    rng = default_rng(12345)
+    n_parts = 1000
+    for _ in range(2):
+        phi_taylor = test_context.nparray_to_context_array(
+                                    rng.random(len(fieldmap._phi_taylor)))
+        fieldmap._phi_taylor[:] = phi_taylor
+        cfieldmap._phi_taylor[:] = phi_taylor
+        cfieldmap.build_coefficient_cache()
+
+        part = xp.Particles(_context=test_context, p0c=450e9,
+                            x=(rng.random(n_parts) - 0.5) * 1.,
+                            y=(rng.random(n_parts) - 0.5) * 0.8)
+        part.zeta = part.beta0 * (rng.random(n_parts) - 0.5)
+        cpart = part.copy()
+
+        ecloud.track(part)
+        cecloud.track(cpart)
+
+        part.move(_context=xo.ContextCpu())
+        cpart.move(_context=xo.ContextCpu())
+        assert np.sum(part.state > 0) > 0.8 * n_parts
+        assert np.all(cpart.state == part.state)
+        xo.assert_allclose(cpart.px, part.px, rtol=1e-14, atol=0)
+        xo.assert_allclose(cpart.py, part.py, rtol=1e-14, atol=0)
+        xo.assert_allclose(cpart.ptau, part.ptau, rtol=1e-14, atol=0)
+
+
+@for_all_test_contexts
+def test_phi_taylor_from_phi(test_context):
+    # Central differences are exact for polynomials of second degree
+    ff = lambda x, y, z: sum([0.1 * (i + 1) * x**i * y**j * z**k
+        for i in range(3) for j in range(3) for k in range(3)])
+    df = lambda x, y, z, a, b, c: sum([0.1 * (i + 1)
+        * np.prod(np.arange(i - a + 1, i + 1)) * x**(i - a)
+        * np.prod(np.arange(j - b + 1, j + 1)) * y**(j - b)
+        * np.prod(np.arange(k - c + 1, k + 1)) * z**(k - c)
+        for i in range(a, 3) for j in range(b, 3) for k in range(c, 3)])
+
+    x_grid = np.linspace(-0.5, 0.5, 9)
+    y_grid = np.linspace(-0.4, 0.4, 7)
+    z_grid = np.linspace(-1., 1., 6)
+    XX, YY, ZZ = np.meshgrid(x_grid, y_grid, z_grid, indexing='ij')
+    phi = ff(XX, YY, ZZ)
+
+    fieldmap = xf.TriCubicInterpolatedFieldMap.from_phi(phi,
+            x_grid=x_grid, y_grid=y_grid, z_grid=z_grid,
+            _context=test_context)
+
+    dx, dy, dz = fieldmap.dx, fieldmap.dy, fieldmap.dz
+    orders = [(0, 0, 0), (1, 0, 0), (0, 1, 0), (0, 0, 1),
+              (1, 1, 0), (1, 0, 1), (0, 1, 1), (1, 1, 1)]
+    phi_taylor = test_context.nparray_from_context_array(
+                        fieldmap._phi_taylor).reshape(6, 7, 9, 8)
+    inner = (slice(1, -1), slice(1, -1), slice(1, -1))
+    for ll, (a, b, c) in enumerate(orders):
+        expected = df(XX, YY, ZZ, a, b, c) * dx**a * dy**b * dz**c
+        xo.assert_allclose(phi_taylor[:, :, :, ll].transpose(2, 1, 0)[inner],
+                           expected[inner], rtol=1e-12, atol=1e-14)
+    # Derivatives are zero at the edges
+    assert np.all(phi_taylor[:, :, 0, 1] == 0)
+    assert np.all(phi_taylor[:, 0, :, 6] == 0)
+    assert np.all(phi_taylor[-1, :, :, 7] == 0)
+
+    # From a trilinear map (on the same context, no copy to the host)
+    tlmap = xf.TriLinearInterpolatedFieldMap(_context=test_context,
+            x_grid=x_grid, y_grid=y_grid, z_grid=z_grid)
+    tlmap.update_phi(test_context.nparray_to_context_array(phi))
+    fieldmap2 = xf.TriCubicInterpolatedFieldMap.from_phi(tlmap)
+    assert fieldmap2._buffer.context is test_context
+    xo.assert_allclose(
+        test_context.nparray_from_context_array(fieldmap2._phi_taylor),
+        test_context.nparray_from_context_array(fieldmap._phi_taylor),
+        rtol=0, atol=0)
+
+    # phi_taylor given at construction
+    fieldmap3 = xf.TriCubicInterpolatedFieldMap(_context=test_context,
+            x_grid=x_grid, y_grid=y_grid, z_grid=z_grid,
+            phi_taylor=phi_taylor.transpose(2, 1, 0, 3))
+    xo.assert_allclose(
+        test_context.nparray_from_context_array(fieldmap3._phi_taylor),
+        test_context.nparray_from_context_array(fieldmap._phi_taylor),
+        rtol=0, atol=0)
+
+
+def _write_ecloud_h5(filename, x_grid, y_grid, z_grid, phi):
+    import h5py
+    with h5py.File(filename, 'w') as ff:
+        ff['grid/xg'] = x_grid
+        ff['grid/yg'] = y_grid
+        ff['grid/zg'] = z_grid
+        ff['settings/symmetric2D'] = 0
+        for iz in range(len(z_grid)):
+            ff[f'slices/slice{iz}/phi'] = phi[iz]
+
+
+def test_fieldmap_from_h5_cache(tmp_path, monkeypatch):
+    pytest.importorskip('h5py')
+    import xfields.config_tools.electroncloud_config_tools as ecloud_tools
+
+    nx, ny, nz = 9, 7, 6
+    x_grid = np.linspace(-2e-3, 2e-3, nx)
+    y_grid = np.linspace(-1e-3, 1e-3, ny)
+    z_grid = np.linspace(-0.3, 0.3, nz)
+    dx, dy, dz = [gg[1] - gg[0] for gg in (x_grid, y_grid, z_grid)]
+    scale = np.array([1., dx, dy, dz, dx * dy, dx * dz, dy * dz,
+                      dx * dy * dz])
+
+    rng = default_rng(seed=12)
+    h5_file = tmp_path / 'ecloud.h5'
+    cache_file = tmp_path / 'ecloud.fmap'
+
+    def check(fmap, phi):
+        # h5 slices are (nx, ny, 8), phi_taylor is ordered as (nz, ny, nx, 8)
+        expected = phi.transpose(0, 2, 1, 3) * scale
+        xo.assert_allclose(fmap._phi_taylor.reshape(nz, ny, nx, 8),
+                           expected, rtol=1e-15, atol=0)
+
+    def load(**kwargs):
+        return ecloud_tools.get_electroncloud_fieldmap_from_h5(
+            str(h5_file), buffer=xo.ContextCpu().new_buffer(),
+            cache_file=str(cache_file), n_threads=2, **kwargs)
+
+    phi = rng.random((nz, nx, ny, 8))
+    _write_ecloud_h5(h5_file, x_grid, y_grid, z_grid, phi)
+
+    # Cold load, the cache is written
+    assert not cache_file.exists()
+    check(load(), phi)
+    assert cache_file.exists()
+    check(xf.TriCubicInterpolatedFieldMap.from_file(cache_file), phi)
+
+    # Cached load, the h5 file is not converted again
+    def no_conversion(*args, **kwargs):
+        raise AssertionError('The cache should have been used')
+    with monkeypatch.context() as mp:
+        mp.setattr(ecloud_tools, '_write_h5_cache', no_conversion)
+        check(load(), phi)
+        wfmap = load(nz_window=3)
+        assert isinstance(wfmap, xf.WindowedTriCubicInterpolatedFieldMap)
+        assert wfmap.nz_window == 3
+        wfmap.close()
+
+    # Stale cache (h5 file newer than the cache), the cache is rewritten
+    phi_new = rng.random((nz, nx, ny, 8))
+    _write_ecloud_h5(h5_file, x_grid, y_grid, z_grid, phi_new)
+    t_cache = cache_file.stat().st_mtime
+    os.utime(h5_file, (t_cache + 10, t_cache + 10))
+    check(load(), phi_new)
+    check(xf.TriCubicInterpolatedFieldMap.from_file(cache_file), phi_new)
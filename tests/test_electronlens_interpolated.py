@@ -4,6 +4,7 @@
 # ########################################### #
 
 import numpy as np
+import xobjects as xo
 import xpart as xp
 import xtrack as xt
 import xfields as xf
@@ -72,3 +73,84 @@ def test_electronlens_interpolated(test_context):
                        atol=1.e-8, rtol=1.e-15)
     assert np.all(part.delta == 0.)
     assert np.all(part.ptau == 0.)
+
+
+@for_all_test_contexts
+def test_bicubic_fieldmap(test_context):
+    # The bicubic interpolation is exact for polynomials of third degree
+    ff = lambda x, y: sum([0.1 * (i + 2*j + 1) * x**i * y**j
+                           for i in range(4) for j in range(4)])
+    dfdx = lambda x, y: sum([0.1 * (i + 2*j + 1) * i * x**(i-1) * y**j
+                             for i in range(1, 4) for j in range(4)])
+    dfdy = lambda x, y: sum([0.1 * (i + 2*j + 1) * j * x**i * y**(j-1)
+                             for i in range(4) for j in range(1, 4)])
+    dfdxy = lambda x, y: sum([0.1 * (i + 2*j + 1) * i * j
+                              * x**(i-1) * y**(j-1)
+                              for i in range(1, 4) for j in range(1, 4)])
+
+    x_grid = np.linspace(-0.5, 0.5, 11)
+    y_grid = np.linspace(-0.4, 0.4, 9)
+    dx = x_grid[1] - x_grid[0]
+    dy = y_grid[1] - y_grid[0]
+    X, Y = np.meshgrid(x_grid, y_grid, indexing='ij')
+    phi_taylor = np.stack([ff(X, Y), dfdx(X, Y) * dx, dfdy(X, Y) * dy,
+                           dfdxy(X, Y) * dx * dy], axis=-1)
+
+    rng = np.random.default_rng(12345)
+    n_part = 1000
+    x_test = rng.uniform(-0.45, 0.45, n_part)
+    y_test = rng.uniform(-0.35, 0.35, n_part)
+
+    for coefficient_cache in [False, True]:
+        fieldmap = xf.BiCubicInterpolatedFieldMap(_context=test_context,
+                x_grid=x_grid, y_grid=y_grid, phi_taylor=phi_taylor,
+                coefficient_cache=coefficient_cache)
+        assert len(fieldmap._phi_taylor) == 4 * 11 * 9
+        elens = xf.ElectronLensInterpolated(_context=test_context,
+                current=1, length=1, voltage=15e3, fieldmap=fieldmap)
+
+        part = xp.Particles(_context=test_context, x=x_test, y=y_test,
+                            p0c=450e9)
+        elens.track(part)
+        part.move(_context=xo.ContextCpu())
+
+        assert np.all(part.state == 1)
+        factor = part.px[0] / dfdx(x_test[0], y_test[0])
+        xo.assert_allclose(part.px, factor * dfdx(x_test, y_test),
+                           rtol=1e-12, atol=1e-14 * abs(factor))
+        xo.assert_allclose(part.py, factor * dfdy(x_test, y_test),
+                           rtol=1e-12, atol=1e-14 * abs(factor))
+
+    # Tricubic map (as used by earlier versions of the element), converted
+    # from its first slice, also from its dictionary representation (with
+    # the field names of the Python class or of the underlying struct,
+    # depending on the xobjects version)
+    nz = 3
+    phi_taylor_3d = np.zeros((11, 9, nz, 8))
+    phi_taylor_3d[:, :, :, [0, 1, 2, 4]] = phi_taylor[:, :, None, :]
+    phi_taylor_3d[:, :, :, [3, 5, 6, 7]] = rng.uniform(size=(11, 9, nz, 4))
+    tc_fieldmap = xf.TriCubicInterpolatedFieldMap(_context=test_context,
+            x_grid=x_grid, y_grid=y_grid, z_range=(-1, 1), nz=nz,
+            phi_taylor=phi_taylor_3d)
+    for fmap in [tc_fieldmap, tc_fieldmap._xobject._to_dict()]:
+        elens = xf.ElectronLensInterpolated(_context=test_context,
+                current=1, length=1, voltage=15e3, fieldmap=fmap)
+        assert isinstance(elens.fieldmap, xf.BiCubicInterpolatedFieldMap)
+        xo.assert_allclose(elens.fieldmap.x_grid, x_grid, rtol=0, atol=1e-15)
+        xo.assert_allclose(elens.fieldmap.y_grid, y_grid, rtol=0, atol=1e-15)
+        phi_taylor_conv = test_context.nparray_from_context_array(
+            elens.fieldmap._phi_taylor).reshape(9, 11, 4).transpose(1, 0, 2)
+        xo.assert_allclose(phi_taylor_conv, phi_taylor, rtol=0, atol=0)
+
+    # Potential given on the grid (derivatives from central differences)
+    fieldmap = xf.BiCubicInterpolatedFieldMap(_context=test_context,
+            x_grid=x_grid, y_grid=y_grid, phi=ff(X, Y))
+    phi_taylor_num = test_context.nparray_from_context_array(
+            fieldmap._phi_taylor).reshape(9, 11, 4).transpose(1, 0, 2)
+    xo.assert_allclose(phi_taylor_num[:, :, 0], phi_taylor[:, :, 0],
+                       rtol=0, atol=0)
+    assert np.all(phi_taylor_num[0, :, 1] == 0)
+    assert np.all(phi_taylor_num[:, -1, 2] == 0)
+    xo.assert_allclose(phi_taylor_num[5, 4, 1],
+                       0.5 * (ff(x_grid[6], y_grid[4])
+                              - ff(x_grid[4], y_grid[4])), rtol=1e-14)
@@ -0,0 +1,449 @@
+# copyright ################################# #
+# This file is part of the Xfields Package.   #
+# Copyright (c) CERN, 2021.                   #
+# ########################################### #
+
+import numpy as np
+import pytest
+
+import xobjects as xo
+from xobjects.test_helpers import for_all_test_contexts
+
+from scipy.constants import epsilon_0
+
+import xfields as xf
+from xfields.solvers import (GreenFunctionCache, FFTSolverRectPipe3D,
+                             FFTSolverRectPipe2p5D, get_fft_backend,
+                             default_green_function_cache)
+from xfields.solvers.fftsolvers import (FFTSolver3D, FFTSolver2p5D,
+                                       FFTSolver2p5DAveraged,
+                                       _multiply_slice_by_slice)
+
+
+@pytest.mark.parametrize('solver_class', [FFTSolver3D, FFTSolver2p5D])
+@for_all_test_contexts
+def test_rfft_solver(solver_class, test_context):
+
+    if isinstance(test_context, xo.ContextPyopencl):
+        pytest.skip('Real-to-complex FFTs not available on OpenCL')
+
+    nx, ny, nz = 32, 24, 16
+    dx, dy, dz = 1e-3, 2e-3, 3e-3
+
+    rho = np.asfortranarray(np.random.rand(nx, ny, nz))
+    rho_dev = test_context.nparray_to_context_array(rho)
+
+    solver = solver_class(dx=dx, dy=dy, dz=dz, nx=nx, ny=ny, nz=nz,
+                          context=test_context)
+    solver_rfft = solver_class(dx=dx, dy=dy, dz=dz, nx=nx, ny=ny, nz=nz,
+                               context=test_context, use_rfft=True)
+
+    # Only the non-redundant half of the spectrum is stored
+    assert solver_rfft._gint_rep_transf_dev.shape[0] == nx + 1
+
+    phi = test_context.nparray_from_context_array(solver.solve(rho_dev))
+    phi_rfft = test_context.nparray_from_context_array(
+                                            solver_rfft.solve(rho_dev))
+
+    xo.assert_allclose(phi_rfft, phi, rtol=0,
+                       atol=1e-12 * np.max(np.abs(phi)))
+
+
+def test_green_function_cache(tmp_path):
+
+    nx, ny, nz = 16, 12, 8
+    dx, dy, dz = 1e-3, 2e-3, 3e-3
+
+    cache = GreenFunctionCache(cache_dir=tmp_path)
+
+    solver = FFTSolver3D(dx=dx, dy=dy, dz=dz, nx=nx, ny=ny, nz=nz,
+                         green_function_cache=cache)
+    assert (cache.hits, cache.misses) == (0, 1)
+    solver_again = FFTSolver3D(dx=dx, dy=dy, dz=dz, nx=nx, ny=ny, nz=nz,
+                               green_function_cache=cache)
+    assert (cache.hits, cache.misses) == (1, 1)
+    xo.assert_allclose(solver_again._gint_rep_transf_dev,
+                       solver._gint_rep_transf_dev, rtol=0, atol=0)
+    # Each solver owns its copy of the cached kernel
+    assert not np.shares_memory(solver_again._gint_rep_transf_dev,
+                                solver._gint_rep_transf_dev)
+
+    # The cache of the package is used only on request
+    default_green_function_cache.clear()
+    n_misses = default_green_function_cache.misses
+    FFTSolver3D(dx=dx, dy=dy, dz=dz, nx=nx, ny=ny, nz=nz)
+    assert default_green_function_cache.misses == n_misses
+    FFTSolver3D(dx=dx, dy=dy, dz=dz, nx=nx, ny=ny, nz=nz,
+                green_function_cache=True)
+    assert default_green_function_cache.misses == n_misses + 1
+    default_green_function_cache.clear()
+
+    # 2.5D solvers share the kernel independently of the longitudinal grid
+    FFTSolver2p5D(dx=dx, dy=dy, dz=dz, nx=nx, ny=ny, nz=nz,
+                  green_function_cache=cache)
+    FFTSolver2p5DAveraged(dx=dx, dy=dy, dz=2*dz, nx=nx, ny=ny, nz=3*nz,
+                          green_function_cache=cache)
+    assert (cache.hits, cache.misses) == (2, 2)
+
+    # Kernels are found on disk by a new cache (e.g. a new job)
+    cache_new_job = GreenFunctionCache(cache_dir=tmp_path)
+    solver_new_job = FFTSolver3D(dx=dx, dy=dy, dz=dz, nx=nx, ny=ny, nz=nz,
+                                 green_function_cache=cache_new_job)
+    assert (cache_new_job.hits, cache_new_job.misses) == (1, 0)
+    xo.assert_allclose(solver_new_job._gint_rep_transf_dev,
+                       solver._gint_rep_transf_dev, rtol=0, atol=0)
+
+    # Least recently used kernels are evicted
+    cache_small = GreenFunctionCache(
+                max_bytes=solver._gint_rep_transf_dev.nbytes)
+    for ddx in [dx, 2*dx, dx]:
+        FFTSolver3D(dx=ddx, dy=dy, dz=dz, nx=nx, ny=ny, nz=nz,
+                    green_function_cache=cache_small)
+    assert (cache_small.hits, cache_small.misses) == (0, 3)
+    assert cache_small.nbytes <= cache_small.max_bytes
+
+
+@pytest.mark.parametrize('use_rfft', [False, True])
+@pytest.mark.parametrize('solver_class', [FFTSolver3D, FFTSolver2p5D,
+                                          FFTSolver2p5DAveraged])
+@for_all_test_contexts
+def test_green_function_on_context(solver_class, use_rfft, test_context):
+
+    if isinstance(test_context, xo.ContextPyopencl) and (
+            use_rfft or solver_class is FFTSolver2p5DAveraged):
+        pytest.skip('Not available on OpenCL')
+    if use_rfft and solver_class is FFTSolver2p5DAveraged:
+        pytest.skip('FFTSolver2p5DAveraged has no rfft mode')
+
+    kwargs = dict(dx=1e-3, dy=2e-3, dz=3e-3, nx=16, ny=12, nz=8,
+                  context=test_context)
+    if use_rfft:
+        kwargs['use_rfft'] = True
+
+    # Without cache the Green function is transformed on the context, with
+    # the cache it is transformed on the host
+    solver = solver_class(**kwargs)
+    solver_cached = solver_class(green_function_cache=GreenFunctionCache(),
+                                 **kwargs)
+
+    gint = test_context.nparray_from_context_array(
+                                        solver._gint_rep_transf_dev)
+    gint_cached = test_context.nparray_from_context_array(
+                                        solver_cached._gint_rep_transf_dev)
+    assert gint.shape == gint_cached.shape
+    assert gint.dtype == gint_cached.dtype
+    xo.assert_allclose(gint, gint_cached, rtol=0,
+                       atol=1e-12 * np.max(np.abs(gint_cached)))
+
+
+@pytest.mark.parametrize('use_rfft', [False, True])
+@pytest.mark.parametrize('solver_class', [FFTSolver3D, FFTSolver2p5D])
+@for_all_test_contexts
+def test_solve_into(solver_class, use_rfft, test_context):
+
+    if use_rfft and isinstance(test_context, xo.ContextPyopencl):
+        pytest.skip('Real-to-complex FFTs not available on OpenCL')
+
+    nx, ny, nz = 32, 24, 16
+    dx, dy, dz = 1e-3, 2e-3, 3e-3
+
+    solver = solver_class(dx=dx, dy=dy, dz=dz, nx=nx, ny=ny, nz=nz,
+                          context=test_context, use_rfft=use_rfft)
+    out = test_context.zeros((nx, ny, nz), dtype=np.float64, order='F')
+
+    for _ in range(2): # second call checks that the workspace is cleaned
+        rho = np.asfortranarray(np.random.rand(nx, ny, nz))
+        rho_dev = test_context.nparray_to_context_array(rho)
+
+        phi = test_context.nparray_from_context_array(solver.solve(rho_dev))
+        res = solver.solve_into(rho_dev, out)
+        assert res is out
+
+        xo.assert_allclose(test_context.nparray_from_context_array(out), phi,
+                           rtol=0, atol=1e-12 * np.max(np.abs(phi)))
+
+
+@pytest.mark.parametrize('mode', ['complex', 'rfft', 'pruned'])
+@pytest.mark.parametrize('solver_class', [FFTSolver3D, FFTSolver2p5D])
+@for_all_test_contexts
+def test_solve_into_no_allocation(solver_class, mode, test_context,
+                                  monkeypatch):
+
+    if mode != 'complex' and isinstance(test_context, xo.ContextPyopencl):
+        pytest.skip('Transform mode not available on OpenCL')
+
+    nx, ny, nz = 32, 24, 16
+    dx, dy, dz = 1e-3, 2e-3, 3e-3
+
+    solver = solver_class(dx=dx, dy=dy, dz=dz, nx=nx, ny=ny, nz=nz,
+                          context=test_context, use_rfft=(mode == 'rfft'),
+                          use_pruned_fft=(mode == 'pruned'))
+    out = test_context.zeros((nx, ny, nz), dtype=np.float64, order='F')
+
+    rho = np.asfortranarray(np.random.rand(nx, ny, nz))
+    rho_dev = test_context.nparray_to_context_array(rho)
+    phi = test_context.nparray_from_context_array(solver.solve(rho_dev))
+    solver.solve_into(rho_dev, out) # warm-up
+
+    def zeros_not_allowed(*args, **kwargs):
+        raise AssertionError('context.zeros called by solve_into')
+    monkeypatch.setattr(test_context, 'zeros', zeros_not_allowed)
+
+    out[:, :, :] = 0
+    assert solver.solve_into(rho_dev, out) is out
+    xo.assert_allclose(test_context.nparray_from_context_array(out), phi,
+                       rtol=0, atol=1e-12 * np.max(np.abs(phi)))
+
+
+@for_all_test_contexts
+def test_solve_separable_no_allocation(test_context, monkeypatch):
+
+    if isinstance(test_context, xo.ContextPyopencl):
+        pytest.skip('FFTSolver2p5DAveraged not available on OpenCL')
+
+    nx, ny, nz = 32, 24, 16
+    dx, dy, dz = 1e-3, 2e-3, 3e-3
+
+    kwargs = dict(dx=dx, dy=dy, dz=dz, nx=nx, ny=ny, nz=nz,
+                  context=test_context)
+    solver = FFTSolver2p5DAveraged(**kwargs)
+    solver.solve_separable(test_context.nparray_to_context_array(
+                    np.asfortranarray(np.random.rand(nx, ny, nz)))) # warm-up
+
+    rho = np.asfortranarray(np.random.rand(nx, ny, nz))
+    rho_dev = test_context.nparray_to_context_array(rho)
+    phi_xy_ref, lambda_z_ref = FFTSolver2p5DAveraged(
+                                        **kwargs).solve_separable(rho_dev)
+    phi_xy_ref = test_context.nparray_from_context_array(phi_xy_ref)
+
+    def zeros_not_allowed(*args, **kwargs):
+        raise AssertionError('context.zeros called by solve_separable')
+    monkeypatch.setattr(test_context, 'zeros', zeros_not_allowed)
+
+    phi_xy, lambda_z = solver.solve_separable(rho_dev)
+    xo.assert_allclose(test_context.nparray_from_context_array(phi_xy),
+                       phi_xy_ref, rtol=0,
+                       atol=1e-12 * np.max(np.abs(phi_xy_ref)))
+    xo.assert_allclose(test_context.nparray_from_context_array(lambda_z),
+                       test_context.nparray_from_context_array(lambda_z_ref),
+                       rtol=1e-12, atol=0)
+
+
+@pytest.mark.parametrize('use_rfft', [False, True])
+@pytest.mark.parametrize('solver_class', [FFTSolver3D, FFTSolver2p5D])
+@for_all_test_contexts
+def test_pruned_fft_solver(solver_class, use_rfft, test_context):
+
+    if isinstance(test_context, xo.ContextPyopencl):
+        pytest.skip('Pruned FFTs not available on OpenCL')
+
+    nx, ny, nz = 32, 24, 16
+    dx, dy, dz = 1e-3, 2e-3, 3e-3
+
+    rho = np.asfortranarray(np.random.rand(nx, ny, nz))
+    rho_dev = test_context.nparray_to_context_array(rho)
+
+    solver = solver_class(dx=dx, dy=dy, dz=dz, nx=nx, ny=ny, nz=nz,
+                          context=test_context)
+    solver_pruned = solver_class(dx=dx, dy=dy, dz=dz, nx=nx, ny=ny, nz=nz,
+                                 context=test_context, use_rfft=use_rfft,
+                                 use_pruned_fft=True)
+
+    phi = test_context.nparray_from_context_array(solver.solve(rho_dev))
+    phi_pruned = test_context.nparray_from_context_array(
+                                            solver_pruned.solve(rho_dev))
+    xo.assert_allclose(phi_pruned, phi, rtol=0,
+                       atol=1e-12 * np.max(np.abs(phi)))
+
+    out = test_context.zeros((nx, ny, nz), dtype=np.float64, order='F')
+    solver_pruned.solve_into(rho_dev, out)
+    xo.assert_allclose(test_context.nparray_from_context_array(out), phi,
+                       rtol=0, atol=1e-12 * np.max(np.abs(phi)))
+
+
+@pytest.mark.parametrize('mode', ['complex', 'rfft', 'pruned'])
+@for_all_test_contexts
+def test_2p5d_skip_empty_slices(mode, test_context):
+
+    if mode != 'complex' and isinstance(test_context, xo.ContextPyopencl):
+        pytest.skip('Transform mode not available on OpenCL')
+
+    nx, ny, nz = 32, 24, 16
+    dx, dy, dz = 1e-3, 2e-3, 3e-3
+
+    # The occupied slices (11 to 15) are solved as the range [8, 16)
+    rho = np.asfortranarray(np.random.rand(nx, ny, nz))
+    rho[:, :, :11] = 0
+    rho[:, :, 13] = 0
+    rho_dev = test_context.nparray_to_context_array(rho)
+
+    kwargs = dict(dx=dx, dy=dy, dz=dz, nx=nx, ny=ny, nz=nz,
+                  context=test_context, use_rfft=(mode == 'rfft'),
+                  use_pruned_fft=(mode == 'pruned'))
+    solver_full = FFTSolver2p5D(skip_empty_slices=False, **kwargs)
+    solver_skip = FFTSolver2p5D(skip_empty_slices=True, **kwargs)
+
+    phi_full = test_context.nparray_from_context_array(
+                                            solver_full.solve(rho_dev))
+    phi_skip = test_context.nparray_from_context_array(
+                                            solver_skip.solve(rho_dev))
+    atol = 1e-12 * np.max(np.abs(phi_full))
+    xo.assert_allclose(phi_skip, phi_full, rtol=0, atol=atol)
+    assert np.all(phi_skip[:, :, :11] == 0)
+    assert solver_skip._get_occupied_range(rho_dev) == (8, 16)
+    if mode == 'complex':
+        assert list(solver_skip._range_fftplans.keys()) == [8]
+
+    out = test_context.zeros((nx, ny, nz), dtype=np.float64, order='F') + 1.
+    solver_skip.solve_into(rho_dev, out)
+    xo.assert_allclose(test_context.nparray_from_context_array(out),
+                       phi_full, rtol=0, atol=atol)
+
+    # Empty grid
+    rho_dev[:, :, :] = 0
+    assert np.all(test_context.nparray_from_context_array(
+                                        solver_skip.solve(rho_dev)) == 0)
+
+
+@pytest.mark.parametrize('solver_class',
+                         [FFTSolverRectPipe3D, FFTSolverRectPipe2p5D])
+@for_all_test_contexts
+def test_rect_pipe_solver(solver_class, test_context):
+
+    if isinstance(test_context, xo.ContextPyopencl):
+        pytest.skip('DST-based solvers not available on OpenCL')
+
+    nx, ny, nz = 40, 30, 20
+    dx, dy, dz = 1e-3, 2e-3, 3e-3
+    is_3d = solver_class is FFTSolverRectPipe3D
+
+    solver = solver_class(dx=dx, dy=dy, dz=dz, nx=nx, ny=ny, nz=nz,
+                          context=test_context)
+    # The 2.5D eigenvalues are broadcast over the slices
+    assert solver._inv_eig_dev.shape == (nx, ny, nz if is_3d else 1)
+
+    # A sine mode vanishing on the walls (half a cell outside the grid) is
+    # an eigenfunction of the discrete Laplacian
+    kx, ky, kz = 3, 2, 1
+    ix, iy, iz = np.meshgrid(np.arange(nx), np.arange(ny), np.arange(nz),
+                             indexing='ij')
+    phi_mode = (np.sin(np.pi * kx * (2*ix + 1) / (2*nx))
+              * np.sin(np.pi * ky * (2*iy + 1) / (2*ny))
+              * np.sin(np.pi * kz * (2*iz + 1) / (2*nz)))
+    eig = (4 * np.sin(np.pi * kx / (2*nx))**2 / dx**2
+         + 4 * np.sin(np.pi * ky / (2*ny))**2 / dy**2)
+    if is_3d:
+        eig += 4 * np.sin(np.pi * kz / (2*nz))**2 / dz**2
+    rho = np.asfortranarray(epsilon_0 * eig * phi_mode)
+
+    phi = test_context.nparray_from_context_array(
+            solver.solve(test_context.nparray_to_context_array(rho)))
+    xo.assert_allclose(phi, phi_mode, rtol=0, atol=1e-12)
+
+
+@pytest.mark.parametrize('solver_name', ['FFTSolverRectPipe2p5D',
+                                         'FFTSolverRectPipe3D'])
+@for_all_test_contexts
+def test_rect_pipe_vs_open_boundary(solver_name, test_context):
+
+    if isinstance(test_context, xo.ContextPyopencl):
+        pytest.skip('DST-based solvers not available on OpenCL')
+
+    # Far from the walls the field is the same as in free space
+    grid_kwargs = dict(x_range=(-3e-2, 3e-2), y_range=(-3e-2, 3e-2),
+                       z_range=(-3e-2, 3e-2), nx=48, ny=48, nz=48)
+    open_solver = solver_name.replace('RectPipe', '')
+    fmap_pipe = xf.TriLinearInterpolatedFieldMap(_context=test_context,
+                                    solver=solver_name, **grid_kwargs)
+    fmap_open = xf.TriLinearInterpolatedFieldMap(_context=test_context,
+                                    solver=open_solver, **grid_kwargs)
+
+    xx, yy, zz = np.meshgrid(fmap_pipe.x_grid, fmap_pipe.y_grid,
+                             fmap_pipe.z_grid, indexing='ij')
+    rho = np.asfortranarray(np.exp(-(xx**2 + yy**2 + zz**2) / (2*4e-3**2)))
+    rho_dev = test_context.nparray_to_context_array(rho)
+    fmap_pipe.update_rho(rho_dev)
+    fmap_pipe.update_phi_from_rho()
+    fmap_open.update_rho(rho_dev)
+    fmap_open.update_phi_from_rho()
+
+    p2np = test_context.nparray_from_context_array
+    center = slice(16, 32)
+    for nn in ['dphi_dx', 'dphi_dy']:
+        ref = p2np(getattr(fmap_open, nn))
+        xo.assert_allclose(
+            p2np(getattr(fmap_pipe, nn))[center, center, center],
+            ref[center, center, center],
+            rtol=0, atol=3e-2 * np.max(np.abs(ref)))
+
+
+@pytest.mark.parametrize('solver_class', [FFTSolver3D, FFTSolver2p5D,
+                                          FFTSolver2p5DAveraged,
+                                          FFTSolverRectPipe3D])
+@pytest.mark.parametrize('use_rfft', [False, True])
+def test_scipy_fft_backend(solver_class, use_rfft):
+
+    nx, ny, nz = 32, 24, 16
+    dx, dy, dz = 1e-3, 2e-3, 3e-3
+
+    kwargs = dict(dx=dx, dy=dy, dz=dz, nx=nx, ny=ny, nz=nz)
+    if use_rfft:
+        if solver_class not in (FFTSolver3D, FFTSolver2p5D):
+            pytest.skip('Real-to-complex FFTs not available for this solver')
+        kwargs['use_rfft'] = True
+
+    rho = np.asfortranarray(np.random.rand(nx, ny, nz))
+
+    solver = solver_class(**kwargs)
+    solver_scipy = solver_class(fft_backend='scipy', fft_threads=2, **kwargs)
+
+    phi = solver.solve(rho)
+    xo.assert_allclose(solver_scipy.solve(rho), phi, rtol=0,
+                       atol=1e-12 * np.max(np.abs(phi)))
+
+    # Backends and plans are shared between solvers
+    solver_scipy_2 = solver_class(fft_backend='scipy', fft_threads=2,
+                                  **kwargs)
+    assert solver_scipy_2._fft_backend is solver_scipy._fft_backend
+    if getattr(solver_scipy, 'fftplan', None) is not None:
+        assert solver_scipy_2.fftplan is solver_scipy.fftplan
+    assert get_fft_backend(xo.ContextCpu(), 'scipy', 3) is not (
+                                            solver_scipy._fft_backend)
+
+
+@pytest.mark.parametrize('mode', ['complex', 'rfft', 'pruned'])
+@pytest.mark.parametrize('solver_class', [FFTSolver3D, FFTSolver2p5D])
+def test_single_precision_solver(solver_class, mode):
+
+    nx, ny, nz = 32, 24, 16
+    dx, dy, dz = 1e-3, 2e-3, 3e-3
+
+    kwargs = dict(dx=dx, dy=dy, dz=dz, nx=nx, ny=ny, nz=nz,
+                  use_rfft=(mode == 'rfft'), use_pruned_fft=(mode == 'pruned'),
+                  green_function_cache=False)
+    solver = solver_class(**kwargs)
+    solver_f32 = solver_class(dtype=np.float32, **kwargs)
+
+    assert solver_f32._gint_rep_transf_dev.dtype in (np.float32,
+                                                     np.complex64)
+
+    rho = np.asfortranarray(np.random.rand(nx, ny, nz))
+    phi = solver.solve(rho)
+    phi_f32 = solver_f32.solve(rho.astype(np.float32))
+    assert phi_f32.dtype == np.float32
+    xo.assert_allclose(phi_f32, phi, rtol=0, atol=1e-5 * np.max(np.abs(phi)))
+
+
+@pytest.mark.parametrize('dtype', [np.complex128, np.complex64])
+def test_multiply_slice_by_slice(dtype):
+
+    # Path used on contexts without array broadcasting (OpenCL), also in
+    # single precision
+    rng = np.random.default_rng(0)
+    workspace = np.asfortranarray(
+        rng.random((8, 6, 4)) + 1j * rng.random((8, 6, 4))).astype(dtype)
+    gint = np.asfortranarray(rng.random((8, 6, 1)).astype(dtype))
+
+    expected = workspace * gint
+    _multiply_slice_by_slice(workspace, gint, 4)
+    xo.assert_allclose(workspace, expected, rtol=1e-6, atol=0)
@@ -0,0 +1,846 @@
+# copyright ################################# #
+# This file is part of the Xfields Package.   #
+# Copyright (c) CERN, 2021.                   #
+# ########################################### #
+
+import numpy as np
+import pytest
+
+import xobjects as xo
+import xpart as xp
+from xobjects.test_helpers import for_all_test_contexts
+
+import xfields as xf
+
+
+def _gaussian_bunch(context, n_part=100000, seed=0):
+    rng = np.random.default_rng(seed)
+    return xp.Particles(_context=context, p0c=7e12,
+                        x=rng.normal(0, 1e-3, n_part),
+                        y=rng.normal(0, 2e-3, n_part),
+                        zeta=rng.normal(0, 5e-2, n_part),
+                        weight=1e11/n_part)
+
+
+def _deposited_qelem(context):
+    # Elementary charge used by the deposition kernels for particle objects
+    # (the C constant QELEM, which can differ from scipy.constants.e in the
+    # last digits depending on the constants header included first)
+    fmap = xf.TriLinearInterpolatedFieldMap(_context=context,
+                    x_range=(-1., 1.), y_range=(-1., 1.), z_range=(-1., 1.),
+                    nx=3, ny=3, nz=3)
+    particles = xp.Particles(_context=context, p0c=7e12, x=0., y=0., zeta=0.)
+    fmap.update_from_particles(particles=particles, update_phi=False)
+    rho = context.nparray_from_context_array(fmap.rho)
+    return np.sum(rho) * fmap.dx * fmap.dy * fmap.dz
+
+
+@for_all_test_contexts
+def test_separable_phi(test_context):
+
+    if isinstance(test_context, xo.ContextPyopencl):
+        pytest.skip('FFTSolver2p5DAveraged not available on OpenCL')
+
+    grid_kwargs = dict(x_range=(-5e-3, 5e-3), y_range=(-1e-2, 1e-2),
+                       z_range=(-0.2, 0.2), nx=32, ny=40, nz=20,
+                       solver='FFTSolver2p5DAveraged')
+    fmap = xf.TriLinearInterpolatedFieldMap(
+                    _context=test_context, **grid_kwargs)
+    fmap_sep = xf.TriLinearInterpolatedFieldMap(
+                    _context=test_context, separable_phi=True, **grid_kwargs)
+
+    # The 3D potential and its derivatives are not allocated
+    assert fmap_sep._phi.size == 0
+    assert fmap_sep._dphi_dz.size == 0
+
+    particles = _gaussian_bunch(test_context)
+    fmap.update_from_particles(particles=particles)
+    fmap_sep.update_from_particles(particles=particles)
+
+    p2np = test_context.nparray_from_context_array
+    for nn in ['phi', 'dphi_dx', 'dphi_dy', 'dphi_dz']:
+        ref = p2np(getattr(fmap, nn))
+        xo.assert_allclose(p2np(getattr(fmap_sep, nn)), ref,
+                           rtol=0, atol=1e-12 * np.max(np.abs(ref)))
+
+    rng = np.random.default_rng(1)
+    x = test_context.nparray_to_context_array(rng.uniform(-6e-3, 6e-3, 1000))
+    y = test_context.nparray_to_context_array(rng.uniform(-1e-2, 1e-2, 1000))
+    z = test_context.nparray_to_context_array(rng.uniform(-0.2, 0.2, 1000))
+
+    values = fmap.get_values_at_points(x, y, z)
+    values_sep = fmap_sep.get_values_at_points(x, y, z)
+    assert len(values_sep) == 5
+    for vv, vv_sep in zip(values, values_sep):
+        vv = p2np(vv)
+        xo.assert_allclose(p2np(vv_sep), vv,
+                           rtol=0, atol=1e-12 * np.max(np.abs(vv)))
+
+    dphi_dz, = fmap_sep.get_values_at_points(x, y, z, return_rho=False,
+                    return_phi=False, return_dphi_dx=False,
+                    return_dphi_dy=False)
+    xo.assert_allclose(p2np(dphi_dz), p2np(values[4]), rtol=0,
+                       atol=1e-12 * np.max(np.abs(p2np(values[4]))))
+
+
+@for_all_test_contexts
+def test_spacecharge_separable_phi(test_context):
+
+    if isinstance(test_context, xo.ContextPyopencl):
+        pytest.skip('FFTSolver2p5DAveraged not available on OpenCL')
+
+    sc_kwargs = dict(_context=test_context, length=10., apply_z_kick=True,
+                     x_range=(-5e-3, 5e-3), y_range=(-1e-2, 1e-2),
+                     z_range=(-0.2, 0.2), nx=32, ny=40, nz=20,
+                     solver='FFTSolver2p5DAveraged')
+    sc = xf.SpaceCharge3D(**sc_kwargs)
+    sc_sep = xf.SpaceCharge3D(separable_phi=True, **sc_kwargs)
+
+    particles = _gaussian_bunch(test_context)
+    particles_sep = particles.copy()
+    sc.track(particles)
+    sc_sep.track(particles_sep)
+
+    p2np = test_context.nparray_from_context_array
+    for nn in ['px', 'py', 'delta']:
+        ref = p2np(getattr(particles, nn))
+        xo.assert_allclose(p2np(getattr(particles_sep, nn)), ref,
+                           rtol=0, atol=1e-10 * np.max(np.abs(ref)))
+
+
+@pytest.mark.parametrize('solver', ['FFTSolver3D', 'FFTSolver2p5D',
+                                    'FFTSolver2p5DAveraged'])
+@for_all_test_contexts
+def test_spacecharge_single_precision(solver, test_context):
+
+    if (isinstance(test_context, xo.ContextPyopencl)
+            and solver == 'FFTSolver2p5DAveraged'):
+        pytest.skip('FFTSolver2p5DAveraged not available on OpenCL')
+    # On OpenCL, FFTSolver2p5D multiplies the single precision workspace by
+    # the Green function slice by slice (no broadcasting)
+
+    sc_kwargs = dict(_context=test_context, length=10., apply_z_kick=True,
+                     x_range=(-5e-3, 5e-3), y_range=(-1e-2, 1e-2),
+                     z_range=(-0.2, 0.2), nx=32, ny=40, nz=20,
+                     solver=solver, gamma0=7000.)
+    sc = xf.SpaceCharge3D(**sc_kwargs)
+    sc_f32 = xf.SpaceCharge3D(dtype='float32', **sc_kwargs)
+
+    assert sc_f32.fieldmap.rho.dtype == np.float32
+    assert sc_f32.fieldmap.dphi_dx.dtype == np.float32
+    assert sc_f32.fieldmap._rho.size == 0 # no double precision maps
+    assert sc_f32.fieldmap.solver.dtype == np.float32
+
+    particles = _gaussian_bunch(test_context)
+    particles_f32 = particles.copy()
+    sc.track(particles)
+    sc_f32.track(particles_f32)
+
+    p2np = test_context.nparray_from_context_array
+    xo.assert_allclose(p2np(sc_f32.fieldmap.rho), p2np(sc.fieldmap.rho),
+                       rtol=0, atol=1e-5 * np.max(p2np(sc.fieldmap.rho)))
+
+    # Coordinates stay in double precision, kicks agree to single precision
+    assert particles_f32.px.dtype == np.float64
+    for nn in ['px', 'py', 'delta']:
+        ref = p2np(getattr(particles, nn))
+        xo.assert_allclose(p2np(getattr(particles_f32, nn)), ref,
+                           rtol=0, atol=1e-4 * np.max(np.abs(ref)))
+
+    # Interpolated values are returned in double precision
+    x, y, z = particles.x, particles.y, particles.zeta
+    values = sc.fieldmap.get_values_at_points(x, y, z)
+    values_f32 = sc_f32.fieldmap.get_values_at_points(x, y, z)
+    for vv, vv_f32 in zip(values, values_f32):
+        assert vv_f32.dtype == np.float64
+        vv = p2np(vv)
+        xo.assert_allclose(p2np(vv_f32), vv, rtol=0,
+                           atol=1e-4 * np.max(np.abs(vv)))
+
+
+@for_all_test_contexts
+def test_spacecharge_adaptive_grid(test_context):
+
+    sc = xf.SpaceCharge3D(_context=test_context, length=10.,
+                          apply_z_kick=False,
+                          x_range=(-2e-2, 2e-2), y_range=(-2e-2, 2e-2),
+                          z_range=(-0.2, 0.2), nx=32, ny=40, nz=20,
+                          solver='FFTSolver2p5D', adaptive_grid=True,
+                          adaptive_grid_n_sigmas=5.)
+    fmap = sc.fieldmap
+    dx_ref, dy_ref = fmap._dx, fmap._dy
+    step = sc.adaptive_grid_cell_size_step
+
+    particles = _gaussian_bunch(test_context)
+    particles.x += 2e-3
+    particles_ref = particles.copy()
+    sc.track(particles)
+
+    # The grid is centered on the beam and covers at least 5 sigmas
+    p2np = test_context.nparray_from_context_array
+    mean_x, sigma_x = xf.mean_and_std(p2np(particles_ref.x))
+    mean_y, sigma_y = xf.mean_and_std(p2np(particles_ref.y))
+    xo.assert_allclose(0.5 * (fmap.x_grid[0] + fmap.x_grid[-1]), mean_x,
+                       rtol=0, atol=1e-12)
+    xo.assert_allclose(0.5 * (fmap.y_grid[0] + fmap.y_grid[-1]), mean_y,
+                       rtol=0, atol=1e-12)
+    assert mean_x + 5 * sigma_x <= fmap.x_grid[-1] < mean_x + 5 * step * sigma_x
+    assert mean_y + 5 * sigma_y <= fmap.y_grid[-1] < mean_y + 5 * step * sigma_y
+    assert fmap._x_min == fmap.x_grid[0]
+
+    # The cell sizes are taken from the quantized sequence
+    for dd, dd_ref in [(fmap._dx, dx_ref), (fmap._dy, dy_ref)]:
+        kk = np.log(dd / dd_ref) / np.log(step)
+        xo.assert_allclose(kk, np.round(kk), rtol=0, atol=1e-10)
+    assert fmap.solver.dx == fmap._dx
+    assert fmap.solver.dy == fmap._dy
+
+    # Same kicks as with a fixed grid equal to the adapted one
+    sc_fixed = xf.SpaceCharge3D(_context=test_context, length=10.,
+                                apply_z_kick=False,
+                                x_grid=fmap.x_grid, y_grid=fmap.y_grid,
+                                z_range=(-0.2, 0.2), nz=20,
+                                solver='FFTSolver2p5D')
+    sc_fixed.track(particles_ref)
+    for nn in ['px', 'py']:
+        ref = p2np(getattr(particles_ref, nn))
+        xo.assert_allclose(p2np(getattr(particles, nn)), ref,
+                           rtol=0, atol=1e-10 * np.max(np.abs(ref)))
+
+    # Small changes of the beam size do not change the cell size
+    solver = fmap.solver
+    dx = fmap._dx
+    particles.x *= 1.05
+    sc.track(particles)
+    assert fmap._dx == dx
+    assert fmap.solver is solver
+
+    # A smaller beam gets a finer grid, the solver is reused when going back
+    particles.x *= 0.5
+    sc.track(particles)
+    assert fmap._dx < dx
+    assert fmap.solver is not solver
+    particles.x *= 2.
+    sc.track(particles)
+    assert fmap._dx == dx
+    assert fmap.solver is solver
+
+    # The generated solvers use the shared Green function cache
+    assert fmap._solver_settings[2]['green_function_cache'] is True
+
+    # The solvers kept for reuse are bounded in memory (the current one is
+    # always kept)
+    fmap.max_nbytes_solvers_by_cell_size = 0
+    particles.x *= 0.25
+    sc.track(particles)
+    assert fmap._dx < dx / 2
+    assert list(fmap._solvers_by_cell_size.values()) == [fmap.solver]
+
+
+@for_all_test_contexts
+def test_adaptive_grid_rect_pipe(test_context):
+
+    if isinstance(test_context, xo.ContextPyopencl):
+        pytest.skip('DST solvers not available on OpenCL')
+
+    grid_kwargs = dict(x_range=(-2e-2, 2e-2), y_range=(-2e-2, 2e-2),
+                       z_range=(-0.2, 0.2), nx=32, ny=40, nz=20)
+
+    # The chamber of the rectangular pipe solvers is defined by the grid
+    with pytest.raises(ValueError):
+        xf.SpaceCharge3D(_context=test_context, length=10.,
+                         solver='FFTSolverRectPipe2p5D', adaptive_grid=True,
+                         **grid_kwargs)
+
+    fmap = xf.TriLinearInterpolatedFieldMap(_context=test_context,
+                                            solver='FFTSolverRectPipe2p5D',
+                                            **grid_kwargs)
+    with pytest.raises(ValueError):
+        fmap.update_transverse_grid(x_center=1e-3)
+
+
+@pytest.mark.parametrize('dtype', ['float64', 'float32'])
+@for_all_test_contexts
+def test_private_grids_deposition(dtype, test_context):
+
+    grid_kwargs = dict(x_range=(-5e-3, 5e-3), y_range=(-1e-2, 1e-2),
+                       z_range=(-0.2, 0.2), nx=32, ny=40, nz=20, dtype=dtype)
+
+    if not isinstance(test_context, xo.ContextCpu):
+        with pytest.raises(ValueError):
+            xf.TriLinearInterpolatedFieldMap(_context=test_context,
+                            deposition='private_grids', **grid_kwargs)
+        return
+
+    contexts = [test_context]
+    if not test_context.openmp_enabled:
+        contexts.append(xo.ContextCpu(omp_num_threads=2))
+
+    for context in contexts:
+        fmap = xf.TriLinearInterpolatedFieldMap(_context=context,
+                            deposition='atomic', **grid_kwargs)
+        fmap_private = xf.TriLinearInterpolatedFieldMap(_context=context,
+                            deposition='private_grids', **grid_kwargs)
+
+        particles = _gaussian_bunch(context)
+        particles.state[:1000] = 0 # lost particles are not deposited
+
+        # Twice to check that the private grids are cleared
+        for _ in range(2):
+            fmap.update_from_particles(particles=particles,
+                                       update_phi=False)
+            fmap_private.update_from_particles(particles=particles,
+                                               update_phi=False)
+        rho = fmap.rho.copy()
+        rtol = 1e-12 if dtype == 'float64' else 1e-5
+        xo.assert_allclose(fmap_private.rho, rho, rtol=0,
+                           atol=rtol * np.max(rho))
+
+        # Deposition from arrays
+        fmap_private.update_from_particles(x_p=particles.x,
+                    y_p=particles.y, z_p=particles.zeta,
+                    ncharges_p=particles.weight, state_p=particles.state,
+                    q0_coulomb=_deposited_qelem(context),
+                    update_phi=False)
+        xo.assert_allclose(fmap_private.rho, rho, rtol=0,
+                           atol=rtol * np.max(rho))
+
+        # Automatic selection
+        fmap_auto = xf.TriLinearInterpolatedFieldMap(_context=context,
+                                                     **grid_kwargs)
+        n_threads = (context.omp_get_max_threads()
+                     if context.openmp_enabled else 1)
+        n_cells = 32 * 40 * 20
+        assert fmap_auto._n_private_grids(100 * n_cells) == (
+                                n_threads if context.openmp_enabled else 0)
+        assert fmap_auto._n_private_grids(n_cells) == 0
+
+
+@for_all_test_contexts(excluding=('ContextPyopencl',))
+def test_sort_particles(test_context):
+
+    sc_kwargs = dict(_context=test_context, length=10., apply_z_kick=True,
+                     x_range=(-5e-3, 5e-3), y_range=(-1e-2, 1e-2),
+                     z_range=(-0.2, 0.2), nx=32, ny=40, nz=20,
+                     solver='FFTSolver2p5D')
+    sc = xf.SpaceCharge3D(**sc_kwargs)
+    sc_sorted = xf.SpaceCharge3D(sort_particles_interval=2, **sc_kwargs)
+    fmap = sc_sorted.fieldmap
+    assert fmap.sort_particles_interval == 2
+    # Stored in the xobject, hence kept by copies
+    assert fmap.copy().sort_particles_interval == 2
+
+    particles = _gaussian_bunch(test_context, n_part=20000)
+    p2np = test_context.nparray_from_context_array
+    state = p2np(particles.state)
+    state[::7] = 0 # some lost particles
+    particles.state[:] = test_context.nparray_to_context_array(state)
+    particles_sorted = particles.copy()
+
+    sc.track(particles)
+    sc_sorted.track(particles_sorted)
+
+    # Active particles first, sorted by cell
+    state = p2np(particles_sorted.state)
+    n_active = int(np.sum(state > 0))
+    assert np.all(state[:n_active] > 0)
+    assert np.all(state[n_active:] <= 0)
+    x0 = p2np(particles.x) # not changed by the kick
+    cell_id = p2np(fmap._cell_index(particles_sorted.x[:n_active],
+                                    particles_sorted.y[:n_active],
+                                    particles_sorted.zeta[:n_active]))
+    assert np.all(np.diff(cell_id) >= 0)
+    assert cell_id[0] < cell_id[-1]
+
+    # Same particles with the same kicks
+    ids = p2np(particles.particle_id)
+    ids_sorted = p2np(particles_sorted.particle_id)
+    assert np.all(np.sort(ids_sorted) == np.sort(ids))
+    order = np.argsort(ids)
+    order_sorted = np.argsort(ids_sorted)
+    xo.assert_allclose(p2np(particles_sorted.x)[order_sorted], x0[order],
+                       rtol=0, atol=0)
+    for nn in ['px', 'py', 'delta', 'state']:
+        ref = p2np(getattr(particles, nn))[order]
+        xo.assert_allclose(p2np(getattr(particles_sorted, nn))[order_sorted],
+                           ref, rtol=0, atol=1e-12 * np.max(np.abs(ref)))
+
+    # Particles in the same cell keep their relative order
+    particles_all = _gaussian_bunch(test_context, n_part=20000, seed=3)
+    cell_id = p2np(fmap._cell_index(particles_all.x, particles_all.y,
+                                    particles_all.zeta))
+    ids = p2np(particles_all.particle_id).copy()
+    fmap.sort_particles(particles_all)
+    assert np.all(p2np(particles_all.particle_id)
+                  == ids[np.argsort(cell_id, kind='stable')])
+
+    # Sorting happens only every sort_particles_interval interactions
+    particles_sorted.x[:] = particles_sorted.x[::-1].copy()
+    x_before = p2np(particles_sorted.x).copy()
+    sc_sorted.track(particles_sorted)
+    xo.assert_allclose(p2np(particles_sorted.x), x_before, rtol=0, atol=0)
+
+    bbpic = xf.BeamBeamPIC3D(_context=test_context, phi=0., alpha=0.,
+                             x_range=(-5e-3, 5e-3), y_range=(-1e-2, 1e-2),
+                             z_range=(-0.2, 0.2), nx=32, ny=40, nz=20,
+                             sort_particles_interval=3)
+    assert bbpic.copy().sort_particles_interval == 3
+
+
+@pytest.mark.parametrize('dtype', ['float64', 'float32'])
+@for_all_test_contexts
+def test_interleaved_dphi(dtype, test_context):
+
+    sc_kwargs = dict(_context=test_context, length=10., apply_z_kick=True,
+                     x_range=(-5e-3, 5e-3), y_range=(-1e-2, 1e-2),
+                     z_range=(-0.2, 0.2), nx=32, ny=40, nz=20,
+                     solver='FFTSolver3D', gamma0=7000., dtype=dtype)
+    sc = xf.SpaceCharge3D(**sc_kwargs)
+    sc_int = xf.SpaceCharge3D(interleaved_dphi=True, **sc_kwargs)
+    fmap, fmap_int = sc.fieldmap, sc_int.fieldmap
+
+    # Only the interleaved array is allocated
+    assert fmap_int.interleaved_dphi
+    assert fmap_int._dphi_dx.size == 0
+    assert fmap_int._dphi_dx_f32.size == 0
+    assert fmap_int.dphi_xyz.shape == (3, 32, 40, 20)
+
+    particles = _gaussian_bunch(test_context)
+    particles_int = particles.copy()
+    sc.track(particles)
+    sc_int.track(particles_int)
+
+    p2np = test_context.nparray_from_context_array
+
+    # Fused gradient against numpy
+    phi = p2np(fmap.phi).astype(np.float64)
+    for ii, (nn, dd) in enumerate([('dphi_dx', fmap.dx), ('dphi_dy', fmap.dy),
+                                   ('dphi_dz', fmap.dz)]):
+        ref = np.gradient(phi, dd, axis=ii)
+        ref = np.moveaxis(ref, ii, 0)
+        ref[0] = 0
+        ref[-1] = 0
+        ref = np.moveaxis(ref, 0, ii)
+        rtol = 1e-12 if dtype == 'float64' else 1e-5
+        xo.assert_allclose(p2np(getattr(fmap, nn)), ref, rtol=0,
+                           atol=rtol * np.max(np.abs(ref)))
+
+        # The separate maps are views of the interleaved array
+        dphi_int = getattr(fmap_int, nn)
+        assert dphi_int.shape == (32, 40, 20)
+        xo.assert_allclose(p2np(dphi_int), p2np(fmap_int.dphi_xyz[ii]),
+                           rtol=0, atol=0)
+        xo.assert_allclose(p2np(dphi_int), p2np(getattr(fmap, nn)),
+                           rtol=0, atol=0)
+
+    for nn in ['px', 'py', 'delta']:
+        xo.assert_allclose(p2np(getattr(particles_int, nn)),
+                           p2np(getattr(particles, nn)), rtol=0, atol=0)
+
+    x, y, z = particles.x, particles.y, particles.zeta
+    values = fmap.get_values_at_points(x, y, z)
+    values_int = fmap_int.get_values_at_points(x, y, z)
+    for vv, vv_int in zip(values, values_int):
+        xo.assert_allclose(p2np(vv_int), p2np(vv), rtol=0, atol=0)
+
+
+@for_all_test_contexts
+def test_tsc_particle_shape(test_context):
+
+    grid_kwargs = dict(x_range=(-5e-3, 5e-3), y_range=(-1e-2, 1e-2),
+                       z_range=(-0.2, 0.2), nx=32, ny=40, nz=20)
+
+    with pytest.raises(ValueError):
+        xf.TriLinearInterpolatedFieldMap(_context=test_context,
+                                         particle_shape='pqs', **grid_kwargs)
+    with pytest.raises(ValueError):
+        xf.TriLinearInterpolatedFieldMap(_context=test_context,
+                solver='FFTSolver2p5DAveraged', separable_phi=True,
+                particle_shape='tsc', **grid_kwargs)
+
+    fmap_cic = xf.TriLinearInterpolatedFieldMap(_context=test_context,
+                                                **grid_kwargs)
+    fmap_tsc = xf.TriLinearInterpolatedFieldMap(_context=test_context,
+                                        particle_shape='tsc', **grid_kwargs)
+    assert fmap_cic.particle_shape == 'cic'
+    assert fmap_tsc.particle_shape == 'tsc'
+
+    p2np = test_context.nparray_from_context_array
+    np2p = test_context.nparray_to_context_array
+    rng = np.random.default_rng(1)
+    dv = fmap_tsc.dx * fmap_tsc.dy * fmap_tsc.dz
+
+    def _deposit(fmap, n_part):
+        x = rng.normal(0, 1e-3, n_part)
+        y = rng.normal(0, 2e-3, n_part)
+        z = rng.normal(0, 5e-2, n_part)
+        fmap.update_from_particles(x_p=np2p(x), y_p=np2p(y), z_p=np2p(z),
+                                   ncharges_p=np2p(np.ones(n_part)),
+                                   q0_coulomb=1., update_phi=False)
+        return x, y, z
+
+    # Charge conservation (particles closer than half a cell to the edges
+    # of the grid are not deposited)
+    x, y, z = _deposit(fmap_tsc, 100000)
+    mask = np.ones(len(x), dtype=bool)
+    for uu, grid, dd in [(x, fmap_tsc.x_grid, fmap_tsc.dx),
+                         (y, fmap_tsc.y_grid, fmap_tsc.dy),
+                         (z, fmap_tsc.z_grid, fmap_tsc.dz)]:
+        ic = np.floor((uu - grid[0]) / dd + 0.5)
+        mask &= (ic >= 1) & (ic <= len(grid) - 2)
+    assert np.sum(~mask) > 0
+    xo.assert_allclose(np.sum(p2np(fmap_tsc.rho)) * dv, np.sum(mask),
+                       rtol=1e-10, atol=0)
+
+    # Private grids give the same charge density
+    if isinstance(test_context, xo.ContextCpu):
+        fmap_private = xf.TriLinearInterpolatedFieldMap(_context=test_context,
+                deposition='private_grids', particle_shape='tsc',
+                **grid_kwargs)
+        fmap_private.update_from_particles(x_p=np2p(x), y_p=np2p(y),
+                z_p=np2p(z), ncharges_p=np2p(np.ones(len(x))),
+                q0_coulomb=1., update_phi=False)
+        rho = p2np(fmap_tsc.rho)
+        xo.assert_allclose(p2np(fmap_private.rho), rho, rtol=0,
+                           atol=1e-12 * np.max(rho))
+
+    # Single precision grids
+    depositions = ['atomic']
+    if isinstance(test_context, xo.ContextCpu):
+        depositions.append('private_grids')
+    rho = p2np(fmap_tsc.rho)
+    for deposition in depositions:
+        fmap_f32 = xf.TriLinearInterpolatedFieldMap(_context=test_context,
+                deposition=deposition, particle_shape='tsc', dtype='float32',
+                **grid_kwargs)
+        fmap_f32.update_from_particles(x_p=np2p(x), y_p=np2p(y),
+                z_p=np2p(z), ncharges_p=np2p(np.ones(len(x))),
+                q0_coulomb=1., update_phi=False)
+        assert fmap_f32.rho.dtype == np.float32
+        xo.assert_allclose(p2np(fmap_f32.rho), rho, rtol=0,
+                           atol=1e-5 * np.max(rho))
+
+    # Lower noise than cloud-in-cell, measured against a deposition with
+    # many more particles
+    noise = {}
+    for fmap in [fmap_cic, fmap_tsc]:
+        _deposit(fmap, 2000000)
+        rho_ref = p2np(fmap.rho).copy()
+        _deposit(fmap, 20000)
+        rho = p2np(fmap.rho) * 100.
+        noise[fmap.particle_shape] = (np.std(rho - rho_ref)
+                                      / np.max(rho_ref))
+    assert noise['tsc'] < 0.85 * noise['cic']
+
+    # The interpolation is exact for linear functions
+    XX, YY, ZZ = np.meshgrid(fmap_tsc.x_grid, fmap_tsc.y_grid,
+                             fmap_tsc.z_grid, indexing='ij')
+    fmap_tsc.update_phi(np2p(3. * XX - 2. * YY + 0.5 * ZZ + 1.))
+    x = rng.uniform(-4e-3, 4e-3, 1000)
+    y = rng.uniform(-8e-3, 8e-3, 1000)
+    z = rng.uniform(-0.15, 0.15, 1000)
+    phi, = fmap_tsc.get_values_at_points(np2p(x), np2p(y), np2p(z),
+                         return_rho=False, return_dphi_dx=False,
+                         return_dphi_dy=False, return_dphi_dz=False)
+    xo.assert_allclose(p2np(phi), 3. * x - 2. * y + 0.5 * z + 1.,
+                       rtol=0, atol=1e-12)
+
+    fmap_f32.update_phi(np2p(3. * XX - 2. * YY + 0.5 * ZZ + 1.))
+    phi, = fmap_f32.get_values_at_points(np2p(x), np2p(y), np2p(z),
+                         return_rho=False, return_dphi_dx=False,
+                         return_dphi_dy=False, return_dphi_dz=False)
+    xo.assert_allclose(p2np(phi), 3. * x - 2. * y + 0.5 * z + 1.,
+                       rtol=0, atol=1e-6)
+
+    # Space charge and beam-beam elements
+    sc_kwargs = dict(_context=test_context, length=10., apply_z_kick=True,
+                     solver='FFTSolver2p5D', **grid_kwargs)
+    sc_cic = xf.SpaceCharge3D(**sc_kwargs)
+    sc_tsc = xf.SpaceCharge3D(particle_shape='tsc', **sc_kwargs)
+    sc_tsc_int = xf.SpaceCharge3D(particle_shape='tsc',
+                                  interleaved_dphi=True, **sc_kwargs)
+    assert sc_tsc.fieldmap.particle_shape == 'tsc'
+
+    particles_cic = _gaussian_bunch(test_context)
+    particles_tsc = particles_cic.copy()
+    particles_tsc_int = particles_cic.copy()
+    sc_cic.track(particles_cic)
+    sc_tsc.track(particles_tsc)
+    sc_tsc_int.track(particles_tsc_int)
+
+    for nn in ['px', 'py', 'delta']:
+        ref = p2np(getattr(particles_cic, nn))
+        vv = p2np(getattr(particles_tsc, nn))
+        assert np.std(vv - ref) < 0.1 * np.std(ref)
+        xo.assert_allclose(p2np(getattr(particles_tsc_int, nn)), vv,
+                           rtol=0, atol=1e-15 * np.max(np.abs(vv)))
+
+    bbpic = xf.BeamBeamPIC3D(_context=test_context, phi=0., alpha=0.,
+                             particle_shape='tsc', **grid_kwargs)
+    assert bbpic.fieldmap_self.particle_shape == 'tsc'
+    assert bbpic.fieldmap_other.particle_shape == 'tsc'
+
+
+@for_all_test_contexts
+def test_fieldmap_to_file(test_context, tmp_path):
+
+    p2np = test_context.nparray_from_context_array
+    np2p = test_context.nparray_to_context_array
+
+    fmap = xf.TriLinearInterpolatedFieldMap(_context=test_context,
+                x_range=(-5e-3, 5e-3), y_range=(-1e-2, 1e-2),
+                z_range=(-0.2, 0.2), nx=32, ny=40, nz=20,
+                solver='FFTSolver2p5D', interleaved_dphi=True)
+    particles = _gaussian_bunch(test_context)
+    fmap.update_from_particles(particles=particles)
+
+    fname = tmp_path / 'fieldmap.bin'
+    fmap.to_file(fname)
+    loaded = xf.TriLinearInterpolatedFieldMap.from_file(fname,
+                                                        _context=test_context)
+
+    if isinstance(test_context, xo.ContextCpu):
+        assert isinstance(loaded._buffer.buffer, np.memmap)
+
+    for nn in ['x_grid', 'y_grid', 'z_grid']:
+        xo.assert_allclose(getattr(loaded, nn), getattr(fmap, nn),
+                           rtol=0, atol=0)
+    for nn in ['rho', 'phi', 'dphi_dx', 'dphi_dy', 'dphi_dz']:
+        xo.assert_allclose(p2np(getattr(loaded, nn)),
+                           p2np(getattr(fmap, nn)), rtol=0, atol=0)
+    assert loaded.interleaved_dphi
+    assert loaded.updatable
+
+    # The solver is regenerated from the stored settings
+    assert isinstance(loaded.solver, xf.solvers.fftsolvers.FFTSolver2p5D)
+    loaded.update_phi_from_rho()
+    xo.assert_allclose(p2np(loaded.phi), p2np(fmap.phi), rtol=0,
+                       atol=1e-12 * np.max(np.abs(p2np(fmap.phi))))
+
+    # The element is allocated in the reserved space of the loaded buffer
+    sc = xf.SpaceCharge3D(_context=test_context, fieldmap=fmap, length=10.,
+                          update_on_track=False)
+    sc_loaded = xf.SpaceCharge3D(_context=test_context, fieldmap=loaded,
+                                 length=10., update_on_track=False)
+    if isinstance(test_context, xo.ContextCpu):
+        assert isinstance(loaded._buffer.buffer, np.memmap)
+    particles_loaded = particles.copy()
+    sc.track(particles)
+    sc_loaded.track(particles_loaded)
+    for nn in ['px', 'py', 'delta']:
+        xo.assert_allclose(p2np(getattr(particles_loaded, nn)),
+                           p2np(getattr(particles, nn)), rtol=0, atol=0)
+
+    # Changes of the loaded map are not written to the file
+    rho = p2np(fmap.rho)
+    loaded.update_rho(np2p(2 * rho))
+    loaded_again = xf.TriLinearInterpolatedFieldMap.from_file(fname,
+                                    _context=test_context, updatable=False)
+    assert not loaded_again.updatable
+    xo.assert_allclose(p2np(loaded_again.rho), rho, rtol=0, atol=0)
+
+    with pytest.raises(ValueError):
+        xf.TriCubicInterpolatedFieldMap.from_file(fname,
+                                                  _context=test_context)
+
+    # Tricubic map
+    tc_fmap = xf.TriCubicInterpolatedFieldMap(_context=test_context,
+                x_range=(-5e-3, 5e-3), y_range=(-1e-2, 1e-2),
+                z_range=(-0.2, 0.2), nx=8, ny=10, nz=6)
+    phi_taylor = np.random.default_rng(2).uniform(size=8 * 10 * 6 * 8)
+    tc_fmap._phi_taylor[:] = np2p(phi_taylor)
+    tc_fname = tmp_path / 'tricubic.bin'
+    tc_fmap.to_file(tc_fname)
+    for mmap_mode in ['c', 'r', None]:
+        tc_loaded = xf.TriCubicInterpolatedFieldMap.from_file(tc_fname,
+                            _context=test_context, mmap_mode=mmap_mode)
+        xo.assert_allclose(p2np(tc_loaded._phi_taylor), phi_taylor,
+                           rtol=0, atol=0)
+        xo.assert_allclose(tc_loaded.z_grid, tc_fmap.z_grid, rtol=0, atol=0)
+
+
+@for_all_test_contexts
+def test_interpolation_plan(test_context):
+
+    p2np = test_context.nparray_from_context_array
+    np2p = test_context.nparray_to_context_array
+
+    solvers = ['FFTSolver2p5D']
+    if not isinstance(test_context, xo.ContextPyopencl):
+        solvers.append('FFTSolver2p5DAveraged')
+
+    rng = np.random.default_rng(3)
+    n_points = 500
+    x = np2p(rng.uniform(-6e-3, 6e-3, n_points))
+    y = np2p(rng.uniform(-1e-2, 1e-2, n_points))
+    z = np2p(rng.uniform(-0.2, 0.2, n_points))
+
+    for solver in solvers:
+        fmap = xf.TriLinearInterpolatedFieldMap(_context=test_context,
+                x_range=(-5e-3, 5e-3), y_range=(-1e-2, 1e-2),
+                z_range=(-0.2, 0.2), nx=32, ny=40, nz=20, solver=solver,
+                separable_phi=(solver == 'FFTSolver2p5DAveraged'))
+        fmap.update_from_particles(particles=_gaussian_bunch(test_context))
+
+        # The quantities are returned in the standard order
+        plan = fmap.plan_interpolation(max_points=1000,
+                                       quantities=['dphi_dy', 'rho', 'phi'])
+        assert plan.quantities == ('rho', 'phi', 'dphi_dy')
+
+        ref = fmap.get_values_at_points(x, y, z, return_dphi_dx=False,
+                                        return_dphi_dz=False)
+        values = plan.evaluate(x, y, z)
+        for vv, rr in zip(values, ref):
+            xo.assert_allclose(p2np(vv), p2np(rr), rtol=0, atol=0)
+
+        # The output buffer of the plan is reused
+        values_half = plan.evaluate(x[:250], y[:250], z[:250])
+        ref_half = fmap.get_values_at_points(x[:250], y[:250], z[:250],
+                            return_dphi_dx=False, return_dphi_dz=False)
+        for vv, rr in zip(values_half, ref_half):
+            xo.assert_allclose(p2np(vv), p2np(rr), rtol=0, atol=0)
+        xo.assert_allclose(p2np(plan._buffer_out[:250]), p2np(ref_half[0]),
+                           rtol=0, atol=0)
+
+        # get_values_at_points allocates its output (also on maps rebuilt
+        # from their xobject)
+        assert len(ref[0]) == n_points
+        ref_copy = fmap.copy().get_values_at_points(x, y, z,
+                            return_dphi_dx=False, return_dphi_dz=False)
+        for vv, rr in zip(ref_copy, ref):
+            xo.assert_allclose(p2np(vv), p2np(rr), rtol=0, atol=0)
+
+        # Preallocated output
+        out = test_context.zeros(shape=(3, n_points), dtype=np.float64)
+        plan.evaluate(x, y, z, out=out)
+        for ii, rr in enumerate(ref):
+            xo.assert_allclose(p2np(out[ii, :]), p2np(rr), rtol=0, atol=0)
+
+        with pytest.raises(ValueError):
+            plan.evaluate(x, y, z, out=out[:2, :])
+        small_plan = fmap.plan_interpolation(max_points=100)
+        with pytest.raises(ValueError):
+            small_plan.evaluate(x, y, z)
+        with pytest.raises(ValueError):
+            fmap.plan_interpolation(max_points=100, quantities=['phi_xy'])
+
+
+@for_all_test_contexts
+def test_accumulate_sources(test_context):
+
+    p2np = test_context.nparray_from_context_array
+
+    grid_kwargs = dict(_context=test_context, x_range=(-5e-3, 5e-3),
+                       y_range=(-1e-2, 1e-2), z_range=(-0.2, 0.2),
+                       nx=32, ny=40, nz=20, solver='FFTSolver2p5D')
+    fmap = xf.TriLinearInterpolatedFieldMap(**grid_kwargs)
+    fmap_batch = xf.TriLinearInterpolatedFieldMap(**grid_kwargs)
+
+    p1 = _gaussian_bunch(test_context, n_part=20000, seed=1)
+    p2 = _gaussian_bunch(test_context, n_part=30000, seed=2)
+    p2.zeta += 0.05
+    p2.weight *= 0.5
+
+    # Sequential accumulation
+    fmap.update_from_particles(particles=p1, update_phi=False)
+    fmap.update_from_particles(particles=p2, reset=False)
+    rho = p2np(fmap.rho)
+    phi = p2np(fmap.phi)
+
+    # Single deposition of both sources
+    fmap_batch.update_from_particles(particles=[p1, p2])
+    xo.assert_allclose(p2np(fmap_batch.rho), rho, rtol=0,
+                       atol=1e-12 * np.max(rho))
+    xo.assert_allclose(p2np(fmap_batch.phi), phi, rtol=0,
+                       atol=1e-12 * np.max(np.abs(phi)))
+
+    # Accumulation of charge density and potential
+    fmap_rho = xf.TriLinearInterpolatedFieldMap(**grid_kwargs)
+    fmap_rho.update_from_particles(particles=p1)
+    rho1 = fmap_rho.rho.copy()
+    phi1 = fmap_rho.phi.copy()
+    fmap_rho.update_from_particles(particles=p2)
+    rho2 = fmap_rho.rho.copy()
+    phi2 = fmap_rho.phi.copy()
+
+    fmap_rho.update_rho(rho1)
+    fmap_rho.update_rho(rho2, reset=False)
+    xo.assert_allclose(p2np(fmap_rho.rho), rho, rtol=0,
+                       atol=1e-12 * np.max(rho))
+
+    fmap_rho.update_phi(phi1)
+    fmap_rho.update_phi(phi2, reset=False)
+    xo.assert_allclose(p2np(fmap_rho.phi), phi, rtol=0,
+                       atol=1e-12 * np.max(np.abs(phi)))
+    for nn in ['dphi_dx', 'dphi_dy', 'dphi_dz']:
+        ref = p2np(getattr(fmap, nn))
+        xo.assert_allclose(p2np(getattr(fmap_rho, nn)), ref, rtol=0,
+                           atol=1e-12 * np.max(np.abs(ref)))
+
+
+@for_all_test_contexts
+def test_deposition_single_species(test_context):
+
+    p2np = test_context.nparray_from_context_array
+
+    grid_kwargs = dict(_context=test_context, x_range=(-5e-3, 5e-3),
+                       y_range=(-1e-2, 1e-2), z_range=(-0.2, 0.2),
+                       nx=32, ny=40, nz=20)
+    depositions = ['atomic']
+    if isinstance(test_context, xo.ContextCpu):
+        depositions.append('private_grids')
+
+    # With charge_ratio equal to one (default) the deposited charge is
+    # weight * q0, as before the charge_ratio weighting
+    particles = _gaussian_bunch(test_context, n_part=20000, seed=1)
+    assert np.all(p2np(particles.charge_ratio) == 1.)
+    qelem = _deposited_qelem(test_context)
+
+    fmap_ref = xf.TriLinearInterpolatedFieldMap(**grid_kwargs)
+    fmap_ref.update_from_particles(x_p=particles.x, y_p=particles.y,
+                                   z_p=particles.zeta,
+                                   ncharges_p=particles.weight,
+                                   q0_coulomb=qelem * particles.q0,
+                                   update_phi=False)
+    rho = p2np(fmap_ref.rho)
+
+    for deposition in depositions:
+        fmap = xf.TriLinearInterpolatedFieldMap(deposition=deposition,
+                                                **grid_kwargs)
+        fmap.update_from_particles(particles=particles, update_phi=False)
+        xo.assert_allclose(p2np(fmap.rho), rho, rtol=0,
+                           atol=1e-12 * np.max(rho))
+
+
+@for_all_test_contexts
+def test_deposition_charge_ratio(test_context):
+
+    p2np = test_context.nparray_from_context_array
+
+    grid_kwargs = dict(_context=test_context, x_range=(-5e-3, 5e-3),
+                       y_range=(-1e-2, 1e-2), z_range=(-0.2, 0.2),
+                       nx=32, ny=40, nz=20)
+    depositions = ['atomic']
+    if isinstance(test_context, xo.ContextCpu):
+        depositions.append('private_grids')
+
+    p1 = _gaussian_bunch(test_context, n_part=20000, seed=1)
+    p2 = _gaussian_bunch(test_context, n_part=30000, seed=2)
+    p2.charge_ratio[:] = 2.
+
+    # Reference from the coordinates (charges in units of q0)
+    qelem = _deposited_qelem(test_context)
+    fmap_ref = xf.TriLinearInterpolatedFieldMap(**grid_kwargs)
+    for pp in [p1, p2]:
+        fmap_ref.update_from_particles(x_p=pp.x, y_p=pp.y, z_p=pp.zeta,
+                          ncharges_p=pp.weight * pp.charge_ratio,
+                          q0_coulomb=qelem * pp.q0, reset=False,
+                          update_phi=False)
+    rho = p2np(fmap_ref.rho)
+
+    for deposition in depositions:
+        fmap = xf.TriLinearInterpolatedFieldMap(deposition=deposition,
+                                                **grid_kwargs)
+        fmap.update_from_particles(particles=[p1, p2], update_phi=False)
+        xo.assert_allclose(p2np(fmap.rho), rho, rtol=0,
+                           atol=1e-12 * np.max(rho))
@@ -4,8 +4,11 @@
 # ########################################### #
 
 import numpy as np
+import pytest
 
 import xfields as xf
+import xobjects as xo
+import xpart as xp
 
 from xobjects.test_helpers import for_all_test_contexts
 
@@ -25,3 +28,92 @@ def test_mean_and_std(test_context):
     mm, ss = xf.mean_and_std(a_dev, weights=weights_dev)
     assert np.isclose(mm, np.mean(a_host))
     assert np.isclose(ss, np.std(a_host))
+
+
+@for_all_test_contexts
+def test_compute_beam_moments(test_context):
+    n_part = 100001
+    rng = np.random.default_rng(seed=12)
+    coords = {
+        'x': 1e-3 + 2e-3 * rng.standard_normal(n_part),
+        'px': 3e-5 * rng.standard_normal(n_part),
+        'y': -2e-3 + 1e-3 * rng.standard_normal(n_part),
+        'py': 1e-5 * rng.standard_normal(n_part),
+        'zeta': 0.1 * rng.standard_normal(n_part),
+        'delta': 1e-4 * rng.standard_normal(n_part),
+    }
+    coords['px'] += 1e-2 * coords['x'] # some correlation
+    weight = rng.uniform(0.5, 1.5, n_part)
+    state = np.ones(n_part, dtype=np.int64)
+    state[::5] = 0
+
+    particles = xp.Particles(_context=test_context, p0c=7e12,
+                             weight=weight, state=state, **coords)
+
+    moments = xf.compute_beam_moments(particles)
+
+    mask = state > 0
+    vv = np.array([coords[cc][mask] for cc in xf.beam_moments.COORDS])
+    ww = weight[mask]
+
+    assert moments.num_macroparticles == mask.sum()
+    xo.assert_allclose(moments.num_particles, ww.sum(), rtol=1e-12, atol=0)
+    mean = np.average(vv, axis=1, weights=ww)
+    cov = np.cov(vv, aweights=ww, bias=True)
+    sigma = np.sqrt(np.diag(cov))
+    # Normalized with the r.m.s. sizes
+    xo.assert_allclose(moments.means / sigma, mean / sigma,
+                       rtol=0, atol=1e-12)
+    xo.assert_allclose(moments.covariance / np.outer(sigma, sigma),
+                       cov / np.outer(sigma, sigma), rtol=0, atol=1e-12)
+    xo.assert_allclose(moments.std('x'), np.sqrt(cov[0, 0]),
+                       rtol=1e-10, atol=0)
+    xo.assert_allclose(moments.cov('x', 'px'), cov[0, 1],
+                       rtol=1e-10, atol=0)
+
+
+@for_all_test_contexts
+def test_ibs_sigmas_from_moments(test_context):
+
+    from xfields.ibs._formulary import (_beam_moments, _sigma_x,
+                                        _sigma_delta, _gemitt_x)
+
+    if isinstance(test_context, xo.ContextPyopencl):
+        particles = xp.Particles(_context=test_context, p0c=7e12, x=[0, 1])
+        moments = xf.compute_beam_moments(particles)
+        # The context is checked also if the moments are provided
+        with pytest.raises(AssertionError):
+            _sigma_x(particles, moments)
+        return
+
+    n_part = 10000
+    rng = np.random.default_rng(seed=5)
+    x = 2e-3 * rng.standard_normal(n_part)
+    delta = 1e-4 * rng.standard_normal(n_part)
+    state = np.ones(n_part, dtype=np.int64)
+    state[::5] = 0
+    mask = state > 0
+
+    # Uniform weights: same as the unweighted standard deviation of the
+    # active particles
+    particles = xp.Particles(_context=test_context, p0c=7e12, x=x,
+                             delta=delta, state=state, weight=2.)
+    xo.assert_allclose(_sigma_x(particles), np.std(x[mask]),
+                       rtol=1e-10, atol=0)
+
+    # Non-uniform weights: the standard deviations are weighted
+    weight = rng.uniform(0.5, 1.5, n_part)
+    particles = xp.Particles(_context=test_context, p0c=7e12, x=x,
+                             delta=delta, state=state, weight=weight)
+    ww = weight[mask]
+    sigma_x = np.sqrt(np.cov(x[mask], aweights=ww, bias=True))
+    sigma_delta = np.sqrt(np.cov(delta[mask], aweights=ww, bias=True))
+    xo.assert_allclose(_sigma_x(particles), sigma_x, rtol=1e-10, atol=0)
+    xo.assert_allclose(_sigma_delta(particles), sigma_delta,
+                       rtol=1e-10, atol=0)
+
+    # The same values are obtained from precomputed moments
+    moments = _beam_moments(particles)
+    xo.assert_allclose(_gemitt_x(particles, 10., 2., moments),
+                       (sigma_x**2 - (2. * sigma_delta)**2) / 10.,
+                       rtol=1e-9, atol=0)
@@ -316,3 +316,236 @@ def test_spacecharge_pic_zkick(test_context):
     xo.assert_allclose(p_test_pic.pzeta - p_zero_pic.pzeta, p_test_frozen.pzeta,
                     rtol=0, atol=float(0.1*np.max(np.abs(p_test_frozen.pzeta))))
     xo.assert_allclose(p_test_frozen.pzeta.max(), 1.3e-13, rtol=0.1, atol=0)
+
+
+@for_all_test_contexts
+def test_spacecharge_shared_beam_statistics(test_context):
+    n_part = 10000
+    n_elements = 6
+    p0c = 25.92e9
+
+    rng = np.random.default_rng(seed=42)
+    particles = xp.Particles(_context=test_context, p0c=p0c,
+                             x=1e-3 + 3e-3 * rng.standard_normal(n_part),
+                             y=-2e-3 + 2e-3 * rng.standard_normal(n_part),
+                             zeta=0.3 * rng.standard_normal(n_part),
+                             weight=1e7)
+
+    lprofile = xf.LongitudinalProfileQGaussian(
+            _context=test_context,
+            number_of_particles=1e11,
+            sigma_z=0.3,
+            z0=0.,
+            q_parameter=1.)
+
+    stats = xf.SpaceChargeBeamStatistics(update_every=3, tolerance=0.1)
+    elements = [xf.SpaceChargeBiGaussian(_context=test_context,
+                                         update_on_track=True,
+                                         length=0.,
+                                         longitudinal_profile=lprofile,
+                                         beam_statistics=stats)
+                for _ in range(n_elements)]
+
+    x0 = test_context.nparray_from_context_array(particles.x).copy()
+    y0 = test_context.nparray_from_context_array(particles.y).copy()
+
+    # Different beam sizes at the different elements (the beam is rescaled
+    # between the elements and brought back at the end of the turn)
+    scales = 1. + 0.2 * np.arange(n_elements)
+
+    def set_coordinates(scale, shift=0.):
+        particles.x[:] = test_context.nparray_to_context_array(
+                                                    scale * x0 + shift)
+        particles.y[:] = test_context.nparray_to_context_array(scale * y0)
+
+    def check(ee, scale, shift=0.):
+        xo.assert_allclose(ee.mean_x, scale * np.mean(x0) + shift,
+                           rtol=1e-12, atol=0)
+        xo.assert_allclose(ee.sigma_x, scale * np.std(x0),
+                           rtol=1e-12, atol=0)
+        xo.assert_allclose(ee.mean_y, scale * np.mean(y0),
+                           rtol=1e-12, atol=0)
+        xo.assert_allclose(ee.sigma_y, scale * np.std(y0),
+                           rtol=1e-12, atol=0)
+
+    # Each element uses the statistics measured at its own location, which
+    # are recomputed every three turns and served from the cache otherwise
+    for i_turn in range(4):
+        for ee, scale in zip(elements, scales):
+            set_coordinates(scale)
+            ee.track(particles)
+            check(ee, scale)
+        assert stats.n_updates == (i_turn // 3 + 1) * n_elements
+
+    # Change of the beam at one element, larger than the tolerance
+    set_coordinates(scales[1], shift=1e-3)
+    elements[1].track(particles)
+    check(elements[1], scales[1], shift=1e-3)
+    assert stats.n_updates == 2 * n_elements + 1
+
+    # Particles moved within an unchanged distribution (as for a betatron
+    # rotation): the moments do not change and the cached values are used
+    x0 = np.roll(x0, n_part // 2)
+    y0 = np.roll(y0, n_part // 2)
+    set_coordinates(scales[2])
+    elements[2].track(particles)
+    check(elements[2], scales[2])
+    assert stats.n_updates == 2 * n_elements + 1
+
+    # Line-wide cadence: statistics shared by the elements, recomputed every
+    # four element passages
+    stats = xf.SpaceChargeBeamStatistics(update_every_elements=4)
+    for ee in elements:
+        ee.beam_statistics = stats
+    set_coordinates(1.)
+    for i_turn in range(2):
+        for ee in elements:
+            ee.track(particles)
+            check(ee, 1.)
+    assert stats.n_updates == 3
+
+    # The values of the last update are used by the following elements
+    set_coordinates(2.)
+    elements[0].track(particles)
+    check(elements[0], 2.)
+    set_coordinates(1.)
+    elements[1].track(particles)
+    check(elements[1], 2.)
+    assert stats.n_updates == 4
+
+    # Line-wide cadence with tolerance
+    stats = xf.SpaceChargeBeamStatistics(update_every_elements=100,
+                                         tolerance=0.1)
+    for ee in elements:
+        ee.beam_statistics = stats
+    set_coordinates(2.)
+    for ee in elements:
+        ee.track(particles)
+        check(ee, 2.)
+    assert stats.n_updates == 1
+    set_coordinates(2., shift=1e-3)
+    elements[0].track(particles)
+    check(elements[0], 2., shift=1e-3)
+    assert stats.n_updates == 2
+
+    with pytest.raises(ValueError):
+        xf.SpaceChargeBeamStatistics(update_every=2, update_every_elements=4)
+
+
+@for_all_test_contexts
+def test_spacecharge_shared_longitudinal_profile(test_context):
+    n_part = 1000
+    n_elements = 5
+    p0c = 25.92e9
+
+    rng = np.random.default_rng(seed=3)
+    particles = xp.Particles(_context=test_context, p0c=p0c,
+                             x=3e-3 * rng.standard_normal(n_part),
+                             y=2e-3 * rng.standard_normal(n_part),
+                             zeta=0.3 * rng.standard_normal(n_part),
+                             weight=1e8)
+
+    lprofile = xf.LongitudinalProfileQGaussian(
+            number_of_particles=1e11, sigma_z=0.3, q_parameter=1.)
+
+    buffer = test_context.new_buffer()
+    elements = [xf.SpaceChargeBiGaussian(_buffer=buffer,
+                                         length=10.,
+                                         longitudinal_profile=lprofile,
+                                         sigma_x=3e-3,
+                                         sigma_y=2e-3)
+                for _ in range(n_elements)]
+    shared = xf.SharedLongitudinalProfile(profile=lprofile,
+                                          elements=elements)
+
+    def shared_offsets(elements):
+        return {ee._xobject._shared_profile._offset for ee in elements}
+
+    # The elements reference a single profile
+    assert len(shared_offsets(elements)) == 1
+
+    def check_tracking(elements, number_of_particles, sigma_z, q_parameter):
+        el_ref = xf.SpaceChargeBiGaussian(
+                _context=test_context,
+                length=10.,
+                longitudinal_profile=xf.LongitudinalProfileQGaussian(
+                    number_of_particles=number_of_particles,
+                    sigma_z=sigma_z, q_parameter=q_parameter),
+                sigma_x=3e-3,
+                sigma_y=2e-3)
+        p_ref = particles.copy()
+        el_ref.track(p_ref)
+        for ee in elements:
+            pp = particles.copy()
+            ee.track(pp)
+            xo.assert_allclose(pp.px, p_ref.px, rtol=0, atol=0)
+            xo.assert_allclose(pp.py, p_ref.py, rtol=0, atol=0)
+
+    shared.update(number_of_particles=2e11, sigma_z=0.2, q_parameter=1.2)
+    check_tracking(elements, 2e11, 0.2, 1.2)
+
+    # A quasi-frozen element updates the shared profile
+    elements[0].update_mean_x_on_track = True
+    elements[0].track(particles.copy())
+    assert shared.profile.number_of_particles == n_part * 1e8
+    check_tracking(elements[1:], n_part * 1e8, 0.2, 1.2)
+    elements[0].update_mean_x_on_track = False
+    elements[0].mean_x = 0.
+
+    # Intensity and bunch length from the particles
+    shared.update(number_of_particles=2e11)
+    shared.update_from_particles(particles)
+    zeta = test_context.nparray_from_context_array(particles.zeta)
+    xo.assert_allclose(shared.profile.number_of_particles, n_part * 1e8,
+                       rtol=1e-12, atol=0)
+    xo.assert_allclose(shared.profile.sigma_z, np.std(zeta),
+                       rtol=1e-12, atol=0)
+    check_tracking(elements, n_part * 1e8, shared.profile.sigma_z, 1.2)
+
+    # Copies (and dictionaries) hold the shared parameters in their own
+    # profile
+    el_copy = elements[1].copy()
+    assert el_copy.shared_longitudinal_profile is None
+    assert el_copy._use_shared_profile == 0
+    assert el_copy.longitudinal_profile.number_of_particles == n_part * 1e8
+    assert el_copy.longitudinal_profile.q_parameter == 1.2
+    assert el_copy.longitudinal_profile.sigma_z == shared.profile.sigma_z
+    dct = elements[1].to_dict()
+    assert dct['number_of_particles'] == n_part * 1e8
+    el_dict = xf.SpaceChargeBiGaussian.from_dict(dct, _context=test_context)
+    check_tracking([el_dict], n_part * 1e8,
+                   shared.profile.sigma_z, 1.2)
+    assert elements[1]._use_shared_profile == 1
+
+    # The reference is restored when the elements are moved
+    new_buffer = test_context.new_buffer()
+    for ee in elements:
+        ee.move(_buffer=new_buffer)
+    assert len(shared_offsets(elements)) == 1
+    assert elements[0]._xobject._shared_profile._buffer is new_buffer
+    assert len(shared._buffer_profiles) == 1
+    shared.update(number_of_particles=3e11, sigma_z=0.25)
+    check_tracking(elements, 3e11, 0.25, 1.2)
+
+
+def test_pic_collection_green_function_cache():
+
+    from xfields.config_tools.spacecharge_config_tools import PICCollection
+    from xfields.solvers import GreenFunctionCache
+
+    cache = GreenFunctionCache()
+    collection_kwargs = dict(nx_grid=16, ny_grid=16, nz_grid=10,
+                             x_lim_min=1e-3, x_lim_max=4e-3, n_lims_x=4,
+                             y_lim_min=1e-3, y_lim_max=4e-3, n_lims_y=4,
+                             z_range=(-0.3, 0.3),
+                             green_function_cache=cache)
+
+    pics = PICCollection(**collection_kwargs)
+    pics.get_pic(2e-3, 3e-3)
+    assert (cache.hits, cache.misses) == (0, 1)
+
+    # The PICs of a new collection (e.g. the setup of another line with the
+    # same grids) reuse the cached Green functions
+    pics_again = PICCollection(**collection_kwargs)
+    pics_again.get_pic(2e-3, 3e-3)
+    assert (cache.hits, cache.misses) == (1, 1)
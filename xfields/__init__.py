@@ -10,13 +10,19 @@ from .ibs import IBSAnalyticalKick, IBSKineticKick
 
 from .fieldmaps import TriLinearInterpolatedFieldMap
 from .fieldmaps import TriCubicInterpolatedFieldMap
+from .fieldmaps import BiCubicInterpolatedFieldMap
+from .fieldmaps import WindowedTriCubicInterpolatedFieldMap
 from .fieldmaps import BiGaussianFieldMap, mean_and_std
 
 from .slicers import UniformBinSlicer
 
+from .beam_moments import BeamMoments, compute_beam_moments
+
 from .solvers.fftsolvers import FFTSolver3D
 
 from .beam_elements.spacecharge import SpaceCharge3D, SpaceChargeBiGaussian
+from .beam_elements.spacecharge import SpaceChargeBeamStatistics
+from .beam_elements.spacecharge import SharedLongitudinalProfile
 from .beam_elements.beambeam2d import BeamBeamBiGaussian2D
 from .beam_elements.beambeam2d import ConfigForUpdateBeamBeamBiGaussian2D
 from .beam_elements.beambeam3d import BeamBeamBiGaussian3D
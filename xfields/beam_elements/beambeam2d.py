@@ -9,6 +9,7 @@ import xobjects as xo
 import xtrack as xt
 
 from ..general import _pkg_root
+from ..beam_moments import compute_beam_moments
 
 class BeamBeamBiGaussian2D(xt.BeamElement):
 
@@ -277,16 +278,20 @@ class BeamBeamBiGaussian2D(xt.BeamElement):
         return None
 
     def compute_spacial_moments(self,particles):
-        nplike_lib = self._buffer.context.nplike_lib
+        """
+        Returns the number of particles (sum of the weights), the weighted
+        means of x and y and the weighted covariances xx, xy, yy of the
+        active particles. Lost particles are excluded, while they used to
+        be included in these moments.
+        """
+        beam_moments = compute_beam_moments(particles)
         moments = np.zeros((1+2+3), dtype=float)
-        moments[0] = nplike_lib.sum(particles.weight)
-        moments[1] = nplike_lib.sum(particles.x*particles.weight) / moments[0]
-        moments[2] = nplike_lib.sum(particles.y*particles.weight) / moments[0]
-        x_diff = particles.x-moments[1]
-        y_diff = particles.y-moments[2]
-        moments[3] = nplike_lib.sum(x_diff**2*particles.weight) / moments[0]
-        moments[4] = nplike_lib.sum(x_diff*y_diff*particles.weight) / moments[0]
-        moments[5] = nplike_lib.sum(y_diff**2*particles.weight) / moments[0]
+        moments[0] = beam_moments.num_particles
+        moments[1] = beam_moments.mean('x')
+        moments[2] = beam_moments.mean('y')
+        moments[3] = beam_moments.cov('x', 'x')
+        moments[4] = beam_moments.cov('x', 'y')
+        moments[5] = beam_moments.cov('y', 'y')
         return moments
 
     def update_from_received_moments(self):
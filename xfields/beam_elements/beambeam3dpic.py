@@ -49,6 +49,10 @@ class BeamBeamPIC3D(xt.BeamElement):
         'fieldmap_self': TriLinearInterpolatedFieldMap,
         'fieldmap_other': TriLinearInterpolatedFieldMap,
 
+        # Particles are reordered by cell of fieldmap_self every
+        # sort_particles_interval interactions (0 for no sorting)
+        'sort_particles_interval': xo.Int64,
+
     }
     iscollective = True
 
@@ -90,8 +94,13 @@ class BeamBeamPIC3D(xt.BeamElement):
                  dx=None, dy=None, dz=None,
                  x_grid=None, y_grid=None, z_grid=None,
                  _context=None, _buffer=None,
+                 sort_particles_interval=0,
+                 particle_shape='cic',
                  **kwargs):
 
+        self._n_interactions = 0
+        self._gather_plan = None
+
         if '_xobject' in kwargs.keys():
             self.xoinitialize(**kwargs)
             return
@@ -107,7 +116,8 @@ class BeamBeamPIC3D(xt.BeamElement):
             x_range=x_range, y_range=y_range, z_range=z_range,
             dx=dx, dy=dy, dz=dz,
             nx=nx, ny=ny, nz=nz,
-            scale_coordinates_in_solver=(1,1,1))
+            scale_coordinates_in_solver=(1,1,1),
+            particle_shape=particle_shape)
 
         fieldmap_other = TriLinearInterpolatedFieldMap(
             _buffer=_buffer,
@@ -116,11 +126,13 @@ class BeamBeamPIC3D(xt.BeamElement):
             dx=dx, dy=dy, dz=dz,
             nx=nx, ny=ny, nz=nz,
             solver='FFTSolver2p5D',
-            scale_coordinates_in_solver=(1,1,1))
+            scale_coordinates_in_solver=(1,1,1),
+            particle_shape=particle_shape)
 
         self.xoinitialize(_buffer=_buffer,
                           fieldmap_self=fieldmap_self,
                           fieldmap_other=fieldmap_other,
+                          sort_particles_interval=sort_particles_interval,
                           **kwargs)
 
         _init_alpha_phi(self, phi=phi, alpha=alpha,
@@ -144,6 +156,12 @@ class BeamBeamPIC3D(xt.BeamElement):
             # Move particles to computation reference frame
             self.change_ref_frame_bbpic(pp)
 
+            if (self.sort_particles_interval
+                    and self._n_interactions % self.sort_particles_interval == 0):
+                self.fieldmap_self.sort_particles(pp)
+                mask_alive = pp.state > 0
+            self._n_interactions += 1
+
             self._i_step = 0
             self._z_steps_self = self.fieldmap_self.z_grid[::-1].copy() # earlier time first
             self._z_steps_other = self.fieldmap_other.z_grid[::-1].copy() # earlier time first
@@ -212,15 +230,15 @@ class BeamBeamPIC3D(xt.BeamElement):
         x_other = -pp.x[mask_alive]
         y_other = pp.y[mask_alive]
 
-        # Get fields in the reference system of the other beam
-        dphi_dx, dphi_dy, dphi_dz = self.fieldmap_other.get_values_at_points(
-            x=x_other, y=y_other, z=z_other,
-            return_rho=False,
-            return_phi=False,
-            return_dphi_dx=True,
-            return_dphi_dy=True,
-            return_dphi_dz=True,
-        )
+        # Get fields in the reference system of the other beam (the plan
+        # reuses the same output buffer at all steps)
+        if (self._gather_plan is None
+                or self._gather_plan.max_points < len(x_other)):
+            self._gather_plan = self.fieldmap_other.plan_interpolation(
+                max_points=pp._capacity,
+                quantities=('dphi_dx', 'dphi_dy', 'dphi_dz'))
+        dphi_dx, dphi_dy, dphi_dz = self._gather_plan.evaluate(
+            x=x_other, y=y_other, z=z_other)
 
         # Transform fields to self reference frame (dphi_dy is unchanged)
         dphi_dx *= -1
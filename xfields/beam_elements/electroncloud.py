@@ -4,6 +4,7 @@
 # ########################################### #
 
 from ..fieldmaps import TriCubicInterpolatedFieldMap
+from ..fieldmaps import WindowedTriCubicInterpolatedFieldMap
 from ..general import _pkg_root
 
 import xobjects as xo
@@ -41,7 +42,16 @@ class ElectronCloud(xt.BeamElement):
         apply_z_kick (bool): If ``True``, the longitudinal kick on the
             particles is applied. The default is ``True``.
         fieldmap (xfields.TriCubicInterpolatedFieldMap): Field map of the 
-            electron cloud forces.
+            electron cloud forces. If a
+            ``WindowedTriCubicInterpolatedFieldMap`` is given, the element
+            is collective and the window of the map is moved to cover the
+            bunch before each interaction.
+        next_tau_shift (float): ``tau_shift`` of the next element using the
+            same windowed field map. If given, after each interaction the
+            window needed by the next one is read in the background (see
+            ``WindowedTriCubicInterpolatedFieldMap.prefetch_window``).
+            Otherwise the window is read when the next element is tracked,
+            unless it is prefetched by the user. The default is ``None``.
     Returns:
         (ElectronCloud): An electron cloud beam element.
     """
@@ -78,10 +88,12 @@ class ElectronCloud(xt.BeamElement):
                  length=None,
                  apply_z_kick=True,
                  fieldmap=None,
+                 next_tau_shift=None,
                  ):
 
         # To be implemented if false
         self.apply_z_kick = apply_z_kick
+        self.next_tau_shift = next_tau_shift
         if self.apply_z_kick is False:
             raise NotImplementedError
 
@@ -104,3 +116,23 @@ class ElectronCloud(xt.BeamElement):
                  dipolar_ptau_kick=dipolar_ptau_kick,
                  length=length,
                  fieldmap=fieldmap)
+
+    @property
+    def iscollective(self):
+        return isinstance(self.fieldmap, WindowedTriCubicInterpolatedFieldMap)
+
+    def track(self, particles):
+
+        windowed = isinstance(self.fieldmap,
+                              WindowedTriCubicInterpolatedFieldMap)
+        if windowed:
+            self.fieldmap.update_window_from_particles(
+                    particles, tau_shift=self.tau_shift)
+
+        super().track(particles)
+
+        if windowed and self.next_tau_shift is not None:
+            # Read the window of the next interaction while the particles
+            # are tracked up to it
+            self.fieldmap.prefetch_window_from_particles(
+                    particles, tau_shift=self.next_tau_shift)
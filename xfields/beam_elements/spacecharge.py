@@ -5,9 +5,10 @@
 
 import numpy as np
 
-from xfields import BiGaussianFieldMap, mean_and_std
+from xfields import BiGaussianFieldMap
 from xfields import TriLinearInterpolatedFieldMap
 from ..longitudinal_profiles import LongitudinalProfileQGaussian
+from ..beam_moments import compute_beam_moments
 from ..fieldmaps import BiGaussianFieldMap
 from ..general import _pkg_root
 
@@ -61,12 +62,64 @@ class SpaceCharge3D(xt.BeamElement):
             Volts. If not provided the ``phi`` is calculated from ``rho``
             using the Poisson solver (if available).
         solver (str or solver object): Defines the Poisson solver to be used
-            to compute phi from rho. Accepted values are ``FFTSolver3D`` and
-            ``FFTSolver2p5D``. A Xfields solver object can also be provided.
+            to compute phi from rho. Accepted values are ``FFTSolver3D``,
+            ``FFTSolver2p5D``, ``FFTSolver2p5DAveraged`` (open boundaries),
+            ``FFTSolverRectPipe3D`` and ``FFTSolverRectPipe2p5D`` (grounded
+            rectangular chamber located half a cell outside the grid).
+            A Xfields solver object can also be provided.
             In case ``update_on_track``is ``False`` and ``phi`` is provided
             by the user, this argument can be omitted.
+        solver_kwargs (dict): Additional keyword arguments passed to the
+            solver constructor when ``solver`` is given by name
+            (e.g. ``{'use_rfft': True}``).
         gamma0 (float): Relativistic gamma factor of the beam. This is required
-            only if the solver is ``FFTSolver3D``.
+            only if the solver is ``FFTSolver3D`` or ``FFTSolverRectPipe3D``.
+        separable_phi (bool): If ``True`` the potential is stored in the
+            separable form ``phi_xy(x, y) * lambda_z(z)`` (see
+            ``TriLinearInterpolatedFieldMap``). It requires the solver
+            ``FFTSolver2p5DAveraged``. The default is ``False``.
+        dtype (str or np.dtype): Floating point type of the field maps and
+            of the solver (``'float64'`` or ``'float32'``). The kicks are
+            always computed in double precision. The default is
+            ``'float64'``.
+        interleaved_dphi (bool): If ``True`` the derivatives of the
+            potential are stored interleaved, so that the kick computation
+            reads the three of them together for each grid point (see
+            ``TriLinearInterpolatedFieldMap``). The default is ``False``.
+        adaptive_grid (bool): If ``True`` the transverse grid follows the
+            beam: every ``adaptive_grid_interval`` interactions it is
+            centered on the beam centroid and its cell sizes are adjusted
+            so that the grid covers ``adaptive_grid_n_sigmas`` r.m.s. beam
+            sizes on each side. The number of cells is not changed. The cell
+            sizes are chosen from a geometric sequence with ratio
+            ``adaptive_grid_cell_size_step`` starting from the initial ones,
+            so that the solvers can be reused. Unless a
+            ``green_function_cache`` is given in ``solver_kwargs``, the
+            solvers use the cache shared by the package
+            (``xfields.solvers.default_green_function_cache``), so that the
+            Green functions of the cell sizes already used are not
+            recomputed. It requires ``update_on_track`` and a solver given
+            by name, and it is not available with the rectangular pipe
+            solvers (the chamber would follow the beam). The default is
+            ``False``.
+        adaptive_grid_n_sigmas (float or tuple): Number of r.m.s. beam sizes
+            covered by the adaptive grid on each side of the centroid
+            (horizontal, vertical). The default is ``(5., 5.)``.
+        adaptive_grid_interval (int): Number of interactions between two
+            updates of the adaptive grid. The default is ``1``.
+        adaptive_grid_cell_size_step (float): Ratio between consecutive
+            cell sizes allowed for the adaptive grid. The default is
+            ``2**0.25``.
+        sort_particles_interval (int): If larger than zero, the particles are
+            reordered in memory by grid cell every ``sort_particles_interval``
+            interactions (see ``TriLinearInterpolatedFieldMap.sort_particles``)
+            to speed up the deposition and the interpolation. If ``None``
+            (default) the setting of the field map is used (no sorting for
+            a new field map).
+        particle_shape (str): Shape function of the macroparticles used for
+            the charge deposition and for the kicks, ``'cic'`` (default,
+            cloud-in-cell) or ``'tsc'`` (triangular-shaped-cloud, lower
+            noise). See ``TriLinearInterpolatedFieldMap``.
     Returns:
         (SpaceCharge3D): A space-charge 3D beam element.
     """
@@ -79,6 +132,7 @@ class SpaceCharge3D(xt.BeamElement):
     _extra_c_sources = [
         _pkg_root.joinpath('headers/constants.h'),
         _pkg_root.joinpath('headers','particle_states.h'),
+        _pkg_root.joinpath('fieldmaps/interpolated_src/tsc_weights.h'),
         _pkg_root.joinpath('fieldmaps/interpolated_src/linear_interpolators.h'),
         _pkg_root.joinpath('beam_elements/spacecharge_src/spacecharge3d.h'),
     ]
@@ -86,12 +140,18 @@ class SpaceCharge3D(xt.BeamElement):
     def copy(self, _context=None, _buffer=None, _offset=None):
         if _buffer is not self._buffer:
             raise NotImplementedError
-        return SpaceCharge3D(_context=_context,
+        new = SpaceCharge3D(_context=_context,
                 _buffer=_buffer, _offset=_offset,
                 update_on_track=self.update_on_track,
                 length=self.length,
                 apply_z_kick=self.apply_z_kick,
-                fieldmap=self.fieldmap)
+                fieldmap=self.fieldmap,
+                adaptive_grid=self.adaptive_grid,
+                adaptive_grid_n_sigmas=self.adaptive_grid_n_sigmas,
+                adaptive_grid_interval=self.adaptive_grid_interval,
+                adaptive_grid_cell_size_step=self.adaptive_grid_cell_size_step)
+        new._adaptive_grid_ref_cell_size = self._adaptive_grid_ref_cell_size
+        return new
 
     def __init__(self,
                  _context=None,
@@ -107,13 +167,47 @@ class SpaceCharge3D(xt.BeamElement):
                  x_grid=None, y_grid=None, z_grid=None,
                  rho=None, phi=None,
                  solver=None,
+                 solver_kwargs=None,
                  gamma0=None,
-                 fftplan=None):
+                 fftplan=None,
+                 separable_phi=False,
+                 dtype='float64',
+                 interleaved_dphi=False,
+                 adaptive_grid=False,
+                 adaptive_grid_n_sigmas=(5., 5.),
+                 adaptive_grid_interval=1,
+                 adaptive_grid_cell_size_step=2**0.25,
+                 sort_particles_interval=None,
+                 particle_shape='cic'):
 
         self.update_on_track = update_on_track
 
-        if solver=='FFTSolver3D':
-            assert gamma0 is not None, ('To use FFTSolver3D '
+        if adaptive_grid:
+            assert update_on_track, ('`adaptive_grid` requires '
+                                     '`update_on_track`')
+            if solver in ('FFTSolverRectPipe3D', 'FFTSolverRectPipe2p5D'):
+                raise ValueError('`adaptive_grid` is not available with '
+                                 f'{solver}, as the chamber is defined by '
+                                 'the grid')
+            if isinstance(solver, str):
+                # The solvers generated for the new cell sizes share the
+                # Green functions through the cache
+                solver_kwargs = dict(solver_kwargs or {})
+                solver_kwargs.setdefault('green_function_cache', True)
+        if np.isscalar(adaptive_grid_n_sigmas):
+            adaptive_grid_n_sigmas = (adaptive_grid_n_sigmas,
+                                      adaptive_grid_n_sigmas)
+        if adaptive_grid_cell_size_step <= 1:
+            raise ValueError('`adaptive_grid_cell_size_step` must be larger '
+                             'than one')
+        self.adaptive_grid = adaptive_grid
+        self.adaptive_grid_n_sigmas = tuple(adaptive_grid_n_sigmas)
+        self.adaptive_grid_interval = adaptive_grid_interval
+        self.adaptive_grid_cell_size_step = adaptive_grid_cell_size_step
+        self._adaptive_grid_counter = 0
+
+        if solver in ('FFTSolver3D', 'FFTSolverRectPipe3D'):
+            assert gamma0 is not None, (f'To use {solver} '
                                         'gamma0 must be provided')
 
         if gamma0 is not None:
@@ -148,9 +242,17 @@ class SpaceCharge3D(xt.BeamElement):
                         dx=dx, dy=dy, dz=dz,
                         nx=nx, ny=ny, nz=nz,
                         solver=solver,
+                        solver_kwargs=solver_kwargs,
                         scale_coordinates_in_solver=scale_coordinates_in_solver,
                         updatable=update_on_track,
-                        fftplan=fftplan)
+                        fftplan=fftplan,
+                        separable_phi=separable_phi,
+                        dtype=dtype,
+                        interleaved_dphi=interleaved_dphi,
+                        sort_particles_interval=sort_particles_interval or 0,
+                        particle_shape=particle_shape)
+        elif sort_particles_interval is not None:
+            fieldmap.sort_particles_interval = sort_particles_interval
 
         self.xoinitialize(
                  _buffer=_buffer,
@@ -160,10 +262,44 @@ class SpaceCharge3D(xt.BeamElement):
 
         self.apply_z_kick = apply_z_kick
 
+        # The adaptive cell sizes are multiples of the initial ones by powers
+        # of adaptive_grid_cell_size_step
+        self._adaptive_grid_ref_cell_size = (fieldmap._dx, fieldmap._dy)
+
     @property
     def iscollective(self):
         return self.update_on_track
 
+    @property
+    def sort_particles_interval(self):
+        return self.fieldmap.sort_particles_interval
+
+    @sort_particles_interval.setter
+    def sort_particles_interval(self, value):
+        self.fieldmap.sort_particles_interval = value
+
+    def _update_adaptive_grid(self, particles):
+
+        moments = compute_beam_moments(particles)
+        mean_x, sigma_x = moments.mean('x'), moments.std('x')
+        mean_y, sigma_y = moments.mean('y'), moments.std('y')
+
+        if not (sigma_x > 0 and sigma_y > 0):
+            return # No beam to follow
+
+        fmap = self.fieldmap
+        n_sigmas_x, n_sigmas_y = self.adaptive_grid_n_sigmas
+        dx_ref, dy_ref = self._adaptive_grid_ref_cell_size
+        step = self.adaptive_grid_cell_size_step
+
+        dx = _quantized_cell_size(2 * n_sigmas_x * sigma_x / (fmap.nx - 1),
+                                  dx_ref, step, fmap._dx)
+        dy = _quantized_cell_size(2 * n_sigmas_y * sigma_y / (fmap.ny - 1),
+                                  dy_ref, step, fmap._dy)
+
+        fmap.update_transverse_grid(x_center=mean_x, y_center=mean_y,
+                                    dx=dx, dy=dy)
+
 
     def track(self, particles):
 
@@ -176,12 +312,27 @@ class SpaceCharge3D(xt.BeamElement):
         """
 
         if self.update_on_track:
+            if self.adaptive_grid:
+                if self._adaptive_grid_counter % self.adaptive_grid_interval == 0:
+                    self._update_adaptive_grid(particles)
+                self._adaptive_grid_counter += 1
             self.fieldmap.update_from_particles(
                 particles=particles)
 
         # call C tracking kernel
         super().track(particles)
 
+def _quantized_cell_size(d_needed, d_ref, step, d_current):
+
+    # The current cell size is kept if the grid is large enough and the cell
+    # is not more than two steps larger than needed, to avoid switching back
+    # and forth between two sizes
+    if d_needed <= d_current <= d_needed * step**2:
+        return d_current
+
+    kk = int(np.ceil(np.log(d_needed / d_ref) / np.log(step)))
+    return d_ref * step**kk
+
 class SpaceChargeBiGaussian(xt.BeamElement):
 
     _xofields = {
@@ -189,12 +340,22 @@ class SpaceChargeBiGaussian(xt.BeamElement):
         'fieldmap': BiGaussianFieldMap,
         'length': xo.Float64,
         'z_kick_num_integ_per_sigma': xo.Int64,
+        # Profile shared by reference with other elements, used instead of
+        # longitudinal_profile if _use_shared_profile is set (see
+        # SharedLongitudinalProfile)
+        '_shared_profile': xo.Ref(LongitudinalProfileQGaussian),
+        '_use_shared_profile': xo.Int64,
         }
 
     rename = {
         'z_kick_num_integ_per_sigma': '_z_kick_num_integ_per_sigma',
     }
 
+    _skip_in_to_dict = ['_shared_profile', '_use_shared_profile']
+
+    # The reference to the shared profile is restored after a move
+    _force_moveable = True
+
     _extra_c_sources = [
         _pkg_root.joinpath('headers/constants.h'),
         _pkg_root.joinpath('headers/sincos.h'),
@@ -209,8 +370,12 @@ class SpaceChargeBiGaussian(xt.BeamElement):
     def to_dict(self):
         dct = super().to_dict()
         # To be loaded by ducktrack:
-        dct['number_of_particles'] = self.longitudinal_profile.number_of_particles
-        dct['bunchlength_rms'] = self.longitudinal_profile.sigma_z
+        if self.shared_longitudinal_profile is not None:
+            profile = self.shared_longitudinal_profile.profile
+        else:
+            profile = self.longitudinal_profile
+        dct['number_of_particles'] = profile.number_of_particles
+        dct['bunchlength_rms'] = profile.sigma_z
         dct['sigma_x'] = self.fieldmap.sigma_x
         dct['sigma_y'] = self.fieldmap.sigma_y
         dct['x_co'] = self.fieldmap.mean_x
@@ -232,6 +397,7 @@ class SpaceChargeBiGaussian(xt.BeamElement):
                  fieldmap=None,
                  min_sigma_diff=1e-10,
                  z_kick_num_integ_per_sigma=0,
+                 beam_statistics=None,
                  **kwargs # to avoid issues when building form dict
                  ):
 
@@ -267,21 +433,26 @@ class SpaceChargeBiGaussian(xt.BeamElement):
                 self.fieldmap=fieldmap
 
         self.z_kick_num_integ_per_sigma = z_kick_num_integ_per_sigma
+        self.beam_statistics = beam_statistics
+        self.shared_longitudinal_profile = None
 
         self.iscollective = None # Inferred from _update_flag
 
     def track(self, particles):
 
         if self._update_flag:
-            self.longitudinal_profile.number_of_particles = (
-                (particles.weight * (particles.state > 0)).sum()
-            )
-            mean_x, sigma_x = mean_and_std(
-                    particles.x,
-                    weights=particles.weight * (particles.state>0))
-            mean_y, sigma_y = mean_and_std(
-                    particles.y,
-                    weights=particles.weight * (particles.state>0))
+            if self.beam_statistics is not None:
+                stats = self.beam_statistics.get(particles, self)
+            else:
+                stats = _compute_beam_statistics(particles)
+            (number_of_particles, mean_x, sigma_x,
+                mean_y, sigma_y) = stats
+            if self.shared_longitudinal_profile is not None:
+                self.shared_longitudinal_profile.update(
+                    number_of_particles=number_of_particles)
+            else:
+                self.longitudinal_profile.number_of_particles = (
+                    number_of_particles)
             if self.update_mean_x_on_track:
                 self.mean_x = mean_x
             if self.update_mean_y_on_track:
@@ -293,6 +464,34 @@ class SpaceChargeBiGaussian(xt.BeamElement):
 
         super().track(particles)
 
+    def move(self, _context=None, _buffer=None, _offset=None):
+        shared = self.shared_longitudinal_profile
+        if shared is not None:
+            # Otherwise the move makes a copy of the shared profile
+            self._xobject._shared_profile = None
+        super().move(_context=_context, _buffer=_buffer, _offset=_offset)
+        if shared is not None:
+            shared._attach(self)
+
+    def copy(self, _context=None, _buffer=None, _offset=None):
+        # The copy is not attached to the shared profile, its own profile
+        # holds the current values of the shared one
+        shared = self.shared_longitudinal_profile
+        if shared is not None:
+            profile = self._xobject._shared_profile
+            self._xobject._shared_profile = None
+        try:
+            new = super().copy(_context=_context, _buffer=_buffer,
+                               _offset=_offset)
+        finally:
+            if shared is not None:
+                self._xobject._shared_profile = profile
+        if shared is not None:
+            new.longitudinal_profile = shared.profile
+            new._use_shared_profile = 0
+            new.shared_longitudinal_profile = None
+        return new
+
     def _init_update_on_track(self, update_on_track):
         self.update_mean_x_on_track = False
         self.update_mean_y_on_track = False
@@ -370,3 +569,304 @@ class SpaceChargeBiGaussian(xt.BeamElement):
     @ sigma_y.setter
     def sigma_y(self, value):
         self.fieldmap.sigma_y = value
+
+
+class SpaceChargeBeamStatistics:
+
+    """
+    Cache of the beam statistics (number of particles, mean and r.m.s. size
+    in x and y) used by quasi-frozen ``SpaceChargeBiGaussian`` elements,
+    which are recomputed from the particles only at a given cadence and
+    served from the cache otherwise. Two cadences are supported:
+
+    - per element (``update_every``): the statistics are cached separately
+      for each element, so that each element uses the values measured at
+      its own location, and they are recomputed every ``update_every``
+      passages through the element (e.g. every ``update_every`` turns);
+    - line-wide (``update_every_elements``): the statistics are shared by
+      all the elements using the object. They are recomputed at one
+      element and used by the following ``update_every_elements - 1``
+      element passages (counted over all the elements, e.g. once per turn
+      if equal to the number of elements).
+
+    In both cases the statistics are also recomputed when the beam has
+    changed by more than ``tolerance``.
+
+    Args:
+        update_every (int): Per element cadence, the statistics of an
+            element are recomputed every ``update_every`` passages through
+            the element.
+        update_every_elements (int): Line-wide cadence, the statistics are
+            recomputed every ``update_every_elements`` element passages.
+            Cannot be given together with ``update_every``.
+        tolerance (float): If given, the statistics are also recomputed
+            when the mean or the r.m.s. size of a sample of particles
+            differ from the ones of the same sample at the last update by
+            more than ``tolerance`` times the r.m.s. beam size. With the
+            line-wide cadence, this also happens if the beam size changes
+            by more than ``tolerance`` along the line. The moments of the
+            sample are computed on the context of the particles.
+        n_sample (int): Number of particles (the first ones of the
+            particles object) used for the ``tolerance`` criterion. It
+            should be large enough for the statistical fluctuations of the
+            moments of the sample to be well below ``tolerance``. The
+            default is ``1000``.
+    """
+
+    def __init__(self, update_every=None, update_every_elements=None,
+                 tolerance=None, n_sample=1000):
+
+        if update_every is not None and update_every_elements is not None:
+            raise ValueError(
+                'update_every and update_every_elements cannot be both given')
+        if (update_every is None and update_every_elements is None
+                and tolerance is None):
+            raise ValueError(
+                'update_every, update_every_elements or tolerance must be '
+                'given')
+        if update_every is not None:
+            assert update_every >= 1
+        if update_every_elements is not None:
+            assert update_every_elements >= 1
+
+        self.update_every = update_every
+        self.update_every_elements = update_every_elements
+        self.tolerance = tolerance
+        self.n_sample = n_sample
+
+        self.n_updates = 0
+        self.reset()
+
+    def reset(self):
+
+        """
+        Discards the cached values, so that the statistics are recomputed
+        at the next passage through each element.
+        """
+
+        self._cache = {}
+
+    def get(self, particles, element):
+
+        """
+        Returns the statistics of the active particles at the given element,
+        recomputed if needed.
+
+        Args:
+            particles (xpart.Particles): Particles being tracked.
+            element (SpaceChargeBiGaussian): Element at which the statistics
+                are needed.
+        Returns:
+            (tuple): Number of particles, mean_x, sigma_x, mean_y, sigma_y.
+        """
+
+        if self.update_every_elements is not None:
+            key = None # Shared by all the elements
+        else:
+            key = id(element)
+
+        entry = self._cache.get(key)
+
+        if self._needs_update(entry, particles):
+            entry = {
+                'values': _compute_beam_statistics(particles),
+                'particles_id': id(particles),
+                'n_calls': 0,
+                'sample_moments': (self._sample_moments(particles)
+                                   if self.tolerance is not None else None),
+            }
+            self._cache[key] = entry
+            self.n_updates += 1
+
+        entry['n_calls'] += 1
+
+        return entry['values']
+
+    def _needs_update(self, entry, particles):
+
+        if entry is None or entry['particles_id'] != id(particles):
+            return True
+
+        if self.update_every_elements is not None:
+            update_every = self.update_every_elements
+        else:
+            update_every = self.update_every
+        if update_every is not None and entry['n_calls'] >= update_every:
+            return True
+
+        if self.tolerance is not None:
+            _, _, sigma_x, _, sigma_y = entry['values']
+            ref = entry['sample_moments']
+            now = self._sample_moments(particles)
+            for ii, sigma in enumerate([sigma_x, sigma_x, sigma_y, sigma_y]):
+                if abs(now[ii] - ref[ii]) > self.tolerance * sigma:
+                    return True
+
+        return False
+
+    def _sample_moments(self, particles):
+
+        # Moments of the sample, which do not change with the betatron phase
+        # of the particles if the beam is stationary. They are computed on
+        # the context of the particles, only four numbers are transferred.
+        nplike = particles._context.nplike_lib
+        n = self.n_sample
+        active = (particles.state[:n] > 0) * 1.
+        n_active = float(nplike.sum(active))
+        if n_active == 0:
+            return (0., 0., 0., 0.)
+
+        moments = []
+        for coord in [particles.x[:n], particles.y[:n]]:
+            mean = float(nplike.sum(active * coord)) / n_active
+            var = float(nplike.sum(active * (coord - mean)**2)) / n_active
+            moments += [mean, np.sqrt(var)]
+
+        return tuple(moments)
+
+
+class SharedLongitudinalProfile:
+
+    """
+    Longitudinal profile shared by several ``SpaceChargeBiGaussian``
+    elements. The elements reference a single profile per buffer instead of
+    their own one, so that the parameters set with ``update`` (e.g. once per
+    turn) are seen by all of them with one write per buffer (a single one
+    once the elements are in the buffer of the tracker). The own profiles of
+    the elements are not used while they share the profile. The reference
+    is restored when the elements are moved (e.g. when building the
+    tracker), while copies of the elements (and their dictionaries) get
+    their own profile with the current shared parameters. Quasi-frozen
+    elements update the number of particles of the shared profile before
+    their kick.
+
+    Args:
+        profile (LongitudinalProfileQGaussian): Profile holding the shared
+            parameters.
+        elements (list): ``SpaceChargeBiGaussian`` elements using the
+            profile. More elements can be added with ``add_elements``.
+    """
+
+    def __init__(self, profile, elements=()):
+
+        self.profile = profile
+        self.elements = []
+        # Copies of the profile in the other buffers holding elements
+        self._buffer_profiles = []
+
+        self.add_elements(elements)
+
+    def add_elements(self, elements):
+
+        """
+        Makes the elements use the shared profile.
+
+        Args:
+            elements (list): ``SpaceChargeBiGaussian`` elements.
+        """
+
+        for ee in elements:
+            ee.shared_longitudinal_profile = self
+            self.elements.append(ee)
+            self._attach(ee)
+
+    def update(self, number_of_particles=None, sigma_z=None,
+               q_parameter=None, z0=None):
+
+        """
+        Updates the parameters of the shared profile (e.g. once per turn).
+        The parameters that are not given are left unchanged.
+
+        Args:
+            number_of_particles (float): Bunch intensity.
+            sigma_z (float): R.m.s. bunch length in meters.
+            q_parameter (float): q parameter of the q-Gaussian.
+            z0 (float): Center of the profile in meters.
+        """
+
+        prof = self.profile
+        changed = False
+        for name, value in [('number_of_particles', number_of_particles),
+                            ('q_parameter', q_parameter),
+                            ('sigma_z', sigma_z),
+                            ('z0', z0)]:
+            if value is not None and value != getattr(prof, name):
+                setattr(prof, name, value)
+                changed = True
+
+        if changed:
+            self._sync_buffer_profiles()
+
+    def update_from_particles(self, particles, update_sigma_z=True):
+
+        """
+        Sets the bunch intensity (and the bunch length) of the profile from
+        the active particles.
+
+        Args:
+            particles (xtrack.Particles): Particles of the bunch.
+            update_sigma_z (bool): If ``True`` (default) the r.m.s. bunch
+                length is also updated.
+        """
+
+        moments = compute_beam_moments(particles)
+        self.update(
+            number_of_particles=moments.num_particles,
+            sigma_z=moments.std('zeta') if update_sigma_z else None)
+
+    def _attach(self, element):
+
+        self._free_unused_buffer_profiles()
+
+        buffer = element._buffer
+        prof = self._profile_in_buffer(buffer)
+        if prof is None:
+            prof = self.profile._xobject.__class__(
+                self.profile._xobject, _buffer=buffer)
+            self._buffer_profiles.append(prof)
+
+        element._xobject._shared_profile = prof
+        element._use_shared_profile = 1
+
+    def _profile_in_buffer(self, buffer):
+
+        if self.profile._buffer is buffer:
+            return self.profile._xobject
+        for prof in self._buffer_profiles:
+            if prof._buffer is buffer:
+                return prof
+        return None
+
+    def _free_unused_buffer_profiles(self):
+
+        # Copies no longer used by any element (e.g. after building the
+        # tracker)
+        buffers = [ee._buffer for ee in self.elements]
+        kept = []
+        for prof in self._buffer_profiles:
+            if any(bb is prof._buffer for bb in buffers):
+                kept.append(prof)
+            else:
+                prof._buffer.free(prof._offset, prof._size)
+        self._buffer_profiles = kept
+
+    def _sync_buffer_profiles(self):
+
+        self._free_unused_buffer_profiles()
+        if len(self._buffer_profiles) == 0:
+            return
+
+        src = self.profile._xobject
+        data = bytes(src._buffer.to_bytearray(src._offset, src._size))
+        for prof in self._buffer_profiles:
+            assert prof._size == src._size
+            prof._buffer.update_from_buffer(prof._offset, data)
+
+
+def _compute_beam_statistics(particles):
+
+    moments = compute_beam_moments(particles)
+
+    return (moments.num_particles,
+            moments.mean('x'), moments.std('x'),
+            moments.mean('y'), moments.std('y'))
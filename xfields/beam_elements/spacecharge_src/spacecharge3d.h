@@ -19,6 +19,42 @@ void SpaceCharge3D_track_local_particle(
 	/*gpuglmem*/ double* dphi_dz_map = SpaceCharge3DData_getp1_fieldmap_dphi_dz(el, 0);
     TriLinearInterpolatedFieldMapData fmap = SpaceCharge3DData_getp_fieldmap(el);
 
+    // Used if the maps are stored in single precision
+    const int64_t single_precision =
+        TriLinearInterpolatedFieldMapData_get_single_precision(fmap);
+    /*gpuglmem*/ float* dphi_dx_map_f32 = SpaceCharge3DData_getp1_fieldmap_dphi_dx_f32(el, 0);
+    /*gpuglmem*/ float* dphi_dy_map_f32 = SpaceCharge3DData_getp1_fieldmap_dphi_dy_f32(el, 0);
+    /*gpuglmem*/ float* dphi_dz_map_f32 = SpaceCharge3DData_getp1_fieldmap_dphi_dz_f32(el, 0);
+
+    // Used if the derivatives are stored interleaved
+    const int64_t interleaved_dphi =
+        TriLinearInterpolatedFieldMapData_get_interleaved_dphi(fmap);
+    /*gpuglmem*/ double* dphi_xyz_map = SpaceCharge3DData_getp1_fieldmap_dphi_xyz(el, 0);
+    /*gpuglmem*/ float* dphi_xyz_map_f32 = SpaceCharge3DData_getp1_fieldmap_dphi_xyz_f32(el, 0);
+
+    // Used for the triangular-shaped-cloud interpolation
+    const int64_t shape_order =
+        TriLinearInterpolatedFieldMapData_get_shape_order(fmap);
+    const int64_t dphi_stride = interleaved_dphi ? 3 : 1;
+    /*gpuglmem*/ double* dphi_maps[3] = {dphi_dx_map, dphi_dy_map, dphi_dz_map};
+    /*gpuglmem*/ float* dphi_maps_f32[3] = {dphi_dx_map_f32, dphi_dy_map_f32,
+                                            dphi_dz_map_f32};
+    if (interleaved_dphi){
+        for (int ii=0; ii<3; ii++){
+            dphi_maps[ii] = dphi_xyz_map + ii;
+            dphi_maps_f32[ii] = dphi_xyz_map_f32 + ii;
+        }
+    }
+
+    // Used if the potential is stored in separable form
+    const int64_t separable_phi =
+        TriLinearInterpolatedFieldMapData_get_separable_phi(fmap);
+    /*gpuglmem*/ double* phi_xy_map = SpaceCharge3DData_getp1_fieldmap_phi_xy(el, 0);
+    /*gpuglmem*/ double* dphi_xy_dx_map = SpaceCharge3DData_getp1_fieldmap_dphi_xy_dx(el, 0);
+    /*gpuglmem*/ double* dphi_xy_dy_map = SpaceCharge3DData_getp1_fieldmap_dphi_xy_dy(el, 0);
+    /*gpuglmem*/ double* lambda_z_map = SpaceCharge3DData_getp1_fieldmap_lambda_z(el, 0);
+    /*gpuglmem*/ double* dlambda_z_dz_map = SpaceCharge3DData_getp1_fieldmap_dlambda_z_dz(el, 0);
+
     //start_per_particle_block (part0->part)
 		double const x = LocalParticle_get_x(part);
 		double const y = LocalParticle_get_y(part);
@@ -33,10 +69,43 @@ void SpaceCharge3D_track_local_particle(
 		const IndicesAndWeights iw = 
 			TriLinearInterpolatedFieldMap_compute_indeces_and_weights(fmap, x, y, z);
 
-		const double dphi_dx = 
-			TriLinearInterpolatedFieldMap_interpolate_3d_map_scalar(dphi_dx_map, iw);
-		const double dphi_dy = 
-			TriLinearInterpolatedFieldMap_interpolate_3d_map_scalar(dphi_dy_map, iw);
+		double dphi_dx = 0., dphi_dy = 0., dphi_dz = 0.;
+		if (shape_order == 2){
+			const TSCIndicesAndWeights tw =
+				TriLinearInterpolatedFieldMap_compute_tsc_indices_and_weights(
+					fmap, x, y, z);
+			double dphi[3] = {0., 0., 0.};
+			const int n_der = (apply_z_kick > 0) ? 3 : 2;
+			for (int ii=0; ii<n_der; ii++){
+				dphi[ii] = XFIELDS_INTERPOLATE_MAP(single_precision,
+					TriLinearInterpolatedFieldMap_interpolate_3d_map_tsc_strided_scalar,
+					dphi_maps[ii], dphi_maps_f32[ii], dphi_stride, tw);
+			}
+			dphi_dx = dphi[0];
+			dphi_dy = dphi[1];
+			dphi_dz = dphi[2];
+		}
+		else if (interleaved_dphi){
+			// The three derivatives are read together
+			XFIELDS_INTERPOLATE_MAP(single_precision,
+				TriLinearInterpolatedFieldMap_interpolate_interleaved_gradient,
+				dphi_xyz_map, dphi_xyz_map_f32,
+				iw, &dphi_dx, &dphi_dy, &dphi_dz);
+		}
+		else if (separable_phi){
+			dphi_dx = TriLinearInterpolatedFieldMap_interpolate_separable_map_scalar(
+					dphi_xy_dx_map, lambda_z_map, iw);
+			dphi_dy = TriLinearInterpolatedFieldMap_interpolate_separable_map_scalar(
+					dphi_xy_dy_map, lambda_z_map, iw);
+		}
+		else{
+			dphi_dx = XFIELDS_INTERPOLATE_MAP(single_precision,
+					TriLinearInterpolatedFieldMap_interpolate_3d_map_scalar,
+					dphi_dx_map, dphi_dx_map_f32, iw);
+			dphi_dy = XFIELDS_INTERPOLATE_MAP(single_precision,
+					TriLinearInterpolatedFieldMap_interpolate_3d_map_scalar,
+					dphi_dy_map, dphi_dy_map_f32, iw);
+		}
 
 		const double charge_mass_ratio = 
 						chi*QELEM*q0/(mass0*QELEM/(C_LIGHT*C_LIGHT));
@@ -48,8 +117,18 @@ void SpaceCharge3D_track_local_particle(
 		LocalParticle_add_to_py(part, factor*dphi_dy);
 
 		if (apply_z_kick > 0){
-			const double dphi_dz =
-				TriLinearInterpolatedFieldMap_interpolate_3d_map_scalar(dphi_dz_map, iw);
+			if (shape_order == 2 || interleaved_dphi){
+				// Already computed
+			}
+			else if (separable_phi){
+				dphi_dz = TriLinearInterpolatedFieldMap_interpolate_separable_map_scalar(
+						phi_xy_map, dlambda_z_dz_map, iw);
+			}
+			else{
+				dphi_dz = XFIELDS_INTERPOLATE_MAP(single_precision,
+						TriLinearInterpolatedFieldMap_interpolate_3d_map_scalar,
+						dphi_dz_map, dphi_dz_map_f32, iw);
+			}
 			LocalParticle_update_delta(part,
 				LocalParticle_get_delta(part) + factor*dphi_dz);
 		}
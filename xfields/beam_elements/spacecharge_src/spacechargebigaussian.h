@@ -14,6 +14,10 @@ void SpaceChargeBiGaussian_track_local_particle(
     BiGaussianFieldMapData fmap = SpaceChargeBiGaussianData_getp_fieldmap(el);
     LongitudinalProfileQGaussianData prof =
 	    SpaceChargeBiGaussianData_getp_longitudinal_profile(el);
+    if (SpaceChargeBiGaussianData_get__use_shared_profile(el)){
+        // Profile shared with other elements
+        prof = SpaceChargeBiGaussianData_getp__shared_profile(el);
+    }
 
 	const int64_t z_kick_num_integ_per_sigma =
 		SpaceChargeBiGaussianData_get_z_kick_num_integ_per_sigma(el);
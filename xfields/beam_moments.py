@@ -0,0 +1,204 @@
+# copyright ################################# #
+# This file is part of the Xfields Package.   #
+# Copyright (c) CERN, 2021.                   #
+# ########################################### #
+
+import numpy as np
+
+import xobjects as xo
+import xtrack as xt
+
+from .general import _pkg_root
+
+COORDS = ['x', 'px', 'y', 'py', 'zeta', 'delta']
+
+_N_PARTIAL = 29 # see headers/beam_moments.h
+_I_UPPER = np.triu_indices(len(COORDS))
+
+
+class BeamMoments:
+
+    """
+    Weighted moments of the active particles (see ``compute_beam_moments``).
+
+    Attributes:
+        num_particles (float): Sum of the weights of the active particles.
+        num_macroparticles (int): Number of active macroparticles.
+        means (np.ndarray): Weighted means of x, px, y, py, zeta, delta.
+        covariance (np.ndarray): Weighted 6x6 covariance matrix, in the
+            same order (normalized with the sum of the weights).
+    """
+
+    def __init__(self, num_particles, num_macroparticles, means, covariance):
+        self.num_particles = num_particles
+        self.num_macroparticles = num_macroparticles
+        self.means = means
+        self.covariance = covariance
+
+    def mean(self, mom_name):
+        """
+        Weighted mean of a coordinate (e.g. ``'x'``).
+        """
+        return float(self.means[COORDS.index(mom_name)])
+
+    def cov(self, mom_name, mom_name_2=None):
+        """
+        Weighted covariance of two coordinates (variance if only one is
+        given).
+        """
+        if mom_name_2 is None:
+            mom_name_2 = mom_name
+        return float(self.covariance[COORDS.index(mom_name),
+                                     COORDS.index(mom_name_2)])
+
+    def var(self, mom_name):
+        """
+        Weighted variance of a coordinate.
+        """
+        return self.cov(mom_name)
+
+    def std(self, mom_name):
+        """
+        Weighted standard deviation of a coordinate.
+        """
+        return float(np.sqrt(max(self.var(mom_name), 0.)))
+
+
+class BeamMomentsAccumulator(xo.HybridClass):
+
+    """
+    Computes the moments of the active particles with a single pass over
+    the particles. The particles are split in ``n_chunks`` chunks, reduced
+    in parallel with weighted Welford updates, and the partial results of
+    the chunks are merged on the host.
+
+    Args:
+        context (xobjects context): identifies the :doc:`context <contexts>`
+            on which the computation is executed.
+        n_chunks (int): Number of chunks. If ``None``, 256 on CPU and 4096
+            on GPU contexts.
+    Returns:
+        (BeamMomentsAccumulator): Accumulator object.
+    """
+
+    _xofields = {
+        'n_chunks': xo.Int64,
+        'partials': xo.Float64[:],
+    }
+
+    _depends_on = [xt.Particles]
+
+    _extra_c_sources = [
+        _pkg_root.joinpath('headers/beam_moments.h'),
+    ]
+
+    _kernels = {
+        'BeamMomentsAccumulator_compute_partials': xo.Kernel(
+            args=[
+                xo.Arg(xo.ThisClass, name='acc'),
+                xo.Arg(xt.Particles._XoStruct, name='particles'),
+                xo.Arg(xo.Int64, name='n_chunks'),
+                xo.Arg(xo.Int64, name='interleaved'),
+                ],
+            n_threads='n_chunks'
+            ),
+        }
+
+    def __init__(self, _context=None, _buffer=None, _offset=None,
+                 _xobject=None, n_chunks=None):
+
+        if _xobject is not None:
+            self.xoinitialize(_xobject=_xobject, _context=_context,
+                              _buffer=_buffer, _offset=_offset)
+            return
+
+        if _context is None and _buffer is not None:
+            _context = _buffer.context
+        if _context is None:
+            _context = xo.context_default
+
+        if n_chunks is None:
+            n_chunks = 256 if isinstance(_context, xo.ContextCpu) else 4096
+
+        self.xoinitialize(_context=_context, _buffer=_buffer,
+                          _offset=_offset, n_chunks=n_chunks,
+                          partials=_N_PARTIAL * n_chunks)
+
+        self.compile_kernels(only_if_needed=True)
+
+    def compute(self, particles):
+
+        """
+        Computes the moments of the active particles.
+
+        Args:
+            particles (xtrack.Particles): Particles object (on the context of
+                the accumulator).
+        Returns:
+            (BeamMoments): Moments of the active particles.
+        """
+
+        context = self._buffer.context
+        context.kernels.BeamMomentsAccumulator_compute_partials(
+            acc=self, particles=particles, n_chunks=self.n_chunks,
+            interleaved=int(not isinstance(context, xo.ContextCpu)))
+
+        partials = context.nparray_from_context_array(self.partials)
+        return _merge_partials(partials.reshape(self.n_chunks, _N_PARTIAL))
+
+
+_accumulators = {}
+
+
+def compute_beam_moments(particles):
+
+    """
+    Computes the number of particles (sum of the weights), the weighted
+    means and the weighted 6x6 covariance matrix of x, px, y, py, zeta,
+    delta of the active particles, with a single pass over the particles on
+    their context.
+
+    Args:
+        particles (xtrack.Particles): Particles object.
+    Returns:
+        (BeamMoments): Moments of the active particles.
+    """
+
+    context = particles._buffer.context
+    if context not in _accumulators:
+        _accumulators[context] = BeamMomentsAccumulator(_context=context)
+    return _accumulators[context].compute(particles)
+
+
+def _merge_partials(partials):
+
+    # Pairwise merge of the partial results of the chunks (Chan et al.)
+    n_active = partials[:, 0].sum()
+    w_sum = partials[:, 1].copy()
+    means = partials[:, 2:8].copy()
+    m2 = partials[:, 8:].copy()
+
+    while len(w_sum) > 1:
+        if len(w_sum) % 2:
+            w_sum = np.append(w_sum, 0.)
+            means = np.append(means, np.zeros((1, 6)), axis=0)
+            m2 = np.append(m2, np.zeros((1, 21)), axis=0)
+        wa, wb = w_sum[0::2], w_sum[1::2]
+        ww = wa + wb
+        fb = np.divide(wb, ww, out=np.zeros_like(ww), where=ww > 0)
+        dd = means[1::2] - means[0::2]
+        means = means[0::2] + dd * fb[:, None]
+        m2 = (m2[0::2] + m2[1::2]
+              + dd[:, _I_UPPER[0]] * dd[:, _I_UPPER[1]] * (wa * fb)[:, None])
+        w_sum = ww
+
+    w_sum = float(w_sum[0])
+    covariance = np.zeros((6, 6))
+    if w_sum > 0:
+        covariance[_I_UPPER] = m2[0] / w_sum
+        covariance.T[_I_UPPER] = m2[0] / w_sum
+
+    return BeamMoments(num_particles=w_sum,
+                       num_macroparticles=int(round(n_active)),
+                       means=means[0],
+                       covariance=covariance)
@@ -3,15 +3,44 @@
 # Copyright (c) CERN, 2021.                   #
 # ########################################### #
 
+import os
+from concurrent.futures import ThreadPoolExecutor
+
 import numpy as np
 
+import xobjects as xo
 import xfields as xf
+from xfields.fieldmaps.fieldmap_io import (_read_fieldmap_header,
+                                           _create_fieldmap_file,
+                                           _close_fieldmap_file)
+from xfields.fieldmaps.tricubicinterpolated import _file_metadata
+from xfields.fieldmaps.windowed_tricubic import _memmap_phi_taylor
 import xpart as xp
 import xtrack as xt
 
 
 def get_electroncloud_fieldmap_from_h5(
-        filename, tau_max=None, buffer=None, ecloud_name="e-cloud"):
+        filename, tau_max=None, buffer=None, ecloud_name="e-cloud",
+        nz_window=None, coefficient_cache=False, cache_file=None,
+        n_threads=8):
+    """
+    Loads an electron-cloud field map from an h5 file. The slices are read
+    by a pool of ``n_threads`` threads into a single host array, which is
+    normalized and copied to ``buffer`` in one transfer.
+
+    If ``cache_file`` is given, the converted map is saved to it (in the
+    format of ``TriCubicInterpolatedFieldMap.to_file``, written slice by
+    slice without holding the full map in memory) and later calls load it
+    from there (memory-mapped) instead of reading the h5 file, as long as
+    the cache is newer than the h5 file and has the same grid.
+
+    If ``nz_window`` is given, a ``WindowedTriCubicInterpolatedFieldMap`` is
+    returned, which keeps only ``nz_window`` slices in ``buffer`` and reads
+    the others from the file (or from the cache) when the window is moved.
+    If ``coefficient_cache`` is ``True`` the coefficients of the
+    interpolating polynomials are stored (see
+    ``TriCubicInterpolatedFieldMap``).
+    """
     assert buffer is not None
     import h5py
     ff = h5py.File(filename, "r")
@@ -48,50 +77,150 @@ def get_electroncloud_fieldmap_from_h5(
     z_grid = ff["grid/zg"][iz1:iz2]
 
     mirror2D = ff["settings/symmetric2D"][()]
+
+    if cache_file is not None and not _cache_is_valid(
+            cache_file, filename, x_grid, y_grid, z_grid):
+        print(f"Converting {ecloud_name} to {cache_file}...")
+        _write_h5_cache(ff, iz1, iz2, cache_file, x_grid, y_grid, z_grid,
+                        mirror2D, n_threads)
+
+    if nz_window is not None:
+        nz_window = min(nz_window, iz2 - iz1)
+        memory_estimate = (ix2 - ix1) * (iy2 - iy1) * nz_window * 8 * 8 * 1.e-9
+        if coefficient_cache:
+            memory_estimate *= 9
+        print(f"Creating windowed fieldmap... "
+              f"(Memory estimate = {memory_estimate:.2f} GB)")
+        if cache_file is not None:
+            ff.close()
+            return xf.WindowedTriCubicInterpolatedFieldMap.from_file(
+                cache_file, nz_window=nz_window, _buffer=buffer,
+                coefficient_cache=coefficient_cache)
+        dx = x_grid[1] - x_grid[0]
+        dy = y_grid[1] - y_grid[0]
+        dz = z_grid[1] - z_grid[0]
+        source = _H5SliceReader(ff, iz1, iz2, scale=[
+            1., dx, dy, dz, dx * dy, dx * dz, dy * dz, dx * dy * dz],
+            n_threads=n_threads)
+        return xf.WindowedTriCubicInterpolatedFieldMap(
+                phi_taylor_source=source, x_grid=x_grid, y_grid=y_grid,
+                z_grid=z_grid, nz_window=nz_window, mirror_x=mirror2D,
+                mirror_y=mirror2D, mirror_z=0, _buffer=buffer,
+                coefficient_cache=coefficient_cache)
+
     # (in GB), 8 bytes per double-precision number
     memory_estimate = (ix2 - ix1) * (iy2 - iy1) * (iz2 - iz1) * 8 * 8 * 1.e-9
+    if coefficient_cache:
+        memory_estimate *= 9
     print(f"Creating fieldmap... (Memory estimate = {memory_estimate:.2f} GB)")
     fieldmap = xf.TriCubicInterpolatedFieldMap(x_grid=x_grid, y_grid=y_grid, z_grid=z_grid,
-                                               mirror_x=mirror2D, mirror_y=mirror2D, mirror_z=0, _buffer=buffer)
-    print(f"Reading {ecloud_name}: ")
-    kk = 0.
-    scale = [1., fieldmap.dx, fieldmap.dy, fieldmap.dz,
-             fieldmap.dx * fieldmap.dy, fieldmap.dx *
-             fieldmap.dz, fieldmap.dy * fieldmap.dz,
-             fieldmap.dx * fieldmap.dy * fieldmap.dz]
-
-    ####### Optimized version of the loop in the block below. ################
-    for iz in range(iz1, iz2):
-        if (iz - iz1) / (iz2 - iz1) > kk:
-            while (iz - iz1) / (iz2 - iz1) > kk:
-                kk += 0.2
-            print(f"{int(np.round(100*kk)):d}%..")
-        phi_slice = ff[f"slices/slice{iz}/phi"][ix1:ix2,
-                                                iy1:iy2, :].transpose(1, 0, 2)
-        for ll in range(8):
-            phi_slice[:, :, ll] *= scale[ll]
-        index_offset = 8 * nx * ny * (iz - iz1)
-        len_slice = phi_slice.shape[0] * \
-            phi_slice.shape[1] * phi_slice.shape[2]
-        fieldmap._phi_taylor[index_offset:index_offset +
-                             len_slice] = fieldmap._context.nparray_to_context_array(phi_slice.flatten())
-    ##########################################################################
-    # for iz in range(iz1, iz2):
-    #     if (iz-iz1)/nz > kk:
-    #         while (iz-iz1)/nz > kk:
-    #             kk += 0.1
-    #         print(f"{int(np.round(100*kk)):d}%..")
-    #     phi_slice = ff[f"slices/slice{iz}/phi"][ix1:ix2, iy1:iy2,:]
-    #     for iy in range(ny):
-    #         for ix in range(nx):
-    #             for ll in range(8):
-    #                 index = ll + 8 * ix + 8 * nx * iy + 8 * nx * ny * (iz - iz1)
-    #                 fieldmap._phi_taylor[index] = phi_slice[ix, iy, ll] * scale[ll]
-    ##########################################################################
+                                               mirror_x=mirror2D, mirror_y=mirror2D, mirror_z=0, _buffer=buffer,
+                                               coefficient_cache=coefficient_cache)
+    print(f"Reading {ecloud_name}...")
+    if cache_file is not None:
+        phi_taylor = _memmap_phi_taylor(cache_file)[0]
+    else:
+        phi_taylor = _read_h5_slices(
+                ff, iz1, iz2, _h5_scale(fieldmap), n_threads)
+    ff.close()
+
+    # Single transfer to the context
+    fieldmap._phi_taylor[:] = fieldmap._context.nparray_to_context_array(
+                                                    phi_taylor.reshape(-1))
+
+    if coefficient_cache:
+        fieldmap.build_coefficient_cache()
 
     return fieldmap
 
 
+def _h5_scale(fieldmap):
+    # The derivatives in the h5 files are not normalized
+    return np.array([1., fieldmap.dx, fieldmap.dy, fieldmap.dz,
+                     fieldmap.dx * fieldmap.dy, fieldmap.dx * fieldmap.dz,
+                     fieldmap.dy * fieldmap.dz,
+                     fieldmap.dx * fieldmap.dy * fieldmap.dz])
+
+
+def _read_h5_slices(ff, iz1, iz2, scale, n_threads=1, out=None):
+
+    # Reads the slices iz1 to iz2 (excluded) of phi and its derivatives
+    # into an array of shape (iz2 - iz1, ny, nx, 8) (the order of
+    # phi_taylor) and normalizes the derivatives. Each slice is written
+    # directly into ``out`` if given.
+    shape = ff[f"slices/slice{iz1}/phi"].shape
+    if out is None:
+        out = np.empty((iz2 - iz1, shape[1], shape[0], shape[2]))
+    else:
+        out = out.reshape(iz2 - iz1, shape[1], shape[0], shape[2])
+
+    def read_slice(iz):
+        out[iz - iz1] = ff[f"slices/slice{iz}/phi"][()].transpose(1, 0, 2)
+        out[iz - iz1] *= scale
+
+    with ThreadPoolExecutor(max_workers=n_threads) as executor:
+        list(executor.map(read_slice, range(iz1, iz2)))
+
+    return out
+
+
+def _write_h5_cache(ff, iz1, iz2, cache_file, x_grid, y_grid, z_grid,
+                    mirror2D, n_threads=1, reserve=65536):
+
+    # Builds the field map in place in the memory-mapped cache file, the
+    # slices are read from the h5 file directly into it
+    size = xf.TriCubicInterpolatedFieldMap._XoStruct._inspect_args(
+        phi_taylor=len(x_grid) * len(y_grid) * len(z_grid) * 8,
+        coefficients=0).size
+    buffer, tmpname = _create_fieldmap_file(
+        xf.TriCubicInterpolatedFieldMap, cache_file, size,
+        _file_metadata(x_grid, y_grid, z_grid), reserve)
+
+    fieldmap = xf.TriCubicInterpolatedFieldMap(
+            x_grid=x_grid, y_grid=y_grid, z_grid=z_grid,
+            mirror_x=mirror2D, mirror_y=mirror2D, mirror_z=0,
+            _buffer=buffer)
+    _read_h5_slices(ff, iz1, iz2, _h5_scale(fieldmap), n_threads,
+                    out=fieldmap._xobject.phi_taylor.to_nplike())
+    del fieldmap
+
+    _close_fieldmap_file(buffer, tmpname, cache_file)
+
+
+def _cache_is_valid(cache_file, filename, x_grid, y_grid, z_grid):
+    if not os.path.exists(cache_file):
+        return False
+    if os.path.getmtime(cache_file) < os.path.getmtime(filename):
+        return False
+    try:
+        metadata = _read_fieldmap_header(cache_file)['metadata']
+    except ValueError:
+        return False
+    return all(np.array_equal(np.array(metadata[kk]), vv) for kk, vv in
+               [('x_grid', x_grid), ('y_grid', y_grid), ('z_grid', z_grid)])
+
+
+class _H5SliceReader:
+
+    # Reads and normalizes the slices of phi from the h5 file when
+    # indexed with a slice (used by the windowed field maps)
+
+    def __init__(self, ff, iz1, iz2, scale, n_threads=1):
+        self.ff = ff
+        self.iz1 = iz1
+        self.iz2 = iz2
+        self.scale = np.array(scale)
+        self.n_threads = n_threads
+
+    def __len__(self):
+        return self.iz2 - self.iz1
+
+    def __getitem__(self, index):
+        start, stop, _ = index.indices(len(self))
+        return _read_h5_slices(self.ff, self.iz1 + start, self.iz1 + stop,
+                               self.scale, self.n_threads)
+
+
 def insert_electronclouds(eclouds, fieldmap=None, line=None):
     assert line is not None
     for name in eclouds.keys():
@@ -163,15 +292,21 @@ def electroncloud_dipolar_kicks_of_fieldmap(fieldmap=None, p0c=None):
 
 
 def full_electroncloud_setup(line=None, ecloud_info=None, filenames=None, context=None,
-                             tau_max=None, subtract_dipolar_kicks=True, shift_to_closed_orbit=True):
+                             tau_max=None, subtract_dipolar_kicks=True, shift_to_closed_orbit=True,
+                             cache_dir=None, n_threads=8):
 
+    # With cache_dir, the converted field maps are stored as
+    # "<cache_dir>/<ecloud_type>.xfmap" and memory-mapped by later runs
     buffer = context.new_buffer()
     fieldmaps = {
         ecloud_type: get_electroncloud_fieldmap_from_h5(
             filename=filename,
             buffer=buffer,
             tau_max=tau_max,
-            ecloud_name=ecloud_type) for (
+            ecloud_name=ecloud_type,
+            cache_file=(None if cache_dir is None else
+                        os.path.join(cache_dir, f"{ecloud_type}.xfmap")),
+            n_threads=n_threads) for (
             ecloud_type,
             filename) in filenames.items()}
 
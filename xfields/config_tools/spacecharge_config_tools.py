@@ -10,6 +10,7 @@ from xtrack.progress_indicator import progress
 
 from ..beam_elements.spacecharge import SpaceChargeBiGaussian
 from ..beam_elements.spacecharge import SpaceCharge3D
+from ..beam_elements.spacecharge import SharedLongitudinalProfile
 
 import xpart as xp
 import xobjects as xo
@@ -22,7 +23,8 @@ def install_spacecharge_frozen(line=None, _buffer=None,
                                tol_spacecharge_position=None,
                                s_spacecharge=None,
                                delta_rms=None,
-                               z_kick_num_integ_per_sigma=0):
+                               z_kick_num_integ_per_sigma=0,
+                               share_longitudinal_profile=False):
 
     '''
     Install spacecharge elements (frozen modeling) in a xtrack.Line object.
@@ -51,6 +53,13 @@ def install_spacecharge_frozen(line=None, _buffer=None,
         Matched momentum spread. If None, it is computed from a matched gaussian bunch.
     z_kick_num_integ_per_sigma : int
         number of integrated longitudinal kick per sigma (default is 0)
+    share_longitudinal_profile : bool
+        If True, the spacecharge elements share ``longitudinal_profile``
+        through a ``xfields.SharedLongitudinalProfile``, available as the
+        ``shared_longitudinal_profile`` attribute of the elements, whose
+        ``update`` method sets the profile parameters of all the elements
+        with a single call (the elements reference a single profile per
+        buffer, default is False).
 
     Returns
     -------
@@ -110,6 +119,10 @@ def install_spacecharge_frozen(line=None, _buffer=None,
 
         insertions.append((ss, [(sc_names[-1], sc_elements[-1])]))
 
+    if share_longitudinal_profile:
+        SharedLongitudinalProfile(profile=longitudinal_profile,
+                                  elements=sc_elements)
+
     # Insert spacecharge elements
     line._insert_thin_elements_at_s(insertions)
 
@@ -151,7 +164,8 @@ def replace_spacecharge_with_quasi_frozen(
                         update_mean_x_on_track=True,
                         update_mean_y_on_track=True,
                         update_sigma_x_on_track=True,
-                        update_sigma_y_on_track=True):
+                        update_sigma_y_on_track=True,
+                        beam_statistics=None):
 
     '''
     Replace spacecharge elements with quasi-frozen spacecharge elements.
@@ -170,6 +184,11 @@ def replace_spacecharge_with_quasi_frozen(
         Update the sigma x position on track.
     update_sigma_y_on_track : bool (optional)
         Update the sigma y position on track.
+    beam_statistics : xfields.SpaceChargeBeamStatistics (optional)
+        Cache of the beam statistics used by all the spacecharge elements.
+        The statistics are recomputed only at the cadence defined in the
+        object (per element or line-wide). If not given, the statistics are
+        recomputed at each passage through each element.
 
     Returns
     -------
@@ -192,9 +211,13 @@ def replace_spacecharge_with_quasi_frozen(
             ee.update_mean_y_on_track = update_mean_y_on_track
             ee.update_sigma_x_on_track = update_sigma_x_on_track
             ee.update_sigma_y_on_track = update_sigma_y_on_track
+            ee.beam_statistics = beam_statistics
             ee.iscollective = True
             spch_elements.append(ee)
 
+    if beam_statistics is not None:
+        beam_statistics.reset()
+
     return spch_elements
 
 
@@ -214,6 +237,7 @@ class PICCollection:
                  solver='FFTSolver2p5D',
                  apply_z_kick=False,
                  gamma0 = None,
+                 green_function_cache=True,
                  _context=None,
                  _buffer=None,
                      ):
@@ -229,6 +253,9 @@ class PICCollection:
         self.solver = solver
         self.apply_z_kick = apply_z_kick
         self.gamma0 = gamma0
+        # Shared by the solvers of all the PICs (True selects the cache of
+        # the package)
+        self.green_function_cache = green_function_cache
 
         self.x_lims = np.linspace(x_lim_min, x_lim_max, n_lims_x)
         self.y_lims = np.linspace(y_lim_min, y_lim_max, n_lims_y)
@@ -261,6 +288,8 @@ class PICCollection:
                 z_range=self.z_range,
                 nx=self.nx_grid, ny=self.ny_grid, nz=self.nz_grid,
                 solver=self.solver,
+                solver_kwargs={
+                    'green_function_cache': self.green_function_cache},
                 gamma0=self.gamma0,
                 fftplan=self._fftplan)
             new_pic._buffer.grow(10*1024**2) # Add 10 MB for sc copies
@@ -276,6 +305,7 @@ def replace_spacecharge_with_PIC(
         n_sigmas_range_pic_x, n_sigmas_range_pic_y,
         nx_grid, ny_grid, nz_grid, n_lims_x, n_lims_y, z_range,
         solver='FFTSolver2p5D',
+        green_function_cache=True,
         _context=None,
         _buffer=None):
 
@@ -302,6 +332,12 @@ def replace_spacecharge_with_PIC(
         Number different limits in y for which PIC need to be generated.
     z_range : float
         Range of the longitudinal grid.
+    green_function_cache : xfields.solvers.GreenFunctionCache (optional)
+        Cache of the Green functions used by the solvers of the PIC
+        elements. If ``True`` (default) the cache of the package
+        (``xfields.solvers.default_green_function_cache``) is used, so that
+        the Green functions are not recomputed for PICs with the same grid
+        (e.g. when the setup is repeated). If ``False`` no cache is used.
     _context : xtrack.Context (optional)
         Context in which the PIC elements are created.
     _buffer : xtrack.Buffer (optional)
@@ -345,6 +381,7 @@ def replace_spacecharge_with_PIC(
         y_lim_min=y_lim_min, y_lim_max=y_lim_max, n_lims_y=n_lims_y,
         z_range=z_range,
         solver=solver,
+        green_function_cache=green_function_cache,
         gamma0=line.particle_ref.gamma0[0])
 
     all_pics = []
@@ -0,0 +1,296 @@
+# copyright ################################# #
+# This file is part of the Xfields Package.   #
+# Copyright (c) CERN, 2021.                   #
+# ########################################### #
+
+import numpy as np
+
+import xobjects as xo
+
+from .interpolated import _configure_grid
+from ..general import _pkg_root
+
+_BiCubicInterpolatedFieldMap_kernels = {
+    'BiCubicInterpolatedFieldMap_phi_taylor_from_phi': xo.Kernel(
+        args=[
+            xo.Arg(xo.ThisClass, pointer=False, name='fmap'),
+            xo.Arg(xo.Int64,   pointer=False, name='n_nodes'),
+            xo.Arg(xo.Float64, pointer=True,  name='phi'),
+            xo.Arg(xo.Int64,   pointer=False, name='stride_x'),
+            xo.Arg(xo.Int64,   pointer=False, name='stride_y'),
+            ],
+        n_threads='n_nodes'
+        ),
+    'BiCubicInterpolatedFieldMap_build_coefficient_cache': xo.Kernel(
+        args=[
+            xo.Arg(xo.ThisClass, pointer=False, name='fmap'),
+            xo.Arg(xo.Int64,   pointer=False, name='n_cells'),
+            ],
+        n_threads='n_cells'
+        ),
+    }
+
+
+class BiCubicInterpolatedFieldMap(xo.HybridClass):
+
+    """
+    Builds a bicubic interpolator for a 2D field map (independent of the
+    longitudinal coordinate).
+
+    Args:
+        context (xobjects context): identifies the :doc:`context <contexts>`
+            on which the computation is executed.
+        x_range (tuple): Horizontal extent (in meters) of the
+            computing grid.
+        y_range (tuple): Vertical extent (in meters) of the
+            computing grid.
+        nx (int): Number of cells in the horizontal direction.
+        ny (int): Number of cells in the vertical direction.
+        dx (float): Horizontal cell size in meters. It can be
+            provided alternatively to ``nx``.
+        dy (float): Vertical cell size in meters. It can be
+            provided alternatively to ``ny``.
+        x_grid (np.ndarray): Equispaced array with the horizontal grid points
+            (cell centers).
+            It can be provided alternatively to ``x_range``, ``dx``/``nx``.
+        y_grid (np.ndarray): Equispaced array with the vertical grid points
+            (cell centers).
+            It can be provided alternatively to ``y_range``, ``dy``/``ny``.
+        mirror_x (int): if equal to 1, the map is mirrored along the x axis
+            around x = 0.
+        mirror_y (int): if equal to 1, the map is mirrored along the y axis
+            around y = 0.
+        phi_taylor (np.ndarray): Normalized scalar potential and its
+            derivatives at the grid points. Should be of dimension
+            (nx, ny, 4). For the last index: 0 -> phi, 1 -> dphi/dx,
+            2 -> dphi/dy, 3 -> d^2phi/dxdy. The derivatives are multiplied
+            with the grid's step sizes, e.g. (d^2phi/dxdy) * (Δx*Δy). Units
+            are Volts.
+        phi (np.ndarray): Electric potential at the grid points in Volts,
+            with shape (nx, ny), from which ``phi_taylor`` is computed (see
+            ``update_phi_taylor_from_phi``).
+        coefficient_cache (bool): If ``True`` the 16 coefficients of the
+            interpolating polynomial of each cell are computed once and
+            stored, instead of being computed for each particle. If
+            ``phi_taylor`` is modified directly, ``build_coefficient_cache``
+            needs to be called. Default is ``False``.
+    Returns:
+        (BiCubicInterpolatedFieldMap): Interpolator object.
+    """
+
+    _xofields = {
+        'x_min': xo.Float64,
+        'y_min': xo.Float64,
+        'nx': xo.Int64,
+        'ny': xo.Int64,
+        'mirror_x': xo.Int64,
+        'mirror_y': xo.Int64,
+        'dx': xo.Float64,
+        'dy': xo.Float64,
+        'phi_taylor': xo.Float64[:],
+        'coefficient_cache': xo.Int64,
+        'coefficients': xo.Float64[:],
+    }
+
+    # I add undescores in front of the names so that I can define custom
+    # properties
+    _rename = {nn: '_'+nn for nn in _xofields}
+
+    _extra_c_sources = [
+        _pkg_root.joinpath('fieldmaps/interpolated_src/bicubic_interpolators.h'),
+        ]
+
+    _kernels = _BiCubicInterpolatedFieldMap_kernels
+
+    def __init__(self,
+                 _context=None,
+                 _buffer=None,
+                 _offset=None,
+                 _xobject=None,
+                 x_range=None, y_range=None,
+                 nx=None, ny=None,
+                 dx=None, dy=None,
+                 x_grid=None, y_grid=None,
+                 mirror_x=0, mirror_y=0,
+                 phi_taylor=None,
+                 phi=None,
+                 coefficient_cache=False,
+                 ):
+
+        if _xobject is not None:
+            self.xoinitialize(_xobject=_xobject, _context=_context,
+                             _buffer=_buffer, _offset=_offset)
+            return
+
+        self._x_grid = _configure_grid('x', x_grid, dx, x_range, nx)
+        self._y_grid = _configure_grid('y', y_grid, dy, y_range, ny)
+
+        nelem = self.nx*self.ny*4
+        self.xoinitialize(
+                 _context=_context,
+                 _buffer=_buffer,
+                 _offset=_offset,
+                 x_min = self._x_grid[0],
+                 y_min = self._y_grid[0],
+                 nx = self.nx,
+                 ny = self.ny,
+                 mirror_x = mirror_x,
+                 mirror_y = mirror_y,
+                 dx = self.dx,
+                 dy = self.dy,
+                 phi_taylor = nelem,
+                 coefficient_cache = coefficient_cache,
+                 coefficients = 4 * nelem if coefficient_cache else 0,
+                 )
+
+        self.compile_kernels(only_if_needed=True)
+
+        if phi_taylor is not None:
+            # (nx, ny, 4) -> index l + 4 * (ix + nx * iy)
+            phi_taylor = np.asarray(phi_taylor).transpose(2, 0, 1)
+            self._phi_taylor[:] = self._buffer.context.nparray_to_context_array(
+                                    phi_taylor.flatten(order='F'))
+            if self.coefficient_cache:
+                self.build_coefficient_cache()
+        elif phi is not None:
+            self.update_phi_taylor_from_phi(phi)
+
+    @classmethod
+    def from_tricubic(cls, fieldmap, iz=0, _context=None, _buffer=None,
+                      coefficient_cache=False):
+
+        """
+        Creates a bicubic field map from one longitudinal slice of a
+        tricubic field map, taking phi, dphi/dx, dphi/dy and d^2phi/dxdy
+        from its ``phi_taylor``.
+
+        Args:
+            fieldmap (TriCubicInterpolatedFieldMap or dict): Tricubic field
+                map, or its dictionary representation (see ``to_dict``).
+            iz (int): Index of the longitudinal slice. The default is ``0``.
+            coefficient_cache (bool): See ``BiCubicInterpolatedFieldMap``.
+        Returns:
+            (BiCubicInterpolatedFieldMap): Field map object.
+        """
+
+        if isinstance(fieldmap, dict):
+            fields = {nn.lstrip('_'): vv for nn, vv in fieldmap.items()}
+            phi_taylor = np.asarray(fields['phi_taylor'])
+        else:
+            fields = {nn: getattr(fieldmap, '_' + nn) for nn in
+                      ['x_min', 'y_min', 'nx', 'ny', 'nz', 'dx', 'dy',
+                       'mirror_x', 'mirror_y', 'nz_window']}
+            phi_taylor = fieldmap._buffer.context.nparray_from_context_array(
+                                                        fieldmap._phi_taylor)
+        nx, ny = int(fields['nx']), int(fields['ny'])
+        nz = int(fields.get('nz_window', fields['nz']))
+
+        # index l + 8 * (ix + nx * (iy + ny * iz)) -> (nx, ny, 4) with
+        # phi, dphi/dx, dphi/dy, d^2phi/dxdy
+        phi_taylor = np.reshape(phi_taylor, (8, nx, ny, nz), order='F')
+        phi_taylor = phi_taylor[[0, 1, 2, 4], :, :, iz].transpose(1, 2, 0)
+
+        return cls(_context=_context, _buffer=_buffer,
+                   x_grid=fields['x_min'] + np.arange(nx) * fields['dx'],
+                   y_grid=fields['y_min'] + np.arange(ny) * fields['dy'],
+                   mirror_x=int(fields['mirror_x']),
+                   mirror_y=int(fields['mirror_y']),
+                   phi_taylor=phi_taylor,
+                   coefficient_cache=coefficient_cache)
+
+    def update_phi_taylor_from_phi(self, phi):
+
+        """
+        Computes ``phi_taylor`` from the potential at the grid points, with
+        one kernel call on the context of the map. The derivatives are
+        computed with central differences and normalized with the cell
+        sizes. They are set to zero at the edges of the grid along the
+        direction of derivation.
+
+        Args:
+            phi (array): Potential at the grid points in Volts, with shape
+                (nx, ny).
+        """
+
+        context = self._buffer.context
+        if isinstance(phi, np.ndarray):
+            phi = context.nparray_to_context_array(phi)
+
+        if tuple(phi.shape) != (self.nx, self.ny):
+            raise ValueError(f'phi has shape {tuple(phi.shape)}, expected '
+                             f'{(self.nx, self.ny)}')
+        if phi.dtype != np.float64:
+            phi = phi.astype(np.float64)
+
+        stride_x, stride_y = [ss // 8 for ss in phi.strides]
+        context.kernels.BiCubicInterpolatedFieldMap_phi_taylor_from_phi(
+                fmap=self, n_nodes=self.nx * self.ny, phi=phi,
+                stride_x=stride_x, stride_y=stride_y)
+
+        if self.coefficient_cache:
+            self.build_coefficient_cache()
+
+    def build_coefficient_cache(self):
+
+        """
+        Computes the coefficients of the interpolating polynomials of all the
+        cells from ``phi_taylor`` (only for maps created with
+        ``coefficient_cache=True``).
+        """
+
+        if not self.coefficient_cache:
+            raise ValueError('The map was created without coefficient cache')
+
+        self._buffer.context.kernels.\
+            BiCubicInterpolatedFieldMap_build_coefficient_cache(
+                fmap=self, n_cells=self.nx * self.ny)
+
+    @property
+    def x_grid(self):
+        """
+        Array with the horizontal grid points (cell centers).
+        """
+        return self._x_grid
+
+    @property
+    def y_grid(self):
+        """
+        Array with the vertical grid points (cell centers).
+        """
+        return self._y_grid
+
+    @property
+    def nx(self):
+        """
+        Number of cells in the horizontal direction.
+        """
+        return len(self.x_grid)
+
+    @property
+    def ny(self):
+        """
+        Number of cells in the vertical direction.
+        """
+        return len(self.y_grid)
+
+    @property
+    def dx(self):
+        """
+        Horizontal cell size in meters.
+        """
+        return self.x_grid[1] - self.x_grid[0]
+
+    @property
+    def dy(self):
+        """
+        Vertical cell size in meters.
+        """
+        return self.y_grid[1] - self.y_grid[0]
+
+    @property
+    def coefficient_cache(self):
+        """
+        ``True`` if the coefficients of the interpolating polynomials are
+        stored.
+        """
+        return bool(self._coefficient_cache)
@@ -0,0 +1,179 @@
+# copyright ################################# #
+# This file is part of the Xfields Package.   #
+# Copyright (c) CERN, 2021.                   #
+# ########################################### #
+
+import json
+import os
+import sys
+
+import numpy as np
+
+import xobjects as xo
+
+# Layout of the files written by ``to_file``:
+#   - 8 bytes: magic string
+#   - 8 bytes: length of the json header (little endian uint64)
+#   - json header (class, metadata, size and position of the xobject)
+#   - padding up to ``data_offset`` (multiple of the page size, so that the
+#     data can be memory-mapped directly)
+#   - the bytes of the xobject of the field map (grid description and maps)
+#   - ``reserve`` bytes left free for objects allocated later in the same
+#     buffer (e.g. the beam element using the field map)
+
+_MAGIC = b'XFFMAP01'
+_ALIGNMENT = 4096
+
+
+class _MemmapBuffer(xo.context_cpu.BufferNumpy):
+
+    # CPU buffer whose memory is a np.memmap. If the buffer grows, the data is
+    # copied to a regular numpy array.
+
+    def __init__(self, memmap, context):
+        self._memmap = memmap
+        super().__init__(capacity=len(memmap), context=context)
+
+    def _new_buffer(self, capacity):
+        if self._memmap is not None and capacity == len(self._memmap):
+            out = self._memmap
+            self._memmap = None
+            return out
+        return np.zeros(capacity, dtype='int8')
+
+
+def _jsonable_kwargs(kwargs):
+
+    # Returns the keyword arguments in a form that can be stored in the json
+    # header (dtypes as strings) or None if they cannot be stored
+    out = {}
+    for kk, vv in kwargs.items():
+        if isinstance(vv, np.dtype) or (isinstance(vv, type)
+                                        and issubclass(vv, np.generic)):
+            vv = np.dtype(vv).name
+        try:
+            json.dumps(vv)
+        except TypeError:
+            return None
+        out[kk] = vv
+    return out
+
+
+def _fieldmap_header(cls, size, reserve, metadata):
+
+    # Returns the json header and the offset of the data in the file
+    header = {
+        'class': cls.__name__,
+        'byteorder': sys.byteorder,
+        'fields': [ff.name for ff in cls._XoStruct._fields],
+        'xobject_size': int(size),
+        'reserve': int(reserve),
+        'metadata': metadata,
+    }
+    header_bytes = json.dumps(header).encode()
+    data_offset = _ALIGNMENT * int(np.ceil(
+                    (len(_MAGIC) + 8 + len(header_bytes)) / _ALIGNMENT))
+    header['data_offset'] = data_offset
+    header_bytes = json.dumps(header).encode()
+    assert len(_MAGIC) + 8 + len(header_bytes) <= data_offset
+
+    return header_bytes, data_offset
+
+
+def _write_header(fid, header_bytes, data_offset, size, reserve):
+    fid.write(_MAGIC)
+    fid.write(np.uint64(len(header_bytes)).astype('<u8').tobytes())
+    fid.write(header_bytes)
+    fid.truncate(data_offset + size + reserve) # sparse on most systems
+
+
+def _write_fieldmap_file(fmap, filename, metadata, reserve):
+
+    xobject = fmap._xobject
+    size = xobject._size
+    header_bytes, data_offset = _fieldmap_header(fmap.__class__, size,
+                                                 reserve, metadata)
+
+    data = xobject._buffer.to_bytearray(xobject._offset, size)
+
+    # Write to a temporary file and rename, so that processes loading the
+    # same file never see it partially written
+    tmpname = f'{filename}.{os.getpid()}.tmp'
+    with open(tmpname, 'wb') as fid:
+        _write_header(fid, header_bytes, data_offset, size, reserve)
+        fid.seek(data_offset)
+        fid.write(data)
+    os.replace(tmpname, filename)
+
+
+def _create_fieldmap_file(cls, filename, size, metadata, reserve):
+
+    # Writes the header of a field map file of class ``cls`` (under a
+    # temporary name) and returns a CPU buffer memory-mapped on its data, in
+    # which the field map can be built in place without holding it in
+    # memory. The file is completed by ``_close_fieldmap_file``.
+    header_bytes, data_offset = _fieldmap_header(cls, size, reserve,
+                                                 metadata)
+
+    tmpname = f'{filename}.{os.getpid()}.tmp'
+    with open(tmpname, 'wb') as fid:
+        _write_header(fid, header_bytes, data_offset, size, reserve)
+
+    data = np.memmap(tmpname, dtype=np.int8, mode='r+',
+                     offset=data_offset, shape=(size + reserve,))
+    return _MemmapBuffer(data, context=xo.ContextCpu()), tmpname
+
+
+def _close_fieldmap_file(buffer, tmpname, filename):
+
+    buffer.buffer.flush()
+    os.replace(tmpname, filename)
+
+
+def _read_fieldmap_header(filename):
+
+    with open(filename, 'rb') as fid:
+        if fid.read(len(_MAGIC)) != _MAGIC:
+            raise ValueError(f'{filename} is not a field map file')
+        header_len = int(np.frombuffer(fid.read(8), dtype='<u8')[0])
+        header = json.loads(fid.read(header_len).decode())
+
+    if header['byteorder'] != sys.byteorder:
+        raise ValueError(f'{filename} was written on a machine with '
+                         'different byte order')
+
+    return header
+
+
+def _load_fieldmap_xobject(cls, filename, _context, mmap_mode):
+
+    header = _read_fieldmap_header(filename)
+    if header['class'] != cls.__name__:
+        raise ValueError(f'{filename} contains a {header["class"]}, '
+                         f'not a {cls.__name__}')
+    if header['fields'] != [ff.name for ff in cls._XoStruct._fields]:
+        raise ValueError(f'{filename} was written with an incompatible '
+                         'version of the field map')
+
+    size = header['xobject_size']
+    capacity = size + header['reserve']
+
+    if _context is None:
+        _context = xo.context_default
+
+    if isinstance(_context, xo.ContextCpu) and mmap_mode is not None:
+        # The pages are shared between the processes loading the same file
+        data = np.memmap(filename, dtype=np.int8, mode=mmap_mode,
+                         offset=header['data_offset'], shape=(capacity,))
+        buffer = _MemmapBuffer(data, context=_context)
+    else:
+        data = np.fromfile(filename, dtype=np.int8, count=size,
+                           offset=header['data_offset'])
+        buffer = _context.new_buffer(capacity=capacity)
+        buffer.update_from_buffer(0, data)
+
+    offset = buffer.allocate(size)
+    assert offset == 0
+    xobject = cls._XoStruct._from_buffer(buffer=buffer, offset=offset)
+
+    return xobject, header['metadata']
@@ -3,13 +3,18 @@
 # Copyright (c) CERN, 2021.                   #
 # ########################################### #
 
+from collections import OrderedDict
+
 import numpy as np
 
 import xobjects as xo
 import xtrack as xt
 
 from ..solvers.fftsolvers import FFTSolver3D, FFTSolver2p5D, FFTSolver2p5DAveraged
+from ..solvers.dstsolvers import FFTSolverRectPipe3D, FFTSolverRectPipe2p5D
 from ..general import _pkg_root
+from .fieldmap_io import (_write_fieldmap_file, _load_fieldmap_xobject,
+                          _jsonable_kwargs)
 
 _TriLinearInterpolatedFielmap_kernels = {
     'central_diff': xo.Kernel(
@@ -25,6 +30,26 @@ _TriLinearInterpolatedFielmap_kernels = {
             ],
         n_threads='nelem'
         ),
+    'central_diff_3d': xo.Kernel(
+        args=[
+            xo.Arg(xo.Int32,   pointer=False, name='nelem'),
+            xo.Arg(xo.Int32,   pointer=False, name='nx'),
+            xo.Arg(xo.Int32,   pointer=False, name='ny'),
+            xo.Arg(xo.Int32,   pointer=False, name='nz'),
+            xo.Arg(xo.Float64, pointer=False, name='factor_x'),
+            xo.Arg(xo.Float64, pointer=False, name='factor_y'),
+            xo.Arg(xo.Float64, pointer=False, name='factor_z'),
+            xo.Arg(xo.Int8,    pointer=True,  name='matrix_buffer'),
+            xo.Arg(xo.Int64,   pointer=False, name='matrix_offset'),
+            xo.Arg(xo.Int8,    pointer=True,  name='res_buffer'),
+            xo.Arg(xo.Int64,   pointer=False, name='res_offset_x'),
+            xo.Arg(xo.Int64,   pointer=False, name='res_offset_y'),
+            xo.Arg(xo.Int64,   pointer=False, name='res_offset_z'),
+            xo.Arg(xo.Int32,   pointer=False, name='res_stride'),
+            xo.Arg(xo.Int64,   pointer=False, name='is_f32'),
+            ],
+        n_threads='nelem'
+        ),
     'p2m_rectmesh3d_xparticles': xo.Kernel(
         args=[
             xo.Arg(xo.Int32,   pointer=False, name='nparticles'),
@@ -38,6 +63,8 @@ _TriLinearInterpolatedFielmap_kernels = {
             xo.Arg(xo.Int32,   pointer=False, name='nx'),
             xo.Arg(xo.Int32,   pointer=False, name='ny'),
             xo.Arg(xo.Int32,   pointer=False, name='nz'),
+            xo.Arg(xo.Int64,   pointer=False, name='shape_order'),
+            xo.Arg(xo.Int64,   pointer=False, name='grid_is_f32'),
             xo.Arg(xo.Int8,    pointer=True,  name='grid1d_buffer'),
             xo.Arg(xo.Int64,   pointer=False, name='grid1d_offset'),
             ],
@@ -60,11 +87,23 @@ _TriLinearInterpolatedFielmap_kernels = {
             xo.Arg(xo.Int32,   pointer=False, name='nx'),
             xo.Arg(xo.Int32,   pointer=False, name='ny'),
             xo.Arg(xo.Int32,   pointer=False, name='nz'),
+            xo.Arg(xo.Int64,   pointer=False, name='shape_order'),
+            xo.Arg(xo.Int64,   pointer=False, name='grid_is_f32'),
             xo.Arg(xo.Int8,    pointer=True,  name='grid1d_buffer'),
             xo.Arg(xo.Int64,   pointer=False, name='grid1d_offset'),
             ],
         n_threads='nparticles'
         ),
+    'cell_sort_permutation': xo.Kernel(
+        args=[
+            xo.Arg(xo.Int64,   pointer=False, name='n_points'),
+            xo.Arg(xo.Int64,   pointer=True,  name='cell_id'),
+            xo.Arg(xo.Int64,   pointer=False, name='n_cells'),
+            xo.Arg(xo.Int64,   pointer=True,  name='counts'),
+            xo.Arg(xo.Int64,   pointer=True,  name='permutation'),
+            ],
+        n_threads='n_points'
+        ),
     'TriLinearInterpolatedFieldMap_interpolate_3d_map_vector': xo.Kernel(
         args=[
             xo.Arg(xo.ThisClass, pointer=False, name='fmap'),
@@ -75,12 +114,64 @@ _TriLinearInterpolatedFielmap_kernels = {
             xo.Arg(xo.Int64,   pointer=False, name='n_quantities'),
             xo.Arg(xo.Int8,    pointer=True,  name='buffer_mesh_quantities'),
             xo.Arg(xo.Int64,   pointer=True,  name='offsets_mesh_quantities'),
+            xo.Arg(xo.Int64,   pointer=True,  name='strides_mesh_quantities'),
+            xo.Arg(xo.Float64, pointer=True,  name='particles_quantities'),
+            ],
+        n_threads='n_points'
+        ),
+    'TriLinearInterpolatedFieldMap_interpolate_separable_map_vector': xo.Kernel(
+        args=[
+            xo.Arg(xo.ThisClass, pointer=False, name='fmap'),
+            xo.Arg(xo.Int64,   pointer=False, name='n_points'),
+            xo.Arg(xo.Float64, pointer=True,  name='x'),
+            xo.Arg(xo.Float64, pointer=True,  name='y'),
+            xo.Arg(xo.Float64, pointer=True,  name='z'),
+            xo.Arg(xo.Int64,   pointer=False, name='n_quantities'),
+            xo.Arg(xo.Int8,    pointer=True,  name='buffer_mesh_quantities'),
+            xo.Arg(xo.Int64,   pointer=True,  name='offsets_mesh_quantities_xy'),
+            xo.Arg(xo.Int64,   pointer=True,  name='offsets_mesh_quantities_z'),
             xo.Arg(xo.Float64, pointer=True,  name='particles_quantities'),
             ],
         n_threads='n_points'
         ),
     }
 
+# Deposition on per-thread private grids (CPU contexts only, the same
+# arguments with the private grids inserted before the shape order)
+for _name in ['p2m_rectmesh3d', 'p2m_rectmesh3d_xparticles']:
+    _args = _TriLinearInterpolatedFielmap_kernels[_name].args
+    _TriLinearInterpolatedFielmap_kernels[_name + '_private'] = xo.Kernel(
+        args=_args[:-4] + [
+            xo.Arg(xo.Int32,   pointer=False, name='n_grids'),
+            xo.Arg(xo.Float64, pointer=True,  name='private_grids'),
+            ] + _args[-4:],
+        n_threads=_TriLinearInterpolatedFielmap_kernels[_name].n_threads)
+
+# Maps having a single precision counterpart
+_single_precision_maps = ['rho', 'phi', 'dphi_dx', 'dphi_dy', 'dphi_dz',
+                          'dphi_xyz']
+
+# Order of the shape functions used for the deposition and the interpolation
+_particle_shapes = {'cic': 1, 'tsc': 2}
+
+# Quantities that can be interpolated (in the order in which they are
+# returned)
+_interpolated_quantities = ('rho', 'phi', 'dphi_dx', 'dphi_dy', 'dphi_dz')
+
+# Position of the derivatives in the interleaved storage
+_interleaved_dphi_components = {'dphi_dx': 0, 'dphi_dy': 1, 'dphi_dz': 2}
+
+# Transverse and longitudinal factors of the quantities stored in separable
+# form (e.g. phi[ix, iy, iz] = phi_xy[ix, iy] * lambda_z[iz])
+_separable_factors = {
+    'phi': ('phi_xy', 'lambda_z'),
+    'dphi_dx': ('dphi_xy_dx', 'lambda_z'),
+    'dphi_dy': ('dphi_xy_dy', 'lambda_z'),
+    'dphi_dz': ('phi_xy', 'dlambda_z_dz'),
+}
+
+
+_deposition_modes = ('auto', 'atomic', 'private_grids')
 
 class TriLinearInterpolatedFieldMap(xo.HybridClass):
 
@@ -121,15 +212,64 @@ class TriLinearInterpolatedFieldMap(xo.HybridClass):
             Volts. If not provided the ``phi`` is calculated from ``rho``
             using the Poisson solver (if available).
         solver (str or solver object): Defines the Poisson solver to be used
-            to compute phi from rho. Accepted values are ``FFTSolver3D`` and
-            ``FFTSolver2p5D``. A Xfields solver object can also be provided.
+            to compute phi from rho. Accepted values are ``FFTSolver3D``,
+            ``FFTSolver2p5D``, ``FFTSolver2p5DAveraged`` (open boundaries),
+            ``FFTSolverRectPipe3D`` and ``FFTSolverRectPipe2p5D`` (grounded
+            rectangular chamber located half a cell outside the grid).
+            A Xfields solver object can also be provided.
             In case ``update_on_track``is ``False`` and ``phi`` is provided
             by the user, this argument can be omitted.
+        solver_kwargs (dict): Additional keyword arguments passed to the
+            solver constructor when ``solver`` is given by name
+            (e.g. ``{'use_rfft': True}``).
         scale_coordinates_in_solver (tuple): Three coefficients used to rescale
             the grid coordinates in the definition of the solver. The default is
             (1.,1.,1.).
         updatable (bool): If ``True`` the field map can be updated after
             creation. Default is ``True``.
+        separable_phi (bool): If ``True`` the potential is stored in the
+            separable form ``phi[ix, iy, iz] = phi_xy[ix, iy] * lambda_z[iz]``
+            and the 3D potential and its derivatives are not allocated (they
+            are evaluated on the fly by the interpolation). It requires a
+            solver providing ``solve_separable`` (``FFTSolver2p5DAveraged``).
+            The default is ``False``.
+        dtype (str or np.dtype): Floating point type of the charge density,
+            of the potential and of its derivatives (``'float64'`` or
+            ``'float32'``). It is also used by the solvers generated by
+            name. Particle coordinates and interpolated quantities are
+            always in double precision. The default is ``'float64'``.
+        interleaved_dphi (bool): If ``True`` the three derivatives of the
+            potential are stored interleaved in a single array
+            (``dphi_xyz[3*i + k]``, with ``k`` = 0, 1, 2 for x, y, z), so
+            that the interpolation reads the three of them from the same
+            memory region for each grid point. ``dphi_dx``, ``dphi_dy`` and
+            ``dphi_dz`` are then strided views of this array. It is not
+            available with ``separable_phi``. The default is ``False``.
+        deposition (str): Strategy used to deposit the charge on the grid.
+            ``'atomic'`` uses atomic additions on the shared grid.
+            ``'private_grids'`` (CPU contexts only) deposits on one private
+            grid per thread, which are then summed in parallel, avoiding the
+            contention between threads in the dense regions of the beam at
+            the cost of extra memory. ``'auto'`` (default) uses the private
+            grids on OpenMP CPU contexts when their reduction is cheaper than
+            the deposition itself.
+        sort_particles_interval (int): If larger than zero, the particles
+            passed to ``update_from_particles`` are reordered in memory by
+            grid cell (see ``sort_particles``) every
+            ``sort_particles_interval`` calls, so that the deposition and
+            the interpolation access the grid memory sequentially. The
+            default is ``0`` (no sorting).
+        particle_shape (str): Shape function of the macroparticles used both
+            to deposit the charge and to interpolate the maps. ``'cic'``
+            (default) uses the first order cloud-in-cell weights on the 8
+            grid points around each particle. ``'tsc'`` uses the second
+            order triangular-shaped-cloud weights on the 27 grid points
+            around the nearest one, which gives a smoother charge density
+            and smoother forces (lower noise for the same number of
+            macroparticles) at the cost of more memory accesses. With
+            ``'tsc'`` the particles closer than half a cell to the edges of
+            the grid are neither deposited nor kicked. It is not available
+            with ``separable_phi``.
     Returns:
         (TriLinearInterpolatedFieldMap): Interpolator object.
     """
@@ -149,6 +289,23 @@ class TriLinearInterpolatedFieldMap(xo.HybridClass):
         'dphi_dx': xo.Float64[:],
         'dphi_dy': xo.Float64[:],
         'dphi_dz': xo.Float64[:],
+        'separable_phi': xo.Int64,
+        'phi_xy': xo.Float64[:],
+        'dphi_xy_dx': xo.Float64[:],
+        'dphi_xy_dy': xo.Float64[:],
+        'lambda_z': xo.Float64[:],
+        'dlambda_z_dz': xo.Float64[:],
+        'single_precision': xo.Int64,
+        'rho_f32': xo.Float32[:],
+        'phi_f32': xo.Float32[:],
+        'dphi_dx_f32': xo.Float32[:],
+        'dphi_dy_f32': xo.Float32[:],
+        'dphi_dz_f32': xo.Float32[:],
+        'interleaved_dphi': xo.Int64,
+        'dphi_xyz': xo.Float64[:],
+        'dphi_xyz_f32': xo.Float32[:],
+        'shape_order': xo.Int64,
+        'sort_particles_interval': xo.Int64,
     }
 
     # I add undescores in front of the names so that I can define custom
@@ -159,8 +316,10 @@ class TriLinearInterpolatedFieldMap(xo.HybridClass):
         _pkg_root.joinpath('headers/constants.h'),
         xt.general._pkg_root.joinpath('headers/atomicadd.h'),
         _pkg_root.joinpath('fieldmaps/interpolated_src/central_diff.h'),
+        _pkg_root.joinpath('fieldmaps/interpolated_src/tsc_weights.h'),
         _pkg_root.joinpath('fieldmaps/interpolated_src/linear_interpolators.h'),
         _pkg_root.joinpath('fieldmaps/interpolated_src/charge_deposition.h'),
+        _pkg_root.joinpath('fieldmaps/interpolated_src/particle_sorting.h'),
         ]
 
     _depends_on = [xt.Particles]
@@ -178,11 +337,22 @@ class TriLinearInterpolatedFieldMap(xo.HybridClass):
                  x_grid=None, y_grid=None, z_grid=None,
                  rho=None, phi=None,
                  solver=None,
+                 solver_kwargs=None,
                  scale_coordinates_in_solver=(1.,1.,1.),
                  updatable=True,
-                 fftplan=None
+                 fftplan=None,
+                 separable_phi=False,
+                 dtype='float64',
+                 interleaved_dphi=False,
+                 deposition='auto',
+                 sort_particles_interval=0,
+                 particle_shape='cic',
                  ):
 
+        self._n_updates_from_particles = 0
+        # Plans without output buffer used by get_values_at_points
+        self._interpolation_plans = {}
+
         if _xobject is not None:
             self.xoinitialize(_xobject=_xobject, _context=_context,
                              _buffer=_buffer, _offset=_offset)
@@ -191,11 +361,60 @@ class TriLinearInterpolatedFieldMap(xo.HybridClass):
         self.updatable = updatable
         self.scale_coordinates_in_solver = scale_coordinates_in_solver
 
+        if deposition not in _deposition_modes:
+            raise ValueError(f'deposition {deposition} not recognized')
+        if (deposition == 'private_grids'
+                and not isinstance(_context or getattr(_buffer, 'context', None)
+                                   or xo.context_default, xo.ContextCpu)):
+            raise ValueError('`private_grids` deposition is available only '
+                             'on CPU contexts')
+        self.deposition = deposition
+        self._private_grids = None
+
         self._x_grid = _configure_grid('x', x_grid, dx, x_range, nx)
         self._y_grid = _configure_grid('y', y_grid, dy, y_range, ny)
         self._z_grid = _configure_grid('z', z_grid, dz, z_range, nz)
 
+        dtype = np.dtype(dtype)
+        if dtype == np.float32:
+            single_precision = True
+        elif dtype == np.float64:
+            single_precision = False
+        else:
+            raise ValueError(f'dtype {dtype} not supported')
+
+        if single_precision and separable_phi:
+            raise ValueError('`separable_phi` is not available in single '
+                             'precision')
+        if interleaved_dphi and separable_phi:
+            raise ValueError('`interleaved_dphi` is not available with '
+                             '`separable_phi`')
+        if particle_shape not in _particle_shapes:
+            raise ValueError(f'particle_shape {particle_shape} not recognized')
+        if particle_shape != 'cic' and separable_phi:
+            raise ValueError('`separable_phi` is available only with the '
+                             '`cic` particle shape')
+
         nelem = self.nx*self.ny*self.nz
+        if separable_phi:
+            nelem_phi, nelem_xy, nelem_z = 0, self.nx*self.ny, self.nz
+        else:
+            nelem_phi, nelem_xy, nelem_z = nelem, 0, 0
+
+        # Only the maps with the chosen precision and layout are allocated
+        if single_precision:
+            nelem_rho, nelem_rho_f32 = 0, nelem
+            nelem_phi, nelem_phi_f32 = 0, nelem_phi
+        else:
+            nelem_rho, nelem_rho_f32 = nelem, 0
+            nelem_phi_f32 = 0
+        if interleaved_dphi:
+            nelem_dphi, nelem_dphi_f32 = 0, 0
+            nelem_dphi_xyz = 3 * nelem_phi
+            nelem_dphi_xyz_f32 = 3 * nelem_phi_f32
+        else:
+            nelem_dphi, nelem_dphi_f32 = nelem_phi, nelem_phi_f32
+            nelem_dphi_xyz, nelem_dphi_xyz_f32 = 0, 0
         self.xoinitialize(
                  _context=_context,
                  _buffer=_buffer,
@@ -209,19 +428,32 @@ class TriLinearInterpolatedFieldMap(xo.HybridClass):
                  dx = self.dx,
                  dy = self.dy,
                  dz = self.dz,
-                 rho = nelem,
-                 phi = nelem,
-                 dphi_dx = nelem,
-                 dphi_dy = nelem,
-                 dphi_dz = nelem)
+                 rho = nelem_rho,
+                 phi = nelem_phi,
+                 dphi_dx = nelem_dphi,
+                 dphi_dy = nelem_dphi,
+                 dphi_dz = nelem_dphi,
+                 separable_phi = separable_phi,
+                 phi_xy = nelem_xy,
+                 dphi_xy_dx = nelem_xy,
+                 dphi_xy_dy = nelem_xy,
+                 lambda_z = nelem_z,
+                 dlambda_z_dz = nelem_z,
+                 single_precision = single_precision,
+                 rho_f32 = nelem_rho_f32,
+                 phi_f32 = nelem_phi_f32,
+                 dphi_dx_f32 = nelem_dphi_f32,
+                 dphi_dy_f32 = nelem_dphi_f32,
+                 dphi_dz_f32 = nelem_dphi_f32,
+                 interleaved_dphi = interleaved_dphi,
+                 dphi_xyz = nelem_dphi_xyz,
+                 dphi_xyz_f32 = nelem_dphi_xyz_f32,
+                 shape_order = _particle_shapes[particle_shape],
+                 sort_particles_interval = sort_particles_interval)
 
         self.compile_kernels(only_if_needed=True)
 
-        if isinstance(solver, str):
-            self.solver = self.generate_solver(solver, fftplan)
-        else:
-            #TODO: consistency check to be added
-            self.solver = solver
+        self._init_solver(solver, fftplan, solver_kwargs)
 
         # Set rho
         if rho is not None:
@@ -234,6 +466,114 @@ class TriLinearInterpolatedFieldMap(xo.HybridClass):
             if solver is not None and rho is not None:
                 self.update_phi_from_rho()
 
+    def _init_solver(self, solver, fftplan, solver_kwargs):
+
+        if solver_kwargs is None:
+            solver_kwargs = {}
+
+        if isinstance(solver, str):
+            self.solver = self.generate_solver(solver, fftplan,
+                                               **solver_kwargs)
+            # Kept to regenerate the solver if the cell size is changed
+            self._solver_settings = (solver, fftplan, solver_kwargs)
+        else:
+            #TODO: consistency check to be added
+            self.solver = solver
+            self._solver_settings = None
+        self._solvers_by_cell_size = OrderedDict()
+        self._solvers_by_cell_size[(self._dx, self._dy)] = self.solver
+
+    def to_file(self, filename, reserve=65536):
+
+        """
+        Saves the field map to a binary file, which can be loaded with
+        ``TriLinearInterpolatedFieldMap.from_file``. The file contains the
+        grid description, all the stored maps (charge density, potential and
+        derivatives, in the precision and layout of the field map) and the
+        settings needed to regenerate the solver (if it was given by name).
+
+        Args:
+            filename (str or Path): Name of the file.
+            reserve (int): Number of bytes left free after the field map in
+                the loaded buffer, to allocate other objects (e.g. the
+                ``SpaceCharge3D`` element using the map) without copying
+                the buffer. The default is 64 kB.
+        """
+
+        solver_settings = None
+        if self._solver_settings is not None:
+            solver, fftplan, solver_kwargs = self._solver_settings
+            solver_kwargs = _jsonable_kwargs(solver_kwargs)
+            if fftplan is None and solver_kwargs is not None:
+                solver_settings = [solver, solver_kwargs]
+
+        metadata = {
+            'x_grid': self.x_grid.tolist(),
+            'y_grid': self.y_grid.tolist(),
+            'z_grid': self.z_grid.tolist(),
+            'updatable': bool(self.updatable),
+            'scale_coordinates_in_solver':
+                        [float(vv) for vv in self.scale_coordinates_in_solver],
+            'solver': solver_settings,
+            'deposition': self.deposition,
+        }
+
+        _write_fieldmap_file(self, filename, metadata, reserve)
+
+    @classmethod
+    def from_file(cls, filename, _context=None, mmap_mode='c', solver=None,
+                  solver_kwargs=None, updatable=None):
+
+        """
+        Loads a field map saved with ``to_file``. On CPU contexts the
+        buffer of the field map is memory-mapped from the file, so that the
+        processes loading the same file share the memory pages of the maps
+        (until they are modified).
+
+        Args:
+            filename (str or Path): Name of the file.
+            _context (xobjects context): Context on which the field map is
+                loaded. On GPU contexts the file is read and copied to the
+                device.
+            mmap_mode (str): Mode used to memory-map the file on CPU
+                contexts (see ``np.memmap``). With ``'c'`` (default) the
+                pages are shared until they are written, and the changes are
+                not saved to the file. With ``'r'`` the map cannot be
+                modified. If ``None`` the file is read into memory.
+            solver (str or solver object): Poisson solver of the loaded map.
+                If ``None`` (default) the solver is regenerated from the
+                settings stored in the file, if any.
+            solver_kwargs (dict): Additional keyword arguments passed to the
+                solver constructor (e.g. a shared ``green_function_cache``),
+                updating the stored ones.
+            updatable (bool): If given, overrides the stored setting.
+        Returns:
+            (TriLinearInterpolatedFieldMap): Field map object.
+        """
+
+        xobject, metadata = _load_fieldmap_xobject(cls, filename, _context,
+                                                   mmap_mode)
+        self = cls(_xobject=xobject)
+
+        self._x_grid = np.array(metadata['x_grid'])
+        self._y_grid = np.array(metadata['y_grid'])
+        self._z_grid = np.array(metadata['z_grid'])
+        self.updatable = (metadata['updatable'] if updatable is None
+                          else updatable)
+        self.scale_coordinates_in_solver = tuple(
+                                    metadata['scale_coordinates_in_solver'])
+        self.deposition = metadata['deposition']
+        self._private_grids = None
+
+        self.compile_kernels(only_if_needed=True)
+
+        if solver is None and metadata['solver'] is not None:
+            solver, stored_kwargs = metadata['solver']
+            solver_kwargs = {**stored_kwargs, **(solver_kwargs or {})}
+        self._init_solver(solver, None, solver_kwargs)
+
+        return self
+
     def _assert_updatable(self):
         assert self.updatable, 'This FieldMap is not updatable!'
 
@@ -251,6 +591,11 @@ class TriLinearInterpolatedFieldMap(xo.HybridClass):
         at the points specified by x, y, z. The output can be customized (see below).
         Zeros are returned for points outside the grid.
 
+        This is the convenience path: a new output array is allocated at each
+        call, so that the returned values are not modified by later calls.
+        For repeated interpolations, use ``plan_interpolation``, whose
+        output buffer is allocated once and reused.
+
         Args:
             x (float64 array): Horizontal coordinates at which the field is evaluated.
             y (float64 array): Vertical coordinates at which the field is evaluated.
@@ -270,45 +615,69 @@ class TriLinearInterpolatedFieldMap(xo.HybridClass):
 
         assert len(x) == len(y) == len(z)
 
-        pos_in_buffer_of_maps_to_interp = []
-        if return_rho:
-            pos_in_buffer_of_maps_to_interp.append(
-                    self._xobject.rho._offset + self._xobject.rho._data_offset)
-        if return_phi:
-            pos_in_buffer_of_maps_to_interp.append(
-                    self._xobject.phi._offset + self._xobject.phi._data_offset)
-        if return_dphi_dx:
-            pos_in_buffer_of_maps_to_interp.append(
-                    self._xobject.dphi_dx._offset + self._xobject.dphi_dx._data_offset)
-        if return_dphi_dy:
-            pos_in_buffer_of_maps_to_interp.append(
-                    self._xobject.dphi_dy._offset + self._xobject.dphi_dy._data_offset)
-        if return_dphi_dz:
-            pos_in_buffer_of_maps_to_interp.append(
-                    self._xobject.dphi_dz._offset + self._xobject.dphi_dz._data_offset)
+        quantities = [nn for nn, flag in [('rho', return_rho),
+                                          ('phi', return_phi),
+                                          ('dphi_dx', return_dphi_dx),
+                                          ('dphi_dy', return_dphi_dy),
+                                          ('dphi_dz', return_dphi_dz)]
+                      if flag]
 
-        context = self._buffer.context
+        # The plans (without output buffer) are kept to avoid rebuilding
+        # the offsets of the maps at each call
+        key = tuple(quantities)
+        if key not in self._interpolation_plans:
+            self._interpolation_plans[key] = self.plan_interpolation(
+                                        max_points=0, quantities=quantities)
 
-        pos_in_buffer_of_maps_to_interp = context.nparray_to_context_array(
-                        np.array(pos_in_buffer_of_maps_to_interp, dtype=np.int64))
-        nmaps_to_interp = len(pos_in_buffer_of_maps_to_interp)
-        buffer_out = context.zeros(
-                shape=(nmaps_to_interp * len(x),), dtype=np.float64)
-        if nmaps_to_interp > 0:
-            context.kernels.TriLinearInterpolatedFieldMap_interpolate_3d_map_vector(
-                    fmap=self._xobject,
-                    n_points=len(x),
-                    x=x, y=y, z=z,
-                    n_quantities=nmaps_to_interp,
-                    buffer_mesh_quantities=self._buffer.buffer,
-                    offsets_mesh_quantities=pos_in_buffer_of_maps_to_interp,
-                    particles_quantities=buffer_out)
+        out = self._buffer.context.zeros(shape=(len(quantities), len(x)),
+                                         dtype=np.float64)
 
-        # Split buffer
-        particles_quantities = [buffer_out[ii*len(x):(ii+1)*len(x)]
-                                        for ii in range(nmaps_to_interp)]
+        return self._interpolation_plans[key].evaluate(x, y, z, out=out)
 
-        return particles_quantities
+    def plan_interpolation(self, max_points, quantities=('rho', 'phi',
+                           'dphi_dx', 'dphi_dy', 'dphi_dz')):
+
+        """
+        Creates an interpolation plan, to be used instead of
+        ``get_values_at_points`` when the same quantities are interpolated
+        repeatedly (e.g. at every interaction). The plan prepares once the
+        description of the maps to be interpolated and an output buffer
+        for ``max_points`` points, which is reused by all the calls.
+
+        Args:
+            max_points (int): Maximum number of points interpolated in one
+                call using the output buffer of the plan.
+            quantities (list of str): Quantities to be interpolated among
+                ``'rho'``, ``'phi'``, ``'dphi_dx'``, ``'dphi_dy'`` and
+                ``'dphi_dz'``. They are returned in this order.
+        Returns:
+            (TriLinearInterpolationPlan): Interpolation plan.
+        """
+
+        return TriLinearInterpolationPlan(fieldmap=self,
+                                          max_points=max_points,
+                                          quantities=quantities)
+
+    def _field_name(self, name):
+        if self.interleaved_dphi and name in _interleaved_dphi_components:
+            name = 'dphi_xyz'
+        if self.single_precision and name in _single_precision_maps:
+            return name + '_f32'
+        return name
+
+    def _pos_in_buffer(self, name):
+        arr = getattr(self._xobject, self._field_name(name))
+        pos = arr._offset + arr._data_offset
+        if self.interleaved_dphi and name in _interleaved_dphi_components:
+            pos += _interleaved_dphi_components[name] * self.dtype.itemsize
+        return pos
+
+    def _stride_in_map(self, name):
+        # Distance (in elements) between consecutive grid points in the
+        # array storing the map
+        if self.interleaved_dphi and name in _interleaved_dphi_components:
+            return 3
+        return 1
 
     #@profile
     def update_from_particles(self,
@@ -323,7 +692,13 @@ class TriLinearInterpolatedFieldMap(xo.HybridClass):
         The potential can be optionally updated accordingly.
 
         Args:
-            particles (xtrack.Particles): xtrack particle object.
+            particles (xtrack.Particles or list): xtrack particle object. A
+                list of particle objects (e.g. several bunches or species)
+                can also be given, in which case the charge of all of them
+                is accumulated on the grid, with one kernel launch per
+                particle object and without copies of their coordinates,
+                and the potential is computed only once. The charge of each
+                macroparticle is ``weight * q0 * charge_ratio``.
             x_p (float64 array): Horizontal coordinates of the macroparticles.
             y_p (float64 array): Vertical coordinates of the macroparticles.
             z_p (float64 array): Longitudinal coordinates of the macroparticles.
@@ -346,9 +721,49 @@ class TriLinearInterpolatedFieldMap(xo.HybridClass):
         if not force:
             self._assert_updatable()
 
+        if isinstance(particles, (list, tuple)):
+            sources = list(particles)
+        elif particles is not None:
+            sources = [particles]
+        else:
+            sources = []
+
+        if sources and self.sort_particles_interval:
+            if (self._n_updates_from_particles
+                    % self.sort_particles_interval == 0):
+                for pp in sources:
+                    self.sort_particles(pp)
+            self._n_updates_from_particles += 1
+
         if reset:
             self.rho[:,:,:] = 0.
 
+        if isinstance(particles, (list, tuple)):
+            assert (x_p is None and y_p is None and z_p is None
+                    and ncharges_p is None and state_p is None)
+            # All the sources are deposited on the same grid, one kernel
+            # launch per source (the kernels act on a single particles
+            # object, a concatenation would copy all the coordinates)
+            for pp in sources:
+                self._deposit_charge(particles=pp)
+        else:
+            self._deposit_charge(particles=particles, x_p=x_p, y_p=y_p,
+                                 z_p=z_p, ncharges_p=ncharges_p,
+                                 state_p=state_p, q0_coulomb=q0_coulomb)
+
+        if hasattr(self, '_average_transverse_distribution'):
+            raise NotImplementedError(
+                '`_average_transverse_distribution` has been removed, '
+                'use `solver=FFTSolver2p5DAveraged` instead')
+
+        if update_phi:
+            self.update_phi_from_rho(solver=solver)
+
+    def _deposit_charge(self, particles=None, x_p=None, y_p=None, z_p=None,
+                        ncharges_p=None, state_p=None, q0_coulomb=None):
+
+        # Adds the charge density of the given particles to the stored one
+
         context = self._buffer.context
 
         if particles is None:
@@ -358,37 +773,147 @@ class TriLinearInterpolatedFieldMap(xo.HybridClass):
             else:
                 assert len(state_p) == len(x_p)
 
-            context.kernels.p2m_rectmesh3d(
-                    nparticles=len(x_p),
-                    x=x_p, y=y_p, z=z_p,
-                    part_weights=q0_coulomb*ncharges_p,
-                    part_state=state_p,
-                    x0=self.x_grid[0], y0=self.y_grid[0], z0=self.z_grid[0],
-                    dx=self.dx, dy=self.dy, dz=self.dz,
-                    nx=self.nx, ny=self.ny, nz=self.nz,
-                    grid1d_buffer=self._xobject.rho._buffer.buffer,
-                    grid1d_offset=self._xobject.rho._offset
-                                 +self._xobject.rho._data_offset)
+            kernel_name = 'p2m_rectmesh3d'
+            nparticles = len(x_p)
+            kwargs = dict(x=x_p, y=y_p, z=z_p,
+                          part_weights=q0_coulomb*ncharges_p,
+                          part_state=state_p)
         else:
             assert (x_p is None and y_p is None and z_p is None
                     and ncharges_p is None and state_p is None)
-            context.kernels.p2m_rectmesh3d_xparticles(
-                    nparticles=particles._capacity,
-                    particles=particles,
-                    x0=self.x_grid[0], y0=self.y_grid[0], z0=self.z_grid[0],
-                    dx=self.dx, dy=self.dy, dz=self.dz,
-                    nx=self.nx, ny=self.ny, nz=self.nz,
-                    grid1d_buffer=self._xobject.rho._buffer.buffer,
-                    grid1d_offset=self._xobject.rho._offset
-                                 +self._xobject.rho._data_offset)
+            kernel_name = 'p2m_rectmesh3d_xparticles'
+            nparticles = particles._capacity
+            kwargs = dict(particles=particles)
+
+        n_grids = self._n_private_grids(nparticles)
+        if n_grids > 0:
+            # The private grids are in double precision also for single
+            # precision maps
+            kernel_name += '_private'
+            kwargs.update(n_grids=n_grids,
+                          private_grids=self._get_private_grids(n_grids))
+
+        getattr(context.kernels, kernel_name)(
+                nparticles=nparticles,
+                x0=self.x_grid[0], y0=self.y_grid[0], z0=self.z_grid[0],
+                dx=self.dx, dy=self.dy, dz=self.dz,
+                nx=self.nx, ny=self.ny, nz=self.nz,
+                shape_order=self._shape_order,
+                grid_is_f32=int(self.single_precision),
+                grid1d_buffer=self._buffer.buffer,
+                grid1d_offset=self._pos_in_buffer('rho'),
+                **kwargs)
+
+    def sort_particles(self, particles):
 
-        if hasattr(self, '_average_transverse_distribution'):
-            raise NotImplementedError(
-                '`_average_transverse_distribution` has been removed, '
-                'use `solver=FFTSolver2p5DAveraged` instead')
+        """
+        Reorders the particles in memory by the index of the grid cell in
+        which they are located (flattened in the storage order of the maps),
+        so that the deposition and the interpolation access the grid
+        sequentially. Active particles are placed first and the lost ones
+        at the end (as in ``particles.reorganize()``), particles outside the
+        grid follow the ones inside it. All per-particle variables
+        (including ``particle_id``) are moved together.
 
-        if update_phi:
-            self.update_phi_from_rho(solver=solver)
+        Args:
+            particles (xtrack.Particles): xtrack particle object.
+        """
+
+        context = particles._buffer.context
+        if isinstance(context, xo.ContextPyopencl):
+            raise NotImplementedError('Sorting is not available on OpenCL')
+
+        if particles.lost_particles_are_hidden:
+            restore_hidden = True
+            particles.unhide_lost_particles()
+        else:
+            restore_hidden = False
+
+        n_active, _ = particles.reorganize()
+
+        cell_id = self._cell_index(particles.x[:n_active],
+                                   particles.y[:n_active],
+                                   particles.zeta[:n_active])
+        # Stable, particles in the same cell keep their relative order
+        if isinstance(context, xo.ContextCpu):
+            # Counting sort, O(n_particles + n_cells)
+            n_cells = self.nx * self.ny * self.nz
+            sorted_index = context.zeros(n_active, dtype=np.int64)
+            context.kernels.cell_sort_permutation(
+                    n_points=n_active,
+                    cell_id=cell_id,
+                    n_cells=n_cells,
+                    counts=context.zeros(n_cells + 1, dtype=np.int64),
+                    permutation=sorted_index)
+        else:
+            sorted_index = context.nplike_lib.argsort(cell_id, kind='stable')
+
+        with particles._bypass_linked_vars():
+            for _, nn in particles.per_particle_vars:
+                vv = getattr(particles, nn)
+                vv[:n_active] = vv[:n_active][sorted_index]
+
+        if restore_hidden:
+            particles.hide_lost_particles(_assume_reorganized=True)
+
+    def _cell_index(self, x, y, z):
+
+        # Flattened index of the cell containing each point (the same
+        # convention of the deposition kernels). Points outside the grid get
+        # the number of cells.
+
+        nplike_lib = self._buffer.context.nplike_lib
+        nx, ny, nz = self.nx, self.ny, self.nz
+        jx = nplike_lib.floor((x - self._x_min) / self._dx).astype(np.int64)
+        jy = nplike_lib.floor((y - self._y_min) / self._dy).astype(np.int64)
+        jz = nplike_lib.floor((z - self._z_min) / self._dz).astype(np.int64)
+
+        inside = ((jx >= 0) & (jx < nx - 1) & (jy >= 0) & (jy < ny - 1)
+                  & (jz >= 0) & (jz < nz - 1))
+
+        return nplike_lib.where(inside, jx + nx * (jy + ny * jz), nx * ny * nz)
+
+    # Maximum memory used by the private grids in 'auto' deposition mode
+    max_private_grids_bytes = 512 * 1024**2
+
+    def _n_private_grids(self, nparticles):
+
+        # Returns the number of private grids to be used for the deposition
+        # (0 for the deposition with atomic additions)
+
+        deposition = getattr(self, 'deposition', 'atomic')
+        if deposition == 'atomic':
+            return 0
+
+        context = self._buffer.context
+        if not isinstance(context, xo.ContextCpu):
+            return 0
+
+        n_threads = 1
+        if context.openmp_enabled:
+            n_threads = context.omp_get_max_threads()
+
+        if deposition == 'private_grids':
+            return n_threads
+
+        # 'auto': the reduction costs about n_threads * n_cells operations
+        # and the deposition 8 * n_particles operations. Without OpenMP the
+        # additions are not atomic and the private grids bring no gain.
+        n_cells = self.nx * self.ny * self.nz
+        if (context.openmp_enabled
+                and n_threads * n_cells <= nparticles
+                and n_threads * n_cells * 8 <= self.max_private_grids_bytes):
+            return n_threads
+        return 0
+
+    def _get_private_grids(self, n_grids):
+        n_cells = self.nx * self.ny * self.nz
+        if (self._private_grids is None
+                or len(self._private_grids) < n_grids * n_cells):
+            # No need to initialize, the grids are cleared by the kernel
+            self._private_grids = self._buffer.context.zeros(
+                                        n_grids * n_cells, dtype=np.float64)
+        return self._private_grids
 
     def update_rho(self, rho, reset=True, force=False):
         """
@@ -409,7 +934,7 @@ class TriLinearInterpolatedFieldMap(xo.HybridClass):
         if reset:
             self.rho[:,:,:] = rho
         else:
-            raise ValueError('Not implemented!')
+            self.rho[:,:,:] += rho
 
     #@profile
     def update_phi(self, phi, reset=True, force=False):
@@ -430,47 +955,77 @@ class TriLinearInterpolatedFieldMap(xo.HybridClass):
         if not force:
             self._assert_updatable()
 
+        if self.separable_phi:
+            raise ValueError('The potential of a field map with '
+                             '`separable_phi=True` can only be computed '
+                             'by the solver')
+
         if reset:
             self.phi.T[:,:,:] = phi.T
         else:
-            raise ValueError('Not implemented!')
+            self.phi.T[:,:,:] += phi.T
+
+        # The derivatives are linear in phi, they are recomputed from the
+        # total potential
+        self._update_dphi_from_phi()
+
+    def _update_dphi_from_phi(self):
+
+        context = self._buffer.context
+
+        if self.separable_phi:
+            self._update_dphi_from_separable_phi()
+            return
+
+        # Compute the three derivatives in a single pass
+        context.kernels.central_diff_3d(
+                nelem = self.nx * self.ny * self.nz,
+                nx = self.nx, ny = self.ny, nz = self.nz,
+                factor_x = 1/(2*self.dx),
+                factor_y = 1/(2*self.dy),
+                factor_z = 1/(2*self.dz),
+                matrix_buffer = self._buffer.buffer,
+                matrix_offset = self._pos_in_buffer('phi'),
+                res_buffer = self._buffer.buffer,
+                res_offset_x = self._pos_in_buffer('dphi_dx'),
+                res_offset_y = self._pos_in_buffer('dphi_dy'),
+                res_offset_z = self._pos_in_buffer('dphi_dz'),
+                res_stride = self._stride_in_map('dphi_dx'),
+                is_f32 = int(self.single_precision))
+
+    def _update_dphi_from_separable_phi(self):
 
         context = self._buffer.context
 
-        # Compute gradient
+        # Transverse derivatives (the longitudinal factor is unchanged)
         context.kernels.central_diff(
-                nelem = self.phi.size,
+                nelem = self.phi_xy.size,
                 row_size = self.nx,
-                stride_in_dbl = self.phi.strides[0]/8,
+                stride_in_dbl = self.phi_xy.strides[0]/8,
                 factor = 1/(2*self.dx),
-                matrix_buffer = self._xobject.phi._buffer.buffer,
-                matrix_offset = (self._xobject.phi._offset
-                               + self._xobject.phi._data_offset),
-                res_buffer = self._xobject.dphi_dx._buffer.buffer,
-                res_offset = (self._xobject.dphi_dx._offset
-                            + self._xobject.dphi_dx._data_offset))
+                matrix_buffer = self._xobject.phi_xy._buffer.buffer,
+                matrix_offset = self._pos_in_buffer('phi_xy'),
+                res_buffer = self._xobject.dphi_xy_dx._buffer.buffer,
+                res_offset = self._pos_in_buffer('dphi_xy_dx'))
         context.kernels.central_diff(
-                nelem = self.phi.size,
+                nelem = self.phi_xy.size,
                 row_size = self.ny,
-                stride_in_dbl = self.phi.strides[1]/8,
+                stride_in_dbl = self.phi_xy.strides[1]/8,
                 factor = 1/(2*self.dy),
-                matrix_buffer = self._xobject.phi._buffer.buffer,
-                matrix_offset = (self._xobject.phi._offset
-                               + self._xobject.phi._data_offset),
-                res_buffer = self._xobject.dphi_dy._buffer.buffer,
-                res_offset = (self._xobject.dphi_dy._offset
-                            + self._xobject.dphi_dy._data_offset))
+                matrix_buffer = self._xobject.phi_xy._buffer.buffer,
+                matrix_offset = self._pos_in_buffer('phi_xy'),
+                res_buffer = self._xobject.dphi_xy_dy._buffer.buffer,
+                res_offset = self._pos_in_buffer('dphi_xy_dy'))
+        # Longitudinal derivative (the transverse factor is unchanged)
         context.kernels.central_diff(
-                nelem = self.phi.size,
+                nelem = self.nz,
                 row_size = self.nz,
-                stride_in_dbl = self.phi.strides[2]/8,
+                stride_in_dbl = 1,
                 factor = 1/(2*self.dz),
-                matrix_buffer = self._xobject.phi._buffer.buffer,
-                matrix_offset = (self._xobject.phi._offset
-                               + self._xobject.phi._data_offset),
-                res_buffer = self._xobject.dphi_dz._buffer.buffer,
-                res_offset = (self._xobject.dphi_dz._offset
-                            + self._xobject.dphi_dz._data_offset))
+                matrix_buffer = self._xobject.lambda_z._buffer.buffer,
+                matrix_offset = self._pos_in_buffer('lambda_z'),
+                res_buffer = self._xobject.dlambda_z_dz._buffer.buffer,
+                res_offset = self._pos_in_buffer('dlambda_z_dz'))
 
     #@profile
     def update_phi_from_rho(self, solver=None):
@@ -494,48 +1049,164 @@ class TriLinearInterpolatedFieldMap(xo.HybridClass):
             else:
                 raise ValueError('I have no solver to compute phi!')
 
-        new_phi = solver.solve(self.rho)
-        self.update_phi(new_phi)
+        if self.separable_phi:
+            phi_xy, lambda_z = solver.solve_separable(self.rho)
+            self.phi_xy.T[:, :] = phi_xy.T
+            self.lambda_z[:] = lambda_z
+        else:
+            # The potential is written directly in the buffer of the fieldmap
+            solver.solve_into(self.rho, self.phi)
+        self._update_dphi_from_phi()
+
+    def update_transverse_grid(self, x_center=None, y_center=None,
+                               dx=None, dy=None, force=False):
+
+        """
+        Moves and/or rescales the transverse grid, keeping the number of
+        cells. The maps are not recomputed (this needs to be done, for
+        example, with ``update_from_particles``). If the cell size is
+        changed, a solver for the new grid is generated, which requires the
+        solver to have been given by name. The last solvers (at most
+        ``max_solvers_by_cell_size``, using at most
+        ``max_nbytes_solvers_by_cell_size`` bytes in total) are kept and
+        reused when the grid goes back to the same cell size. The grid of a
+        map using a rectangular pipe solver cannot be changed, as the
+        position and size of the chamber are defined by the grid.
+
+        Args:
+            x_center (float): Horizontal position of the center of the grid
+                in meters. If ``None`` the current one is kept.
+            y_center (float): Vertical position of the center of the grid
+                in meters. If ``None`` the current one is kept.
+            dx (float): Horizontal cell size in meters. If ``None`` the
+                current one is kept.
+            dy (float): Vertical cell size in meters. If ``None`` the current
+                one is kept.
+            force (bool): If ``True`` the grid is updated even if the map is
+                declared as not updatable.
+        """
+
+        if not force:
+            self._assert_updatable()
+
+        if isinstance(self.solver, (FFTSolverRectPipe3D,
+                                    FFTSolverRectPipe2p5D)):
+            raise ValueError('The grid cannot be changed with a rectangular '
+                             'pipe solver (the chamber is defined by the '
+                             'grid)')
+
+        if x_center is None:
+            x_center = 0.5 * (self.x_grid[0] + self.x_grid[-1])
+        if y_center is None:
+            y_center = 0.5 * (self.y_grid[0] + self.y_grid[-1])
+        if dx is None:
+            dx = self._dx
+        if dy is None:
+            dy = self._dy
+
+        if (dx, dy) != (self._dx, self._dy):
+            self.solver = self._get_solver_for_cell_size(dx, dy)
+
+        self._x_grid = x_center + (np.arange(self.nx) - 0.5*(self.nx - 1))*dx
+        self._y_grid = y_center + (np.arange(self.ny) - 0.5*(self.ny - 1))*dy
+        self._x_min = self._x_grid[0]
+        self._y_min = self._y_grid[0]
+        # The nominal cell sizes are stored (and not the ones obtained from
+        # the grid) so that the solvers can be reused
+        self._dx = dx
+        self._dy = dy
+
+    max_solvers_by_cell_size = 4
+    max_nbytes_solvers_by_cell_size = 512 * 1024**2
+
+    def _get_solver_for_cell_size(self, dx, dy):
+
+        key = (dx, dy)
+        if key in self._solvers_by_cell_size:
+            self._solvers_by_cell_size.move_to_end(key)
+            return self._solvers_by_cell_size[key]
+
+        if self._solver_settings is None:
+            raise ValueError('The cell size can be changed only if the '
+                             'solver is given by name')
+        solver_name, fftplan, solver_kwargs = self._solver_settings
+        solver = self._generate_solver(solver_name, fftplan, dx, dy,
+                                       self.dz, **solver_kwargs)
+
+        self._solvers_by_cell_size[key] = solver
+        # The new solver is always kept
+        nbytes = sum(_solver_nbytes(ss)
+                     for ss in self._solvers_by_cell_size.values())
+        while (len(self._solvers_by_cell_size) > 1 and (
+                len(self._solvers_by_cell_size) > self.max_solvers_by_cell_size
+                or nbytes > self.max_nbytes_solvers_by_cell_size)):
+            _, old_solver = self._solvers_by_cell_size.popitem(last=False)
+            nbytes -= _solver_nbytes(old_solver)
+
+        return solver
 
-    def generate_solver(self, solver, fftplan):
+    def generate_solver(self, solver, fftplan, **kwargs):
 
         """
         Generates a Poisson solver associated to the defined grid.
 
         Args:
             solver (str): Defines the Poisson solver to be used
-            to compute phi from rho. Accepted values are ``FFTSolver3D`` and
-            ``FFTSolver2p5D``.
+            to compute phi from rho. Accepted values are ``FFTSolver3D``,
+            ``FFTSolver2p5D``, ``FFTSolver2p5DAveraged``,
+            ``FFTSolverRectPipe3D`` and ``FFTSolverRectPipe2p5D``.
+            **kwargs: Additional arguments passed to the solver constructor.
         Returns:
             (Solver): Solver object associated to the defined grid.
         """
 
+        return self._generate_solver(solver, fftplan, self.dx, self.dy,
+                                     self.dz, **kwargs)
+
+    def _generate_solver(self, solver, fftplan, dx, dy, dz, **kwargs):
+
         scale_dx, scale_dy, scale_dz = self.scale_coordinates_in_solver
 
+        kwargs.setdefault('dtype', self.dtype)
+
         if solver == 'FFTSolver3D':
             solver = FFTSolver3D(
-                    dx=self.dx*scale_dx,
-                    dy=self.dy*scale_dy,
-                    dz=self.dz*scale_dz,
+                    dx=dx*scale_dx,
+                    dy=dy*scale_dy,
+                    dz=dz*scale_dz,
                     nx=self.nx, ny=self.ny, nz=self.nz,
                     context=self._buffer.context,
-                    fftplan=fftplan)
+                    fftplan=fftplan, **kwargs)
         elif solver == 'FFTSolver2p5D':
             solver = FFTSolver2p5D(
-                    dx=self.dx*scale_dx,
-                    dy=self.dy*scale_dy,
-                    dz=self.dz*scale_dz,
+                    dx=dx*scale_dx,
+                    dy=dy*scale_dy,
+                    dz=dz*scale_dz,
                     nx=self.nx, ny=self.ny, nz=self.nz,
                     context=self._buffer.context,
-                    fftplan=fftplan)
+                    fftplan=fftplan, **kwargs)
         elif solver == 'FFTSolver2p5DAveraged':
             solver = FFTSolver2p5DAveraged(
-                    dx=self.dx*scale_dx,
-                    dy=self.dy*scale_dy,
-                    dz=self.dz*scale_dz,
+                    dx=dx*scale_dx,
+                    dy=dy*scale_dy,
+                    dz=dz*scale_dz,
                     nx=self.nx, ny=self.ny, nz=self.nz,
                     context=self._buffer.context,
-                    fftplan=fftplan)
+                    fftplan=fftplan, **kwargs)
+        elif solver == 'FFTSolverRectPipe3D':
+            solver = FFTSolverRectPipe3D(
+                    dx=dx*scale_dx,
+                    dy=dy*scale_dy,
+                    dz=dz*scale_dz,
+                    nx=self.nx, ny=self.ny, nz=self.nz,
+                    context=self._buffer.context, **kwargs)
+        elif solver == 'FFTSolverRectPipe2p5D':
+            solver = FFTSolverRectPipe2p5D(
+                    dx=dx*scale_dx,
+                    dy=dy*scale_dy,
+                    dz=dz*scale_dz,
+                    nx=self.nx, ny=self.ny, nz=self.nz,
+                    context=self._buffer.context, **kwargs)
         else:
             raise ValueError(f'solver name {solver} not recognized')
 
@@ -604,36 +1275,296 @@ class TriLinearInterpolatedFieldMap(xo.HybridClass):
         """
         return self.z_grid[1] - self.z_grid[0]
 
+    @property
+    def single_precision(self):
+        """
+        ``True`` if the maps are stored in single precision.
+        """
+        return bool(self._single_precision)
+
+    @property
+    def dtype(self):
+        """
+        Floating point type of the maps.
+        """
+        return np.dtype(np.float32 if self.single_precision else np.float64)
+
+    def _get_map(self, name):
+        if self.interleaved_dphi and name in _interleaved_dphi_components:
+            # Strided view of the interleaved array
+            return self.dphi_xyz[_interleaved_dphi_components[name]]
+        return getattr(self, '_' + self._field_name(name)).reshape(
+                (self.nx, self.ny, self.nz), order='F')
+
+    @property
+    def interleaved_dphi(self):
+        """
+        ``True`` if the derivatives of the potential are stored interleaved.
+        """
+        return bool(self._interleaved_dphi)
+
+    @property
+    def particle_shape(self):
+        """
+        Shape function used for the deposition and the interpolation
+        (``'cic'`` or ``'tsc'``).
+        """
+        return {vv: kk for kk, vv in _particle_shapes.items()}[
+                                                    self._shape_order]
+
+    @property
+    def sort_particles_interval(self):
+        """
+        Number of calls of ``update_from_particles`` between two sortings
+        of the particles by grid cell (0 for no sorting).
+        """
+        return self._sort_particles_interval
+
+    @sort_particles_interval.setter
+    def sort_particles_interval(self, value):
+        self._sort_particles_interval = value
+
+    @property
+    def dphi_xyz(self):
+        """
+        Derivatives of the potential stored interleaved, with shape
+        (3, nx, ny, nz). Available only if ``interleaved_dphi`` is ``True``.
+        """
+        if not self.interleaved_dphi:
+            raise ValueError('The derivatives are not stored interleaved')
+        return getattr(self, '_' + self._field_name('dphi_xyz')).reshape(
+                (3, self.nx, self.ny, self.nz), order='F')
+
     # TODO: these reshapes can be avoided by allocating 3d arrays directly in the xobject
     @property
     def rho(self):
-        return self._rho.reshape(
-                (self.nx, self.ny, self.nz), order='F')
+        return self._get_map('rho')
+
+    @property
+    def separable_phi(self):
+        """
+        ``True`` if the potential is stored in separable form.
+        """
+        return bool(self._separable_phi)
 
     @property
     def phi(self):
         """
-        Electric potential at the grid points in Volts.
+        Electric potential at the grid points in Volts. If the potential is
+        stored in separable form, it is computed at each access.
         """
-        return self._phi.reshape(
-                (self.nx, self.ny, self.nz), order='F')
+        if self.separable_phi:
+            return self._separable_product('phi')
+        return self._get_map('phi')
 
     @property
     def dphi_dx(self):
-        return self._dphi_dx.reshape(
-                (self.nx, self.ny, self.nz), order='F')
+        if self.separable_phi:
+            return self._separable_product('dphi_dx')
+        return self._get_map('dphi_dx')
 
     @property
     def dphi_dy(self):
-        return self._dphi_dy.reshape(
-                (self.nx, self.ny, self.nz), order='F')
+        if self.separable_phi:
+            return self._separable_product('dphi_dy')
+        return self._get_map('dphi_dy')
 
     @property
     def dphi_dz(self):
-        return self._dphi_dz.reshape(
-                (self.nx, self.ny, self.nz), order='F')
+        if self.separable_phi:
+            return self._separable_product('dphi_dz')
+        return self._get_map('dphi_dz')
+
+    @property
+    def phi_xy(self):
+        """
+        Transverse factor of the potential (separable form only).
+        """
+        return self._phi_xy.reshape((self.nx, self.ny), order='F')
+
+    @property
+    def dphi_xy_dx(self):
+        return self._dphi_xy_dx.reshape((self.nx, self.ny), order='F')
+
+    @property
+    def dphi_xy_dy(self):
+        return self._dphi_xy_dy.reshape((self.nx, self.ny), order='F')
+
+    @property
+    def lambda_z(self):
+        """
+        Longitudinal factor of the potential (separable form only).
+        """
+        return self._lambda_z
+
+    @property
+    def dlambda_z_dz(self):
+        return self._dlambda_z_dz
+
+    def _separable_product(self, name):
+        name_xy, name_z = _separable_factors[name]
+        map_xy = getattr(self, name_xy)
+        map_z = getattr(self, name_z)
+        res = self._buffer.context.zeros((self.nx, self.ny, self.nz),
+                                         dtype=np.float64, order='F')
+        res.T[:, :, :] = map_z[:, None, None] * map_xy.T[None, :, :]
+        return res
+
+
+
+class TriLinearInterpolationPlan:
+
+    """
+    Interpolation of a fixed set of quantities of a
+    ``TriLinearInterpolatedFieldMap``, normally created with
+    ``TriLinearInterpolatedFieldMap.plan_interpolation``. The offsets of the
+    maps in the buffer and the output buffer are allocated on the context
+    once and reused by all the calls, so that repeated interpolations do not
+    require host-device transfers or allocations.
+
+    Args:
+        fieldmap (TriLinearInterpolatedFieldMap): Field map to be
+            interpolated.
+        max_points (int): Maximum number of points interpolated in one call
+            using the output buffer of the plan.
+        quantities (list of str): Quantities to be interpolated among
+            ``'rho'``, ``'phi'``, ``'dphi_dx'``, ``'dphi_dy'`` and
+            ``'dphi_dz'``. They are returned in this order.
+    Returns:
+        (TriLinearInterpolationPlan): Interpolation plan.
+    """
 
+    def __init__(self, fieldmap, max_points, quantities):
 
+        for nn in quantities:
+            if nn not in _interpolated_quantities:
+                raise ValueError(f'Cannot interpolate {nn}')
+
+        self.fieldmap = fieldmap
+        self.max_points = max_points
+        self.quantities = tuple(nn for nn in _interpolated_quantities
+                                if nn in quantities)
+
+        if fieldmap.separable_phi:
+            # rho is always stored as a 3D map
+            self._maps_3d = [nn for nn in self.quantities if nn == 'rho']
+            self._maps_separable = [nn for nn in self.quantities
+                                    if nn != 'rho']
+        else:
+            self._maps_3d = list(self.quantities)
+            self._maps_separable = []
+
+        self._prepare_offsets()
+
+        context = fieldmap._buffer.context
+        self._buffer_out = context.zeros(
+                shape=(len(self.quantities) * max_points,), dtype=np.float64)
+
+    def _prepare_offsets(self):
+
+        fmap = self.fieldmap
+        context = fmap._buffer.context
+
+        self._xobject = fmap._xobject
+        self._offsets_3d = context.nparray_to_context_array(
+                np.array([fmap._pos_in_buffer(nn) for nn in self._maps_3d],
+                         dtype=np.int64))
+        self._strides_3d = context.nparray_to_context_array(
+                np.array([fmap._stride_in_map(nn) for nn in self._maps_3d],
+                         dtype=np.int64))
+        self._offsets_xy = context.nparray_to_context_array(
+                np.array([fmap._pos_in_buffer(_separable_factors[nn][0])
+                          for nn in self._maps_separable], dtype=np.int64))
+        self._offsets_z = context.nparray_to_context_array(
+                np.array([fmap._pos_in_buffer(_separable_factors[nn][1])
+                          for nn in self._maps_separable], dtype=np.int64))
+
+    def evaluate(self, x, y, z, out=None):
+
+        """
+        Interpolates the quantities of the plan at the points specified by
+        x, y, z. Zeros are returned for points outside the grid.
+
+        Args:
+            x (float64 array): Horizontal coordinates of the points.
+            y (float64 array): Vertical coordinates of the points.
+            z (float64 array): Longitudinal coordinates of the points.
+            out (float64 array): Contiguous array with shape
+                (number of quantities, number of points) on the context of
+                the field map, in which the results are written. If ``None``
+                (default) the output buffer of the plan is used, and its
+                content is overwritten by the next call.
+        Returns:
+            (list of float64 array): Views of the output with the
+            interpolated quantities.
+        """
+
+        fmap = self.fieldmap
+        context = fmap._buffer.context
+
+        n_points = len(x)
+        assert len(y) == len(z) == n_points
+        n_quantities = len(self.quantities)
+
+        if fmap._xobject is not self._xobject:
+            # The field map has been moved
+            self._prepare_offsets()
+
+        if out is None:
+            if n_points > self.max_points:
+                raise ValueError(f'The plan is limited to {self.max_points} '
+                                 'points')
+            out_flat = self._buffer_out[:n_quantities * n_points]
+        else:
+            if (tuple(out.shape) != (n_quantities, n_points)
+                    or not out.flags.c_contiguous):
+                raise ValueError('`out` must be a contiguous array with '
+                                 f'shape {(n_quantities, n_points)}')
+            out_flat = out.reshape(n_quantities * n_points)
+
+        n_3d = len(self._maps_3d)
+        if n_3d == n_quantities:
+            out_3d = out_flat
+        else:
+            out_3d = out_flat[:n_3d * n_points]
+
+        if n_3d > 0:
+            context.kernels.TriLinearInterpolatedFieldMap_interpolate_3d_map_vector(
+                    fmap=fmap._xobject,
+                    n_points=n_points,
+                    x=x, y=y, z=z,
+                    n_quantities=n_3d,
+                    buffer_mesh_quantities=fmap._buffer.buffer,
+                    offsets_mesh_quantities=self._offsets_3d,
+                    strides_mesh_quantities=self._strides_3d,
+                    particles_quantities=out_3d)
+        if len(self._maps_separable) > 0:
+            context.kernels.TriLinearInterpolatedFieldMap_interpolate_separable_map_vector(
+                    fmap=fmap._xobject,
+                    n_points=n_points,
+                    x=x, y=y, z=z,
+                    n_quantities=len(self._maps_separable),
+                    buffer_mesh_quantities=fmap._buffer.buffer,
+                    offsets_mesh_quantities_xy=self._offsets_xy,
+                    offsets_mesh_quantities_z=self._offsets_z,
+                    particles_quantities=out_flat[n_3d * n_points:])
+
+        # Split buffer
+        return [out_flat[ii*n_points:(ii+1)*n_points]
+                for ii in range(n_quantities)]
+
+
+def _solver_nbytes(solver):
+
+    # Memory used by the arrays held by the solver (Green function and
+    # workspaces)
+    nbytes = 0
+    for vv in vars(solver).values():
+        if isinstance(vv, dict):
+            nbytes += sum(getattr(ww, 'nbytes', 0) for ww in vv.values())
+        else:
+            nbytes += getattr(vv, 'nbytes', 0)
+    return nbytes
 
 def _configure_grid(vname, v_grid, dv, v_range, nv):
 
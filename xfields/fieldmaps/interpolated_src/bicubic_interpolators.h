@@ -0,0 +1,215 @@
+// copyright ################################# //
+// This file is part of the Xfields Package.   //
+// Copyright (c) CERN, 2021.                   //
+// ########################################### //
+
+#ifndef XFIELDS_BICUBIC_INTERPOLATORS_H
+#define XFIELDS_BICUBIC_INTERPOLATORS_H
+
+/*gpufun*/
+void BiCubicInterpolatedFieldMap_construct_b(
+	BiCubicInterpolatedFieldMapData fmap,
+	   const int64_t ix, const int64_t iy,
+       double* b_vector){
+
+    /*gpuglmem*/ double* phi_taylor = BiCubicInterpolatedFieldMapData_getp1_phi_taylor(fmap, 0);
+    const int64_t nx = BiCubicInterpolatedFieldMapData_get_nx(fmap);
+
+    for(int l = 0; l < 4; l++)
+    {
+        const int m = 4 * l;
+        b_vector[m    ] = phi_taylor[ l + 4 * ( (ix    ) + nx * (iy    ) ) ];
+        b_vector[m + 1] = phi_taylor[ l + 4 * ( (ix + 1) + nx * (iy    ) ) ];
+        b_vector[m + 2] = phi_taylor[ l + 4 * ( (ix    ) + nx * (iy + 1) ) ];
+        b_vector[m + 3] = phi_taylor[ l + 4 * ( (ix + 1) + nx * (iy + 1) ) ];
+    }
+    return ;
+}
+
+/*gpufun*/
+void BiCubicInterpolatedFieldMap_construct_coefficients(
+    const double* b, double* coefs){
+
+    // coefs = M F M^T, where F contains the values at the four corners
+    // (phi, dphi/dx, dphi/dy, d^2phi/dxdy) and the coefficient of
+    // x^i y^j is coefs[i + 4 * j]
+    const double M[4][4] = {{ 1.,  0.,  0.,  0.},
+                            { 0.,  0.,  1.,  0.},
+                            {-3.,  3., -2., -1.},
+                            { 2., -2.,  1.,  1.}};
+
+    // b[4 * l + c], l: quantity, c: corner (0,0), (1,0), (0,1), (1,1)
+    const double F[4][4] = {{b[0],  b[2],  b[8],  b[10]},
+                            {b[1],  b[3],  b[9],  b[11]},
+                            {b[4],  b[6],  b[12], b[14]},
+                            {b[5],  b[7],  b[13], b[15]}};
+
+    double MF[4][4];
+    for (int i = 0; i < 4; i++){
+        for (int k = 0; k < 4; k++){
+            MF[i][k] = 0.;
+            for (int l = 0; l < 4; l++){
+                MF[i][k] += M[i][l] * F[l][k];
+            }
+        }
+    }
+    for (int i = 0; i < 4; i++){
+        for (int j = 0; j < 4; j++){
+            double cc = 0.;
+            for (int k = 0; k < 4; k++){
+                cc += MF[i][k] * M[j][k];
+            }
+            coefs[i + 4 * j] = cc;
+        }
+    }
+}
+
+/*gpukern*/
+void BiCubicInterpolatedFieldMap_build_coefficient_cache(
+	BiCubicInterpolatedFieldMapData fmap,
+	   const int64_t n_cells){
+
+    // The coefficients of the cell with lower corner (ix, iy) are stored at
+    // 16 * (ix + nx * iy), the last cell along each direction is not used
+    /*gpuglmem*/ double* cache = BiCubicInterpolatedFieldMapData_getp1_coefficients(fmap, 0);
+    const int64_t nx = BiCubicInterpolatedFieldMapData_get_nx(fmap);
+    const int64_t ny = BiCubicInterpolatedFieldMapData_get_ny(fmap);
+
+    #pragma omp parallel for //only_for_context cpu_openmp
+    for (int64_t icell = 0; icell < n_cells; icell++){ //vectorize_over icell n_cells
+        const int64_t ix = icell % nx;
+        const int64_t iy = icell / nx;
+        if (ix < nx - 1 && iy < ny - 1){
+            double b_vector[16];
+            double coefs[16];
+            BiCubicInterpolatedFieldMap_construct_b(fmap, ix, iy, b_vector);
+            BiCubicInterpolatedFieldMap_construct_coefficients(b_vector, coefs);
+            for (int l = 0; l < 16; l++){
+                cache[16 * icell + l] = coefs[l];
+            }
+        }
+    }//end_vectorize
+}
+
+/*gpukern*/
+void BiCubicInterpolatedFieldMap_phi_taylor_from_phi(
+	BiCubicInterpolatedFieldMapData fmap,
+	   const int64_t n_nodes,
+/*gpuglmem*/ const double* phi,
+	   const int64_t stride_x,
+	   const int64_t stride_y){
+
+    /*gpuglmem*/ double* phi_taylor = BiCubicInterpolatedFieldMapData_getp1_phi_taylor(fmap, 0);
+    const int64_t nx = BiCubicInterpolatedFieldMapData_get_nx(fmap);
+    const int64_t ny = BiCubicInterpolatedFieldMapData_get_ny(fmap);
+
+    #pragma omp parallel for //only_for_context cpu_openmp
+    for (int64_t inode = 0; inode < n_nodes; inode++){ //vectorize_over inode n_nodes
+        const int64_t ix = inode % nx;
+        const int64_t iy = inode / nx;
+
+        // normalized central differences, set to zero at the edges of the
+        // grid
+        const int64_t sx = (ix > 0 && ix < nx - 1) ? stride_x : 0;
+        const int64_t sy = (iy > 0 && iy < ny - 1) ? stride_y : 0;
+
+        /*gpuglmem*/ const double* p = phi + ix * stride_x + iy * stride_y;
+        /*gpuglmem*/ double* out = phi_taylor + 4 * inode;
+
+        out[0] = p[0];
+        out[1] = 0.5 * (p[sx] - p[-sx]);
+        out[2] = 0.5 * (p[sy] - p[-sy]);
+        out[3] = 0.5 * (0.5 * (p[sx + sy] - p[sx - sy])
+                      - 0.5 * (p[-sx + sy] - p[-sx - sy]));
+    }//end_vectorize
+}
+
+/*gpufun*/
+int BiCubicInterpolatedFieldMap_interpolate_grad(
+	BiCubicInterpolatedFieldMapData fmap,
+	   const double x, const double y,
+	   double* dphi_dx, double* dphi_dy){
+
+    double const x_min = BiCubicInterpolatedFieldMapData_get_x_min(fmap);
+    double const y_min = BiCubicInterpolatedFieldMapData_get_y_min(fmap);
+
+    double const inv_dx = 1. / BiCubicInterpolatedFieldMapData_get_dx(fmap);
+    double const inv_dy = 1. / BiCubicInterpolatedFieldMapData_get_dy(fmap);
+
+    double const fx = ( x - x_min ) * inv_dx; // distance in normalized grid w.r.t. grid reference.
+    double const fy = ( y - y_min ) * inv_dy;
+
+    int64_t mirror_x = BiCubicInterpolatedFieldMapData_get_mirror_x(fmap);
+    int64_t mirror_y = BiCubicInterpolatedFieldMapData_get_mirror_y(fmap);
+
+    double const sign_x = (mirror_x == 1 && fx < 0.0 ) ?  -1. : 1.; // calculate if sign needs to be
+    double const sign_y = (mirror_y == 1 && fy < 0.0 ) ?  -1. : 1.; // changed if mirroring is enabled
+
+    double const sfx = sign_x * fx;
+    double const sfy = sign_y * fy;
+
+    double const ixf = floor(sfx); // lower left corner of cell
+    double const iyf = floor(sfy);
+
+    int64_t const ix = (int64_t) ixf;
+    int64_t const iy = (int64_t) iyf;
+
+    double const xn = sfx - ixf; // position inside the cell
+    double const yn = sfy - iyf;
+
+    const int64_t nx = BiCubicInterpolatedFieldMapData_get_nx(fmap);
+    const int64_t ny = BiCubicInterpolatedFieldMapData_get_ny(fmap);
+
+    int indices_are_inside_box = ( ix >= 0 ) && ( ix <= nx - 2 )
+                              && ( iy >= 0 ) && ( iy <= ny - 2 );
+
+    if(!indices_are_inside_box){ // flag particle for death, it is outside the grid,
+        return 1;                // no need for interpolation
+    }
+
+    double coefs[16];
+    if (BiCubicInterpolatedFieldMapData_get_coefficient_cache(fmap)){
+        // precomputed coefficients (see build_coefficient_cache)
+        /*gpuglmem*/ double* cached = BiCubicInterpolatedFieldMapData_getp1_coefficients(fmap,
+                                                        16 * ( ix + nx * iy ) );
+        for (int l = 0; l < 16; l++){
+            coefs[l] = cached[l];
+        }
+    }
+    else{
+        double b_vector[16];
+        BiCubicInterpolatedFieldMap_construct_b(fmap, ix, iy, b_vector);
+        BiCubicInterpolatedFieldMap_construct_coefficients(b_vector, coefs);
+    }
+
+    double x_power[4], y_power[4];
+    x_power[0] = 1;
+    y_power[0] = 1;
+
+    x_power[1] = xn;
+    y_power[1] = yn;
+
+    x_power[2] = xn * xn;
+    y_power[2] = yn * yn;
+
+    x_power[3] = x_power[2] * xn;
+    y_power[3] = y_power[2] * yn;
+
+    for( int i = 1; i < 4; i++ ){
+        for( int j = 0; j < 4; j++ ){
+            *dphi_dx += i * ( ( coefs[i + 4 * j] * x_power[i-1] ) * y_power[j] );
+        }
+    }
+    *dphi_dx *= sign_x * inv_dx;
+
+    for( int i = 0; i < 4; i++ ){
+        for( int j = 1; j < 4; j++ ){
+            *dphi_dy += j * ( ( coefs[i + 4 * j] * x_power[i] ) * y_power[j-1] );
+        }
+    }
+    *dphi_dy *= sign_y * inv_dy;
+
+	return 0;
+}
+
+#endif
@@ -36,4 +36,86 @@ void central_diff(
 
 }
 
+/*gpufun*/ double central_diff_load(
+/*gpuglmem*/  const int8_t* buffer,
+              const int64_t offset,
+              const int64_t ii,
+              const int64_t is_f32){
+   if (is_f32){
+      return ((/*gpuglmem*/ const float*) (buffer + offset))[ii];
+   }
+   return ((/*gpuglmem*/ const double*) (buffer + offset))[ii];
+}
+
+/*gpufun*/ void central_diff_store(
+/*gpuglmem*/        int8_t* buffer,
+              const int64_t offset,
+              const int64_t ii,
+              const double  value,
+              const int64_t is_f32){
+   if (is_f32){
+      ((/*gpuglmem*/ float*) (buffer + offset))[ii] = (float) value;
+   }
+   else{
+      ((/*gpuglmem*/ double*) (buffer + offset))[ii] = value;
+   }
+}
+
+/*gpukern*/
+void central_diff_3d(
+	      const int     nelem,
+	      const int     nx,
+	      const int     ny,
+	      const int     nz,
+	      const double  factor_x,
+	      const double  factor_y,
+	      const double  factor_z,
+/*gpuglmem*/  const int8_t* matrix_buffer,
+              const int64_t matrix_offset,
+/*gpuglmem*/        int8_t* res_buffer,
+                    int64_t res_offset_x,
+                    int64_t res_offset_y,
+                    int64_t res_offset_z,
+              const int     res_stride,
+              const int64_t is_f32
+              ){
+
+   // Computes the three derivatives in a single pass over the matrix
+   // (Fortran order). The results are written with stride res_stride
+   // (1 for separate arrays, 3 for interleaved arrays). Matrix and results
+   // are in single precision if is_f32 is set, the differences are
+   // computed in double precision.
+
+   for(int ii=0; ii<nelem; ii++){//vectorize_over ii nelem
+      const int ix = ii % nx;
+      const int iy = (ii / nx) % ny;
+      const int iz = ii / (nx * ny);
+      const int stride_y = nx;
+      const int stride_z = nx * ny;
+
+      double der_x = 0;
+      double der_y = 0;
+      double der_z = 0;
+      if (ix > 0 && ix < nx - 1){
+         der_x = factor_x * (
+	    central_diff_load(matrix_buffer, matrix_offset, ii + 1, is_f32)
+	  - central_diff_load(matrix_buffer, matrix_offset, ii - 1, is_f32));
+      }
+      if (iy > 0 && iy < ny - 1){
+         der_y = factor_y * (
+	    central_diff_load(matrix_buffer, matrix_offset, ii + stride_y, is_f32)
+	  - central_diff_load(matrix_buffer, matrix_offset, ii - stride_y, is_f32));
+      }
+      if (iz > 0 && iz < nz - 1){
+         der_z = factor_z * (
+	    central_diff_load(matrix_buffer, matrix_offset, ii + stride_z, is_f32)
+	  - central_diff_load(matrix_buffer, matrix_offset, ii - stride_z, is_f32));
+      }
+      central_diff_store(res_buffer, res_offset_x, ii * res_stride, der_x, is_f32);
+      central_diff_store(res_buffer, res_offset_y, ii * res_stride, der_y, is_f32);
+      central_diff_store(res_buffer, res_offset_z, ii * res_stride, der_z, is_f32);
+   }//end_vectorize 
+
+}
+
 #endif
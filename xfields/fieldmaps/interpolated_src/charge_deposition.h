@@ -6,7 +6,42 @@
 #ifndef XFIELDS_CHARGE_DEPOSITION_H
 #define XFIELDS_CHARGE_DEPOSITION_H
 
-/*gpufun*/ void p2m_rectmesh3d_one_particle(
+#define XFIELDS_ATOMICADD_F32_CPU //only_for_context cpu_serial cpu_openmp
+#define XFIELDS_ATOMICADD_F32_OPENCL //only_for_context opencl
+#define XFIELDS_ATOMICADD_F32_CUDA //only_for_context cuda
+
+#ifdef XFIELDS_ATOMICADD_F32_CPU
+inline void xf_atomicAdd_f32(float *addr, float val)
+{
+   #pragma omp atomic //only_for_context cpu_openmp
+   *addr = *addr + val;
+}
+#endif // XFIELDS_ATOMICADD_F32_CPU
+
+#ifdef XFIELDS_ATOMICADD_F32_OPENCL
+inline void xf_atomicAdd_f32(volatile __global float *addr, float val)
+{
+	union {
+		int u32;
+		float f32;
+	} next, expected, current;
+	current.f32 = *addr;
+	do {
+		expected.f32 = current.f32;
+		next.f32 = expected.f32 + val;
+		current.u32 = atomic_cmpxchg(
+			(volatile __global int *)addr,
+		        expected.u32,
+			next.u32);
+	} while( current.u32 != expected.u32 );
+}
+#endif // XFIELDS_ATOMICADD_F32_OPENCL
+
+#ifdef XFIELDS_ATOMICADD_F32_CUDA
+#define xf_atomicAdd_f32(addr, val) atomicAdd(addr, val)
+#endif // XFIELDS_ATOMICADD_F32_CUDA
+
+/*gpufun*/ int p2m_rectmesh3d_indices_and_weights(
         // INPUTS:
         const double x, 
 	const double y, 
@@ -19,8 +54,8 @@
         const double dx, const double dy, const double dz,
           // mesh dimension (number of cells)
         const int nx, const int ny, const int nz,
-        // OUTPUTS:
-        /*gpuglmem*/ double *grid1d
+        // OUTPUTS (returns 0 if the particle is outside the grid):
+        int64_t* inds, double* weights
 ) {
 
     double vol_m1 = 1/(dx*dy*dz);
@@ -30,32 +65,169 @@
     int ix = floor((y - y0) / dy);
     int kx = floor((z - z0) / dz);
 
+    if (!(jx >= 0 && jx < nx - 1 && ix >= 0 && ix < ny - 1
+        	    && kx >= 0 && kx < nz - 1)){
+        return 0;
+    }
+
     // distances
     double dxi = x - (x0 + jx * dx);
     double dyi = y - (y0 + ix * dy);
     double dzi = z - (z0 + kx * dz);
 
     // weights
-    double wijk =    pwei * vol_m1 * (1.-dxi/dx) * (1.-dyi/dy) * (1.-dzi/dz);
-    double wi1jk =   pwei * vol_m1 * (1.-dxi/dx) * (dyi/dy)    * (1.-dzi/dz);
-    double wij1k =   pwei * vol_m1 * (dxi/dx)    * (1.-dyi/dy) * (1.-dzi/dz);
-    double wi1j1k =  pwei * vol_m1 * (dxi/dx)    * (dyi/dy)    * (1.-dzi/dz);
-    double wijk1 =   pwei * vol_m1 * (1.-dxi/dx) * (1.-dyi/dy) * (dzi/dz);
-    double wi1jk1 =  pwei * vol_m1 * (1.-dxi/dx) * (dyi/dy)    * (dzi/dz);
-    double wij1k1 =  pwei * vol_m1 * (dxi/dx)    * (1.-dyi/dy) * (dzi/dz);
-    double wi1j1k1 = pwei * vol_m1 * (dxi/dx)    * (dyi/dy)    * (dzi/dz);
-
-    if (jx >= 0 && jx < nx - 1 && ix >= 0 && ix < ny - 1
-        	    && kx >= 0 && kx < nz - 1)
-    {
-        atomicAdd(&grid1d[jx   + ix*nx     + kx*nx*ny],     wijk);
-        atomicAdd(&grid1d[jx+1 + ix*nx     + kx*nx*ny],     wij1k);
-        atomicAdd(&grid1d[jx   + (ix+1)*nx + kx*nx*ny],     wi1jk);
-        atomicAdd(&grid1d[jx+1 + (ix+1)*nx + kx*nx*ny],     wi1j1k);
-        atomicAdd(&grid1d[jx   + ix*nx     + (kx+1)*nx*ny], wijk1);
-        atomicAdd(&grid1d[jx+1 + ix*nx     + (kx+1)*nx*ny], wij1k1);
-        atomicAdd(&grid1d[jx   + (ix+1)*nx + (kx+1)*nx*ny], wi1jk1);
-        atomicAdd(&grid1d[jx+1 + (ix+1)*nx + (kx+1)*nx*ny], wi1j1k1);
+    weights[0] = pwei * vol_m1 * (1.-dxi/dx) * (1.-dyi/dy) * (1.-dzi/dz);
+    weights[1] = pwei * vol_m1 * (dxi/dx)    * (1.-dyi/dy) * (1.-dzi/dz);
+    weights[2] = pwei * vol_m1 * (1.-dxi/dx) * (dyi/dy)    * (1.-dzi/dz);
+    weights[3] = pwei * vol_m1 * (dxi/dx)    * (dyi/dy)    * (1.-dzi/dz);
+    weights[4] = pwei * vol_m1 * (1.-dxi/dx) * (1.-dyi/dy) * (dzi/dz);
+    weights[5] = pwei * vol_m1 * (dxi/dx)    * (1.-dyi/dy) * (dzi/dz);
+    weights[6] = pwei * vol_m1 * (1.-dxi/dx) * (dyi/dy)    * (dzi/dz);
+    weights[7] = pwei * vol_m1 * (dxi/dx)    * (dyi/dy)    * (dzi/dz);
+
+    inds[0] = jx   + ix*nx     + kx*nx*ny;
+    inds[1] = jx+1 + ix*nx     + kx*nx*ny;
+    inds[2] = jx   + (ix+1)*nx + kx*nx*ny;
+    inds[3] = jx+1 + (ix+1)*nx + kx*nx*ny;
+    inds[4] = jx   + ix*nx     + (kx+1)*nx*ny;
+    inds[5] = jx+1 + ix*nx     + (kx+1)*nx*ny;
+    inds[6] = jx   + (ix+1)*nx + (kx+1)*nx*ny;
+    inds[7] = jx+1 + (ix+1)*nx + (kx+1)*nx*ny;
+
+    return 1;
+}
+
+/*gpufun*/ int p2m_rectmesh3d_tsc_indices_and_weights(
+        // INPUTS:
+        const double x, 
+	const double y, 
+	const double z,
+	  // particle weight
+	const double pwei,
+          // mesh origin
+        const double x0, const double y0, const double z0,
+          // mesh distances per cell
+        const double dx, const double dy, const double dz,
+          // mesh dimension (number of cells)
+        const int nx, const int ny, const int nz,
+        // OUTPUTS (27 grid points, returns 0 if the particle is outside
+        // the grid or closer than half a cell to its edges):
+        int64_t* inds, double* weights
+) {
+
+    int64_t jx, jy, jz;
+    double wx[3], wy[3], wz[3];
+
+    if (!(tsc_weights_1d((x - x0) / dx, nx, &jx, wx)
+          && tsc_weights_1d((y - y0) / dy, ny, &jy, wy)
+          && tsc_weights_1d((z - z0) / dz, nz, &jz, wz))){
+        return 0;
+    }
+
+    const double vol_m1 = 1/(dx*dy*dz);
+
+    int ii = 0;
+    for (int kk=0; kk<3; kk++){
+        for (int jj=0; jj<3; jj++){
+            for (int ll=0; ll<3; ll++){
+                inds[ii] = (jx + ll) + (jy + jj) * nx + (jz + kk) * nx * ny;
+                weights[ii] = pwei * vol_m1 * wx[ll] * wy[jj] * wz[kk];
+                ii++;
+            }
+        }
+    }
+
+    return 1;
+}
+
+/*gpufun*/ int p2m_rectmesh3d_shape_indices_and_weights(
+        // INPUTS:
+        const double x, 
+	const double y, 
+	const double z,
+	  // particle weight
+	const double pwei,
+          // mesh origin
+        const double x0, const double y0, const double z0,
+          // mesh distances per cell
+        const double dx, const double dy, const double dz,
+          // mesh dimension (number of cells)
+        const int nx, const int ny, const int nz,
+          // 1 for cloud-in-cell, 2 for triangular-shaped-cloud
+        const int64_t shape_order,
+        // OUTPUTS (up to 27 grid points, returns the number of points, 0 if
+        // the particle is outside the grid):
+        int64_t* inds, double* weights
+) {
+
+    if (shape_order == 2){
+        if (p2m_rectmesh3d_tsc_indices_and_weights(x, y, z, pwei, x0, y0, z0,
+                                  dx, dy, dz, nx, ny, nz, inds, weights)){
+            return 27;
+        }
+        return 0;
+    }
+
+    if (p2m_rectmesh3d_indices_and_weights(x, y, z, pwei, x0, y0, z0,
+                                  dx, dy, dz, nx, ny, nz, inds, weights)){
+        return 8;
+    }
+    return 0;
+}
+
+// Atomic addition of the weights to the grid, generated for double
+// precision grids (no suffix) and for single precision grids (suffix _f32)
+#define XFIELDS_DEFINE_P2M_ADD_TO_GRID(SUFFIX, GRID_T, ATOMIC_ADD)            \
+/*gpufun*/ void p2m_rectmesh3d_add_to_grid##SUFFIX(                           \
+        const int n_points, const int64_t* inds, const double* weights,       \
+        /*gpuglmem*/ int8_t*  grid1d_buffer,                                  \
+	             int64_t  grid1d_offset){                                   \
+                                                                              \
+    /*gpuglmem*/ GRID_T* grid1d =                                             \
+		(/*gpuglmem*/ GRID_T*)(grid1d_buffer + grid1d_offset);          \
+    for (int ii=0; ii<n_points; ii++){                                        \
+        ATOMIC_ADD(&grid1d[inds[ii]], (GRID_T) weights[ii]);                  \
+    }                                                                         \
+}
+
+XFIELDS_DEFINE_P2M_ADD_TO_GRID(, double, atomicAdd)
+XFIELDS_DEFINE_P2M_ADD_TO_GRID(_f32, float, xf_atomicAdd_f32)
+
+/*gpufun*/ void p2m_rectmesh3d_one_particle(
+        // INPUTS:
+        const double x, 
+	const double y, 
+	const double z,
+	  // particle weight
+	const double pwei,
+          // mesh origin
+        const double x0, const double y0, const double z0,
+          // mesh distances per cell
+        const double dx, const double dy, const double dz,
+          // mesh dimension (number of cells)
+        const int nx, const int ny, const int nz,
+          // 1 for cloud-in-cell, 2 for triangular-shaped-cloud
+        const int64_t shape_order,
+        // OUTPUTS (double or single precision grid):
+        const int64_t grid_is_f32,
+        /*gpuglmem*/ int8_t*  grid1d_buffer,
+	             int64_t  grid1d_offset
+) {
+
+    int64_t inds[27];
+    double weights[27];
+
+    const int n_points = p2m_rectmesh3d_shape_indices_and_weights(x, y, z,
+                                  pwei, x0, y0, z0, dx, dy, dz, nx, ny, nz,
+                                  shape_order, inds, weights);
+
+    if (grid_is_f32){
+        p2m_rectmesh3d_add_to_grid_f32(n_points, inds, weights,
+                                       grid1d_buffer, grid1d_offset);
+    }
+    else{
+        p2m_rectmesh3d_add_to_grid(n_points, inds, weights,
+                                   grid1d_buffer, grid1d_offset);
     }
 
 }
@@ -78,13 +250,13 @@
         const double dx, const double dy, const double dz,
           // mesh dimension (number of cells)
         const int nx, const int ny, const int nz,
-        // OUTPUTS:
+          // 1 for cloud-in-cell, 2 for triangular-shaped-cloud
+        const int64_t shape_order,
+        // OUTPUTS (double or single precision grid):
+        const int64_t grid_is_f32,
         /*gpuglmem*/ int8_t*  grid1d_buffer,
 	             int64_t  grid1d_offset){
 
-    /*gpuglmem*/ double* grid1d = 
-		(/*gpuglmem*/ double*)(grid1d_buffer + grid1d_offset);
-
     #pragma omp parallel for //only_for_context cpu_openmp 
     for (int pidx=0; pidx<nparticles; pidx++){ //vectorize_over pidx nparticles
         if (part_state[pidx] > 0){
@@ -92,7 +264,8 @@
 
             p2m_rectmesh3d_one_particle(x[pidx], y[pidx], z[pidx], pwei,
                                         x0, y0, z0, dx, dy, dz, nx, ny, nz,
-                                        grid1d);
+                                        shape_order, grid_is_f32,
+                                        grid1d_buffer, grid1d_offset);
 	}
     }//end_vectorize
 }
@@ -108,13 +281,13 @@
         const double dx, const double dy, const double dz,
           // mesh dimension (number of cells)
         const int nx, const int ny, const int nz,
-        // OUTPUTS:
+          // 1 for cloud-in-cell, 2 for triangular-shaped-cloud
+        const int64_t shape_order,
+        // OUTPUTS (double or single precision grid):
+        const int64_t grid_is_f32,
         /*gpuglmem*/ int8_t*  grid1d_buffer,
 	             int64_t  grid1d_offset){
 
-    /*gpuglmem*/ double* grid1d = 
-    	(/*gpuglmem*/ double*)(grid1d_buffer + grid1d_offset);
-    
     /*gpuglmem*/ const double* x = ParticlesData_getp1_x(particles, 0); 
     /*gpuglmem*/ const double* y = ParticlesData_getp1_y(particles, 0); 
     /*gpuglmem*/ const double* z = ParticlesData_getp1_zeta(particles, 0);
@@ -122,19 +295,169 @@
     		                                             particles, 0);
     /*gpuglmem*/ const int64_t* part_state = ParticlesData_getp1_state(
     		                                             particles, 0);
-    // TODO I am forgetting about charge_ratio and mass_ratio
+    /*gpuglmem*/ const double* charge_ratio =
+                        ParticlesData_getp1_charge_ratio(particles, 0);
     const double q0_coulomb = QELEM * ParticlesData_get_q0(particles);
 
     #pragma omp parallel for //only_for_context cpu_openmp 
     for (int pidx=0; pidx<nparticles; pidx++){ //vectorize_over pidx nparticles
         if (part_state[pidx] > 0){
-    	    double pwei = part_weights[pidx] * q0_coulomb;
+    	    double pwei = part_weights[pidx] * charge_ratio[pidx] * q0_coulomb;
 
             p2m_rectmesh3d_one_particle(x[pidx], y[pidx], z[pidx], pwei,
                                         x0, y0, z0, dx, dy, dz, nx, ny, nz,
-                                        grid1d);
+                                        shape_order, grid_is_f32,
+                                        grid1d_buffer, grid1d_offset);
 	}
     }//end_vectorize
 
 }
+
+// Deposition on per-thread private grids followed by a parallel reduction,
+// avoiding the atomic operations on the shared grid (CPU contexts only, the
+// kernels are empty on GPU contexts)
+#define XFIELDS_P2M_PRIVATE_GRIDS //only_for_context cpu_serial cpu_openmp
+
+#ifdef XFIELDS_P2M_PRIVATE_GRIDS
+void p2m_rectmesh3d_private_grids(
+        // INPUTS:
+        const int nparticles,
+        const double* x, const double* y, const double* z,
+        const double* part_weights, const int64_t* part_state,
+          // factors applied to the particle weights (charge_ratio can be
+          // NULL)
+        const double weight_factor, const double* charge_ratio,
+          // mesh origin
+        const double x0, const double y0, const double z0,
+          // mesh distances per cell
+        const double dx, const double dy, const double dz,
+          // mesh dimension (number of cells)
+        const int nx, const int ny, const int nz,
+          // maximum number of threads and workspace (n_grids * grid size)
+        const int n_grids, double* private_grids,
+          // 1 for cloud-in-cell, 2 for triangular-shaped-cloud
+        const int64_t shape_order,
+        // OUTPUTS (double or single precision grid):
+        const int64_t grid_is_f32,
+        int8_t* grid1d_buffer, int64_t grid1d_offset){
+
+    const int64_t ncells = ((int64_t) nx) * ny * nz;
+
+    #pragma omp parallel num_threads(n_grids) //only_for_context cpu_openmp
+    { //only_for_context cpu_openmp
+        int tid = 0;
+        int nthreads = 1;
+        tid = omp_get_thread_num(); //only_for_context cpu_openmp
+        nthreads = omp_get_num_threads(); //only_for_context cpu_openmp
+
+        // Each thread clears its own grid (first touch)
+        double* my_grid = private_grids + tid * ncells;
+        for (int64_t ii=0; ii<ncells; ii++){
+            my_grid[ii] = 0.;
+        }
+
+        #pragma omp for //only_for_context cpu_openmp
+        for (int pidx=0; pidx<nparticles; pidx++){
+            if (part_state[pidx] > 0){
+                int64_t inds[27];
+                double weights[27];
+                const int n_points = p2m_rectmesh3d_shape_indices_and_weights(
+                        x[pidx], y[pidx], z[pidx],
+                        part_weights[pidx] * weight_factor
+                          * (charge_ratio ? charge_ratio[pidx] : 1.),
+                        x0, y0, z0, dx, dy, dz, nx, ny, nz,
+                        shape_order, inds, weights);
+                for (int ii=0; ii<n_points; ii++){
+                    my_grid[inds[ii]] += weights[ii];
+                }
+            }
+        } // implicit barrier
+
+        // Reduction, each thread sums a block of cells over all grids
+        #pragma omp for //only_for_context cpu_openmp
+        for (int64_t ii=0; ii<ncells; ii++){
+            double acc = 0.;
+            for (int tt=0; tt<nthreads; tt++){
+                acc += private_grids[tt * ncells + ii];
+            }
+            if (grid_is_f32){
+                ((float*)(grid1d_buffer + grid1d_offset))[ii] += (float) acc;
+            }
+            else{
+                ((double*)(grid1d_buffer + grid1d_offset))[ii] += acc;
+            }
+        }
+    } //only_for_context cpu_openmp
+}
+#endif // XFIELDS_P2M_PRIVATE_GRIDS
+
+/*gpukern*/ void p2m_rectmesh3d_private(
+        // INPUTS:
+          // length of x, y, z arrays
+        const int nparticles,
+          // particle positions
+        /*gpuglmem*/ const double* x, 
+	/*gpuglmem*/ const double* y, 
+	/*gpuglmem*/ const double* z,
+	  // particle weights and stat flags
+	/*gpuglmem*/ const double* part_weights,
+	/*gpuglmem*/ const int64_t* part_state,
+          // mesh origin
+        const double x0, const double y0, const double z0,
+          // mesh distances per cell
+        const double dx, const double dy, const double dz,
+          // mesh dimension (number of cells)
+        const int nx, const int ny, const int nz,
+          // private grids
+        const int n_grids, /*gpuglmem*/ double* private_grids,
+        const int64_t shape_order,
+        // OUTPUTS:
+        const int64_t grid_is_f32,
+        /*gpuglmem*/ int8_t*  grid1d_buffer,
+	             int64_t  grid1d_offset){
+
+#ifdef XFIELDS_P2M_PRIVATE_GRIDS
+    p2m_rectmesh3d_private_grids(nparticles, x, y, z, part_weights,
+                                 part_state, 1., NULL, x0, y0, z0, dx, dy, dz,
+                                 nx, ny, nz, n_grids, private_grids,
+                                 shape_order, grid_is_f32, grid1d_buffer,
+                                 grid1d_offset);
+#endif
+}
+
+/*gpukern*/ void p2m_rectmesh3d_xparticles_private(
+        // INPUTS:
+          // length of x, y, z arrays
+        const int nparticles,
+	ParticlesData particles,
+          // mesh origin
+        const double x0, const double y0, const double z0,
+          // mesh distances per cell
+        const double dx, const double dy, const double dz,
+          // mesh dimension (number of cells)
+        const int nx, const int ny, const int nz,
+          // private grids
+        const int n_grids, /*gpuglmem*/ double* private_grids,
+        const int64_t shape_order,
+        // OUTPUTS:
+        const int64_t grid_is_f32,
+        /*gpuglmem*/ int8_t*  grid1d_buffer,
+	             int64_t  grid1d_offset){
+
+#ifdef XFIELDS_P2M_PRIVATE_GRIDS
+    const double q0_coulomb = QELEM * ParticlesData_get_q0(particles);
+
+    p2m_rectmesh3d_private_grids(nparticles,
+                    ParticlesData_getp1_x(particles, 0),
+                    ParticlesData_getp1_y(particles, 0),
+                    ParticlesData_getp1_zeta(particles, 0),
+                    ParticlesData_getp1_weight(particles, 0),
+                    ParticlesData_getp1_state(particles, 0),
+                    q0_coulomb, ParticlesData_getp1_charge_ratio(particles, 0),
+                    x0, y0, z0, dx, dy, dz,
+                    nx, ny, nz, n_grids, private_grids,
+                    shape_order, grid_is_f32, grid1d_buffer, grid1d_offset);
+#endif
+}
+
 #endif
@@ -33,6 +33,36 @@ void TriCubicInterpolatedFieldMap_construct_b(
     return ;
 }
 
+/*gpukern*/
+void TriCubicInterpolatedFieldMap_build_coefficient_cache(
+	TriCubicInterpolatedFieldMapData fmap,
+	   const int64_t n_cells){
+
+    // The coefficients of the cell with lower corner (ix, iy, iz) are
+    // stored at 64 * (ix + nx * (iy + ny * iz)), the last cell along each
+    // direction is not used
+    /*gpuglmem*/ double* cache = TriCubicInterpolatedFieldMapData_getp1_coefficients(fmap, 0);
+    const int64_t nx = TriCubicInterpolatedFieldMapData_get_nx(fmap);
+    const int64_t ny = TriCubicInterpolatedFieldMapData_get_ny(fmap);
+    const int64_t nz_window = TriCubicInterpolatedFieldMapData_get_nz_window(fmap);
+
+    #pragma omp parallel for //only_for_context cpu_openmp
+    for (int64_t icell = 0; icell < n_cells; icell++){ //vectorize_over icell n_cells
+        const int64_t ix = icell % nx;
+        const int64_t iy = (icell / nx) % ny;
+        const int64_t iz = icell / (nx * ny);
+        if (ix < nx - 1 && iy < ny - 1 && iz < nz_window - 1){
+            double b_vector[64];
+            double coefs[64];
+            TriCubicInterpolatedFieldMap_construct_b(fmap, ix, iy, iz, b_vector);
+            TriCubicInterpolatedFieldMap_construct_coefficients(b_vector, coefs);
+            for (int l = 0; l < 64; l++){
+                cache[64 * icell + l] = coefs[l];
+            }
+        }
+    }//end_vectorize
+}
+
 /*gpufun*/
 int TriCubicInterpolatedFieldMap_interpolate_grad(
 	TriCubicInterpolatedFieldMapData fmap,
@@ -77,21 +107,38 @@ int TriCubicInterpolatedFieldMap_interpolate_grad(
     double const yn = sfy - iyf; // w.r.t. grid point in the single cell
     double const zn = sfz - izf;
 
+    // only the slices from iz_window_start are stored in phi_taylor
+    // (all of them unless the map is windowed)
+    int64_t const iz_window_start = TriCubicInterpolatedFieldMapData_get_iz_window_start(fmap);
+    int64_t const nz_window = TriCubicInterpolatedFieldMapData_get_nz_window(fmap);
+
     // check that indices are within the grid
     // TODO: replace with ranges in x,y,z
     int indices_are_inside_box = ( ix >= 0 ) && ( ix <= ( TriCubicInterpolatedFieldMapData_get_nx(fmap) - 2 ) ) 
                               && ( iy >= 0 ) && ( iy <= ( TriCubicInterpolatedFieldMapData_get_ny(fmap) - 2 ) ) 
-                              && ( iz >= 0 ) && ( iz <= ( TriCubicInterpolatedFieldMapData_get_nz(fmap) - 2 ) );
+                              && ( iz >= 0 ) && ( iz <= ( TriCubicInterpolatedFieldMapData_get_nz(fmap) - 2 ) )
+                              && ( iz >= iz_window_start ) && ( iz <= ( iz_window_start + nz_window - 2 ) );
 
     if(!indices_are_inside_box){ // flag particle for death, it is outside the grid,
         return 1;                // no need for interpolation
     }
 
-    double b_vector[64];
-    TriCubicInterpolatedFieldMap_construct_b(fmap, ix, iy, iz, b_vector);
-
     double coefs[64];
-    TriCubicInterpolatedFieldMap_construct_coefficients(b_vector, coefs);
+    if (TriCubicInterpolatedFieldMapData_get_coefficient_cache(fmap)){
+        // precomputed coefficients (see build_coefficient_cache)
+        const int64_t nx = TriCubicInterpolatedFieldMapData_get_nx(fmap);
+        const int64_t ny = TriCubicInterpolatedFieldMapData_get_ny(fmap);
+        /*gpuglmem*/ double* cached = TriCubicInterpolatedFieldMapData_getp1_coefficients(fmap,
+                            64 * ( ix + nx * ( iy + ny * ( iz - iz_window_start ) ) ) );
+        for (int l = 0; l < 64; l++){
+            coefs[l] = cached[l];
+        }
+    }
+    else{
+        double b_vector[64];
+        TriCubicInterpolatedFieldMap_construct_b(fmap, ix, iy, iz - iz_window_start, b_vector);
+        TriCubicInterpolatedFieldMap_construct_coefficients(b_vector, coefs);
+    }
 
     double x_power[4], y_power[4], z_power[4];
     x_power[0] = 1;
@@ -78,31 +78,191 @@ IndicesAndWeights TriLinearInterpolatedFieldMap_compute_indeces_and_weights(
 
 }	
 
+// The interpolators of the maps are generated for double precision maps
+// (no suffix) and for single precision maps (suffix _f32), the
+// interpolation being done in double in both cases
+#define XFIELDS_DEFINE_LINEAR_INTERPOLATORS(SUFFIX, MAP_T)                    \
+                                                                              \
+/*gpufun*/                                                                    \
+double TriLinearInterpolatedFieldMap_interpolate_3d_map_strided_scalar##SUFFIX(\
+	/*gpuglmem*/ const MAP_T* map,                                          \
+	   const int64_t stride,                                                \
+	   const IndicesAndWeights iw){                                         \
+                                                                              \
+    /* The value of the grid point (ix, iy, iz) is map[stride * index],    */ \
+    /* with stride > 1 for maps interleaved with other quantities          */ \
+    double val;                                                               \
+                                                                              \
+    if (iw.ix < 0){                                                           \
+	 val = 0.;                                                              \
+    }                                                                         \
+    else{                                                                     \
+	const int64_t i000 = iw.ix + iw.iy * iw.nx + iw.iz * iw.nx * iw.ny;     \
+	const int64_t sy = iw.nx;                                               \
+	const int64_t sz = iw.nx * iw.ny;                                       \
+	val =                                                                   \
+    	       iw.w000 * map[stride * (i000          )]                      \
+    	     + iw.w100 * map[stride * (i000 + 1      )]                      \
+    	     + iw.w010 * map[stride * (i000     + sy )]                      \
+    	     + iw.w110 * map[stride * (i000 + 1 + sy )]                      \
+    	     + iw.w001 * map[stride * (i000      + sz)]                      \
+    	     + iw.w101 * map[stride * (i000 + 1  + sz)]                      \
+    	     + iw.w011 * map[stride * (i000 + sy + sz)]                      \
+    	     + iw.w111 * map[stride * (i000 + 1 + sy + sz)];                 \
+    }                                                                         \
+                                                                              \
+    return val;                                                               \
+}                                                                             \
+                                                                              \
+/*gpufun*/                                                                    \
+double TriLinearInterpolatedFieldMap_interpolate_3d_map_scalar##SUFFIX(       \
+	/*gpuglmem*/ const MAP_T* map,                                          \
+	   const IndicesAndWeights iw){                                         \
+    return TriLinearInterpolatedFieldMap_interpolate_3d_map_strided_scalar##SUFFIX(\
+                                                                map, 1, iw);  \
+}                                                                             \
+                                                                              \
+/*gpufun*/                                                                    \
+void TriLinearInterpolatedFieldMap_interpolate_interleaved_gradient##SUFFIX(  \
+	/*gpuglmem*/ const MAP_T* map_xyz,                                      \
+	   const IndicesAndWeights iw,                                          \
+	   double* dphi_dx, double* dphi_dy, double* dphi_dz){                  \
+                                                                              \
+    /* Interpolates the three derivatives stored interleaved               */ \
+    /* (dphi_dx, dphi_dy, dphi_dz) at each grid point, reading the three   */ \
+    /* values of each corner together                                      */ \
+    *dphi_dx = 0.;                                                            \
+    *dphi_dy = 0.;                                                            \
+    *dphi_dz = 0.;                                                            \
+                                                                              \
+    if (iw.ix >= 0){                                                          \
+	const int64_t i000 = iw.ix + iw.iy * iw.nx + iw.iz * iw.nx * iw.ny;     \
+	const int64_t sy = iw.nx;                                               \
+	const int64_t sz = iw.nx * iw.ny;                                       \
+	const int64_t corners[8] = {i000, i000 + 1, i000 + sy, i000 + 1 + sy,   \
+	                            i000 + sz, i000 + 1 + sz, i000 + sy + sz,   \
+	                            i000 + 1 + sy + sz};                        \
+	const double weights[8] = {iw.w000, iw.w100, iw.w010, iw.w110,          \
+	                           iw.w001, iw.w101, iw.w011, iw.w111};         \
+	for (int ic=0; ic<8; ic++){                                             \
+	    /*gpuglmem*/ const MAP_T* vv = map_xyz + 3 * corners[ic];           \
+	    *dphi_dx += weights[ic] * vv[0];                                    \
+	    *dphi_dy += weights[ic] * vv[1];                                    \
+	    *dphi_dz += weights[ic] * vv[2];                                    \
+	}                                                                       \
+    }                                                                         \
+}
+
+XFIELDS_DEFINE_LINEAR_INTERPOLATORS(, double)
+XFIELDS_DEFINE_LINEAR_INTERPOLATORS(_f32, float)
+
+// Calls the double or the single precision version of an interpolator
+#define XFIELDS_INTERPOLATE_MAP(IS_F32, FUNC, MAP, MAP_F32, ...)              \
+    ((IS_F32) ? FUNC##_f32(MAP_F32, __VA_ARGS__) : FUNC(MAP, __VA_ARGS__))
+
 /*gpufun*/
-double TriLinearInterpolatedFieldMap_interpolate_3d_map_scalar(
-	/*gpuglmem*/ const double* map,
+double TriLinearInterpolatedFieldMap_interpolate_separable_map_scalar(
+	/*gpuglmem*/ const double* map_xy,
+	/*gpuglmem*/ const double* map_z,
 	   const IndicesAndWeights iw){
-	
+
+    // Interpolates map_xy[ix, iy] * map_z[iz], the trilinear weights being
+    // products of the transverse and of the longitudinal ones
     double val;
 
     if (iw.ix < 0){
 	 val = 0.;
     }
     else{
-	val = 
-    	       iw.w000 * map[iw.ix   + (iw.iy  ) * iw.nx + (iw.iz  ) * iw.nx * iw.ny]
-    	     + iw.w100 * map[iw.ix+1 + (iw.iy  ) * iw.nx + (iw.iz  ) * iw.nx * iw.ny]
-    	     + iw.w010 * map[iw.ix+  + (iw.iy+1) * iw.nx + (iw.iz  ) * iw.nx * iw.ny]
-    	     + iw.w110 * map[iw.ix+1 + (iw.iy+1) * iw.nx + (iw.iz  ) * iw.nx * iw.ny]
-    	     + iw.w001 * map[iw.ix   + (iw.iy  ) * iw.nx + (iw.iz+1) * iw.nx * iw.ny]
-    	     + iw.w101 * map[iw.ix+1 + (iw.iy  ) * iw.nx + (iw.iz+1) * iw.nx * iw.ny]
-    	     + iw.w011 * map[iw.ix+  + (iw.iy+1) * iw.nx + (iw.iz+1) * iw.nx * iw.ny]
-    	     + iw.w111 * map[iw.ix+1 + (iw.iy+1) * iw.nx + (iw.iz+1) * iw.nx * iw.ny];
+	const double val_xy =
+    	       (iw.w000 + iw.w001) * map_xy[iw.ix   + (iw.iy  ) * iw.nx]
+    	     + (iw.w100 + iw.w101) * map_xy[iw.ix+1 + (iw.iy  ) * iw.nx]
+    	     + (iw.w010 + iw.w011) * map_xy[iw.ix   + (iw.iy+1) * iw.nx]
+    	     + (iw.w110 + iw.w111) * map_xy[iw.ix+1 + (iw.iy+1) * iw.nx];
+	const double val_z =
+    	       (iw.w000 + iw.w100 + iw.w010 + iw.w110) * map_z[iw.iz  ]
+    	     + (iw.w001 + iw.w101 + iw.w011 + iw.w111) * map_z[iw.iz+1];
+	val = val_xy * val_z;
     }
 
     return val;
 }
 
+typedef struct{
+    // first of the three grid points in each direction (-999 if the point
+    // is outside the grid or closer than half a cell to its edges)
+    int64_t ix;
+    int64_t iy;
+    int64_t iz;
+    int64_t nx;
+    int64_t ny;
+    int64_t nz;
+    double wx[3];
+    double wy[3];
+    double wz[3];
+}TSCIndicesAndWeights;
+
+/*gpufun*/
+TSCIndicesAndWeights TriLinearInterpolatedFieldMap_compute_tsc_indices_and_weights(
+	TriLinearInterpolatedFieldMapData fmap,
+	double x, double y, double z){
+
+	TSCIndicesAndWeights tw;
+
+	const double dx = TriLinearInterpolatedFieldMapData_get_dx(fmap);
+	const double dy = TriLinearInterpolatedFieldMapData_get_dy(fmap);
+	const double dz = TriLinearInterpolatedFieldMapData_get_dz(fmap);
+	const double x0 = TriLinearInterpolatedFieldMapData_get_x_min(fmap);
+	const double y0 = TriLinearInterpolatedFieldMapData_get_y_min(fmap);
+	const double z0 = TriLinearInterpolatedFieldMapData_get_z_min(fmap);
+
+	tw.nx = TriLinearInterpolatedFieldMapData_get_nx(fmap);
+	tw.ny = TriLinearInterpolatedFieldMapData_get_ny(fmap);
+	tw.nz = TriLinearInterpolatedFieldMapData_get_nz(fmap);
+
+	if (!(tsc_weights_1d((x - x0) / dx, tw.nx, &tw.ix, tw.wx)
+	      && tsc_weights_1d((y - y0) / dy, tw.ny, &tw.iy, tw.wy)
+	      && tsc_weights_1d((z - z0) / dz, tw.nz, &tw.iz, tw.wz))){
+	    tw.ix = -999;
+	    tw.iy = -999;
+	    tw.iz = -999;
+	}
+
+	return tw;
+}
+
+// Generated for double and single precision maps as the interpolators above
+#define XFIELDS_DEFINE_TSC_INTERPOLATORS(SUFFIX, MAP_T)                       \
+                                                                              \
+/*gpufun*/                                                                    \
+double TriLinearInterpolatedFieldMap_interpolate_3d_map_tsc_strided_scalar##SUFFIX(\
+	/*gpuglmem*/ const MAP_T* map,                                          \
+	   const int64_t stride,                                                \
+	   const TSCIndicesAndWeights tw){                                      \
+                                                                              \
+    /* Triangular-shaped-cloud interpolation on the 27 grid points around  */ \
+    /* the nearest one (same weights as the deposition)                    */ \
+    double val = 0.;                                                          \
+                                                                              \
+    if (tw.ix >= 0){                                                          \
+	for (int kk=0; kk<3; kk++){                                             \
+	    for (int jj=0; jj<3; jj++){                                         \
+	        const int64_t i0 = tw.ix + (tw.iy + jj) * tw.nx                 \
+	                                 + (tw.iz + kk) * tw.nx * tw.ny;        \
+	        const double wyz = tw.wy[jj] * tw.wz[kk];                       \
+	        val += wyz * (tw.wx[0] * map[stride * (i0    )]                 \
+	                    + tw.wx[1] * map[stride * (i0 + 1)]                 \
+	                    + tw.wx[2] * map[stride * (i0 + 2)]);               \
+	    }                                                                   \
+	}                                                                       \
+    }                                                                         \
+                                                                              \
+    return val;                                                               \
+}
+
+XFIELDS_DEFINE_TSC_INTERPOLATORS(, double)
+XFIELDS_DEFINE_TSC_INTERPOLATORS(_f32, float)
+
 /*gpukern*/
 void TriLinearInterpolatedFieldMap_interpolate_3d_map_vector(
     TriLinearInterpolatedFieldMapData  fmap,
@@ -113,6 +273,61 @@ void TriLinearInterpolatedFieldMap_interpolate_3d_map_vector(
                         const int64_t  n_quantities,
            /*gpuglmem*/ const int8_t*  buffer_mesh_quantities,
            /*gpuglmem*/ const int64_t* offsets_mesh_quantities,
+           /*gpuglmem*/ const int64_t* strides_mesh_quantities,
+           /*gpuglmem*/       double*  particles_quantities) {
+
+    const int64_t single_precision =
+        TriLinearInterpolatedFieldMapData_get_single_precision(fmap);
+    const int64_t shape_order =
+        TriLinearInterpolatedFieldMapData_get_shape_order(fmap);
+
+    #pragma omp parallel for //only_for_context cpu_openmp 
+    for (int pidx=0; pidx<n_points; pidx++){ //vectorize_over pidx n_points
+
+      if (shape_order == 2){
+	const TSCIndicesAndWeights tw =
+		TriLinearInterpolatedFieldMap_compute_tsc_indices_and_weights(
+	                                      fmap, x[pidx], y[pidx], z[pidx]);
+    	for (int iq=0; iq<n_quantities; iq++){
+	    /*gpuglmem*/ const int8_t* map =
+	               buffer_mesh_quantities + offsets_mesh_quantities[iq];
+	    particles_quantities[iq*n_points + pidx] = XFIELDS_INTERPOLATE_MAP(
+		    single_precision,
+		    TriLinearInterpolatedFieldMap_interpolate_3d_map_tsc_strided_scalar,
+		    (/*gpuglmem*/ const double*) map,
+		    (/*gpuglmem*/ const float*) map,
+		    strides_mesh_quantities[iq], tw);
+	}
+      }
+      else{
+	const IndicesAndWeights iw = 
+		TriLinearInterpolatedFieldMap_compute_indeces_and_weights(
+	                                      fmap, x[pidx], y[pidx], z[pidx]);
+    	for (int iq=0; iq<n_quantities; iq++){
+	    /*gpuglmem*/ const int8_t* map =
+	               buffer_mesh_quantities + offsets_mesh_quantities[iq];
+	    particles_quantities[iq*n_points + pidx] = XFIELDS_INTERPOLATE_MAP(
+		    single_precision,
+		    TriLinearInterpolatedFieldMap_interpolate_3d_map_strided_scalar,
+		    (/*gpuglmem*/ const double*) map,
+		    (/*gpuglmem*/ const float*) map,
+		    strides_mesh_quantities[iq], iw);
+	}
+      }
+    }//end_vectorize
+}
+
+/*gpukern*/
+void TriLinearInterpolatedFieldMap_interpolate_separable_map_vector(
+    TriLinearInterpolatedFieldMapData  fmap,
+                        const int64_t  n_points,
+           /*gpuglmem*/ const double*  x,
+           /*gpuglmem*/ const double*  y,
+           /*gpuglmem*/ const double*  z,
+                        const int64_t  n_quantities,
+           /*gpuglmem*/ const int8_t*  buffer_mesh_quantities,
+           /*gpuglmem*/ const int64_t* offsets_mesh_quantities_xy,
+           /*gpuglmem*/ const int64_t* offsets_mesh_quantities_z,
            /*gpuglmem*/       double*  particles_quantities) {
 
     #pragma omp parallel for //only_for_context cpu_openmp 
@@ -123,8 +338,9 @@ void TriLinearInterpolatedFieldMap_interpolate_3d_map_vector(
 	                                      fmap, x[pidx], y[pidx], z[pidx]);
     	for (int iq=0; iq<n_quantities; iq++){
 	    particles_quantities[iq*n_points + pidx] = 
-		TriLinearInterpolatedFieldMap_interpolate_3d_map_scalar(
-	           (/*gpuglmem*/ double*)(buffer_mesh_quantities + offsets_mesh_quantities[iq]),
+		TriLinearInterpolatedFieldMap_interpolate_separable_map_scalar(
+	           (/*gpuglmem*/ double*)(buffer_mesh_quantities + offsets_mesh_quantities_xy[iq]),
+	           (/*gpuglmem*/ double*)(buffer_mesh_quantities + offsets_mesh_quantities_z[iq]),
 		   iw);
 	}
     }//end_vectorize
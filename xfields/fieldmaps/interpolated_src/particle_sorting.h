@@ -0,0 +1,48 @@
+// copyright ################################# //
+// This file is part of the Xfields Package.   //
+// Copyright (c) CERN, 2021.                   //
+// ########################################### //
+
+#ifndef XFIELDS_PARTICLE_SORTING_H
+#define XFIELDS_PARTICLE_SORTING_H
+
+// Stable counting sort by cell index (CPU contexts only, the kernel is empty
+// on GPU contexts)
+#define XFIELDS_CELL_COUNTING_SORT //only_for_context cpu_serial cpu_openmp
+
+/*gpukern*/ void cell_sort_permutation(
+        // INPUTS:
+        const int64_t n_points,
+          // cell index of each point (in [0, n_cells])
+        /*gpuglmem*/ const int64_t* cell_id,
+        const int64_t n_cells,
+          // workspace (n_cells + 1 elements, cleared by the kernel)
+        /*gpuglmem*/ int64_t* counts,
+        // OUTPUTS:
+          // indices of the points sorted by cell
+        /*gpuglmem*/ int64_t* permutation){
+
+#ifdef XFIELDS_CELL_COUNTING_SORT
+    for (int64_t cc=0; cc<=n_cells; cc++){
+        counts[cc] = 0;
+    }
+    for (int64_t ii=0; ii<n_points; ii++){
+        counts[cell_id[ii]]++;
+    }
+
+    // Exclusive prefix sum, counts[cc] becomes the first position of cell cc
+    int64_t pos = 0;
+    for (int64_t cc=0; cc<=n_cells; cc++){
+        const int64_t n_in_cell = counts[cc];
+        counts[cc] = pos;
+        pos += n_in_cell;
+    }
+
+    // Points in the same cell keep their relative order
+    for (int64_t ii=0; ii<n_points; ii++){
+        permutation[counts[cell_id[ii]]++] = ii;
+    }
+#endif
+}
+
+#endif
@@ -0,0 +1,73 @@
+// copyright ################################# //
+// This file is part of the Xfields Package.   //
+// Copyright (c) CERN, 2021.                   //
+// ########################################### //
+
+#ifndef XFIELDS_PHI_TAYLOR_H
+#define XFIELDS_PHI_TAYLOR_H
+
+// Normalized central differences (derivatives multiplied by the cell
+// sizes) along the directions with strides s1, s2, s3. A zero stride gives
+// a zero derivative (used at the edges of the grid).
+
+/*gpufun*/
+double TriCubicInterpolatedFieldMap_diff1(
+        /*gpuglmem*/ const double* p, const int64_t s1){
+    return 0.5 * (p[s1] - p[-s1]);
+}
+
+/*gpufun*/
+double TriCubicInterpolatedFieldMap_diff2(
+        /*gpuglmem*/ const double* p, const int64_t s1, const int64_t s2){
+    return 0.5 * (TriCubicInterpolatedFieldMap_diff1(p + s1, s2)
+                - TriCubicInterpolatedFieldMap_diff1(p - s1, s2));
+}
+
+/*gpufun*/
+double TriCubicInterpolatedFieldMap_diff3(
+        /*gpuglmem*/ const double* p, const int64_t s1, const int64_t s2,
+        const int64_t s3){
+    return 0.5 * (TriCubicInterpolatedFieldMap_diff2(p + s1, s2, s3)
+                - TriCubicInterpolatedFieldMap_diff2(p - s1, s2, s3));
+}
+
+/*gpukern*/
+void TriCubicInterpolatedFieldMap_phi_taylor_from_phi(
+	TriCubicInterpolatedFieldMapData fmap,
+	   const int64_t n_nodes,
+/*gpuglmem*/ const double* phi,
+	   const int64_t stride_x,
+	   const int64_t stride_y,
+	   const int64_t stride_z){
+
+    /*gpuglmem*/ double* phi_taylor = TriCubicInterpolatedFieldMapData_getp1_phi_taylor(fmap, 0);
+    const int64_t nx = TriCubicInterpolatedFieldMapData_get_nx(fmap);
+    const int64_t ny = TriCubicInterpolatedFieldMapData_get_ny(fmap);
+    const int64_t nz = TriCubicInterpolatedFieldMapData_get_nz(fmap);
+
+    #pragma omp parallel for //only_for_context cpu_openmp
+    for (int64_t inode = 0; inode < n_nodes; inode++){ //vectorize_over inode n_nodes
+        const int64_t ix = inode % nx;
+        const int64_t iy = (inode / nx) % ny;
+        const int64_t iz = inode / (nx * ny);
+
+        // the derivatives are set to zero at the edges of the grid
+        const int64_t sx = (ix > 0 && ix < nx - 1) ? stride_x : 0;
+        const int64_t sy = (iy > 0 && iy < ny - 1) ? stride_y : 0;
+        const int64_t sz = (iz > 0 && iz < nz - 1) ? stride_z : 0;
+
+        /*gpuglmem*/ const double* p = phi + ix * stride_x + iy * stride_y + iz * stride_z;
+        /*gpuglmem*/ double* out = phi_taylor + 8 * inode;
+
+        out[0] = p[0];
+        out[1] = TriCubicInterpolatedFieldMap_diff1(p, sx);
+        out[2] = TriCubicInterpolatedFieldMap_diff1(p, sy);
+        out[3] = TriCubicInterpolatedFieldMap_diff1(p, sz);
+        out[4] = TriCubicInterpolatedFieldMap_diff2(p, sx, sy);
+        out[5] = TriCubicInterpolatedFieldMap_diff2(p, sx, sz);
+        out[6] = TriCubicInterpolatedFieldMap_diff2(p, sy, sz);
+        out[7] = TriCubicInterpolatedFieldMap_diff3(p, sx, sy, sz);
+    }//end_vectorize
+}
+
+#endif
@@ -0,0 +1,39 @@
+// copyright ################################# //
+// This file is part of the Xfields Package.   //
+// Copyright (c) CERN, 2021.                   //
+// ########################################### //
+
+#ifndef XFIELDS_TSC_WEIGHTS_H
+#define XFIELDS_TSC_WEIGHTS_H
+
+/*gpufun*/
+int tsc_weights_1d(
+        // INPUTS:
+          // position in cells from the first grid point
+        const double u,
+          // number of grid points
+        const int64_t n,
+        // OUTPUTS (returns 0 if the particle is too close to the edges):
+          // first of the three grid points
+        int64_t* i0,
+        double* weights
+) {
+
+    // Triangular-shaped-cloud (second order) weights on the three grid
+    // points around the nearest one
+    const int64_t ic = floor(u + 0.5);
+
+    if (!(ic >= 1 && ic < n - 1)){
+        return 0;
+    }
+
+    const double dd = u - ic;
+    weights[0] = 0.5 * (0.5 - dd) * (0.5 - dd);
+    weights[1] = 0.75 - dd * dd;
+    weights[2] = 0.5 * (0.5 + dd) * (0.5 + dd);
+    *i0 = ic - 1;
+
+    return 1;
+}
+
+#endif
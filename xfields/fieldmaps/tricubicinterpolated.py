@@ -9,7 +9,9 @@ import xobjects as xo
 import xpart as xp
 import xtrack as xt
 
-from .interpolated import _configure_grid
+from .interpolated import (_configure_grid, TriLinearInterpolatedFieldMap,
+                           _TriLinearInterpolatedFielmap_kernels)
+from .fieldmap_io import _write_fieldmap_file, _load_fieldmap_xobject
 from ..general import _pkg_root
 
 _TriCubicInterpolatedFieldMap_kernels = {
@@ -26,45 +28,27 @@ _TriCubicInterpolatedFieldMap_kernels = {
             ],
         n_threads='nelem'
         ),
-    'p2m_rectmesh3d_xparticles': xo.Kernel(
+    # Deposition kernels (shared with the trilinear field map)
+    'p2m_rectmesh3d_xparticles':
+        _TriLinearInterpolatedFielmap_kernels['p2m_rectmesh3d_xparticles'],
+    'p2m_rectmesh3d': _TriLinearInterpolatedFielmap_kernels['p2m_rectmesh3d'],
+    'TriCubicInterpolatedFieldMap_phi_taylor_from_phi': xo.Kernel(
         args=[
-            xo.Arg(xo.Int32,   pointer=False, name='nparticles'),
-            xo.Arg(xp.Particles, pointer=False, name='particles'),
-            xo.Arg(xo.Float64, pointer=False, name='x0'),
-            xo.Arg(xo.Float64, pointer=False, name='y0'),
-            xo.Arg(xo.Float64, pointer=False, name='z0'),
-            xo.Arg(xo.Float64, pointer=False, name='dx'),
-            xo.Arg(xo.Float64, pointer=False, name='dy'),
-            xo.Arg(xo.Float64, pointer=False, name='dz'),
-            xo.Arg(xo.Int32,   pointer=False, name='nx'),
-            xo.Arg(xo.Int32,   pointer=False, name='ny'),
-            xo.Arg(xo.Int32,   pointer=False, name='nz'),
-            xo.Arg(xo.Int8,    pointer=True,  name='grid1d_buffer'),
-            xo.Arg(xo.Int64,   pointer=False, name='grid1d_offset'),
+            xo.Arg(xo.ThisClass, pointer=False, name='fmap'),
+            xo.Arg(xo.Int64,   pointer=False, name='n_nodes'),
+            xo.Arg(xo.Float64, pointer=True,  name='phi'),
+            xo.Arg(xo.Int64,   pointer=False, name='stride_x'),
+            xo.Arg(xo.Int64,   pointer=False, name='stride_y'),
+            xo.Arg(xo.Int64,   pointer=False, name='stride_z'),
             ],
-        n_threads='nparticles'
+        n_threads='n_nodes'
         ),
-    'p2m_rectmesh3d': xo.Kernel(
+    'TriCubicInterpolatedFieldMap_build_coefficient_cache': xo.Kernel(
         args=[
-            xo.Arg(xo.Int32,   pointer=False, name='nparticles'),
-            xo.Arg(xo.Float64, pointer=True, name='x'),
-            xo.Arg(xo.Float64, pointer=True, name='y'),
-            xo.Arg(xo.Float64, pointer=True, name='z'),
-            xo.Arg(xo.Float64, pointer=True, name='part_weights'),
-            xo.Arg(xo.Int64,   pointer=True, name='part_state'),
-            xo.Arg(xo.Float64, pointer=False, name='x0'),
-            xo.Arg(xo.Float64, pointer=False, name='y0'),
-            xo.Arg(xo.Float64, pointer=False, name='z0'),
-            xo.Arg(xo.Float64, pointer=False, name='dx'),
-            xo.Arg(xo.Float64, pointer=False, name='dy'),
-            xo.Arg(xo.Float64, pointer=False, name='dz'),
-            xo.Arg(xo.Int32,   pointer=False, name='nx'),
-            xo.Arg(xo.Int32,   pointer=False, name='ny'),
-            xo.Arg(xo.Int32,   pointer=False, name='nz'),
-            xo.Arg(xo.Int8,    pointer=True,  name='grid1d_buffer'),
-            xo.Arg(xo.Int64,   pointer=False, name='grid1d_offset'),
+            xo.Arg(xo.ThisClass, pointer=False, name='fmap'),
+            xo.Arg(xo.Int64,   pointer=False, name='n_cells'),
             ],
-        n_threads='nparticles'
+        n_threads='n_cells'
         ),
     }
 
@@ -117,9 +101,9 @@ class TriCubicInterpolatedFieldMap(xo.HybridClass):
             phi_taylor will be calculated from phi.
         rho (np.ndarray): initial charge density at the grid points in
             Coulomb/m^3.
-        phi (np.ndarray): initial electric potential at the grid points in
-            Volts. If not provided the ``phi`` is calculated from ``rho``
-            using the Poisson solver (if available).
+        phi (np.ndarray or TriLinearInterpolatedFieldMap): electric
+            potential at the grid points in Volts, from which ``phi_taylor``
+            is computed (see ``update_phi_taylor_from_phi``).
         solver (str or solver object): Defines the Poisson solver to be used
             to compute phi from rho. Accepted values are ``FFTSolver3D`` and
             ``FFTSolver2p5D``. A Xfields solver object can also be provided.
@@ -130,6 +114,13 @@ class TriCubicInterpolatedFieldMap(xo.HybridClass):
             (1.,1.,1.).
         updatable (bool): If ``True`` the field map can be updated after
             creation. Default is ``True``.
+        coefficient_cache (bool): If ``True`` the 64 coefficients of the
+            interpolating polynomial of each cell are computed once and
+            stored (8 times the memory of ``phi_taylor``), instead of being
+            computed for each particle at each kick. This is faster for
+            small maps that are used many times. If ``phi_taylor`` is
+            modified directly, ``build_coefficient_cache`` needs to be
+            called. Default is ``False``.
     Returns:
         (TriCubicInterpolatedFieldMap): Interpolator object.
     """
@@ -148,6 +139,10 @@ class TriCubicInterpolatedFieldMap(xo.HybridClass):
         'dy': xo.Float64,
         'dz': xo.Float64,
         'phi_taylor': xo.Float64[:],
+        'iz_window_start': xo.Int64,
+        'nz_window': xo.Int64,
+        'coefficient_cache': xo.Int64,
+        'coefficients': xo.Float64[:],
     }
 
     # I add undescores in front of the names so that I can define custom
@@ -159,7 +154,9 @@ class TriCubicInterpolatedFieldMap(xo.HybridClass):
         _pkg_root.joinpath('headers/constants.h'),
         _pkg_root.joinpath('fieldmaps/interpolated_src/tricubic_coefficients.h'),
         _pkg_root.joinpath('fieldmaps/interpolated_src/cubic_interpolators.h'),
+        _pkg_root.joinpath('fieldmaps/interpolated_src/phi_taylor.h'),
         _pkg_root.joinpath('fieldmaps/interpolated_src/central_diff.h'),
+        _pkg_root.joinpath('fieldmaps/interpolated_src/tsc_weights.h'),
         _pkg_root.joinpath('fieldmaps/interpolated_src/charge_deposition.h'),
         ]
 
@@ -183,6 +180,7 @@ class TriCubicInterpolatedFieldMap(xo.HybridClass):
                  phi_taylor=None,
                  scale_coordinates_in_solver=(1.,1.,1.),
                  updatable=True,
+                 coefficient_cache=False,
                  ):
 
         if _xobject is not None:
@@ -214,24 +212,196 @@ class TriCubicInterpolatedFieldMap(xo.HybridClass):
                  mirror_x = mirror_x,
                  mirror_y = mirror_y,
                  mirror_z = mirror_z,
-                 phi_taylor = nelem
+                 phi_taylor = nelem,
+                 iz_window_start = 0,
+                 nz_window = self.nz,
+                 coefficient_cache = coefficient_cache,
+                 coefficients = 8 * nelem if coefficient_cache else 0,
                  )
 
         self.compile_kernels(only_if_needed=True)
 
         if phi_taylor is not None:
-            self.phi_taylor = phi_taylor
+            # (nx, ny, nz, 8) -> index l + 8 * (ix + nx * (iy + ny * iz))
+            phi_taylor = np.asarray(phi_taylor).transpose(3, 0, 1, 2)
+            self._phi_taylor[:] = self._buffer.context.nparray_to_context_array(
+                                    phi_taylor.flatten(order='F'))
+        elif phi is not None:
+            self.update_phi_taylor_from_phi(phi, force=True)
         else:
             # Set rho
             if rho is not None:
                 self.update_rho(rho, force=True)
 
-            # Set phi
-            if phi is not None:
-                self.update_phi(phi, force=True)
-            else:
-                if solver is not None and rho is not None:
-                    self.update_phi_from_rho()
+            if solver is not None and rho is not None:
+                self.update_phi_from_rho()
+
+        if self.coefficient_cache:
+            self.build_coefficient_cache()
+
+    @classmethod
+    def from_phi(cls, phi, x_grid=None, y_grid=None, z_grid=None,
+                 _context=None, _buffer=None, **kwargs):
+
+        """
+        Creates a tricubic field map from the potential at the grid points.
+        The normalized derivatives in ``phi_taylor`` are computed on the
+        context of the map (see ``update_phi_taylor_from_phi``).
+
+        Args:
+            phi (array or TriLinearInterpolatedFieldMap): Potential at the
+                grid points in Volts, with shape (nx, ny, nz). If a
+                ``TriLinearInterpolatedFieldMap`` is given, its potential is
+                used without copying it to the host, and its grid and
+                context are used unless provided.
+            x_grid (np.ndarray): Horizontal grid points.
+            y_grid (np.ndarray): Vertical grid points.
+            z_grid (np.ndarray): Longitudinal grid points.
+            **kwargs: Further arguments passed to
+                ``TriCubicInterpolatedFieldMap`` (e.g. ``mirror_x``,
+                ``coefficient_cache``, ``updatable``).
+        Returns:
+            (TriCubicInterpolatedFieldMap): Field map object.
+        """
+
+        if isinstance(phi, TriLinearInterpolatedFieldMap):
+            if x_grid is None:
+                x_grid = phi.x_grid
+            if y_grid is None:
+                y_grid = phi.y_grid
+            if z_grid is None:
+                z_grid = phi.z_grid
+            if _context is None and _buffer is None:
+                _context = phi._buffer.context
+
+        return cls(phi=phi, x_grid=x_grid, y_grid=y_grid, z_grid=z_grid,
+                   _context=_context, _buffer=_buffer, **kwargs)
+
+    def update_phi_taylor_from_phi(self, phi, force=False):
+
+        """
+        Computes ``phi_taylor`` from the potential at the grid points, with
+        one kernel call on the context of the map. The derivatives
+        (including the mixed ones) are computed with central differences
+        and normalized with the cell sizes. They are set to zero at the edges
+        of the grid along the direction of derivation.
+
+        Args:
+            phi (array or TriLinearInterpolatedFieldMap): Potential at the
+                grid points in Volts, with shape (nx, ny, nz). If a
+                ``TriLinearInterpolatedFieldMap`` on the same context is
+                given, its potential is used directly.
+            force (bool): If ``True`` the map is updated even if it is
+                declared as not updateable. The default is ``False``.
+        """
+
+        if not force:
+            self._assert_updatable()
+
+        if self.nz_window != self.nz:
+            raise ValueError('phi_taylor of a windowed map cannot be '
+                             'computed from phi')
+
+        context = self._buffer.context
+        if isinstance(phi, TriLinearInterpolatedFieldMap):
+            if phi._buffer.context is not context:
+                raise ValueError('The two field maps must be on the same '
+                                 'context')
+            phi = phi.phi
+        elif isinstance(phi, np.ndarray):
+            phi = context.nparray_to_context_array(phi)
+
+        if tuple(phi.shape) != (self.nx, self.ny, self.nz):
+            raise ValueError(f'phi has shape {tuple(phi.shape)}, expected '
+                             f'{(self.nx, self.ny, self.nz)}')
+        if phi.dtype != np.float64:
+            phi = phi.astype(np.float64)
+
+        stride_x, stride_y, stride_z = [ss // 8 for ss in phi.strides]
+        context.kernels.TriCubicInterpolatedFieldMap_phi_taylor_from_phi(
+                fmap=self, n_nodes=self.nx * self.ny * self.nz, phi=phi,
+                stride_x=stride_x, stride_y=stride_y, stride_z=stride_z)
+
+        if self.coefficient_cache:
+            self.build_coefficient_cache()
+
+    def build_coefficient_cache(self):
+
+        """
+        Computes the coefficients of the interpolating polynomials of all the
+        cells from ``phi_taylor`` (only for maps created with
+        ``coefficient_cache=True``). The cells are processed in parallel on
+        the context of the map.
+        """
+
+        if not self.coefficient_cache:
+            raise ValueError('The map was created without coefficient cache')
+
+        self._buffer.context.kernels.\
+            TriCubicInterpolatedFieldMap_build_coefficient_cache(
+                fmap=self, n_cells=self.nx * self.ny * self.nz_window)
+
+    def to_file(self, filename, reserve=65536):
+
+        """
+        Saves the field map to a binary file, which can be loaded with
+        ``TriCubicInterpolatedFieldMap.from_file``. The file contains the
+        grid description and ``phi_taylor``.
+
+        Args:
+            filename (str or Path): Name of the file.
+            reserve (int): Number of bytes left free after the field map in
+                the loaded buffer, to allocate other objects (e.g. the
+                beam element using the map) without copying the buffer. The
+                default is 64 kB.
+        """
+
+        metadata = _file_metadata(self.x_grid, self.y_grid, self.z_grid,
+                                  self.updatable,
+                                  self.scale_coordinates_in_solver)
+
+        _write_fieldmap_file(self, filename, metadata, reserve)
+
+    @classmethod
+    def from_file(cls, filename, _context=None, mmap_mode='c',
+                  updatable=None):
+
+        """
+        Loads a field map saved with ``to_file``. On CPU contexts the
+        buffer of the field map is memory-mapped from the file, so that the
+        processes loading the same file share the memory pages of
+        ``phi_taylor`` (until they are modified).
+
+        Args:
+            filename (str or Path): Name of the file.
+            _context (xobjects context): Context on which the field map is
+                loaded. On GPU contexts the file is read and copied to the
+                device.
+            mmap_mode (str): Mode used to memory-map the file on CPU
+                contexts (see ``np.memmap``). With ``'c'`` (default) the
+                pages are shared until they are written, and the changes are
+                not saved to the file. With ``'r'`` the map cannot be
+                modified. If ``None`` the file is read into memory.
+            updatable (bool): If given, overrides the stored setting.
+        Returns:
+            (TriCubicInterpolatedFieldMap): Field map object.
+        """
+
+        xobject, metadata = _load_fieldmap_xobject(cls, filename, _context,
+                                                   mmap_mode)
+        self = cls(_xobject=xobject)
+
+        self._x_grid = np.array(metadata['x_grid'])
+        self._y_grid = np.array(metadata['y_grid'])
+        self._z_grid = np.array(metadata['z_grid'])
+        self.updatable = (metadata['updatable'] if updatable is None
+                          else updatable)
+        self.scale_coordinates_in_solver = tuple(
+                                    metadata['scale_coordinates_in_solver'])
+
+        self.compile_kernels(only_if_needed=True)
+
+        return self
 
     def _assert_updatable(self):
         assert self.updatable, 'This FieldMap is not updatable!'
@@ -499,6 +669,29 @@ class TriCubicInterpolatedFieldMap(xo.HybridClass):
         """
         return len(self.z_grid)
 
+    @property
+    def iz_window_start(self):
+        """
+        Index of the first z slice stored in ``phi_taylor`` (non-zero only
+        for windowed maps, see ``WindowedTriCubicInterpolatedFieldMap``).
+        """
+        return self._iz_window_start
+
+    @property
+    def nz_window(self):
+        """
+        Number of z slices stored in ``phi_taylor``.
+        """
+        return self._nz_window
+
+    @property
+    def coefficient_cache(self):
+        """
+        ``True`` if the coefficients of the interpolating polynomials are
+        stored.
+        """
+        return bool(self._coefficient_cache)
+
     @property
     def dx(self):
         """
@@ -521,3 +714,15 @@ class TriCubicInterpolatedFieldMap(xo.HybridClass):
         return self.z_grid[1] - self.z_grid[0]
 
 
+def _file_metadata(x_grid, y_grid, z_grid, updatable=True,
+                   scale_coordinates_in_solver=(1., 1., 1.)):
+
+    # Metadata stored in the files written by to_file
+    return {
+        'x_grid': np.asarray(x_grid).tolist(),
+        'y_grid': np.asarray(y_grid).tolist(),
+        'z_grid': np.asarray(z_grid).tolist(),
+        'updatable': bool(updatable),
+        'scale_coordinates_in_solver':
+                    [float(vv) for vv in scale_coordinates_in_solver],
+    }
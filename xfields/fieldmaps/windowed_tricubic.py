@@ -0,0 +1,367 @@
+# copyright ################################# #
+# This file is part of the Xfields Package.   #
+# Copyright (c) CERN, 2021.                   #
+# ########################################### #
+
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+import xobjects as xo
+
+from .interpolated import _configure_grid
+from .tricubicinterpolated import TriCubicInterpolatedFieldMap
+from .fieldmap_io import _load_fieldmap_xobject
+
+
+class WindowedTriCubicInterpolatedFieldMap(TriCubicInterpolatedFieldMap):
+
+    """
+    Tricubic field map of which only a window of consecutive longitudinal
+    slices is stored on the context. The full ``phi_taylor`` stays on the
+    host (typically in a memory-mapped file or in an HDF5 dataset) and the
+    window is moved along z to follow the bunch (see ``update_window`` and
+    ``update_window_from_particles``). For the particles within the window
+    the kicks are bit-identical to the ones of a
+    ``TriCubicInterpolatedFieldMap`` holding the full map. The map can be
+    used in place of a ``TriCubicInterpolatedFieldMap`` in the
+    ``ElectronCloud`` element, which then moves the window before each
+    interaction. Only the window is stored, so ``to_file`` is not supported
+    (it raises a ``ValueError``): the full map has to be saved instead. The
+    thread used for prefetching is stopped by ``close``.
+
+    Args:
+        phi_taylor_source (array-like): Full normalized potential and its
+            derivatives (see ``TriCubicInterpolatedFieldMap``). Indexing it
+            with a slice ``[iz1:iz2]`` must return the data of the z slices
+            from ``iz1`` to ``iz2`` (excluded), each with ``nx*ny*8`` values
+            in the order of ``phi_taylor`` (e.g. an array of shape
+            (nz, ny, nx, 8), a ``np.memmap`` or an ``h5py`` dataset).
+        x_grid (np.ndarray): Equispaced array with the horizontal grid points.
+        y_grid (np.ndarray): Equispaced array with the vertical grid points.
+        z_grid (np.ndarray): Equispaced array with the longitudinal grid
+            points of the full map.
+        nz_window (int): Number of z slices stored on the context.
+        mirror_x (int): if equal to 1, the map is mirrored along the x axis
+            around x = 0.
+        mirror_y (int): if equal to 1, the map is mirrored along the y axis
+            around y = 0.
+        mirror_z (int): if equal to 1, the map is mirrored along the z axis
+            around z = 0.
+        prefetch (bool): If ``True`` (default) the windows requested with
+            ``prefetch_window`` are read from the source in a background
+            thread.
+        coefficient_cache (bool): If ``True`` the coefficients of the
+            interpolating polynomials of the cells of the window are
+            computed whenever the window is moved (see
+            ``TriCubicInterpolatedFieldMap``). Default is ``False``.
+    Returns:
+        (WindowedTriCubicInterpolatedFieldMap): Field map object.
+    """
+
+    def __init__(self,
+                 phi_taylor_source=None,
+                 _context=None,
+                 _buffer=None,
+                 _offset=None,
+                 _xobject=None,
+                 x_grid=None, y_grid=None, z_grid=None,
+                 nz_window=None,
+                 mirror_x=0, mirror_y=0, mirror_z=0,
+                 prefetch=True,
+                 coefficient_cache=False,
+                 ):
+
+        if _xobject is not None:
+            raise ValueError('A windowed field map cannot be built from an '
+                             'existing xobject')
+
+        assert phi_taylor_source is not None
+        assert nz_window is not None
+
+        self.updatable = False
+        self.scale_coordinates_in_solver = (1., 1., 1.)
+
+        self._x_grid = _configure_grid('x', x_grid, None, None, None)
+        self._y_grid = _configure_grid('y', y_grid, None, None, None)
+        self._z_grid = _configure_grid('z', z_grid, None, None, None)
+
+        if len(phi_taylor_source) != self.nz:
+            raise ValueError('The source must contain one entry per z slice')
+
+        nz_window = min(int(nz_window), self.nz)
+        if nz_window < 2:
+            raise ValueError('The window must contain at least two slices')
+
+        nelem = self.nx * self.ny * nz_window * 8
+        self.xoinitialize(
+                 _context=_context,
+                 _buffer=_buffer,
+                 _offset=_offset,
+                 x_min = self._x_grid[0],
+                 y_min = self._y_grid[0],
+                 z_min = self._z_grid[0],
+                 nx = self.nx,
+                 ny = self.ny,
+                 nz = self.nz,
+                 dx = self.dx,
+                 dy = self.dy,
+                 dz = self.dz,
+                 mirror_x = mirror_x,
+                 mirror_y = mirror_y,
+                 mirror_z = mirror_z,
+                 phi_taylor = nelem,
+                 iz_window_start = 0,
+                 nz_window = nz_window,
+                 coefficient_cache = coefficient_cache,
+                 coefficients = 8 * nelem if coefficient_cache else 0,
+                 )
+
+        self.compile_kernels(only_if_needed=True)
+
+        self._source = phi_taylor_source
+        self.prefetch = prefetch
+        self._executor = None
+        self._prefetched = None
+
+        self.set_window(0)
+
+    @classmethod
+    def from_file(cls, filename, nz_window, _context=None, _buffer=None,
+                  prefetch=True, coefficient_cache=False):
+
+        """
+        Creates a windowed field map from a file written by
+        ``TriCubicInterpolatedFieldMap.to_file``. The file is memory-mapped
+        and only the slices of the window are read.
+
+        Args:
+            filename (str or Path): Name of the file.
+            nz_window (int): Number of z slices stored on the context.
+            _context (xobjects context): Context on which the window is
+                stored.
+            prefetch (bool): If ``True`` (default) the prefetched windows are
+                read in a background thread.
+            coefficient_cache (bool): If ``True`` the coefficients of the
+                interpolating polynomials of the window are stored.
+        Returns:
+            (WindowedTriCubicInterpolatedFieldMap): Field map object.
+        """
+
+        source, xobject, metadata = _memmap_phi_taylor(filename)
+
+        return cls(phi_taylor_source=source,
+                   _context=_context, _buffer=_buffer,
+                   x_grid=np.array(metadata['x_grid']),
+                   y_grid=np.array(metadata['y_grid']),
+                   z_grid=np.array(metadata['z_grid']),
+                   nz_window=nz_window,
+                   mirror_x=xobject.mirror_x,
+                   mirror_y=xobject.mirror_y,
+                   mirror_z=xobject.mirror_z,
+                   prefetch=prefetch,
+                   coefficient_cache=coefficient_cache)
+
+    def to_file(self, filename, reserve=65536):
+        raise ValueError(
+            'Only the window of the map is stored, save the full map instead')
+
+    def close(self):
+
+        """
+        Stops the thread used for prefetching (if it was started). The map
+        can still be used, the next prefetch starts a new thread.
+        """
+
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+            self._prefetched = None
+
+    def __del__(self):
+        if getattr(self, '_executor', None) is not None:
+            self._executor.shutdown(wait=False)
+
+    def set_window(self, iz_start):
+
+        """
+        Loads on the context the slices from ``iz_start`` to
+        ``iz_start + nz_window`` (excluded). The start is clipped so that
+        the window lies inside the full map.
+
+        Args:
+            iz_start (int): Index of the first slice of the window.
+        """
+
+        iz_start = self._clip_window_start(iz_start)
+
+        if self._prefetched is not None and self._prefetched[0] == iz_start:
+            data = self._prefetched[1].result()
+            self._prefetched = None
+        else:
+            data = self._read_window(iz_start)
+
+        context = self._buffer.context
+        self._phi_taylor[:] = context.nparray_to_context_array(data)
+        self._iz_window_start = iz_start
+        if self.coefficient_cache:
+            self.build_coefficient_cache()
+
+    def update_window(self, tau_min, tau_max):
+
+        """
+        Moves the window, if needed, so that the kicks are computed for all
+        the longitudinal coordinates in [tau_min, tau_max]. If possible the
+        window is centered on the range.
+
+        Args:
+            tau_min (float): Lower edge of the range (in the coordinates of
+                the map, i.e. after subtracting the ``tau_shift`` of the
+                element).
+            tau_max (float): Upper edge of the range.
+        """
+
+        iz_first, iz_last = self._slice_range(tau_min, tau_max)
+        if self._covers(iz_first, iz_last):
+            return
+        self.set_window(self._centered_window_start(iz_first, iz_last))
+
+    def update_window_from_particles(self, particles, tau_shift=0.):
+
+        """
+        Moves the window, if needed, to cover the longitudinal extent of the
+        active particles. The window is left unchanged if there are no
+        active particles.
+
+        Args:
+            particles (xpart.Particles): Particles to be tracked.
+            tau_shift (float or array): ``tau_shift`` of the element(s)
+                using the map. If several values are given, the window
+                covers the bunch for all of them.
+        """
+
+        extent = _tau_extent(particles, tau_shift)
+        if extent is not None:
+            self.update_window(*extent)
+
+    def prefetch_window(self, tau_min, tau_max):
+
+        """
+        Starts reading in the background the window that will be set by
+        ``update_window(tau_min, tau_max)`` (e.g. for the next bunch), so
+        that the next update only copies the data to the context.
+
+        Args:
+            tau_min (float): Lower edge of the range.
+            tau_max (float): Upper edge of the range.
+        """
+
+        iz_first, iz_last = self._slice_range(tau_min, tau_max)
+        if self._covers(iz_first, iz_last):
+            return
+        iz_start = self._clip_window_start(
+                        self._centered_window_start(iz_first, iz_last))
+        if self._prefetched is not None and self._prefetched[0] == iz_start:
+            return
+
+        if self.prefetch:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=1)
+            future = self._executor.submit(self._read_window, iz_start)
+        else:
+            future = _Done(self._read_window(iz_start))
+        self._prefetched = (iz_start, future)
+
+    def prefetch_window_from_particles(self, particles, tau_shift=0.):
+
+        """
+        Starts reading in the background the window covering the
+        longitudinal extent of the active particles (see
+        ``prefetch_window``).
+
+        Args:
+            particles (xpart.Particles): Particles to be tracked next.
+            tau_shift (float or array): ``tau_shift`` of the element(s)
+                using the map.
+        """
+
+        extent = _tau_extent(particles, tau_shift)
+        if extent is not None:
+            self.prefetch_window(*extent)
+
+    def _read_window(self, iz_start):
+        data = self._source[iz_start: iz_start + self.nz_window]
+        return np.ascontiguousarray(data, dtype=np.float64).reshape(-1)
+
+    def _covers(self, iz_first, iz_last):
+        return (iz_first >= self.iz_window_start
+                and iz_last < self.iz_window_start + self.nz_window)
+
+    def _clip_window_start(self, iz_start):
+        return int(min(max(iz_start, 0), self.nz - self.nz_window))
+
+    def _centered_window_start(self, iz_first, iz_last):
+        return iz_first - (self.nz_window - (iz_last - iz_first + 1)) // 2
+
+    def _slice_range(self, tau_min, tau_max):
+
+        # Slices used by the interpolation for the given range (same
+        # operations as in TriCubicInterpolatedFieldMap_interpolate_grad)
+        inv_dz = 1. / self._xobject.dz
+        fz = (np.array([tau_min, tau_max], dtype=np.float64)
+              - self._xobject.z_min) * inv_dz
+        if self._xobject.mirror_z == 1 and fz[0] < 0.:
+            fz = (np.array([0., max(-fz[0], fz[1])]) if fz[1] > 0.
+                  else -fz[::-1])
+        iz = np.floor(fz)
+        iz_first = int(max(iz.min(), 0))
+        iz_last = int(min(iz.max() + 1, self.nz - 1))
+
+        if iz_last - iz_first + 1 > self.nz_window:
+            raise ValueError(
+                f'The range ({tau_min}, {tau_max}) needs '
+                f'{iz_last - iz_first + 1} slices, but the window has '
+                f'{self.nz_window}')
+
+        return iz_first, iz_last
+
+
+def _memmap_phi_taylor(filename):
+
+    # Memory-maps phi_taylor from a file written by
+    # TriCubicInterpolatedFieldMap.to_file, as an array of shape
+    # (nz, nx * ny * 8)
+    xobject, metadata = _load_fieldmap_xobject(
+            TriCubicInterpolatedFieldMap, filename,
+            _context=xo.ContextCpu(), mmap_mode='r')
+
+    nz = xobject.nz
+    n_slice = 8 * xobject.nx * xobject.ny
+    start = xobject.phi_taylor._offset + xobject.phi_taylor._data_offset
+    phi_taylor = (xobject._buffer.buffer[start: start + 8 * n_slice * nz]
+                  .view(np.float64).reshape(nz, n_slice))
+
+    return phi_taylor, xobject, metadata
+
+
+class _Done:
+
+    # Stands for a future when prefetching is disabled
+
+    def __init__(self, result):
+        self._result = result
+
+    def result(self):
+        return self._result
+
+
+def _tau_extent(particles, tau_shift):
+
+    # None if there are no active particles
+    mask = particles.state > 0
+    tau = particles.zeta[mask] / particles.beta0[mask]
+    if len(tau) == 0:
+        return None
+    tau_shift = np.atleast_1d(tau_shift)
+    return (float(tau.min()) - float(np.max(tau_shift)),
+            float(tau.max()) - float(np.min(tau_shift)))
@@ -0,0 +1,94 @@
+// copyright ################################# //
+// This file is part of the Xfields Package.   //
+// Copyright (c) CERN, 2021.                   //
+// ########################################### //
+
+#ifndef XFIELDS_BEAM_MOMENTS_H
+#define XFIELDS_BEAM_MOMENTS_H
+
+// Partial results of each chunk (29 values):
+//   0: number of active macroparticles
+//   1: sum of the weights
+//   2-7: weighted means of x, px, y, py, zeta, delta
+//   8-28: sums of the weighted products of the deviations from the mean
+//         (upper triangle of the 6x6 matrix, row by row)
+
+/*gpukern*/
+void BeamMomentsAccumulator_compute_partials(
+    BeamMomentsAccumulatorData acc,
+                 ParticlesData particles,
+                 const int64_t n_chunks,
+                 const int64_t interleaved){
+
+    /*gpuglmem*/ double* partials = BeamMomentsAccumulatorData_getp1_partials(acc, 0);
+    const int64_t n_part = ParticlesData_get__capacity(particles);
+    const int64_t chunk_size = (n_part + n_chunks - 1) / n_chunks;
+
+    #pragma omp parallel for //only_for_context cpu_openmp
+    for (int64_t ichunk = 0; ichunk < n_chunks; ichunk++){ //vectorize_over ichunk n_chunks
+
+        double n_active = 0.;
+        double w_sum = 0.;
+        double mean[6] = {0., 0., 0., 0., 0., 0.};
+        double m2[21];
+        for (int k = 0; k < 21; k++){
+            m2[k] = 0.;
+        }
+
+        for (int64_t jj = 0; jj < chunk_size; jj++){
+            // interleaved: consecutive threads read consecutive particles
+            // (GPU), otherwise each thread reads a contiguous block (CPU)
+            const int64_t ii = interleaved ? jj * n_chunks + ichunk
+                                           : ichunk * chunk_size + jj;
+            if (ii >= n_part){
+                break;
+            }
+            if (ParticlesData_get_state(particles, ii) <= 0){
+                continue;
+            }
+            n_active += 1.;
+
+            const double ww = ParticlesData_get_weight(particles, ii);
+            if (ww == 0.){
+                continue;
+            }
+            w_sum += ww;
+
+            const double vv[6] = {
+                ParticlesData_get_x(particles, ii),
+                ParticlesData_get_px(particles, ii),
+                ParticlesData_get_y(particles, ii),
+                ParticlesData_get_py(particles, ii),
+                ParticlesData_get_zeta(particles, ii),
+                ParticlesData_get_delta(particles, ii)};
+
+            // Weighted Welford update (deviations before and after the
+            // update of the mean)
+            const double rr = ww / w_sum;
+            double dd[6];
+            for (int k = 0; k < 6; k++){
+                dd[k] = vv[k] - mean[k];
+                mean[k] += rr * dd[k];
+            }
+            int kk = 0;
+            for (int a = 0; a < 6; a++){
+                for (int b = a; b < 6; b++){
+                    m2[kk] += ww * dd[a] * (vv[b] - mean[b]);
+                    kk++;
+                }
+            }
+        }
+
+        /*gpuglmem*/ double* out = partials + 29 * ichunk;
+        out[0] = n_active;
+        out[1] = w_sum;
+        for (int k = 0; k < 6; k++){
+            out[2 + k] = mean[k];
+        }
+        for (int k = 0; k < 21; k++){
+            out[8 + k] = m2[k];
+        }
+    }//end_vectorize
+}
+
+#endif
@@ -11,6 +11,8 @@ import xobjects as xo
 import xtrack as xt
 from numpy.typing import ArrayLike
 
+from xfields.beam_moments import BeamMoments, compute_beam_moments
+
 LOGGER = logging.getLogger(__name__)
 
 
@@ -39,71 +41,85 @@ def phi(beta: ArrayLike, alpha: ArrayLike, dx: ArrayLike, dpx: ArrayLike) -> Arr
 
 
 # ----- Some helpers on xtrack.Particles objects ----- #
+# The moments are computed in a single pass over the particles (see
+# xfields.beam_moments). Callers needing several quantities should compute
+# the moments once with ``_beam_moments`` and pass them along. The standard
+# deviations are weighted by the particle weights (identical to the
+# unweighted ones for uniform weights).
 
 
-def _beam_intensity(particles: xt.Particles) -> float:
-    """Get the beam intensity from the particles."""
+def _beam_moments(particles: xt.Particles, moments: BeamMoments = None) -> BeamMoments:
+    """
+    Get the moments of the active particles, weighted by their
+    weights. The given ``moments`` are returned if provided.
+    The standard deviations (and emittances) derived from them are
+    therefore weighted, while they used to be plain standard deviations
+    of the active particles. Both are the same for uniform weights.
+    """
     _assert_accepted_context(particles._context)
-    nplike = particles._context.nplike_lib
-    return float(nplike.sum(particles.weight[particles.state > 0]))
+    if moments is None:
+        moments = compute_beam_moments(particles)
+    return moments
 
 
-def _bunch_length(particles: xt.Particles) -> float:
-    """Get the bunch length from the particles."""
-    _assert_accepted_context(particles._context)
-    nplike = particles._context.nplike_lib
-    return float(nplike.std(particles.zeta[particles.state > 0]))
+def _beam_intensity(particles: xt.Particles, moments: BeamMoments = None) -> float:
+    """Get the beam intensity from the particles."""
+    moments = _beam_moments(particles, moments)
+    return float(moments.num_particles)
+
 
+def _bunch_length(particles: xt.Particles, moments: BeamMoments = None) -> float:
+    """Get the (weighted) bunch length from the particles."""
+    moments = _beam_moments(particles, moments)
+    return moments.std("zeta")
 
-def _sigma_delta(particles: xt.Particles) -> float:
+
+def _sigma_delta(particles: xt.Particles, moments: BeamMoments = None) -> float:
     """
-    Get the standard deviation of the momentum spread
-    from the particles.
+    Get the (weighted) standard deviation of the momentum
+    spread from the particles.
     """
-    _assert_accepted_context(particles._context)
-    nplike = particles._context.nplike_lib
-    return float(nplike.std(particles.delta[particles.state > 0]))
+    moments = _beam_moments(particles, moments)
+    return moments.std("delta")
 
 
-def _sigma_x(particles: xt.Particles) -> float:
+def _sigma_x(particles: xt.Particles, moments: BeamMoments = None) -> float:
     """
-    Get the horizontal coordinate standard deviation
+    Get the horizontal coordinate (weighted) standard deviation
     from the particles.
     """
-    _assert_accepted_context(particles._context)
-    nplike = particles._context.nplike_lib
-    return float(nplike.std(particles.x[particles.state > 0]))
+    moments = _beam_moments(particles, moments)
+    return moments.std("x")
 
 
-def _sigma_y(particles: xt.Particles) -> float:
+def _sigma_y(particles: xt.Particles, moments: BeamMoments = None) -> float:
     """
-    Get the vertical coordinate standard deviation
+    Get the vertical coordinate (weighted) standard deviation
     from the particles.
     """
-    _assert_accepted_context(particles._context)
-    nplike = particles._context.nplike_lib
-    return float(nplike.std(particles.y[particles.state > 0]))
+    moments = _beam_moments(particles, moments)
+    return moments.std("y")
 
 
-def _gemitt_x(particles: xt.Particles, betx: float, dx: float) -> float:
+def _gemitt_x(particles: xt.Particles, betx: float, dx: float, moments: BeamMoments = None) -> float:
     """
     Horizontal geometric emittance at a location in the machine,
     for the beta and dispersion functions at this location.
     """
-    # Context check is performed in the called functions
-    sigma_x = _sigma_x(particles)
-    sig_delta = _sigma_delta(particles)
+    moments = _beam_moments(particles, moments)
+    sigma_x = _sigma_x(particles, moments)
+    sig_delta = _sigma_delta(particles, moments)
     return float((sigma_x**2 - (dx * sig_delta) ** 2) / betx)
 
 
-def _gemitt_y(particles: xt.Particles, bety: float, dy: float) -> float:
+def _gemitt_y(particles: xt.Particles, bety: float, dy: float, moments: BeamMoments = None) -> float:
     """
     Vertical geometric emittance at a location in the machine,
     for the beta and dispersion functions at this location.
     """
-    # Context check is performed in the called functions
-    sigma_y = _sigma_y(particles)
-    sig_delta = _sigma_delta(particles)
+    moments = _beam_moments(particles, moments)
+    sigma_y = _sigma_y(particles, moments)
+    sig_delta = _sigma_delta(particles, moments)
     return float((sigma_y**2 - (dy * sig_delta) ** 2) / bety)
 
 
@@ -116,24 +132,22 @@ def _current_turn(particles: xt.Particles) -> int:
     return int(particles.at_turn[particles.state > 0][0])
 
 
-def _sigma_px(particles: xt.Particles) -> float:
+def _sigma_px(particles: xt.Particles, moments: BeamMoments = None) -> float:
     """
-    Get the horizontal momentum standard deviation
+    Get the horizontal momentum (weighted) standard deviation
     from the particles.
     """
-    _assert_accepted_context(particles._context)
-    nplike = particles._context.nplike_lib
-    return float(nplike.std(particles.px[particles.state > 0]))
+    moments = _beam_moments(particles, moments)
+    return moments.std("px")
 
 
-def _sigma_py(particles: xt.Particles) -> float:
+def _sigma_py(particles: xt.Particles, moments: BeamMoments = None) -> float:
     """
-    Get the vertical momentum standard deviation
+    Get the vertical momentum (weighted) standard deviation
     from the particles.
     """
-    _assert_accepted_context(particles._context)
-    nplike = particles._context.nplike_lib
-    return float(nplike.std(particles.py[particles.state > 0]))
+    moments = _beam_moments(particles, moments)
+    return moments.std("py")
 
 
 # ----- Private helper to check the validity of the context ----- #
@@ -19,6 +19,7 @@ from xfields.ibs._analytical import BjorkenMtingwaIBS, IBSGrowthRates
 from xfields.ibs._formulary import (
     _assert_accepted_context,
     _beam_intensity,
+    _beam_moments,
     _bunch_length,
     _current_turn,
     _gemitt_x,
@@ -302,7 +303,8 @@ class IBSAnalyticalKick(IBSKick):
             The calculation is done according to the following steps, which are related
             to different terms in Eq (8) of :cite:`PRAB:Bruce:Simple_IBS_Kicks`:
 
-                - Computes various properties from the non-lost particles in the bunch (:math:`\sigma_{x,y,\delta,t}`).
+                - Computes various properties from the non-lost particles in the bunch (:math:`\sigma_{x,y,\delta,t}`),
+                  weighted by the particle weights (unweighted before, the same for uniform weights).
                 - Computes the standard deviation of momenta for each plane (:math:`\sigma_{p_u}`).
                 - Computes the constant term :math:`\sqrt{2 T_{rev} \sqrt{\pi}}`.
                 - Computes the analytical growth rates :math:`T_{x,y,z}` (:math:`T^{-1}_{IBS_u}` in Eq (8)).
@@ -333,18 +335,19 @@ class IBSAnalyticalKick(IBSKick):
         # ----------------------------------------------------------------------------------------------
         # Compute the momentum spread, bunch length and (geometric) emittances from the Particles object
         LOGGER.debug("Computing emittances, momentum spread and bunch length from particles")
-        beam_intensity: float = _beam_intensity(particles)
-        bunch_length: float = _bunch_length(particles)
-        sigma_delta: float = _sigma_delta(particles)
-        gemitt_x: float = _gemitt_x(particles, self._twiss["betx", self._name], self._twiss["dx", self._name])
-        gemitt_y: float = _gemitt_y(particles, self._twiss["bety", self._name], self._twiss["dy", self._name])
+        moments = _beam_moments(particles)  # single pass over the particles
+        beam_intensity: float = _beam_intensity(particles, moments)
+        bunch_length: float = _bunch_length(particles, moments)
+        sigma_delta: float = _sigma_delta(particles, moments)
+        gemitt_x: float = _gemitt_x(particles, self._twiss["betx", self._name], self._twiss["dx", self._name], moments)
+        gemitt_y: float = _gemitt_y(particles, self._twiss["bety", self._name], self._twiss["dy", self._name], moments)
         # ----------------------------------------------------------------------------------------------
         # Computing standard deviation of (normalized) momenta, corresponding to sigma_{pu} in Eq (8) of reference
         # Normalized: for momentum we have to multiply with 1/sqrt(gamma) = sqrt(beta) / sqrt(1 + alpha^2), and the
         # sqrt(beta) is included in the std of p[xy]. If bunch is rotated, the std takes from the "other plane" so
         # we take the normalized momenta to compensate.
-        sigma_px_normalized: float = _sigma_px(particles) / np.sqrt(1 + self._twiss["alfx", self._name] ** 2)
-        sigma_py_normalized: float = _sigma_py(particles) / np.sqrt(1 + self._twiss["alfy", self._name] ** 2)
+        sigma_px_normalized: float = _sigma_px(particles, moments) / np.sqrt(1 + self._twiss["alfx", self._name] ** 2)
+        sigma_py_normalized: float = _sigma_py(particles, moments) / np.sqrt(1 + self._twiss["alfy", self._name] ** 2)
         # ----------------------------------------------------------------------------------------------
         # Determine the "scaling factor", corresponding to 2 * sigma_t * sqrt(pi) in Eq (8) of reference
         scaling_factor: float = float(2 * np.sqrt(np.pi) * bunch_length)
@@ -528,6 +531,8 @@ class IBSKineticKick(IBSKick):
             to the derivations found in :cite:arXiv:`Zampetakis:Interplay_SC_IBS_LHC`
             (in which the generalized diffusion and friction coefficients are used):
 
+                - Computes the emittances, momentum spread and bunch length from the non-lost particles
+                  in the bunch, weighted by the particle weights (unweighted before, the same for uniform weights).
                 - Computes various terms from the Nagaitsev formalism
                 - Computes the intermediate :math:`D_{xx}, D_{xz}, D_{yy}` and :math:`D_{zz}` terms from Eq (39-41, 44)
                 - Computes the intermediate :math:`K_x, K_y` and :math:`K_z` terms from Eq (42-44)
@@ -552,13 +557,14 @@ class IBSKineticKick(IBSKick):
         # ----------------------------------------------------------------------------------------------
         # Compute (geometric) emittances, momentum spread, bunch length and sigmas from the Particles
         LOGGER.debug("Computing emittances, momentum spread and bunch length from particles")
-        gemitt_x: float = _gemitt_x(particles, self._twiss["betx", self._name], self._twiss["dx", self._name])
-        gemitt_y: float = _gemitt_y(particles, self._twiss["bety", self._name], self._twiss["dy", self._name])
-        total_beam_intensity: float = _beam_intensity(particles)
-        bunch_length: float = _bunch_length(particles)
-        sigma_delta: float = _sigma_delta(particles)
-        sigma_x: float = _sigma_x(particles)
-        sigma_y: float = _sigma_y(particles)
+        moments = _beam_moments(particles)  # single pass over the particles
+        gemitt_x: float = _gemitt_x(particles, self._twiss["betx", self._name], self._twiss["dx", self._name], moments)
+        gemitt_y: float = _gemitt_y(particles, self._twiss["bety", self._name], self._twiss["dy", self._name], moments)
+        total_beam_intensity: float = _beam_intensity(particles, moments)
+        bunch_length: float = _bunch_length(particles, moments)
+        sigma_delta: float = _sigma_delta(particles, moments)
+        sigma_x: float = _sigma_x(particles, moments)
+        sigma_y: float = _sigma_y(particles, moments)
         # ----------------------------------------------------------------------------------------------
         # Allocating some properties to simple variables for readability
         beta0: float = self._twiss.beta0
@@ -670,7 +676,8 @@ class IBSKineticKick(IBSKick):
         # ----------------------------------------------------------------------------------------------
         # TODO: Michalis wrote rho(z) in the paper but the way he had implemented it, it is actually
         # 2 * sqrt(pi) * sigma_t * rho(z) so I apply the factor here. Remove comment when new paper is out
-        bunch_length: float = _bunch_length(particles)
+        moments = _beam_moments(particles)  # single pass over the particles
+        bunch_length: float = _bunch_length(particles, moments)
         factor: float = float(bunch_length * 2 * np.sqrt(np.pi))
         rho_z = factor * rho_z
         # fmt: off
@@ -679,18 +686,18 @@ class IBSKineticKick(IBSKick):
         # reference. Normalized: for momentum we have to multiply with 1 / sqrt(gamma) which is equal to
         # sqrt(beta) / sqrt(1 + alpha^2), and the sqrt(beta) is included in the std of p[xy]. If the bunch
         # is rotated, the stdev takes from the "other plane" so we take the normalized momenta to compensate.
-        sigma_delta: float = _sigma_delta(particles)                                                               # on context
-        sigma_px_normalized: float = _sigma_px(particles) / nplike.sqrt(1 + self._twiss["alfx", self._name] ** 2)  # on context
-        sigma_py_normalized: float = _sigma_py(particles) / nplike.sqrt(1 + self._twiss["alfy", self._name] ** 2)  # on context
+        sigma_delta: float = _sigma_delta(particles, moments)
+        sigma_px_normalized: float = _sigma_px(particles, moments) / np.sqrt(1 + self._twiss["alfx", self._name] ** 2)
+        sigma_py_normalized: float = _sigma_py(particles, moments) / np.sqrt(1 + self._twiss["alfy", self._name] ** 2)
         # ----------------------------------------------------------------------------------------------
         # Determining the Friction kicks (momenta change from friction forces)
         # Friction term is in absolute value and depends on the momentum. If we have a distribution
         # the friction term is with respect to the center -> if the beam is off-center we need to
         # compensate for this, so we use deviation of particle p[xy] from distribution mean of p[xy]
         LOGGER.debug("Determining friction kicks")
-        dev_px: ArrayLike = particles.px[particles.state > 0] - nplike.mean(particles.px[particles.state > 0])           # on context
-        dev_py: ArrayLike = particles.py[particles.state > 0] - nplike.mean(particles.py[particles.state > 0])           # on context
-        dev_delta: ArrayLike = particles.delta[particles.state > 0] - nplike.mean(particles.delta[particles.state > 0])  # on context
+        dev_px: ArrayLike = particles.px[particles.state > 0] - moments.mean("px")        # on context
+        dev_py: ArrayLike = particles.py[particles.state > 0] - moments.mean("py")        # on context
+        dev_delta: ArrayLike = particles.delta[particles.state > 0] - moments.mean("delta")  # on context
         Fx, Fy, Fz = self.friction_coefficients.as_tuple()  # floats
         delta_px_friction: ArrayLike = -Fx * dev_px * dt * rho_z        # on context
         delta_py_friction: ArrayLike = -Fy * dev_py * dt * rho_z        # on context
@@ -3,4 +3,8 @@
 # Copyright (c) CERN, 2021.                   #
 # ########################################### #
 
-from .fftsolvers import FFTSolver3D, FFTSolver2p5D
\ No newline at end of file
+from .fftsolvers import FFTSolver3D, FFTSolver2p5D
+from .dstsolvers import FFTSolverRectPipe3D, FFTSolverRectPipe2p5D
+from .green_function_cache import GreenFunctionCache, default_green_function_cache
+from .fft_backends import (ContextFFTBackend, ScipyFFTBackend,
+                           get_fft_backend)
@@ -16,4 +16,8 @@ class Solver(ABC):
     def solve(self, rho):
         return phi
 
+    def solve_into(self, rho, out):
+        out.T[:, :, :] = self.solve(rho).T
+        return out
+
 
@@ -0,0 +1,142 @@
+# copyright ################################# #
+# This file is part of the Xfields Package.   #
+# Copyright (c) CERN, 2021.                   #
+# ########################################### #
+
+import numpy as np
+from scipy.constants import epsilon_0
+from numpy import pi
+
+from .base import Solver
+from .fft_backends import get_fft_backend
+
+from xobjects import context_default
+
+class FFTSolverRectPipe3D(Solver):
+
+    '''
+    Creates a Poisson solver object that solves the full 3D Poisson
+    equation in a grounded rectangular box using discrete sine transforms.
+    The grounded walls are located half a cell outside the outermost grid
+    points (in all three directions), hence no zero padding of the grid is
+    needed.
+
+    Args:
+        nx (int): Number of cells in the horizontal direction.
+        ny (int): Number of cells in the vertical direction.
+        nz (int): Number of cells in the longitudinal direction.
+        dx (float): Horizontal cell size in meters.
+        dy (float): Vertical cell size in meters.
+        dz (float): Longitudinal cell size in meters.
+        context (XfContext): identifies the :doc:`context <contexts>`
+            on which the computation is executed. The OpenCL context is not
+            supported.
+        fft_backend (str or backend object): Transform implementation used
+            by the solver. ``'context'`` (default) uses the FFT library of
+            the context, ``'scipy'`` uses ``scipy.fft`` with multiple threads
+            (CPU context only). See ``xfields.solvers.get_fft_backend``.
+        fft_threads (int): Number of threads used by the ``'scipy'`` FFT
+            backend. If ``None`` the number of OpenMP threads of the context
+            is used.
+        dtype (np.dtype): Floating point type used for the transforms
+            (``np.float64`` or ``np.float32``). The default is
+            ``np.float64``.
+    Returns:
+        (FFTSolverRectPipe3D): Poisson solver object.
+    '''
+
+    # Axes of the sine transforms (and of the Laplacian)
+    _dst_axes = (0, 1, 2)
+
+    def __init__(self, dx, dy, dz, nx, ny, nz, context=None,
+                 fft_backend=None, fft_threads=None, dtype=np.float64):
+
+        if context is None:
+            context = context_default
+        self.context = context
+
+        self._fft_backend = get_fft_backend(context, fft_backend, fft_threads)
+        self._dst_lib = self._fft_backend.dst_lib
+        self.dtype = np.dtype(dtype)
+
+        self.dx = dx
+        self.dy = dy
+        self.dz = dz
+        self.nx = nx
+        self.ny = ny
+        self.nz = nz
+
+        # Inverse of the eigenvalues of the discrete Laplacian (times -eps0),
+        # summed over the transformed axes only (transverse Laplacian in 2.5D)
+        kx2 = _dst_laplacian_eigenvalues(dx, nx)
+        ky2 = _dst_laplacian_eigenvalues(dy, ny)
+        eig = kx2[:, None, None] + ky2[None, :, None]
+        if 2 in self._dst_axes:
+            kz2 = _dst_laplacian_eigenvalues(dz, nz)
+            eig = eig + kz2[None, None, :]
+        inv_eig = 1. / (epsilon_0 * eig)
+        self._inv_eig_dev = context.nparray_to_context_array(
+                                np.asfortranarray(inv_eig, dtype=self.dtype))
+
+    def solve(self, rho):
+
+        '''
+        Solves Poisson's equation in the grounded rectangular box for a given
+        charge density.
+
+        Args:
+            rho (float64 array): charge density at the grid points in
+                Coulomb/m^3.
+        Returns:
+            phi (float64 array): electric potential at the grid points in Volts.
+        '''
+
+        dst = self._dst_lib
+        rho = rho.astype(self.dtype, copy=False)
+
+        rho_hat = dst.dstn(rho, type=2, axes=self._dst_axes)
+        rho_hat *= self._inv_eig_dev # phi_hat (broadcast in 2.5D)
+        phi = dst.idstn(rho_hat, type=2, axes=self._dst_axes)
+
+        return phi
+
+class FFTSolverRectPipe2p5D(FFTSolverRectPipe3D):
+
+    '''
+    Creates a Poisson solver object that solves Poisson's equation in the
+    2.5D approximation in a grounded rectangular pipe using discrete sine
+    transforms. The grounded walls are located half a cell outside the
+    outermost grid points, hence no zero padding of the grid is needed.
+
+    Args:
+        nx (int): Number of cells in the horizontal direction.
+        ny (int): Number of cells in the vertical direction.
+        nz (int): Number of cells in the longitudinal direction.
+        dx (float): Horizontal cell size in meters.
+        dy (float): Vertical cell size in meters.
+        dz (float): Longitudinal cell size in meters.
+        context (XfContext): identifies the :doc:`context <contexts>`
+            on which the computation is executed. The OpenCL context is not
+            supported.
+        fft_backend (str or backend object): Transform implementation used
+            by the solver. ``'context'`` (default) uses the FFT library of
+            the context, ``'scipy'`` uses ``scipy.fft`` with multiple threads
+            (CPU context only). See ``xfields.solvers.get_fft_backend``.
+        fft_threads (int): Number of threads used by the ``'scipy'`` FFT
+            backend. If ``None`` the number of OpenMP threads of the context
+            is used.
+        dtype (np.dtype): Floating point type used for the transforms
+            (``np.float64`` or ``np.float32``). The default is
+            ``np.float64``.
+    Returns:
+        (FFTSolverRectPipe2p5D): Poisson solver object.
+    '''
+
+    # Transverse transforms only, the slices are solved independently
+    _dst_axes = (0, 1)
+
+def _dst_laplacian_eigenvalues(dd, nn):
+    # Eigenvalues (sign changed) of the second order finite difference
+    # operator for the sine modes of the type-II DST
+    kk = np.arange(1, nn + 1)
+    return 4. * np.sin(pi * kk / (2 * nn))**2 / dd**2
@@ -0,0 +1,184 @@
+# copyright ################################# #
+# This file is part of the Xfields Package.   #
+# Copyright (c) CERN, 2021.                   #
+# ########################################### #
+
+import os
+from functools import partial
+
+import numpy as np
+
+import xobjects as xo
+
+class ContextFFTBackend:
+
+    '''
+    FFT backend using the FFT plans provided by the xobjects context and the
+    FFT module of its numpy-like library.
+
+    Args:
+        context (XfContext): identifies the :doc:`context <contexts>`
+            on which the computation is executed.
+    Returns:
+        (ContextFFTBackend): FFT backend object.
+    '''
+
+    name = 'context'
+
+    def __init__(self, context):
+        self.context = context
+
+    def plan_FFT(self, data, axes):
+        '''
+        Returns a plan for in-place complex transforms of ``data`` along
+        ``axes``.
+        '''
+        return self.context.plan_FFT(data, axes=axes)
+
+    @property
+    def fft_lib(self):
+        '''
+        Module providing the out-of-place transforms (numpy.fft interface).
+        '''
+        return self.context.nplike_lib.fft
+
+    @property
+    def dst_lib(self):
+        '''
+        Module providing the discrete sine transforms (scipy.fft interface).
+        '''
+        if isinstance(self.context, xo.ContextCpu):
+            import scipy.fft
+            return scipy.fft
+        if isinstance(self.context, xo.ContextCupy):
+            import cupyx.scipy.fft
+            return cupyx.scipy.fft
+        raise NotImplementedError(
+            'DST-based solvers are not available on this context')
+
+class ScipyFFTBackend:
+
+    '''
+    Multithreaded FFT backend for the CPU context based on ``scipy.fft``.
+    The plans are created once per array shape and shared by all the
+    solvers using the same backend object (see ``get_fft_backend``).
+
+    Args:
+        n_threads (int): Number of threads used by each transform.
+    Returns:
+        (ScipyFFTBackend): FFT backend object.
+    '''
+
+    name = 'scipy'
+
+    def __init__(self, n_threads=1):
+        import scipy.fft
+
+        self.n_threads = n_threads
+        self.fft_lib = _ScipyFFTLib(scipy.fft, workers=n_threads)
+        self.dst_lib = self.fft_lib
+        self._plans = {}
+
+    def plan_FFT(self, data, axes):
+        '''
+        Returns a plan for in-place complex transforms of ``data`` along
+        ``axes``. Plans are shared between arrays with the same shape.
+        '''
+        key = (tuple(data.shape), tuple(axes), data.dtype.str)
+        if key not in self._plans:
+            self._plans[key] = ScipyFFTPlan(data, axes, self.n_threads)
+        return self._plans[key]
+
+class ScipyFFTPlan:
+
+    '''
+    In-place complex transforms with ``scipy.fft``. scipy does not expose
+    plans: the object only stores the axes and the number of threads, and
+    one transform is done at creation so that scipy caches the twiddle
+    factors for the shape. The transforms are computed with
+    ``overwrite_x=True``, so that complex arrays are transformed in their
+    own memory without allocating a temporary (a copy is made only if scipy
+    returns a new array).
+    '''
+
+    def __init__(self, data, axes, n_threads):
+        import scipy.fft
+        self._scipy_fft = scipy.fft
+        self.axes = tuple(axes)
+        self.n_threads = n_threads
+
+        # I perform one fft to have scipy cache the twiddle factors
+        _ = scipy.fft.fftn(data, axes=self.axes, workers=n_threads)
+
+    def transform(self, data):
+        """The transform is done inplace"""
+        res = self._scipy_fft.fftn(data, axes=self.axes,
+                                   workers=self.n_threads, overwrite_x=True)
+        if not np.may_share_memory(res, data):
+            data[...] = res
+
+    def itransform(self, data):
+        """The transform is done inplace"""
+        res = self._scipy_fft.ifftn(data, axes=self.axes,
+                                    workers=self.n_threads, overwrite_x=True)
+        if not np.may_share_memory(res, data):
+            data[...] = res
+
+class _ScipyFFTLib:
+
+    # scipy.fft functions with the number of workers bound
+    _functions = ['fft', 'ifft', 'rfft', 'irfft', 'fftn', 'ifftn',
+                  'rfftn', 'irfftn', 'dstn', 'idstn']
+
+    def __init__(self, module, workers):
+        for nn in self._functions:
+            setattr(self, nn, partial(getattr(module, nn), workers=workers))
+
+_shared_backends = {}
+
+def get_fft_backend(context, fft_backend=None, fft_threads=None):
+
+    '''
+    Returns the FFT backend to be used by a solver.
+
+    Args:
+        context (XfContext): identifies the :doc:`context <contexts>`
+            on which the computation is executed.
+        fft_backend (str or backend object): ``'context'`` (default) uses the
+            FFT plans of the context. ``'scipy'`` uses ``scipy.fft`` with
+            multiple threads (CPU context only). A backend object providing
+            ``plan_FFT``, ``fft_lib`` and ``dst_lib`` can also be given.
+        fft_threads (int): Number of threads used by the ``'scipy'`` backend.
+            If ``None``, the number of OpenMP threads of the context is used
+            (all the available cores if set to ``'auto'``).
+    Returns:
+        FFT backend object.
+    '''
+
+    if fft_backend is None or fft_backend == 'context':
+        if fft_threads is not None:
+            raise ValueError('`fft_threads` cannot be set for the '
+                             'context FFT backend')
+        return ContextFFTBackend(context)
+
+    if fft_backend == 'scipy':
+        if not isinstance(context, xo.ContextCpu):
+            raise ValueError('The scipy FFT backend is available only on '
+                             'the CPU context')
+        if fft_threads is None:
+            fft_threads = _default_n_threads(context)
+        key = ('scipy', fft_threads)
+        if key not in _shared_backends:
+            _shared_backends[key] = ScipyFFTBackend(n_threads=fft_threads)
+        return _shared_backends[key]
+
+    if isinstance(fft_backend, str):
+        raise ValueError(f'FFT backend {fft_backend} not recognized')
+
+    return fft_backend
+
+def _default_n_threads(context):
+    omp_num_threads = context.omp_num_threads
+    if omp_num_threads == 'auto':
+        return os.cpu_count()
+    return max(int(omp_num_threads), 1)
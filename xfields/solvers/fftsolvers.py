@@ -3,12 +3,19 @@
 # Copyright (c) CERN, 2021.                   #
 # ########################################### #
 
+import inspect
+from functools import lru_cache
+
 import numpy as np
 from scipy.constants import epsilon_0
 from numpy import pi
 
 from .base import Solver
+from .green_function_cache import (GreenFunctionCache,
+                                   default_green_function_cache)
+from .fft_backends import get_fft_backend
 
+import xobjects as xo
 from xobjects import context_default
 
 class FFTSolver2D(Solver):
@@ -31,65 +38,53 @@ class FFTSolver3D(Solver):
         dz (float): Longitudinal cell size in meters.
         context (XfContext): identifies the :doc:`context <contexts>`
             on which the computation is executed.
+        use_rfft (bool): If ``True`` real-to-complex transforms are used and
+            only the non-redundant half of the spectrum of the Green function
+            and of the charge density is stored. This roughly halves the
+            memory and the time needed by the solver. Not available on
+            the OpenCL context. The default is ``False``.
+        use_pruned_fft (bool): If ``True`` the multidimensional transforms
+            are computed axis by axis, skipping the 1D transforms over lines
+            that are known to be zero (forward transform) and over lines
+            that are not needed in the result (inverse transform). Can be
+            combined with ``use_rfft``. Not available on the OpenCL context.
+            The default is ``False``.
+        fft_backend (str or backend object): FFT implementation used by the
+            solver. ``'context'`` (default) uses the FFT plans of the
+            context, ``'scipy'`` uses ``scipy.fft`` with multiple threads
+            (CPU context only). See ``xfields.solvers.get_fft_backend``.
+        fft_threads (int): Number of threads used by the ``'scipy'`` FFT
+            backend. If ``None`` the number of OpenMP threads of the context
+            is used.
+        dtype (np.dtype): Floating point type used for the transforms
+            (``np.float64`` or ``np.float32``, the complex transforms are
+            done in the corresponding complex type). The default is
+            ``np.float64``.
+        green_function_cache (GreenFunctionCache): Cache used to store and
+            retrieve the transformed integrated Green function. If ``True``
+            the cache shared by the package
+            (``xfields.solvers.default_green_function_cache``) is used. If
+            ``None`` or ``False`` (default) the Green function is computed
+            by the solver. The solver keeps its own copy of the cached
+            Green function.
     Returns:
         (FFTSolver3D): Poisson solver object.
     '''
 
-    def __init__(self, dx, dy, dz, nx, ny, nz, context=None, fftplan=None):
+    def __init__(self, dx, dy, dz, nx, ny, nz, context=None, fftplan=None,
+                 use_rfft=False, use_pruned_fft=False,
+                 fft_backend=None, fft_threads=None, dtype=np.float64,
+                 green_function_cache=None):
 
         if context is None:
             context = context_default
 
         self.context = context
 
-        # Prepare arrays
-        workspace_dev = context.nparray_to_context_array(
-                    np.zeros((2*nx, 2*ny, 2*nz), dtype=np.complex128, order='F'))
-
-
-        # Build grid for primitive function
-        xg_F = np.arange(0, nx+2) * dx - dx/2
-        yg_F = np.arange(0, ny+2) * dy - dy/2
-        zg_F = np.arange(0, nz+2) * dz - dz/2
-        XX_F, YY_F, ZZ_F = np.meshgrid(xg_F, yg_F, zg_F, indexing='ij')
-
-        # Compute primitive
-        F_temp = primitive_func_3d(XX_F, YY_F, ZZ_F)
-
-        # Integrated Green Function (I will transform inplace)
-        gint_rep= np.zeros((2*nx, 2*ny, 2*nz), dtype=np.complex128, order='F')
-        gint_rep[:nx+1, :ny+1, :nz+1] = (F_temp[ 1:,  1:,  1:]
-                                       - F_temp[:-1,  1:,  1:]
-                                       - F_temp[ 1:, :-1,  1:]
-                                       + F_temp[:-1, :-1,  1:]
-                                       - F_temp[ 1:,  1:, :-1]
-                                       + F_temp[:-1,  1:, :-1]
-                                       + F_temp[ 1:, :-1, :-1]
-                                       - F_temp[:-1, :-1, :-1])
-
-        # Replicate
-        # To define how to make the replicas I have a look at:
-        # np.abs(np.fft.fftfreq(10))*10
-        # = [0., 1., 2., 3., 4., 5., 4., 3., 2., 1.]
-        gint_rep[nx+1:, :ny+1, :nz+1] = gint_rep[nx-1:0:-1, :ny+1,     :nz+1    ]
-        gint_rep[:nx+1, ny+1:, :nz+1] = gint_rep[:nx+1,     ny-1:0:-1, :nz+1    ]
-        gint_rep[nx+1:, ny+1:, :nz+1] = gint_rep[nx-1:0:-1, ny-1:0:-1, :nz+1    ]
-        gint_rep[:nx+1, :ny+1, nz+1:] = gint_rep[:nx+1,     :ny+1,     nz-1:0:-1]
-        gint_rep[nx+1:, :ny+1, nz+1:] = gint_rep[nx-1:0:-1, :ny+1,     nz-1:0:-1]
-        gint_rep[:nx+1, ny+1:, nz+1:] = gint_rep[:nx+1,     ny-1:0:-1, nz-1:0:-1]
-        gint_rep[nx+1:, ny+1:, nz+1:] = gint_rep[nx-1:0:-1, ny-1:0:-1, nz-1:0:-1]
-
-        self._gint_rep = gint_rep.copy()
-
-        # Tranasfer to device
-        gint_rep_dev = context.nparray_to_context_array(gint_rep)
-
-        # Prepare fft plan
-        if fftplan is None:
-            fftplan = context.plan_FFT(workspace_dev, axes=(0,1,2))
-
-        # Transform the green function (in place)
-        fftplan.transform(gint_rep_dev)
+        _check_fft_lib_supported(context, use_rfft, use_pruned_fft)
+        self._fft_backend = get_fft_backend(context, fft_backend, fft_threads)
+        self.dtype = np.dtype(dtype)
+        self._complex_dtype = np.result_type(self.dtype, np.complex64)
 
         self.dx = dx
         self.dy = dy
@@ -97,8 +92,40 @@ class FFTSolver3D(Solver):
         self.nx = nx
         self.ny = ny
         self.nz = nz
+        self.use_rfft = use_rfft
+        self.use_pruned_fft = use_pruned_fft
+        self._fft_axes = (0, 1, 2)
+
+        # Transformed integrated Green function (computed on the context or
+        # from the cache)
+        self._gint_rep_transf_dev = _get_transformed_green_function(
+                green_function_cache, '3D', 'r2c' if use_rfft else 'c2c',
+                dx, dy, dz, nx, ny, nz, context=context,
+                fft_backend=self._fft_backend, dtype=self.dtype)
+
+        # Workspaces of the rfft and pruned modes (see _get_workspace)
+        self._workspaces = {}
+
+        if use_rfft or use_pruned_fft:
+            # Transforms are computed directly by the FFT library of the
+            # context, no plan is needed and the workspaces are allocated at
+            # the first call
+            self._rfft_axes = (1, 2, 0)
+            self._rfft_shape = (2*ny, 2*nz, 2*nx)
+            self._workspace_dev = None
+            self.fftplan = None
+            return
+
+        # Prepare arrays
+        workspace_dev = context.nparray_to_context_array(
+                    np.zeros((2*nx, 2*ny, 2*nz), dtype=self._complex_dtype,
+                             order='F'))
+
+        # Prepare fft plan
+        if fftplan is None:
+            fftplan = self._fft_backend.plan_FFT(workspace_dev, axes=(0,1,2))
+
         self._workspace_dev = workspace_dev
-        self._gint_rep_transf_dev = gint_rep_dev
         self.fftplan = fftplan
 
     #@profile
@@ -114,30 +141,171 @@ class FFTSolver3D(Solver):
             phi (float64 array): electric potential at the grid points in Volts.
         '''
 
+        if self.use_rfft or self.use_pruned_fft:
+            phi = self.context.zeros((self.nx, self.ny, self.nz),
+                                     dtype=self.dtype, order='F')
+            return self.solve_into(rho, phi)
+
         nz_alloc = self.nz
         if self._gint_rep_transf_dev.shape[2] > 1:
             nz_alloc = self._gint_rep_transf_dev.shape[2]
         _workspace_dev = self.context.zeros(
-                (2*self.nx, 2*self.ny, nz_alloc), dtype=np.complex128, order='F')
+                (2*self.nx, 2*self.ny, nz_alloc), dtype=self._complex_dtype,
+                order='F')
+
+        self._solve_in_workspace(rho, _workspace_dev)
+
+        return _workspace_dev.real[:self.nx, :self.ny, :self.nz]
+
+    def solve_into(self, rho, out):
+
+        '''
+        Solves Poisson's equation in free space for a given charge density
+        and writes the potential into a preallocated array. The workspaces
+        of the solver are reused (they are allocated at the creation of the
+        solver or, for the rfft and pruned modes, at the first call), hence
+        no memory is allocated by the solver itself after the first call
+        (the FFT library may still allocate temporary buffers).
+
+        Args:
+            rho (float64 array): charge density at the grid points in
+                Coulomb/m^3.
+            out (float64 array): array of shape (nx, ny, nz) in which the
+                electric potential at the grid points (in Volts) is written.
+        Returns:
+            out (float64 array): the array provided as input.
+        '''
+
+        if self.use_pruned_fft:
+            self._solve_pruned(rho, out)
+        elif self.use_rfft:
+            self._solve_rfft(rho, out)
+        else:
+            self._solve_c2c(rho, out, self._workspace_dev, self.fftplan)
+        return out
+
+    def _solve_c2c(self, rho, out, _workspace_dev, fftplan):
+
+        _workspace_dev.T[:, :, :] = 0.
+
+        self._solve_in_workspace(rho, _workspace_dev, fftplan)
+
+        n_slices = rho.shape[2]
+        out.T[:, :, :] = _workspace_dev.real.T[:n_slices, :self.ny, :self.nx]
+
+    def _solve_in_workspace(self, rho, _workspace_dev, fftplan=None):
+
+        if fftplan is None:
+            fftplan = self.fftplan
 
         # The transposes make it faster in cupy (C-contigous arrays)
-        _workspace_dev.T[:self.nz, :self.ny, :self.nx] = rho.T
-        self.fftplan.transform(_workspace_dev) # rho_rep_hat
+        _workspace_dev.T[:rho.shape[2], :self.ny, :self.nx] = rho.T
+        fftplan.transform(_workspace_dev) # rho_rep_hat
 
         try:
             _workspace_dev.T[:,:,:] *= (
                         self._gint_rep_transf_dev.T) # phi_rep_hat
         except Exception: # pyopencl does not support array broadcasting (used in 2.5D)
-            # Check F-contiguity
-            assert _workspace_dev.strides[0] == 16
-            assert self._gint_rep_transf_dev.strides[0] == 16
-
-            for ii in range(self.nz):
-                _workspace_dev.T[ii,:,:] *= (
-                        self._gint_rep_transf_dev.T[0, :, :]) # phi_rep_hat
-
-        self.fftplan.itransform(_workspace_dev) #phi_rep
-        return _workspace_dev.real[:self.nx, :self.ny, :self.nz]
+            _multiply_slice_by_slice(_workspace_dev,
+                                     self._gint_rep_transf_dev,
+                                     self.nz) # phi_rep_hat
+
+        fftplan.itransform(_workspace_dev) #phi_rep
+
+    def _get_workspace(self, name, shape, dtype):
+
+        # Persistent workspace of the transforms computed by the FFT library
+        # (rfft and pruned modes). A view on the leading slices is returned
+        # if fewer slices are needed (contiguous in Fortran order).
+        dtype = np.dtype(dtype)
+        workspace = self._workspaces.get(name)
+        if (workspace is None or workspace.dtype != dtype
+                or workspace.shape[:2] != tuple(shape[:2])
+                or workspace.shape[2] < shape[2]):
+            workspace = self.context.zeros(tuple(shape), dtype=dtype,
+                                           order='F')
+            self._workspaces[name] = workspace
+        return workspace[:, :, :shape[2]]
+
+    def _solve_rfft(self, rho, out):
+
+        fft = self._fft_backend.fft_lib
+        n_slices = rho.shape[2]
+
+        # Zero padding to the doubled grid
+        rep_shape = [self.nx, self.ny, n_slices]
+        for ax in self._fft_axes:
+            rep_shape[ax] *= 2
+        rho_rep = self._get_workspace('rho_rep', rep_shape, self.dtype)
+        rho_rep.T[:, :, :] = 0.
+        rho_rep.T[:n_slices, :self.ny, :self.nx] = rho.T
+
+        # Only the non-redundant half of the spectrum is computed along the
+        # first (contiguous) axis
+        hat_shape = list(rep_shape)
+        hat_shape[self._rfft_axes[-1]] = rep_shape[self._rfft_axes[-1]]//2 + 1
+        rho_rep_hat = _fft_into(fft.rfftn, rho_rep,
+                    self._get_workspace('rho_rep_hat', hat_shape,
+                                        self._complex_dtype),
+                    axes=self._rfft_axes)
+        rho_rep_hat *= self._gint_rep_transf_dev # phi_rep_hat (broadcast in 2.5D)
+        phi_rep = _fft_into(fft.irfftn, rho_rep_hat, rho_rep,
+                            s=self._rfft_shape, axes=self._rfft_axes)
+
+        out.T[:, :, :] = phi_rep.T[:n_slices, :self.ny, :self.nx]
+
+    def _solve_pruned(self, rho, out):
+
+        fft = self._fft_backend.fft_lib
+        rho = rho.astype(self.dtype, copy=False)
+        n_grid = (self.nx, self.ny, rho.shape[2])
+        ax_first = self._fft_axes[0]
+
+        # Forward transform: the transform along the first axis is computed
+        # only on the lines holding rho, the one along the second axis only
+        # on the planes holding rho, etc. The zero padding is done by the
+        # transform itself. Each step writes in its own workspace.
+        shape = list(n_grid)
+        rho_rep_hat = rho
+        for ii, ax in enumerate(self._fft_axes):
+            if ii == 0 and self.use_rfft:
+                fft_func = fft.rfft
+                shape[ax] = n_grid[ax] + 1
+            else:
+                fft_func = fft.fft
+                shape[ax] = 2*n_grid[ax]
+            rho_rep_hat = _fft_into(fft_func, rho_rep_hat,
+                    self._get_workspace(f'pruned_{ii}', shape,
+                                        self._complex_dtype),
+                    n=2*n_grid[ax], axis=ax)
+
+        rho_rep_hat *= self._gint_rep_transf_dev # phi_rep_hat (broadcast in 2.5D)
+        phi_rep_hat = rho_rep_hat
+
+        # Inverse transform: after each 1D transform only the part needed
+        # for the result is kept (the result has the shape of the workspace
+        # of the corresponding forward step)
+        for ii in range(len(self._fft_axes) - 1, 0, -1):
+            ax = self._fft_axes[ii]
+            phi_rep_hat = _take_first(_fft_into(fft.ifft, phi_rep_hat,
+                    self._get_workspace(f'pruned_{ii}', phi_rep_hat.shape,
+                                        self._complex_dtype),
+                    axis=ax), n_grid[ax], axis=ax)
+        if self.use_rfft:
+            shape = list(phi_rep_hat.shape)
+            shape[ax_first] = 2*n_grid[ax_first]
+            phi = _fft_into(fft.irfft, phi_rep_hat,
+                            self._get_workspace('pruned_phi', shape,
+                                                self.dtype),
+                            n=2*n_grid[ax_first], axis=ax_first)
+        else:
+            phi = _fft_into(fft.ifft, phi_rep_hat,
+                            self._get_workspace('pruned_0',
+                                                phi_rep_hat.shape,
+                                                self._complex_dtype),
+                            axis=ax_first).real
+
+        out.T[:, :, :] = _take_first(phi, n_grid[ax_first], axis=ax_first).T
 
 class FFTSolver2p5D(FFTSolver3D):
 
@@ -154,55 +322,58 @@ class FFTSolver2p5D(FFTSolver3D):
         dz (float): Longitudinal cell size in meters.
         context (XfContext): identifies the :doc:`context <contexts>`
             on which the computation is executed.
+        use_rfft (bool): If ``True`` real-to-complex transforms are used and
+            only the non-redundant half of the spectrum of the Green function
+            and of the charge density is stored. Not available on the OpenCL
+            context. The default is ``False``.
+        use_pruned_fft (bool): If ``True`` the 2D transforms are computed
+            axis by axis, skipping the 1D transforms over lines that are
+            known to be zero (forward transform) and over lines that are not
+            needed in the result (inverse transform). Can be combined with
+            ``use_rfft``. Not available on the OpenCL context. The default
+            is ``False``.
+        skip_empty_slices (bool): If ``True`` the range of longitudinal
+            slices holding the charge is detected at each call (this
+            requires a transfer to the host on GPU contexts) and the
+            transforms are computed only on a contiguous range of slices
+            containing it, using the workspace of the solver (the potential
+            is set to zero elsewhere). Ignored on the OpenCL context. The
+            default is ``False``.
+        fft_backend (str or backend object): FFT implementation used by the
+            solver. ``'context'`` (default) uses the FFT plans of the
+            context, ``'scipy'`` uses ``scipy.fft`` with multiple threads
+            (CPU context only). See ``xfields.solvers.get_fft_backend``.
+        fft_threads (int): Number of threads used by the ``'scipy'`` FFT
+            backend. If ``None`` the number of OpenMP threads of the context
+            is used.
+        dtype (np.dtype): Floating point type used for the transforms
+            (``np.float64`` or ``np.float32``, the complex transforms are
+            done in the corresponding complex type). The default is
+            ``np.float64``.
+        green_function_cache (GreenFunctionCache): Cache used to store and
+            retrieve the transformed integrated Green function. If ``True``
+            the cache shared by the package
+            (``xfields.solvers.default_green_function_cache``) is used. If
+            ``None`` or ``False`` (default) the Green function is computed
+            by the solver. The solver keeps its own copy of the cached
+            Green function.
     Returns:
         (FFTSolver3D): Poisson solver object.
     '''
 
-    def __init__(self, dx, dy, dz, nx, ny, nz, context=None, fftplan=None):
+    def __init__(self, dx, dy, dz, nx, ny, nz, context=None, fftplan=None,
+                 use_rfft=False, use_pruned_fft=False, skip_empty_slices=False,
+                 fft_backend=None, fft_threads=None, dtype=np.float64,
+                 green_function_cache=None):
 
         if context is None:
             context = context_default
         self.context = context
 
-        # Build grid for primitive function
-        xg_F = np.arange(0, nx+2) * dx - dx/2
-        yg_F = np.arange(0, ny+2) * dy - dy/2
-        XX_F, YY_F= np.meshgrid(xg_F, yg_F, indexing='ij')
-
-        # Compute primitive
-        F_temp = primitive_func_2p5d(XX_F, YY_F)
-
-        # Integrated Green Function (I will transform inplace)
-        gint_rep= np.zeros((2*nx, 2*ny), dtype=np.complex128, order='F')
-        gint_rep[:nx+1, :ny+1] = (F_temp[ 1:,  1:]
-                                - F_temp[:-1,  1:]
-                                - F_temp[ 1:, :-1]
-                                + F_temp[:-1, :-1])
-
-        # Replicate
-        # To define how to make the replicas I have a look at:
-        # np.abs(np.fft.fftfreq(10))*10
-        # = [0., 1., 2., 3., 4., 5., 4., 3., 2., 1.]
-        gint_rep[nx+1:, :ny+1] = gint_rep[nx-1:0:-1, :ny+1]
-        gint_rep[:nx+1, ny+1:] = gint_rep[:nx+1, ny-1:0:-1]
-        gint_rep[nx+1:, ny+1:] = gint_rep[nx-1:0:-1, ny-1:0:-1]
-
-
-        # Prepare fft plan
-        if fftplan is None:
-            temp_dev = context.zeros((2*nx, 2*ny, nz),
-                                    dtype=np.complex128, order='F')
-            fftplan = context.plan_FFT(temp_dev, axes=(0,1))
-            del(temp_dev)
-
-        # Transform the green function
-        gint_rep_transf = np.zeros((2*nx, 2*ny),
-                           dtype=np.complex128, order='F')
-        gint_rep_transf[:, :] = np.fft.fftn(gint_rep, axes=(0,1))
-
-        # Transfer to GPU (if needed)
-        gint_rep_transf_dev = context.nparray_to_context_array(
-                                       np.atleast_3d(gint_rep_transf))
+        _check_fft_lib_supported(context, use_rfft, use_pruned_fft)
+        self._fft_backend = get_fft_backend(context, fft_backend, fft_threads)
+        self.dtype = np.dtype(dtype)
+        self._complex_dtype = np.result_type(self.dtype, np.complex64)
 
         self.dx = dx
         self.dy = dy
@@ -210,56 +381,157 @@ class FFTSolver2p5D(FFTSolver3D):
         self.nx = nx
         self.ny = ny
         self.nz = nz
-        self._gint_rep_transf_dev = gint_rep_transf_dev
+        self.use_rfft = use_rfft
+        self.use_pruned_fft = use_pruned_fft
+        self.skip_empty_slices = skip_empty_slices
+        self._fft_axes = (0, 1)
+
+        # Transformed integrated Green function (computed on the context or
+        # from the cache), with a third axis of length one
+        gint_rep_transf_dev = _get_transformed_green_function(
+                green_function_cache, '2p5D', 'r2c' if use_rfft else 'c2c',
+                dx, dy, dz, nx, ny, nz, context=context,
+                fft_backend=self._fft_backend, dtype=self.dtype)
+        self._gint_rep_transf_dev = gint_rep_transf_dev.reshape(
+                gint_rep_transf_dev.shape + (1,), order='F')
+
+        # Workspaces of the rfft and pruned modes (see _get_workspace)
+        self._workspaces = {}
+        # Plans on the leading slices of the workspace (see _get_fftplan)
+        self._range_fftplans = {}
+
+        if use_rfft or use_pruned_fft:
+            # Transforms are computed directly by the FFT library of the
+            # context, no plan is needed and the workspaces are allocated at
+            # the first call
+            self._rfft_axes = (1, 0)
+            self._rfft_shape = (2*ny, 2*nx)
+            self._workspace_dev = None
+            self.fftplan = None
+            return
+
+        # Prepare arrays
+        workspace_dev = context.zeros((2*nx, 2*ny, nz),
+                                      dtype=self._complex_dtype, order='F')
+
+        # Prepare fft plan
+        if fftplan is None:
+            fftplan = self._fft_backend.plan_FFT(workspace_dev, axes=(0,1))
+
+        self._workspace_dev = workspace_dev
         self.fftplan = fftplan
 
+    def solve(self, rho):
+
+        '''
+        Solves Poisson's equation in the 2.5D approximation for a given
+        charge density.
+
+        Args:
+            rho (float64 array): charge density at the grid points in
+                Coulomb/m^3.
+        Returns:
+            phi (float64 array): electric potential at the grid points in Volts.
+        '''
+
+        i_range = self._get_occupied_range(rho)
+        if i_range is None:
+            return FFTSolver3D.solve(self, rho)
+
+        phi = self.context.zeros((self.nx, self.ny, self.nz),
+                                 dtype=self.dtype, order='F')
+        return self._solve_range_into(rho, phi, *i_range)
+
+    def solve_into(self, rho, out):
+
+        i_range = self._get_occupied_range(rho)
+        if i_range is None:
+            return FFTSolver3D.solve_into(self, rho, out)
+        return self._solve_range_into(rho, out, *i_range)
+
+    solve_into.__doc__ = FFTSolver3D.solve_into.__doc__
+
+    def _get_occupied_range(self, rho):
+
+        # Returns the first and the last (excluded) slice of a contiguous
+        # range holding all the charge, or None if all slices need to be
+        # computed. The length of the range is rounded up to a power of two
+        # to limit the number of plans.
+        if (not self.skip_empty_slices
+                or isinstance(self.context, xo.ContextPyopencl)):
+            return None
+
+        occupied = self.context.nparray_from_context_array(
+                                                    rho.any(axis=(0, 1)))
+        i_occupied = np.flatnonzero(occupied)
+        if len(i_occupied) == 0:
+            return 0, 0
+
+        n_slices = int(i_occupied[-1] - i_occupied[0]) + 1
+        n_slices = min(1 << (n_slices - 1).bit_length(), self.nz)
+        if n_slices == self.nz:
+            return None
+        i_start = min(int(i_occupied[0]), self.nz - n_slices)
+        return i_start, i_start + n_slices
+
+    def _solve_range_into(self, rho, out, i_start, i_end):
+
+        # Solves on the slices in [i_start, i_end), the potential is set to
+        # zero on the other slices
+        out.T[:i_start, :, :] = 0.
+        out.T[i_end:, :, :] = 0.
+        if i_end == i_start:
+            return out
+
+        rho_range = rho[:, :, i_start:i_end]
+        out_range = out[:, :, i_start:i_end]
+        if self.use_pruned_fft:
+            self._solve_pruned(rho_range, out_range)
+        elif self.use_rfft:
+            self._solve_rfft(rho_range, out_range)
+        else:
+            _workspace_dev, fftplan = self._get_fftplan(i_end - i_start)
+            self._solve_c2c(rho_range, out_range, _workspace_dev, fftplan)
+        return out
+
+    def _get_fftplan(self, n_slices):
+
+        # Plan on the leading slices of the workspace (contiguous in Fortran
+        # order), built at the first use
+        if n_slices not in self._range_fftplans:
+            _workspace_dev = self._workspace_dev[:, :, :n_slices]
+            self._range_fftplans[n_slices] = (_workspace_dev,
+                    self._fft_backend.plan_FFT(_workspace_dev, axes=(0, 1)))
+        return self._range_fftplans[n_slices]
+
 class FFTSolver2p5DAveraged(Solver):
 
-    def __init__(self, dx, dy, dz, nx, ny, nz, context=None, fftplan=None):
+    def __init__(self, dx, dy, dz, nx, ny, nz, context=None, fftplan=None,
+                 fft_backend=None, fft_threads=None, dtype=np.float64,
+                 green_function_cache=None):
 
         if context is None:
             context = context_default
         self.context = context
 
-        # Build grid for primitive function
-        xg_F = np.arange(0, nx+2) * dx - dx/2
-        yg_F = np.arange(0, ny+2) * dy - dy/2
-        XX_F, YY_F= np.meshgrid(xg_F, yg_F, indexing='ij')
-
-        # Compute primitive
-        F_temp = primitive_func_2p5d(XX_F, YY_F)
-
-        # Integrated Green Function (I will transform inplace)
-        gint_rep= np.zeros((2*nx, 2*ny), dtype=np.complex128, order='F')
-        gint_rep[:nx+1, :ny+1] = (F_temp[ 1:,  1:]
-                                - F_temp[:-1,  1:]
-                                - F_temp[ 1:, :-1]
-                                + F_temp[:-1, :-1])
-
-        # Replicate
-        # To define how to make the replicas I have a look at:
-        # np.abs(np.fft.fftfreq(10))*10
-        # = [0., 1., 2., 3., 4., 5., 4., 3., 2., 1.]
-        gint_rep[nx+1:, :ny+1] = gint_rep[nx-1:0:-1, :ny+1]
-        gint_rep[:nx+1, ny+1:] = gint_rep[:nx+1, ny-1:0:-1]
-        gint_rep[nx+1:, ny+1:] = gint_rep[nx-1:0:-1, ny-1:0:-1]
+        self._fft_backend = get_fft_backend(context, fft_backend, fft_threads)
+        self.dtype = np.dtype(dtype)
+        self._complex_dtype = np.result_type(self.dtype, np.complex64)
 
+        # Prepare arrays
+        workspace_dev = context.zeros((2*nx, 2*ny),
+                                      dtype=self._complex_dtype, order='F')
 
         # Prepare fft plan
         if fftplan is None:
-            temp_dev = context.zeros((2*nx, 2*ny),
-                                    dtype=np.complex128, order='F')
-            fftplan = context.plan_FFT(temp_dev, axes=(0,1))
-            del(temp_dev)
-
-        # Transform the green function
-        gint_rep_transf = np.zeros((2*nx, 2*ny),
-                           dtype=np.complex128, order='F')
-        gint_rep_transf[:, :] = np.fft.fftn(gint_rep, axes=(0,1))
+            fftplan = self._fft_backend.plan_FFT(workspace_dev, axes=(0,1))
 
-        # Transfer to GPU (if needed)
-        gint_rep_transf_dev = context.nparray_to_context_array(
-                                       np.atleast_2d(gint_rep_transf))
+        # Transformed integrated Green function (computed on the context or
+        # from the cache)
+        gint_rep_transf_dev = _get_transformed_green_function(
+                green_function_cache, '2p5D', 'c2c', dx, dy, dz, nx, ny, nz,
+                context=context, fft_backend=self._fft_backend,
+                dtype=self.dtype)
 
         self.dx = dx
         self.dy = dy
@@ -268,6 +540,7 @@ class FFTSolver2p5DAveraged(Solver):
         self.ny = ny
         self.nz = nz
         self._gint_rep_transf_dev = gint_rep_transf_dev
+        self._workspace_dev = workspace_dev
         self.fftplan = fftplan
 
     #@profile
@@ -283,11 +556,45 @@ class FFTSolver2p5DAveraged(Solver):
             phi (float64 array): electric potential at the grid points in Volts.
         '''
 
-        _workspace_dev = self.context.zeros(
-                (2*self.nx, 2*self.ny), dtype=np.complex128, order='F')
+        phi_xy, lambda_z = self.solve_separable(rho)
+
+        phi = self.context.zeros((self.nx, self.ny, self.nz),
+                                 dtype=self.dtype, order='F')
+        try:
+            phi.T[:, :, :] = lambda_z[:, None, None] * phi_xy.T[None, :, :]
+        except Exception: # pyopencl does not support array broadcasting
+            for iz in range(self.nz):
+                phi[:, :, iz] = phi_xy * lambda_z[iz]
+
+        return phi
+
+    def solve_separable(self, rho):
+
+        '''
+        Solves Poisson's equation for a given charge density returning the
+        potential in separable form, i.e.
+        ``phi[ix, iy, iz] = phi_xy[ix, iy] * lambda_z[iz]``, without building
+        the 3D potential.
+
+        Args:
+            rho (float64 array): charge density at the grid points in
+                Coulomb/m^3.
+        Returns:
+            phi_xy (float64 array): transverse potential in Volts of the
+                charge density integrated along z, of shape (nx, ny). It is
+                a view of the workspace of the solver, overwritten by the
+                next call.
+            lambda_z (float64 array): fraction of the charge in each
+                longitudinal slice, of shape (nz,).
+        '''
+
+        _workspace_dev = self._workspace_dev
 
         sum_rho_xy = rho.sum(axis=0).sum(axis=0)
         sum_rho = sum_rho_xy.sum()
+        # Clear the padding (written by the previous call)
+        _workspace_dev[self.nx:, :] = 0
+        _workspace_dev[:self.nx, self.ny:] = 0
         _workspace_dev[:self.nx, :self.ny] = rho.sum(axis=2)
         self.fftplan.transform(_workspace_dev) # rho_rep_hat
 
@@ -295,16 +602,189 @@ class FFTSolver2p5DAveraged(Solver):
                         self._gint_rep_transf_dev) # phi_rep_hat
 
         self.fftplan.itransform(_workspace_dev) #phi_rep
-        phi_sum = _workspace_dev.real[:self.nx, :self.ny]
-
-        phi = 0 * rho
-        for iz in range(self.nz):
-            phi[:, :, iz] = phi_sum * sum_rho_xy[iz] / sum_rho
+        phi_xy = _workspace_dev.real[:self.nx, :self.ny]
 
         self._sum_rho_xy = sum_rho_xy
         self._sum_rho = sum_rho
 
-        return phi
+        return phi_xy, sum_rho_xy / sum_rho
+
+def _integrated_green_function_3d(dx, dy, dz, nx, ny, nz):
+
+    # Build grid for primitive function
+    xg_F = np.arange(0, nx+2) * dx - dx/2
+    yg_F = np.arange(0, ny+2) * dy - dy/2
+    zg_F = np.arange(0, nz+2) * dz - dz/2
+    XX_F, YY_F, ZZ_F = np.meshgrid(xg_F, yg_F, zg_F, indexing='ij')
+
+    # Compute primitive
+    F_temp = primitive_func_3d(XX_F, YY_F, ZZ_F)
+
+    # Integrated Green Function
+    gint_rep= np.zeros((2*nx, 2*ny, 2*nz), dtype=np.float64, order='F')
+    gint_rep[:nx+1, :ny+1, :nz+1] = (F_temp[ 1:,  1:,  1:]
+                                   - F_temp[:-1,  1:,  1:]
+                                   - F_temp[ 1:, :-1,  1:]
+                                   + F_temp[:-1, :-1,  1:]
+                                   - F_temp[ 1:,  1:, :-1]
+                                   + F_temp[:-1,  1:, :-1]
+                                   + F_temp[ 1:, :-1, :-1]
+                                   - F_temp[:-1, :-1, :-1])
+
+    # Replicate
+    # To define how to make the replicas I have a look at:
+    # np.abs(np.fft.fftfreq(10))*10
+    # = [0., 1., 2., 3., 4., 5., 4., 3., 2., 1.]
+    gint_rep[nx+1:, :ny+1, :nz+1] = gint_rep[nx-1:0:-1, :ny+1,     :nz+1    ]
+    gint_rep[:nx+1, ny+1:, :nz+1] = gint_rep[:nx+1,     ny-1:0:-1, :nz+1    ]
+    gint_rep[nx+1:, ny+1:, :nz+1] = gint_rep[nx-1:0:-1, ny-1:0:-1, :nz+1    ]
+    gint_rep[:nx+1, :ny+1, nz+1:] = gint_rep[:nx+1,     :ny+1,     nz-1:0:-1]
+    gint_rep[nx+1:, :ny+1, nz+1:] = gint_rep[nx-1:0:-1, :ny+1,     nz-1:0:-1]
+    gint_rep[:nx+1, ny+1:, nz+1:] = gint_rep[:nx+1,     ny-1:0:-1, nz-1:0:-1]
+    gint_rep[nx+1:, ny+1:, nz+1:] = gint_rep[nx-1:0:-1, ny-1:0:-1, nz-1:0:-1]
+
+    return gint_rep
+
+def _integrated_green_function_2p5d(dx, dy, nx, ny):
+
+    # Build grid for primitive function
+    xg_F = np.arange(0, nx+2) * dx - dx/2
+    yg_F = np.arange(0, ny+2) * dy - dy/2
+    XX_F, YY_F= np.meshgrid(xg_F, yg_F, indexing='ij')
+
+    # Compute primitive
+    F_temp = primitive_func_2p5d(XX_F, YY_F)
+
+    # Integrated Green Function
+    gint_rep= np.zeros((2*nx, 2*ny), dtype=np.float64, order='F')
+    gint_rep[:nx+1, :ny+1] = (F_temp[ 1:,  1:]
+                            - F_temp[:-1,  1:]
+                            - F_temp[ 1:, :-1]
+                            + F_temp[:-1, :-1])
+
+    # Replicate (see comment in _integrated_green_function_3d)
+    gint_rep[nx+1:, :ny+1] = gint_rep[nx-1:0:-1, :ny+1]
+    gint_rep[:nx+1, ny+1:] = gint_rep[:nx+1, ny-1:0:-1]
+    gint_rep[nx+1:, ny+1:] = gint_rep[nx-1:0:-1, ny-1:0:-1]
+
+    return gint_rep
+
+def _compute_transformed_green_function(geometry, transform,
+                                        dx, dy, dz, nx, ny, nz,
+                                        context=None, fft_backend=None):
+
+    # The transform is computed with numpy on the host if no context is
+    # given, otherwise on the context with the given FFT backend
+
+    if geometry == '3D':
+        gint_rep = _integrated_green_function_3d(dx, dy, dz, nx, ny, nz)
+        axes = (0, 1, 2)
+        rfft_axes = (1, 2, 0)
+    elif geometry == '2p5D':
+        gint_rep = _integrated_green_function_2p5d(dx, dy, nx, ny)
+        axes = (0, 1)
+        rfft_axes = (1, 0)
+    else:
+        raise ValueError(f'Unknown geometry {geometry}')
+
+    if transform == 'c2c':
+        if context is None:
+            return np.asfortranarray(
+                np.fft.fftn(gint_rep.astype(np.complex128), axes=axes))
+        # Transform in place on the context
+        gint_rep_dev = context.nparray_to_context_array(
+                                        gint_rep.astype(np.complex128))
+        fft_backend.plan_FFT(gint_rep_dev, axes=axes).transform(gint_rep_dev)
+        return gint_rep_dev
+    elif transform == 'r2c':
+        # The replicated Green function is real and even, hence its
+        # transform is real and only its real part is stored. The
+        # real-to-complex transform is taken along the first (contiguous)
+        # axis, which is the one that is halved.
+        if context is None:
+            return np.asfortranarray(
+                np.fft.rfftn(gint_rep, axes=rfft_axes).real)
+        gint_rep_dev = context.nparray_to_context_array(gint_rep)
+        return context.nplike_lib.asfortranarray(
+            fft_backend.fft_lib.rfftn(gint_rep_dev, axes=rfft_axes).real)
+    else:
+        raise ValueError(f'Unknown transform {transform}')
+
+def _get_transformed_green_function(cache, geometry, transform,
+                                    dx, dy, dz, nx, ny, nz,
+                                    context, fft_backend,
+                                    dtype=np.float64):
+
+    # Returns the transformed Green function as an array on the context
+
+    if geometry == '2p5D':
+        # The 2.5D Green function does not depend on the longitudinal grid
+        dz = None
+        nz = None
+
+    # The Green function is always computed in double precision and then
+    # converted to the precision used by the solver
+    dtype = np.dtype(dtype)
+    if transform == 'c2c':
+        dtype = np.result_type(dtype, np.complex64)
+
+    if cache is None or cache is False:
+        # Transformed directly on the context
+        return _compute_transformed_green_function(geometry, transform,
+                    dx, dy, dz, nx, ny, nz, context=context,
+                    fft_backend=fft_backend).astype(dtype)
+    if cache is True:
+        cache = default_green_function_cache
+
+    def build():
+        return _compute_transformed_green_function(geometry, transform,
+                                    dx, dy, dz, nx, ny, nz).astype(dtype)
+
+    key = GreenFunctionCache.make_key(
+        kind=f'{geometry}_{transform}', dx=dx, dy=dy, dz=dz,
+        nx=nx, ny=ny, nz=nz, dtype=dtype)
+
+    # The cached array is not shared with the solver (on CPU the context
+    # array would be the cached array itself)
+    return context.nparray_to_context_array(np.array(cache.get(key, build)))
+
+def _multiply_slice_by_slice(workspace, gint_rep_transf, n_slices):
+    # Multiplies each longitudinal slice of the workspace by the 2.5D Green
+    # function, for array libraries without broadcasting
+
+    # Check F-contiguity (complex64 or complex128)
+    assert workspace.strides[0] == workspace.itemsize
+    assert gint_rep_transf.strides[0] == gint_rep_transf.itemsize
+
+    for ii in range(n_slices):
+        workspace.T[ii, :, :] *= gint_rep_transf.T[0, :, :]
+
+def _check_fft_lib_supported(context, use_rfft, use_pruned_fft):
+    if isinstance(context, xo.ContextPyopencl):
+        if use_rfft:
+            raise NotImplementedError(
+                'Real-to-complex FFTs are not available on the OpenCL context')
+        if use_pruned_fft:
+            raise NotImplementedError(
+                'Pruned FFTs are not available on the OpenCL context')
+
+def _take_first(arr, n, axis):
+    return arr[(slice(None),) * axis + (slice(0, n),)]
+
+def _fft_into(fft_func, arr, out, **kwargs):
+    # Writes the transform into ``out``, directly if supported by the FFT
+    # library (numpy >= 2), otherwise by copying the result
+    if _accepts_out(fft_func):
+        return fft_func(arr, out=out, **kwargs)
+    out[...] = fft_func(arr, **kwargs)
+    return out
+
+@lru_cache(maxsize=None)
+def _accepts_out(fft_func):
+    try:
+        return 'out' in inspect.signature(fft_func).parameters
+    except (TypeError, ValueError):
+        return False
 
 def primitive_func_3d(x,y,z):
     abs_r = np.sqrt(x * x + y * y + z * z)
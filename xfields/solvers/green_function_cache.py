@@ -0,0 +1,149 @@
+# copyright ################################# #
+# This file is part of the Xfields Package.   #
+# Copyright (c) CERN, 2021.                   #
+# ########################################### #
+
+import hashlib
+import os
+from collections import OrderedDict
+from pathlib import Path
+
+import numpy as np
+
+
+class GreenFunctionCache:
+
+    '''
+    Cache for the transformed integrated Green functions used by the FFT
+    Poisson solvers. The transformed kernels are kept in memory (host arrays)
+    and evicted in least-recently-used order when the total size exceeds
+    ``max_bytes``. Optionally, the kernels are also stored in a directory on
+    disk, from which they are memory-mapped, so that repeated runs and
+    different processes sharing the same directory can skip their
+    computation. The solvers use a cache only if it is given explicitly
+    (``True`` selects ``default_green_function_cache``) and keep their own
+    copy of the cached kernel.
+
+    Args:
+        max_bytes (int): Maximum size in bytes of the kernels kept in memory.
+            The default is 256 MB.
+        cache_dir (str or Path): Directory used to store the kernels on disk.
+            If ``None`` (default) no disk storage is used.
+    Returns:
+        (GreenFunctionCache): Cache object.
+    '''
+
+    def __init__(self, max_bytes=256*1024**2, cache_dir=None):
+        self.max_bytes = max_bytes
+        self.cache_dir = cache_dir
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def cache_dir(self):
+        return self._cache_dir
+
+    @cache_dir.setter
+    def cache_dir(self, value):
+        if value is not None:
+            value = Path(value)
+            value.mkdir(parents=True, exist_ok=True)
+        self._cache_dir = value
+
+    @property
+    def nbytes(self):
+        '''
+        Total size in bytes of the kernels kept in memory.
+        '''
+        return sum(vv.nbytes for vv in self._entries.values())
+
+    @staticmethod
+    def make_key(kind, dx, dy, dz, nx, ny, nz, dtype):
+        '''
+        Builds the key identifying a transformed Green function. The cell
+        sizes must be the ones seen by the solver (i.e. already scaled by
+        ``scale_coordinates_in_solver``).
+        '''
+        def _fl(vv):
+            return None if vv is None else float(vv).hex()
+        def _int(vv):
+            return None if vv is None else int(vv)
+        return (kind, _fl(dx), _fl(dy), _fl(dz),
+                _int(nx), _int(ny), _int(nz), str(np.dtype(dtype)))
+
+    def get(self, key, build):
+        '''
+        Returns the kernel associated to ``key``. If it is not available in
+        memory or on disk, it is computed by calling ``build()`` and stored.
+        The returned array is read-only.
+        '''
+
+        if key in self._entries:
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return self._entries[key]
+
+        arr = None
+        if self.cache_dir is not None:
+            arr = self._load_from_disk(key)
+
+        if arr is None:
+            self.misses += 1
+            arr = build()
+            if self.cache_dir is not None:
+                self._save_to_disk(key, arr)
+                # Serve the memory-mapped version to share pages between
+                # processes
+                arr = self._load_from_disk(key)
+        else:
+            self.hits += 1
+
+        arr.flags.writeable = False
+        self._entries[key] = arr
+        self._evict()
+
+        return arr
+
+    def clear(self, disk=False):
+        '''
+        Removes all kernels from memory and, if ``disk`` is ``True``, from
+        the disk storage.
+        '''
+        self._entries.clear()
+        if disk and self.cache_dir is not None:
+            for ff in self.cache_dir.glob('greenfunction_*.npy'):
+                ff.unlink()
+
+    def _evict(self):
+        nbytes = self.nbytes
+        while nbytes > self.max_bytes and len(self._entries) > 0:
+            _, arr = self._entries.popitem(last=False)
+            nbytes -= arr.nbytes
+
+    def _filename(self, key):
+        digest = hashlib.sha1(repr(key).encode()).hexdigest()
+        return self.cache_dir / f'greenfunction_{digest}.npy'
+
+    def _load_from_disk(self, key):
+        fname = self._filename(key)
+        if not fname.exists():
+            return None
+        try:
+            return np.load(fname, mmap_mode='r')
+        except (ValueError, OSError):
+            # Incomplete or corrupted file, it will be rebuilt
+            return None
+
+    def _save_to_disk(self, key, arr):
+        fname = self._filename(key)
+        # Write to a temporary file and rename, so that concurrent processes
+        # never see a partially written file
+        tmpname = fname.with_suffix(f'.{os.getpid()}.tmp')
+        with open(tmpname, 'wb') as fid:
+            np.save(fid, arr)
+        os.replace(tmpname, fname)
+
+
+# Cache shared by the solvers created with ``green_function_cache=True``
+default_green_function_cache = GreenFunctionCache()